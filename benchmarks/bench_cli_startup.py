@@ -0,0 +1,97 @@
+"""
+Benchmark of the start-up time of the command line tools: for every console script in `setup.cfg`, the wall time
+of a fresh interpreter that only imports the entry point (a no-op run) and of one that prints `-h`, against the
+time of an empty interpreter, with the heavy dependencies that were imported along the way.
+
+Run with, e.g.: `python benchmarks/bench_cli_startup.py --repeats 5` or, for some of the tools,
+`python benchmarks/bench_cli_startup.py --scripts hrkIntersectMasks hrkCombineROIMasks`
+"""
+from __future__ import annotations
+
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+import configparser
+import os
+import subprocess
+import sys
+import time
+from typing import Dict, List, Optional, Tuple
+
+from hrkneeseg.utils.lazy_import import HEAVY_MODULES
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# imports the entry point, optionally calls it with the remaining arguments, and reports the heavy modules imported
+RUN = '''
+import sys
+heavy = set(sys.argv.pop(1).split(","))
+module, function = sys.argv.pop(1).split(":")
+call = sys.argv.pop(1) == "call"
+try:
+    entry_point = getattr(__import__(module, fromlist=[function]), function)
+    if call:
+        entry_point()
+except SystemExit:
+    pass
+finally:
+    print(",".join(sorted({m.split(".")[0] for m in sys.modules} & heavy)), file=sys.stderr)
+'''
+
+
+def create_parser() -> ArgumentParser:
+    parser = ArgumentParser(
+        description="Command line tool start-up benchmark",
+        formatter_class=ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        "--scripts", "-s", type=str, nargs="+", default=None, metavar="NAME",
+        help="the console scripts to time, all of them if not given"
+    )
+    parser.add_argument("--repeats", "-r", type=int, default=3, metavar="N", help="runs per measurement, best is kept")
+    return parser
+
+
+def get_console_scripts() -> Dict[str, str]:
+    config = configparser.ConfigParser()
+    config.read(os.path.join(ROOT, "setup.cfg"))
+    lines = config["entry_points"]["console_scripts"].strip().splitlines()
+    return dict(tuple(part.strip() for part in line.split("=")) for line in lines)
+
+
+def time_run(args: List[str], repeats: int) -> Tuple[float, str, int]:
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable] + args, capture_output=True, text=True, cwd=ROOT)
+        best = min(best, time.perf_counter() - start)
+    lines = result.stderr.strip().splitlines()
+    return best, lines[-1] if lines else "", result.returncode
+
+
+def time_entry_point(entry_point: str, call: bool, repeats: int) -> Tuple[float, str, Optional[str]]:
+    args = ["-c", RUN, ",".join(HEAVY_MODULES), entry_point, "call" if call else "import"] + (["-h"] if call else [])
+    seconds, heavy, returncode = time_run(args, repeats)
+    # a failed import prints its traceback, the heavy modules are only reported by a clean run
+    if returncode != 0:
+        return seconds, "", heavy
+    return seconds, heavy, None
+
+
+def main() -> None:
+    args = create_parser().parse_args()
+    scripts = get_console_scripts()
+    names = list(scripts) if args.scripts is None else args.scripts
+    baseline, _, _ = time_run(["-c", "pass"], args.repeats)
+    print(f"{'empty interpreter':32s} {baseline:8.3f} s")
+    print(f"{'console script':32s} {'import':>8s} {'-h':>10s}   heavy modules imported by -h")
+    for name in names:
+        import_seconds, _, import_error = time_entry_point(scripts[name], False, args.repeats)
+        help_seconds, heavy, help_error = time_entry_point(scripts[name], True, args.repeats)
+        error = import_error or help_error
+        print(
+            f"{name:32s} {import_seconds:8.3f} s {help_seconds:8.3f} s   "
+            + (f"failed: {error}" if error else heavy or "-")
+        )
+
+
+if __name__ == "__main__":
+    main()
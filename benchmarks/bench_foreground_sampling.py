@@ -0,0 +1,111 @@
+"""
+Microbenchmark of drawing foreground-biased 128^3 patches from a full-size knee volume, comparing searching the
+labels for foreground voxels on every draw, as a sampler without an index has to, with drawing from a
+`ForegroundIndex` built once per volume, both from arrays in memory and from a memory-mapped volume store.
+
+Run with, e.g.: `python benchmarks/bench_foreground_sampling.py --shape 330 900 900 --draws 200`
+"""
+from __future__ import annotations
+
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+import shutil
+import tempfile
+import time
+import numpy as np
+from typing import List, Tuple
+
+from hrkneeseg.datasets.foreground_index import ForegroundIndex
+from hrkneeseg.datasets.patch_sampling import get_patch_slices, sample_patch
+from hrkneeseg.datasets.volume_store import VolumeStore, write_volume
+
+
+def create_parser() -> ArgumentParser:
+    parser = ArgumentParser(
+        description="Foreground patch sampling microbenchmark",
+        formatter_class=ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        "--shape", "-sh", type=int, nargs=3, default=[330, 900, 900], metavar="N",
+        help="shape (z, y, x) of the synthetic volume"
+    )
+    parser.add_argument("--patch-width", "-pw", type=int, default=128, metavar="N", help="width of the patches")
+    parser.add_argument("--probability", "-p", type=float, default=0.5, metavar="P", help="foreground probability")
+    parser.add_argument("--draws", "-d", type=int, default=200, metavar="N", help="number of patches to draw")
+    parser.add_argument(
+        "--search-draws", "-sd", type=int, default=5, metavar="N",
+        help="number of patches to draw when searching the labels on every draw, which is much slower"
+    )
+    return parser
+
+
+def create_volume(shape: List[int]) -> Tuple[np.ndarray, np.ndarray]:
+    rng = np.random.default_rng(0)
+    # a thick ellipsoidal shell, so the foreground is a bone-like fraction of the volume
+    z, y, x = np.ogrid[tuple(slice(0, s) for s in shape)]
+    r = ((z - shape[0] / 2) / (0.45 * shape[0])) ** 2 + ((y - shape[1] / 2) / (0.35 * shape[1])) ** 2 \
+        + ((x - shape[2] / 2) / (0.35 * shape[2])) ** 2
+    labels = ((r < 1) & (r > 0.5)).astype(np.uint8)[np.newaxis]
+    image = rng.random((1, *shape), dtype=np.float32)
+    return image, labels
+
+
+def search_patch(
+        image: np.ndarray, labels: np.ndarray, patch_width: int, probability: float, rng: np.random.Generator
+) -> Tuple[np.ndarray, np.ndarray]:
+    spatial_shape = image.shape[1:]
+    if rng.random() < probability:
+        foreground = np.argwhere(labels[0] > 0)
+        center = tuple(foreground[rng.integers(len(foreground))])
+    else:
+        center = tuple(int(rng.integers(s)) for s in spatial_shape)
+    slices, _ = get_patch_slices(center, spatial_shape, patch_width)
+    return np.array(image[(slice(None),) + slices]), np.array(labels[(slice(None),) + slices])
+
+
+def rate(func, draws: int) -> float:
+    start = time.perf_counter()
+    for _ in range(draws):
+        func()
+    return draws / (time.perf_counter() - start)
+
+
+def main() -> None:
+    args = create_parser().parse_args()
+    image, labels = create_volume(args.shape)
+    print(
+        f"volume: {args.shape}, {np.prod(args.shape) / 1e6:.0f} Mvoxels, "
+        f"{labels.mean() * 100:.0f}% foreground, {args.patch_width}^3 patches, p = {args.probability}"
+    )
+    rng = np.random.default_rng(0)
+
+    start = time.perf_counter()
+    index = ForegroundIndex.from_labels(labels, 3)
+    build_time = time.perf_counter() - start
+    print(f"{'build index, once per volume':45s} {build_time:8.3f} s, {index.indices.nbytes / 1e6:.0f} MB")
+    print(f"{'draw a foreground voxel, indexed':45s} {rate(lambda: index.draw(rng), 10000):8.0f} draws/s")
+
+    def searched(image: np.ndarray, labels: np.ndarray):
+        return lambda: search_patch(image, labels, args.patch_width, args.probability, rng)
+
+    def indexed(image: np.ndarray, labels: np.ndarray, index: ForegroundIndex):
+        return lambda: sample_patch(image, labels, index, args.patch_width, args.probability, rng)
+
+    print(
+        f"{'patches, search labels every draw':45s} {rate(searched(image, labels), args.search_draws):8.2f} samples/s"
+    )
+    print(f"{'patches, indexed, in memory':45s} {rate(indexed(image, labels, index), args.draws):8.2f} samples/s")
+
+    store_dir = tempfile.mkdtemp()
+    try:
+        write_volume(store_dir, "0", image, labels)
+        del image, labels
+        print(
+            f"{'patches, indexed, memory-mapped volume store':45s} "
+            f"{rate(indexed(*VolumeStore(store_dir)[0]), args.draws):8.2f} samples/s"
+        )
+    finally:
+        shutil.rmtree(store_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""
+Microbenchmark of relabelling a full-size peri-articular VOI mask with the 16 default site codes, comparing the
+per-code SimpleITK comparisons that `get_medial_and_lateral_masks` used to do with the single-pass lookup table
+relabelling in `hrkneeseg.utils.label_remapping`.
+
+Run with, e.g.: `python benchmarks/bench_label_remapping.py --shape 330 900 900 --repeats 3`
+"""
+from __future__ import annotations
+
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+import time
+import SimpleITK as sitk
+import numpy as np
+from typing import Callable, List
+
+from hrkneeseg.utils.label_remapping import remap_labels_array, remap_labels_image, codes_to_mapping
+
+MEDIAL_SITE_CODES = [13, 14, 15, 17, 33, 34, 35, 37]
+LATERAL_SITE_CODES = [10, 11, 12, 16, 30, 31, 32, 36]
+
+
+def create_parser() -> ArgumentParser:
+    parser = ArgumentParser(
+        description="Label remapping microbenchmark",
+        formatter_class=ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        "--shape", "-sh", type=int, nargs=3, default=[330, 900, 900], metavar="N",
+        help="shape (z, y, x) of the synthetic label volume"
+    )
+    parser.add_argument("--repeats", "-r", type=int, default=3, metavar="N", help="number of timed repeats")
+    return parser
+
+
+def create_label_volume(shape: List[int]) -> sitk.Image:
+    rng = np.random.default_rng(0)
+    codes = np.array([0] + MEDIAL_SITE_CODES + LATERAL_SITE_CODES, dtype=np.uint8)
+    # blocky labels, so the volume looks more like a VOI mask than noise
+    blocks = rng.integers(0, len(codes), size=[(s + 15) // 16 for s in shape])
+    labels = codes[blocks].repeat(16, 0).repeat(16, 1).repeat(16, 2)[:shape[0], :shape[1], :shape[2]]
+    return sitk.GetImageFromArray(np.ascontiguousarray(labels))
+
+
+def loop_masks(mask: sitk.Image) -> List[sitk.Image]:
+    masks = []
+    for codes in [MEDIAL_SITE_CODES, LATERAL_SITE_CODES]:
+        m = sitk.Image(*mask.GetSize(), mask.GetPixelIDValue())
+        m.CopyInformation(mask)
+        for code in codes:
+            m += (mask == code)
+        masks.append(m)
+    return masks
+
+
+def lut_image_masks(mask: sitk.Image) -> List[sitk.Image]:
+    return [
+        remap_labels_image(mask, codes_to_mapping(codes, 1)) for codes in [MEDIAL_SITE_CODES, LATERAL_SITE_CODES]
+    ]
+
+
+def lut_array_masks(mask: sitk.Image) -> List[np.ndarray]:
+    view = sitk.GetArrayViewFromImage(mask)
+    return [remap_labels_array(view, codes_to_mapping(codes, 1)) for codes in [MEDIAL_SITE_CODES, LATERAL_SITE_CODES]]
+
+
+def loop_combined(mask: sitk.Image) -> sitk.Image:
+    medial_mask, lateral_mask = loop_masks(mask)
+    return 2 * lateral_mask + 1 * medial_mask
+
+
+def lut_combined(mask: sitk.Image) -> sitk.Image:
+    return remap_labels_image(mask, {**codes_to_mapping(MEDIAL_SITE_CODES, 1), **codes_to_mapping(LATERAL_SITE_CODES, 2)})
+
+
+def best_time(func: Callable, mask: sitk.Image, repeats: int) -> float:
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func(mask)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main() -> None:
+    args = create_parser().parse_args()
+    mask = create_label_volume(args.shape)
+    print(f"label volume: {args.shape}, {np.prod(args.shape) / 1e6:.0f} Mvoxels, best of {args.repeats}")
+    expected = [sitk.GetArrayFromImage(m) for m in loop_masks(mask)]
+    for got in [[sitk.GetArrayFromImage(m) for m in lut_image_masks(mask)], lut_array_masks(mask)]:
+        assert all(np.array_equal(e, g) for e, g in zip(expected, got))
+    assert np.array_equal(sitk.GetArrayFromImage(loop_combined(mask)), sitk.GetArrayFromImage(lut_combined(mask)))
+    for name, func in [
+        ("medial + lateral masks, per-code sitk loop", loop_masks),
+        ("medial + lateral masks, LUT on sitk image", lut_image_masks),
+        ("medial + lateral masks, LUT on numpy view", lut_array_masks),
+        ("combined mask, per-code sitk loop", loop_combined),
+        ("combined mask, single LUT", lut_combined),
+    ]:
+        print(f"{name:45s} {best_time(func, mask, args.repeats):8.3f} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+Microbenchmark of drawing foreground-biased 2.5D slice stack patches from a full-size knee volume, comparing one
+slice stack per draw, searching the slice for foreground pixels as `MultisliceSampler` composed with
+`ForegroundPatchSampler` does, with drawing a batch of stacks at once with `draw_slice_stacks`.
+
+Run with, e.g.: `python benchmarks/bench_slice_sampling.py --shape 330 900 900 --draws 1000`
+"""
+from __future__ import annotations
+
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+import time
+import numpy as np
+from typing import Tuple
+
+from hrkneeseg.datasets.foreground_index import ForegroundIndex
+from hrkneeseg.datasets.slice_sampling import draw_slice_stacks
+
+
+def create_parser() -> ArgumentParser:
+    parser = ArgumentParser(
+        description="Slice stack sampling microbenchmark",
+        formatter_class=ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        "--shape", "-sh", type=int, nargs=3, default=[330, 900, 900], metavar="N",
+        help="shape (z, y, x) of the synthetic volume"
+    )
+    parser.add_argument("--patch-width", "-pw", type=int, default=128, metavar="N", help="width of the patches")
+    parser.add_argument(
+        "--num-adjacent-slices", "-nas", type=int, default=2, metavar="N",
+        help="number of adjacent slices on each side of the central slice"
+    )
+    parser.add_argument("--probability", "-p", type=float, default=0.5, metavar="P", help="foreground probability")
+    parser.add_argument("--draws", "-d", type=int, default=1000, metavar="N", help="number of stacks to draw")
+    parser.add_argument("--batch-size", "-bs", type=int, default=256, metavar="N", help="stacks drawn at once")
+    return parser
+
+
+def create_volume(shape) -> Tuple[np.ndarray, np.ndarray]:
+    rng = np.random.default_rng(0)
+    # a thick ellipsoidal shell, so the foreground is a bone-like fraction of the volume
+    z, y, x = np.ogrid[tuple(slice(0, s) for s in shape)]
+    r = ((z - shape[0] / 2) / (0.45 * shape[0])) ** 2 + ((y - shape[1] / 2) / (0.35 * shape[1])) ** 2 \
+        + ((x - shape[2] / 2) / (0.35 * shape[2])) ** 2
+    labels = ((r < 1) & (r > 0.5)).astype(np.uint8)[np.newaxis]
+    image = rng.random((1, *shape), dtype=np.float32)
+    return image, labels
+
+
+def draw_one(
+        image: np.ndarray, labels: np.ndarray, patch_width: int, n: int, probability: float, rng: np.random.Generator
+) -> Tuple[np.ndarray, np.ndarray]:
+    z = int(rng.integers(n, image.shape[1] - n))
+    stack = image[:, z - n:z + n + 1].reshape(-1, *image.shape[2:])
+    if rng.random() < probability:
+        foreground = np.argwhere(labels[0, z] > 0)
+        center = foreground[rng.integers(len(foreground))] if len(foreground) > 0 else rng.integers(image.shape[2:])
+    else:
+        center = rng.integers(image.shape[2:])
+    y, x = np.clip(center - patch_width // 2, 0, np.array(image.shape[2:]) - patch_width)
+    return (
+        np.array(stack[:, y:y + patch_width, x:x + patch_width]),
+        np.array(labels[:, z, y:y + patch_width, x:x + patch_width])
+    )
+
+
+def main() -> None:
+    args = create_parser().parse_args()
+    image, labels = create_volume(args.shape)
+    n = args.num_adjacent_slices
+    print(
+        f"volume: {args.shape}, {labels.mean() * 100:.0f}% foreground, stacks of {2 * n + 1} "
+        f"{args.patch_width}^2 slices, p = {args.probability}"
+    )
+    rng = np.random.default_rng(0)
+
+    start = time.perf_counter()
+    for _ in range(args.draws):
+        draw_one(image, labels, args.patch_width, n, args.probability, rng)
+    print(f"{'one stack per draw':45s} {args.draws / (time.perf_counter() - start):8.0f} samples/s")
+
+    start = time.perf_counter()
+    foreground = ForegroundIndex.from_labels(labels, 3)
+    print(f"{'build index, once per volume':45s} {time.perf_counter() - start:8.3f} s")
+
+    start = time.perf_counter()
+    for done in range(0, args.draws, args.batch_size):
+        draw_slice_stacks(
+            image, labels, foreground, min(args.batch_size, args.draws - done), args.patch_width, n,
+            args.probability, rng
+        )
+    print(f"{f'batches of {args.batch_size}':45s} {args.draws / (time.perf_counter() - start):8.0f} samples/s")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+from __future__ import annotations
+
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter, Namespace
+import json
+import os
+import time
+from typing import Dict, List, Optional
+
+from hrkneeseg.aim_nifti.aim_io import AIMHeader, is_aim_filename, read_aim_header
+
+AIM_INDEX_FILENAME = "aim_index.json"
+# bump this if the way entries are stored changes, so that old indexes are rebuilt instead of misread
+AIM_INDEX_FORMAT_VERSION = 1
+HEADER_FIELDS = [
+    "version", "dimensions", "position", "element_size", "processing_log",
+    "offset", "supdim", "suppos", "subdim", "testoff", "data_offset", "type_code"
+]
+
+
+def header_to_dict(header: AIMHeader) -> Dict:
+    entry = {field: getattr(header, field) for field in HEADER_FIELDS}
+    entry["dtype"] = header.dtype.str if header.dtype is not None else None
+    return entry
+
+
+def header_from_dict(entry: Dict) -> AIMHeader:
+    fields = {field: entry[field] for field in HEADER_FIELDS}
+    return AIMHeader(
+        fields.pop("version"), entry["dtype"], fields.pop("dimensions"), fields.pop("position"),
+        fields.pop("element_size"), **fields
+    )
+
+
+class AIMIndex:
+    """
+    An index of the headers of the AIMs in a directory, kept in a JSON file next to them.
+
+    An entry is read again from its AIM when the size or modification time of the AIM changes, so the index never
+    has to be invalidated by hand. Only the headers are read, so indexing a compressed AIM is as fast as an
+    uncompressed one. The index is only a cache: if it cannot be written, e.g. in a read-only directory, the headers
+    are read from the AIMs each time.
+
+    Parameters
+    ----------
+    directory : str
+        The directory of AIMs.
+
+    index_fn : Optional[str]
+        The index file. If `None`, `aim_index.json` in `directory`. Default is `None`.
+    """
+
+    def __init__(self, directory: str, index_fn: Optional[str] = None):
+        self.directory = directory
+        self.index_fn = index_fn if index_fn is not None else os.path.join(directory, AIM_INDEX_FILENAME)
+        self._entries = self._load()
+        self._modified = False
+        self.num_read = 0
+
+    def _load(self) -> Dict[str, Dict]:
+        try:
+            with open(self.index_fn, "r") as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if not isinstance(index, dict) or index.get("format_version") != AIM_INDEX_FORMAT_VERSION:
+            return {}
+        return index.get("entries", {})
+
+    def _key(self, fn: str) -> str:
+        return os.path.relpath(os.path.abspath(fn), os.path.abspath(self.directory))
+
+    def get(self, fn: str) -> AIMHeader:
+        """
+        Get the header of an AIM, reading it from the AIM only if the AIM is not indexed or has changed.
+
+        Parameters
+        ----------
+        fn : str
+            The AIM filename.
+
+        Returns
+        -------
+        AIMHeader
+            The header, with a `dtype` of `None` if the AIM is compressed.
+        """
+        key = self._key(fn)
+        stat = os.stat(fn)
+        entry = self._entries.get(key)
+        if entry is None or entry["size"] != stat.st_size or entry["mtime_ns"] != stat.st_mtime_ns:
+            entry = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+            try:
+                entry["header"] = header_to_dict(read_aim_header(fn, allow_compressed=True))
+            except ValueError as e:
+                # remember files that are not AIMs too, so they are not read again until they change
+                entry["error"] = str(e)
+            self._entries[key] = entry
+            self._modified = True
+            self.num_read += 1
+        if "error" in entry:
+            raise ValueError(entry["error"])
+        return header_from_dict(entry["header"])
+
+    def update(self) -> List[str]:
+        """
+        Index every AIM in the directory and forget the entries of AIMs that no longer exist.
+
+        Returns
+        -------
+        List[str]
+            The AIM filenames in the directory.
+        """
+        fns = sorted(os.path.join(self.directory, fn) for fn in os.listdir(self.directory) if is_aim_filename(fn))
+        for fn in fns:
+            try:
+                self.get(fn)
+            except ValueError:
+                pass
+        for key in list(self._entries):
+            if not os.path.isfile(os.path.join(self.directory, key)):
+                del self._entries[key]
+                self._modified = True
+        return fns
+
+    def save(self) -> bool:
+        """
+        Write the index if it has changed. The index is written to a temporary file and moved into place, so jobs
+        sharing a directory never read a partially written index.
+
+        Returns
+        -------
+        bool
+            Whether the index on disk is up to date.
+        """
+        if not self._modified:
+            return True
+        tmp_fn = f"{self.index_fn}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_fn, "w") as f:
+                json.dump({"format_version": AIM_INDEX_FORMAT_VERSION, "entries": self._entries}, f)
+            os.replace(tmp_fn, self.index_fn)
+        except OSError:
+            if os.path.isfile(tmp_fn):
+                os.remove(tmp_fn)
+            return False
+        self._modified = False
+        return True
+
+
+def get_aim_header(fn: str) -> AIMHeader:
+    """
+    Get the header of an AIM through the index of its directory, updating the index if the header had to be read.
+
+    Parameters
+    ----------
+    fn : str
+        The AIM filename.
+
+    Returns
+    -------
+    AIMHeader
+        The header, with a `dtype` of `None` if the AIM is compressed.
+    """
+    index = AIMIndex(os.path.dirname(os.path.abspath(fn)))
+    header = index.get(fn)
+    index.save()
+    return header
+
+
+def index_aims(args: Namespace) -> None:
+    from bonelab.util.echo_arguments import echo_arguments
+    from bonelab.util.registration_util import message_s
+    if not args.silent:
+        print(echo_arguments("Index AIMs", vars(args)))
+    if not os.path.isdir(args.directory):
+        raise FileNotFoundError(f"{args.directory} is not a directory")
+    if args.rebuild and os.path.isfile(os.path.join(args.directory, AIM_INDEX_FILENAME)):
+        os.remove(os.path.join(args.directory, AIM_INDEX_FILENAME))
+    start = time.perf_counter()
+    index = AIMIndex(args.directory)
+    fns = index.update()
+    saved = index.save()
+    message_s(
+        f"Indexed {len(fns)} AIMs in {time.perf_counter() - start:.2f} s, read the headers of {index.num_read}"
+        + ("" if saved else f", could not write {index.index_fn}"),
+        args.silent
+    )
+    if args.list:
+        for fn in fns:
+            try:
+                header = index.get(fn)
+            except ValueError as e:
+                print(f"{os.path.basename(fn)}: {e}")
+                continue
+            print(
+                f"{os.path.basename(fn)}: dimensions {header.dimensions}, position {header.position}, "
+                f"element size {tuple(round(e, 6) for e in header.element_size)}, "
+                f"{'compressed' if header.compressed else header.dtype.name}, {header.version}"
+            )
+
+
+def create_parser() -> ArgumentParser:
+    parser = ArgumentParser(
+        description="Index the headers of the AIMs in a directory, in `aim_index.json` in that directory. The tools "
+                    "that only need the metadata of an AIM (dimensions, position, element size, processing log) look "
+                    "it up in the index instead of reading the whole image, and update the index themselves when an "
+                    "AIM is new or has changed, so running this is optional; it just does all of the reading at once.",
+        formatter_class=ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("directory", type=str, metavar="DIR", help="the directory of AIMs")
+    parser.add_argument(
+        "--rebuild", "-r", default=False, action="store_true",
+        help="read all of the headers again instead of only those of new or changed AIMs"
+    )
+    parser.add_argument(
+        "--list", "-l", default=False, action="store_true",
+        help="print the dimensions, position, element size and data type of every AIM"
+    )
+    parser.add_argument(
+        "--silent", "-s", default=False, action="store_true",
+        help="enable this flag to suppress terminal output"
+    )
+    return parser
+
+
+def main() -> None:
+    args = create_parser().parse_args()
+    index_aims(args)
+
+
+if __name__ == "__main__":
+    main()
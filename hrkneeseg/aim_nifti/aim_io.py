@@ -0,0 +1,318 @@
+from __future__ import annotations
+
+import numpy as np
+import os
+from typing import Optional, Sequence, Tuple
+
+AIM_BACKENDS = ["vtk", "numpy"]
+
+AIM_V020 = "AIMDATA_V020"
+AIM_V030 = "AIMDATA_V030"
+AIM_VERSIONS = [AIM_V020, AIM_V030]
+
+# the v030 files start with the version as a null terminated 16 byte string, v020 files have no version string
+AIM_V030_MAGIC = b"AIMDATA_V030   \x00"
+
+# (pre-header, image struct) sizes in bytes
+AIM_HEADER_SIZES = {
+    AIM_V020: (20, 140),
+    AIM_V030: (40, 280),
+}
+
+# bytes between the start of the image struct and the data type: version, two pointers, id, and ref
+AIM_STRUCT_TYPE_OFFSET = 20
+
+# only the uncompressed data types are supported, the packed types have to go through the vtk backend
+AIM_DATA_TYPES = {
+    0x00010001: np.dtype("<i1"),
+    0x00160001: np.dtype("<u1"),
+    0x00020002: np.dtype("<i2"),
+    0x00170002: np.dtype("<u2"),
+    0x00030004: np.dtype("<i4"),
+    0x001a0004: np.dtype("<f4"),
+}
+AIM_DATA_TYPE_CODES = {dtype: code for code, dtype in AIM_DATA_TYPES.items()}
+
+
+def decode_vax_float(data: bytes) -> np.ndarray:
+    """
+    Decode VAX F floats, which is how the element size is stored in v020 AIMs.
+
+    Parameters
+    ----------
+    data : bytes
+        The encoded floats, 4 bytes each.
+
+    Returns
+    -------
+    np.ndarray
+        The decoded float32 values.
+    """
+    words = np.frombuffer(data, dtype="<u2").reshape(-1, 2).astype(np.uint32)
+    return ((words[:, 0] << 16) | words[:, 1]).view(np.float32) / np.float32(4)
+
+
+def encode_vax_float(values: Sequence[float]) -> bytes:
+    """
+    Encode values as VAX F floats, the inverse of `decode_vax_float`.
+
+    Parameters
+    ----------
+    values : Sequence[float]
+        The values to encode.
+
+    Returns
+    -------
+    bytes
+    """
+    bits = (np.asarray(values, dtype=np.float32) * np.float32(4)).view(np.uint32)
+    return np.stack([bits >> 16, bits & 0xFFFF], axis=-1).astype("<u2").tobytes()
+
+
+class AIMHeader:
+    """
+    The header of a Scanco AIM file.
+
+    Parameters
+    ----------
+    version : str
+        The AIM version, `AIMDATA_V020` or `AIMDATA_V030`.
+
+    dtype : Optional[np.dtype]
+        The voxel data type, `None` for a compressed AIM.
+
+    dimensions : Tuple[int, int, int]
+        The image dimensions, in (x, y, z) order.
+
+    position : Tuple[int, int, int]
+        The position of the image in the scanner coordinate system, in voxels.
+
+    element_size : Tuple[float, float, float]
+        The voxel spacing, in mm.
+
+    processing_log : str
+        The processing log, including the calibration used by `get_aim_density_equation`.
+
+    offset, supdim, suppos, subdim, testoff : Tuple[int, int, int]
+        The offset, super-dimensions, super-position, sub-dimensions and test offset fields of the image struct. These
+        are not used by the tools here but are carried over when writing an AIM with a reference header.
+
+    data_offset : int
+        The byte offset of the voxel data in the file.
+
+    type_code : Optional[int]
+        The AIM data type code. If `None`, the code of `dtype`.
+    """
+
+    def __init__(
+            self,
+            version: str,
+            dtype: np.dtype,
+            dimensions: Tuple[int, int, int],
+            position: Tuple[int, int, int],
+            element_size: Tuple[float, float, float],
+            processing_log: str = "",
+            offset: Tuple[int, int, int] = (0, 0, 0),
+            supdim: Tuple[int, int, int] = (0, 0, 0),
+            suppos: Tuple[int, int, int] = (0, 0, 0),
+            subdim: Tuple[int, int, int] = (0, 0, 0),
+            testoff: Tuple[int, int, int] = (0, 0, 0),
+            data_offset: Optional[int] = None,
+            type_code: Optional[int] = None
+    ):
+        self.version = version
+        self.dtype = np.dtype(dtype) if dtype is not None else None
+        self.dimensions = tuple(int(d) for d in dimensions)
+        self.position = tuple(int(p) for p in position)
+        self.element_size = tuple(float(e) for e in element_size)
+        self.processing_log = processing_log
+        self.offset = tuple(int(v) for v in offset)
+        self.supdim = tuple(int(v) for v in supdim)
+        self.suppos = tuple(int(v) for v in suppos)
+        self.subdim = tuple(int(v) for v in subdim)
+        self.testoff = tuple(int(v) for v in testoff)
+        self.data_offset = data_offset
+        self.type_code = int(type_code) if type_code is not None else AIM_DATA_TYPE_CODES.get(self.dtype)
+
+    @property
+    def compressed(self) -> bool:
+        return self.dtype is None
+
+    @property
+    def spacing(self) -> Tuple[float, float, float]:
+        return self.element_size
+
+    @property
+    def origin(self) -> Tuple[float, float, float]:
+        # the same convention as `vtkboneAIMReader`, the origin is the position scaled by the element size
+        return tuple(p * e for p, e in zip(self.position, self.element_size))
+
+
+def read_aim_header(fn: str, allow_compressed: bool = False) -> AIMHeader:
+    """
+    Read the header of an AIM file, without reading the voxel data.
+
+    Parameters
+    ----------
+    fn : str
+        The AIM filename.
+
+    allow_compressed : bool
+        If `True`, the header of a compressed AIM is returned with a `dtype` of `None`, e.g. to get its dimensions,
+        position and processing log. If `False`, compressed AIMs raise a `NotImplementedError`. Default is `False`.
+
+    Returns
+    -------
+    AIMHeader
+    """
+    with open(fn, "rb") as f:
+        magic = f.read(len(AIM_V030_MAGIC))
+        if magic == AIM_V030_MAGIC:
+            version, int_type, start = AIM_V030, np.dtype("<i8"), len(AIM_V030_MAGIC)
+        else:
+            version, int_type, start = AIM_V020, np.dtype("<i4"), 0
+        f.seek(start)
+        pre_header = np.frombuffer(f.read(5 * int_type.itemsize), dtype=int_type)
+        if pre_header.size < 5:
+            raise ValueError(f"{fn} is too short to be an AIM file")
+        pre_header_size, struct_size, log_size, data_size = (int(v) for v in pre_header[:4])
+        f.seek(start + pre_header_size)
+        struct = f.read(struct_size)
+        processing_log = f.read(log_size)
+    if len(struct) != struct_size or len(processing_log) != log_size:
+        raise ValueError(f"{fn} is too short for the header sizes it gives, it is not a valid AIM file")
+    type_code = int(np.frombuffer(struct, dtype="<i4", count=1, offset=AIM_STRUCT_TYPE_OFFSET)[0])
+    if type_code not in AIM_DATA_TYPES and not allow_compressed:
+        raise NotImplementedError(
+            f"{fn} has AIM data type {hex(type_code)}, only the uncompressed types "
+            f"{[hex(c) for c in AIM_DATA_TYPES]} can be read without vtkbone"
+        )
+    fields_offset = AIM_STRUCT_TYPE_OFFSET + 4
+    fields = np.frombuffer(struct, dtype=int_type, count=21, offset=fields_offset).reshape(7, 3)
+    element_size_offset = fields_offset + 21 * int_type.itemsize
+    if version == AIM_V030:
+        # stored as integers in units of 1e-6 mm
+        element_size = 1e-6 * np.frombuffer(struct, dtype="<i8", count=3, offset=element_size_offset)
+    else:
+        element_size = decode_vax_float(struct[element_size_offset:element_size_offset + 12])
+    header = AIMHeader(
+        version, AIM_DATA_TYPES.get(type_code), fields[1], fields[0], element_size,
+        processing_log.decode("latin-1").rstrip("\x00"),
+        offset=fields[2], supdim=fields[3], suppos=fields[4], subdim=fields[5], testoff=fields[6],
+        data_offset=start + pre_header_size + struct_size + log_size, type_code=type_code
+    )
+    if header.compressed:
+        return header
+    expected_size = int(np.prod(header.dimensions)) * header.dtype.itemsize
+    if data_size != expected_size:
+        if allow_compressed:
+            header.dtype = None
+            return header
+        raise NotImplementedError(
+            f"{fn} has {data_size} bytes of voxel data but {expected_size} bytes are expected for dimensions "
+            f"{header.dimensions}, it is probably compressed and has to be read with vtkbone"
+        )
+    return header
+
+
+def read_aim(fn: str, mmap: bool = True) -> Tuple[np.ndarray, AIMHeader]:
+    """
+    Read an uncompressed AIM file.
+
+    Parameters
+    ----------
+    fn : str
+        The AIM filename.
+
+    mmap : bool
+        If `True`, the voxel data is memory-mapped read-only instead of being read into memory. Default is `True`.
+
+    Returns
+    -------
+    Tuple[np.ndarray, AIMHeader]
+        The voxel data in (z, y, x) order, which is how it is laid out in the file and how SimpleITK orders arrays.
+        The transpose is in the (x, y, z) order of `vtkImageData_to_numpy`. The second element is the header.
+    """
+    header = read_aim_header(fn)
+    shape = header.dimensions[::-1]
+    if mmap:
+        return np.memmap(fn, dtype=header.dtype, mode="r", offset=header.data_offset, shape=shape), header
+    with open(fn, "rb") as f:
+        f.seek(header.data_offset)
+        array = np.fromfile(f, dtype=header.dtype, count=int(np.prod(shape))).reshape(shape)
+    return array, header
+
+
+def write_aim(
+        fn: str,
+        array: np.ndarray,
+        element_size: Sequence[float],
+        position: Sequence[int] = (0, 0, 0),
+        processing_log: str = "",
+        version: str = AIM_V020,
+        reference: Optional[AIMHeader] = None
+) -> None:
+    """
+    Write an uncompressed AIM file.
+
+    Parameters
+    ----------
+    fn : str
+        The AIM filename.
+
+    array : np.ndarray
+        The voxel data in (z, y, x) order. Must have one of the dtypes in `AIM_DATA_TYPES`, e.g. int8 for masks.
+
+    element_size : Sequence[float]
+        The voxel spacing, in mm.
+
+    position : Sequence[int]
+        The position of the image in the scanner coordinate system, in voxels. Default is `(0, 0, 0)`.
+
+    processing_log : str
+        The processing log. Default is `""`.
+
+    version : str
+        The AIM version to write, `AIMDATA_V020` or `AIMDATA_V030`. Default is `AIMDATA_V020`.
+
+    reference : Optional[AIMHeader]
+        If given, the offset, super- and sub-dimension fields are copied from this header. Default is `None`.
+    """
+    if version not in AIM_VERSIONS:
+        raise ValueError(f"`version` must be one of {AIM_VERSIONS}, got {version}")
+    dtype = array.dtype.newbyteorder("<")
+    if dtype not in AIM_DATA_TYPE_CODES:
+        raise ValueError(f"cannot write an AIM with dtype {array.dtype}, must be one of {list(AIM_DATA_TYPE_CODES)}")
+    if array.ndim != 3:
+        raise ValueError(f"`array` must be 3D, got shape {array.shape}")
+    int_type = np.dtype("<i8") if version == AIM_V030 else np.dtype("<i4")
+    pre_header_size, struct_size = AIM_HEADER_SIZES[version]
+    log = processing_log.encode("latin-1")
+    data_size = array.size * dtype.itemsize
+    fields = [position, array.shape[::-1]]
+    if reference is not None:
+        fields += [reference.offset, reference.supdim, reference.suppos, reference.subdim, reference.testoff]
+    else:
+        fields += [(0, 0, 0)] * 5
+    if version == AIM_V030:
+        element_size_bytes = np.round(np.asarray(element_size) * 1e6).astype("<i8").tobytes()
+    else:
+        element_size_bytes = encode_vax_float(element_size)
+    struct = (
+        bytes(AIM_STRUCT_TYPE_OFFSET)
+        + np.array([AIM_DATA_TYPE_CODES[dtype]], dtype="<i4").tobytes()
+        + np.asarray(fields, dtype=int_type).tobytes()
+        + element_size_bytes
+    )
+    struct += bytes(struct_size - len(struct))
+    with open(fn, "wb") as f:
+        if version == AIM_V030:
+            f.write(AIM_V030_MAGIC)
+        f.write(np.array([pre_header_size, struct_size, len(log), data_size, 0], dtype=int_type).tobytes())
+        f.write(struct)
+        f.write(log)
+        np.ascontiguousarray(array, dtype=dtype).tofile(f)
+
+
+def is_aim_filename(fn: str) -> bool:
+    return os.path.splitext(fn)[1].lower() == ".aim"
@@ -0,0 +1,409 @@
+from __future__ import annotations
+
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter, Namespace
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+import numpy as np
+import os
+import time
+import traceback
+import yaml
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from hrkneeseg.aim_nifti.aim_io import AIM_BACKENDS, is_aim_filename
+from hrkneeseg.aim_nifti.aim_index import AIMIndex
+from hrkneeseg.aim_nifti.convert_aims_to_nifti import convert_aim_to_nifti, get_nifti_filename, message_s
+from hrkneeseg.registration.transform_cache import hash_file_contents
+from hrkneeseg.utils.nifti_format import NIFTI_FORMATS, get_intermediate_format
+
+SKIP_MODES = ["mtime", "hash", "none"]
+STATE_FILENAME = "batch_conversion_state.yaml"
+# bytes held per image voxel during a conversion: the AIM data, its copy in SimpleITK, and the float32 density image
+IMAGE_BYTES_PER_VOXEL = 8
+MASK_BYTES_PER_VOXEL = 2
+
+
+def create_parser() -> ArgumentParser:
+    parser = ArgumentParser(
+        description="Convert a whole directory, or a manifest, of AIM images and their masks to NIfTI images with a "
+                    "pool of worker processes. Each image and its masks are one task, converted the same way as "
+                    "`hrkAIMs2NIIs` does. Tasks are only started while their estimated memory fits in the memory "
+                    "budget, and tasks whose outputs are already up to date are skipped.",
+        formatter_class=ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        "input", type=str, metavar="INPUT",
+        help="a directory of AIMs, or a YAML manifest with a list of entries with an `image` key and an optional "
+             "`masks` list (relative paths are relative to the manifest). in a directory, an AIM is a mask of another "
+             "AIM if its name is that AIM's name followed by an underscore, e.g. `C0001234_CORT_MASK.AIM` is a mask of "
+             "`C0001234.AIM`"
+    )
+    parser.add_argument("output_dir", type=str, metavar="OUTPUT_DIR", help="the output directory")
+    parser.add_argument(
+        "--num-workers", "-nw", default=1, type=int, metavar="N",
+        help="maximum number of scans to convert at once"
+    )
+    parser.add_argument(
+        "--memory-budget", "-mb", default=None, type=float, metavar="GB",
+        help="memory budget for the conversions running at once, in GB. if `None`, the SLURM job memory is used if "
+             "set, otherwise 80%% of the physical memory. a task that is estimated to need more than the whole budget "
+             "is run on its own"
+    )
+    parser.add_argument(
+        "--skip-mode", "-sm", default="mtime", choices=SKIP_MODES,
+        help="how to decide that a scan's outputs are up to date and can be skipped. `mtime`: all outputs exist and "
+             "are newer than their AIMs. `hash`: all outputs exist and were converted from AIMs with the same size "
+             f"and content hash, as recorded in `{STATE_FILENAME}` in the output directory. `none`: never skip"
+    )
+    parser.add_argument(
+        "--aim-backend", "-ab", default="vtk", choices=AIM_BACKENDS,
+        help="how to read the AIMs. `numpy` reads uncompressed AIMs directly without importing vtk/vtkbone."
+    )
+    parser.add_argument(
+        "--output-format", "-of", default=get_intermediate_format(), choices=NIFTI_FORMATS,
+        help="format of the NIfTI files, `nii` is not compressed and is much faster to write. the default is set by "
+             "the `HRKNEESEG_INTERMEDIATE_FORMAT` environment variable"
+    )
+    parser.add_argument(
+        "--overwrite", "-ow", default=False, action="store_true",
+        help="with `skip-mode` `none`, overwrite existing outputs. with the other modes, outputs that are not up to "
+             "date are always overwritten"
+    )
+    parser.add_argument(
+        "--silent", "-s", default=False, action="store_true",
+        help="enable this flag to suppress terminal output"
+    )
+    return parser
+
+
+def find_aim_tasks(directory: str) -> List[Tuple[str, List[str]]]:
+    """
+    Group the AIMs in a directory into images and their masks.
+
+    Parameters
+    ----------
+    directory : str
+        The directory.
+
+    Returns
+    -------
+    List[Tuple[str, List[str]]]
+        The (image, masks) tasks.
+    """
+    stems = {os.path.splitext(fn)[0]: fn for fn in sorted(os.listdir(directory)) if is_aim_filename(fn)}
+    images = [s for s in stems if not any(s.startswith(f"{other}_") for other in stems if other != s)]
+    masks = {image: [] for image in images}
+    for stem in stems:
+        if stem in masks:
+            continue
+        # a mask goes with the image that is the longest prefix of its name
+        parent = max((image for image in images if stem.startswith(f"{image}_")), key=len)
+        masks[parent].append(stem)
+    return [
+        (os.path.join(directory, stems[image]), [os.path.join(directory, stems[m]) for m in masks[image]])
+        for image in images
+    ]
+
+
+def read_manifest(fn: str) -> List[Tuple[str, List[str]]]:
+    """
+    Read the (image, masks) tasks from a YAML manifest.
+
+    Parameters
+    ----------
+    fn : str
+        The manifest filename.
+
+    Returns
+    -------
+    List[Tuple[str, List[str]]]
+    """
+    with open(fn, "r") as f:
+        entries = yaml.safe_load(f)
+    base = os.path.dirname(os.path.abspath(fn))
+    return [
+        (
+            os.path.join(base, entry["image"]),
+            [os.path.join(base, mask) for mask in (entry.get("masks") or [])]
+        )
+        for entry in entries
+    ]
+
+
+def get_default_memory_budget() -> float:
+    """
+    Get the default memory budget in bytes: the memory of the SLURM job if running in one, otherwise 80% of the
+    physical memory.
+
+    Returns
+    -------
+    float
+    """
+    slurm_memory = os.environ.get("SLURM_MEM_PER_NODE")
+    if slurm_memory is not None:
+        return float(slurm_memory) * 1024 ** 2
+    return 0.8 * os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+
+def estimate_voxels(fn: str, indexes: Dict[str, AIMIndex]) -> int:
+    directory = os.path.dirname(os.path.abspath(fn))
+    if directory not in indexes:
+        indexes[directory] = AIMIndex(directory)
+    try:
+        # the dimensions are in the header of compressed AIMs too
+        return int(np.prod(indexes[directory].get(fn).dimensions))
+    except ValueError:
+        # not an AIM we can read the header of, so assume one byte per voxel on disk
+        return os.path.getsize(fn)
+
+
+def estimate_task_memory(image: str, masks: List[str], indexes: Dict[str, AIMIndex]) -> float:
+    """
+    Estimate the peak memory of converting an image and its masks, in bytes. The masks are converted one at a time
+    while the image is still held.
+
+    Parameters
+    ----------
+    image : str
+        The image AIM.
+
+    masks : List[str]
+        The mask AIMs.
+
+    indexes : Dict[str, AIMIndex]
+        The AIM indexes to look the dimensions up in, by directory. Indexes for new directories are added to it.
+
+    Returns
+    -------
+    float
+    """
+    return (
+        IMAGE_BYTES_PER_VOXEL * estimate_voxels(image, indexes)
+        + MASK_BYTES_PER_VOXEL * max([estimate_voxels(mask, indexes) for mask in masks], default=0)
+    )
+
+
+def get_source_record(fn: str) -> Dict:
+    return {"size": os.path.getsize(fn), "hash": hash_file_contents(fn)}
+
+
+def is_up_to_date(
+        image: str,
+        masks: List[str],
+        output_dir: str,
+        skip_mode: str,
+        state: Dict[str, Dict],
+        output_format: str = "nii.gz"
+) -> bool:
+    """
+    Check whether the outputs of a task are up to date.
+
+    Parameters
+    ----------
+    image : str
+        The image AIM.
+
+    masks : List[str]
+        The mask AIMs.
+
+    output_dir : str
+        The output directory.
+
+    skip_mode : str
+        `mtime`, `hash`, or `none`.
+
+    state : Dict[str, Dict]
+        The recorded source size and hash of each output, used in `hash` mode.
+
+    output_format : str
+        The format of the outputs, `nii.gz` or `nii`. Default is `nii.gz`.
+
+    Returns
+    -------
+    bool
+    """
+    if skip_mode == "none":
+        return False
+    for source in [image] + masks:
+        output = get_nifti_filename(source, output_dir, output_format)
+        if not os.path.isfile(output) or os.path.getsize(output) == 0:
+            return False
+        if skip_mode == "mtime" and os.path.getmtime(output) < os.path.getmtime(source):
+            return False
+        if skip_mode == "hash":
+            record = state.get(os.path.basename(output))
+            # compare the sizes first so that changed files are usually caught without hashing them
+            if record is None or record["size"] != os.path.getsize(source) or record != get_source_record(source):
+                return False
+    return True
+
+
+def convert_task(
+        image: str,
+        masks: List[str],
+        output_dir: str,
+        output_format: str,
+        aim_backend: str,
+        overwrite: bool,
+        record_sources: bool
+) -> Tuple[str, float, Optional[Dict[str, Dict]], Optional[str]]:
+    """
+    Convert one image and its masks, in a worker process.
+
+    Parameters
+    ----------
+    image : str
+        The image AIM.
+
+    masks : List[str]
+        The mask AIMs.
+
+    output_dir : str
+        The output directory.
+
+    output_format : str
+        The format of the outputs, `nii.gz` or `nii`.
+
+    aim_backend : str
+        The backend to read the AIMs with.
+
+    overwrite : bool
+        Whether to overwrite existing outputs.
+
+    record_sources : bool
+        Whether to compute the size and hash of the sources, for the `hash` skip mode.
+
+    Returns
+    -------
+    Tuple[str, float, Optional[Dict[str, Dict]], Optional[str]]
+        The image, the time taken in seconds, the source records of the outputs if `record_sources` is `True`, and
+        the traceback if the conversion failed.
+    """
+    start = time.perf_counter()
+    try:
+        convert_aim_to_nifti(Namespace(
+            image=image, output_dir=output_dir, masks=masks if masks else None,
+            output_format=output_format, aim_backend=aim_backend, overwrite=overwrite, silent=True
+        ))
+        records = {
+            os.path.basename(get_nifti_filename(source, output_dir, output_format)): get_source_record(source)
+            for source in [image] + masks
+        } if record_sources else None
+        return image, time.perf_counter() - start, records, None
+    except Exception:
+        return image, time.perf_counter() - start, None, traceback.format_exc()
+
+
+def run_tasks(
+        tasks: List[Tuple[str, List[str], float]], args: Namespace, memory_budget: float
+) -> Iterator[Tuple[str, float, Optional[Dict[str, Dict]], Optional[str]]]:
+    """
+    Run the conversion tasks with a process pool, only starting a task while the estimated memory of the running
+    tasks plus its own fits in the memory budget, and yield the results as the tasks finish.
+
+    Parameters
+    ----------
+    tasks : List[Tuple[str, List[str], float]]
+        The (image, masks, estimated memory) tasks.
+
+    args : Namespace
+        The command line arguments.
+
+    memory_budget : float
+        The memory budget, in bytes.
+
+    Returns
+    -------
+    Iterator[Tuple[str, float, Optional[Dict[str, Dict]], Optional[str]]]
+    """
+    pending = list(tasks)
+    running = {}
+    with ProcessPoolExecutor(max_workers=args.num_workers) as executor:
+        while pending or running:
+            while pending and len(running) < args.num_workers:
+                image, masks, memory = pending[0]
+                if running and sum(running.values()) + memory > memory_budget:
+                    break
+                if memory > memory_budget:
+                    message_s(
+                        f"{image} needs about {memory / 1024 ** 3:.1f} GB, more than the budget, running it alone",
+                        args.silent
+                    )
+                pending.pop(0)
+                future = executor.submit(
+                    convert_task, image, masks, args.output_dir, args.output_format, args.aim_backend,
+                    args.overwrite or args.skip_mode != "none", args.skip_mode == "hash"
+                )
+                running[future] = memory
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                running.pop(future)
+                yield future.result()
+
+
+def batch_convert_aims_to_nifti(args: Namespace) -> None:
+    from bonelab.util.echo_arguments import echo_arguments
+    from bonelab.cli.registration import check_inputs_exist
+    if not args.silent:
+        print(echo_arguments("Batch Convert AIMs to NIfTIs", vars(args)))
+    if args.num_workers < 1:
+        raise ValueError(f"`num-workers` must be at least 1, given {args.num_workers}")
+    if os.path.isdir(args.input):
+        tasks = find_aim_tasks(args.input)
+    elif os.path.isfile(args.input):
+        tasks = read_manifest(args.input)
+    else:
+        raise FileNotFoundError(f"{args.input} is not a directory or a manifest")
+    check_inputs_exist([fn for image, masks in tasks for fn in [image] + masks], args.silent)
+    os.makedirs(args.output_dir, exist_ok=True)
+    state_fn = os.path.join(args.output_dir, STATE_FILENAME)
+    state = {}
+    if args.skip_mode == "hash" and os.path.isfile(state_fn):
+        with open(state_fn, "r") as f:
+            state = yaml.safe_load(f) or {}
+    to_convert = []
+    indexes = {}
+    for image, masks in tasks:
+        if is_up_to_date(image, masks, args.output_dir, args.skip_mode, state, args.output_format):
+            message_s(f"Skipping {image}, outputs are up to date", args.silent)
+        else:
+            to_convert.append((image, masks, estimate_task_memory(image, masks, indexes)))
+    for index in indexes.values():
+        index.save()
+    memory_budget = (
+        args.memory_budget * 1024 ** 3 if args.memory_budget is not None else get_default_memory_budget()
+    )
+    message_s(
+        f"Converting {len(to_convert)} of {len(tasks)} scans with up to {args.num_workers} workers and a memory budget "
+        f"of {memory_budget / 1024 ** 3:.1f} GB",
+        args.silent
+    )
+    start = time.perf_counter()
+    failed = []
+    for image, elapsed, records, error in run_tasks(to_convert, args, memory_budget):
+        if error is not None:
+            message_s(f"Failed to convert {image} after {elapsed:.1f} s:\n{error}", args.silent)
+            failed.append(image)
+            continue
+        message_s(f"Converted {image} in {elapsed:.1f} s", args.silent)
+        if records is not None:
+            state.update(records)
+            with open(state_fn, "w") as f:
+                yaml.dump(state, f)
+    wall_time = time.perf_counter() - start
+    converted = len(to_convert) - len(failed)
+    message_s(
+        f"Converted {converted} scans, skipped {len(tasks) - len(to_convert)}, failed {len(failed)}, in {wall_time:.1f} s"
+        + (f" ({3600 * converted / wall_time:.1f} scans/hour)" if converted > 0 else ""),
+        args.silent
+    )
+    if failed:
+        raise RuntimeError(f"failed to convert {len(failed)} scans: {failed}")
+
+
+def main() -> None:
+    args = create_parser().parse_args()
+    batch_convert_aims_to_nifti(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,17 @@
 from __future__ import annotations
 
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter, Namespace, ArgumentTypeError
-import SimpleITK as sitk
 import numpy as np
-import vtkbone
 import os
+from typing import Optional, Sequence, Tuple
 
-from bonelab.util.echo_arguments import echo_arguments
-from bonelab.util.time_stamp import message
-from bonelab.util.vtk_util import vtkImageData_to_numpy
-from bonelab.util.aim_calibration_header import get_aim_density_equation
-from bonelab.cli.registration import check_inputs_exist, check_for_output_overwrite
+from hrkneeseg.aim_nifti.aim_io import AIM_BACKENDS, read_aim
+from hrkneeseg.aim_nifti.mask_alignment import align_mask_to_image
+from hrkneeseg.utils.fingerprint import StepFingerprint, add_skip_if_unchanged_argument
+from hrkneeseg.utils.nifti_format import NIFTI_FORMATS, get_intermediate_format
+from hrkneeseg.utils.lazy_import import lazy_import
+
+sitk = lazy_import("SimpleITK")
 
 
 def create_parser() -> ArgumentParser:
@@ -35,6 +36,16 @@ def create_parser() -> ArgumentParser:
     parser.add_argument(
         "--masks", "-m", default=None, type=str, nargs="+", help="The mask AIM files to convert."
     )
+    parser.add_argument(
+        "--aim-backend", "-ab", default="vtk", choices=AIM_BACKENDS,
+        help="How to read the AIMs. `numpy` reads uncompressed AIMs directly without importing vtk/vtkbone."
+    )
+    parser.add_argument(
+        "--output-format", "-of", default=get_intermediate_format(), choices=NIFTI_FORMATS,
+        help="Format of the NIfTI files. `nii` skips the gzip compression, which takes most of the time to write a "
+             "large image. The default is set by the `HRKNEESEG_INTERMEDIATE_FORMAT` environment variable."
+    )
+    add_skip_if_unchanged_argument(parser)
     parser.add_argument(
         "--overwrite", "-ow", action="store_true", help="Overwrite output files if they exist."
     )
@@ -59,10 +70,189 @@ def message_s(m: str, s: bool):
     -------
     None
     """
+    from bonelab.util.time_stamp import message
     if not s:
         message(m)
 
 
+def aim_array_to_sitk(
+        array: np.ndarray,
+        spacing: Sequence[float],
+        origin: Sequence[float],
+        density_slope: Optional[float] = None,
+        density_intercept: Optional[float] = None
+) -> sitk.Image:
+    """
+    Convert AIM voxel data to a SimpleITK image, optionally applying the density calibration, while holding at most
+    about one float32 copy of the image in memory.
+
+    The array is copied once into a SimpleITK image in the AIM's pixel type. The calibration is then applied in place
+    to a float32 cast of that image, instead of building float64 intermediates in numpy.
+
+    Parameters
+    ----------
+    array : np.ndarray
+        The voxel data in (z, y, x) order, e.g. a view of the VTK buffer or a memory-map of the AIM file.
+
+    spacing : Sequence[float]
+        The voxel spacing.
+
+    origin : Sequence[float]
+        The image origin.
+
+    density_slope : Optional[float]
+        The slope of the density calibration. If `None`, the image is not calibrated or cast. Default is `None`.
+
+    density_intercept : Optional[float]
+        The intercept of the density calibration. Default is `None`.
+
+    Returns
+    -------
+    sitk.Image
+    """
+    img = sitk.GetImageFromArray(array)
+    if density_slope is not None:
+        img = sitk.Cast(img, sitk.sitkFloat32)
+        img *= density_slope
+        img += density_intercept
+    img.SetSpacing(tuple(spacing))
+    img.SetOrigin(tuple(origin))
+    return img
+
+
+def vtk_image_data_to_sitk(
+        image_data,
+        density_slope: Optional[float] = None,
+        density_intercept: Optional[float] = None
+) -> sitk.Image:
+    """
+    Convert the vtkImageData output of an AIM reader to a SimpleITK image with `aim_array_to_sitk`. The (x, y, z)
+    array from `vtkImageData_to_numpy` is a view of the VTK buffer and its transpose is a C-contiguous (z, y, x) view,
+    so no copy is made before the one into the SimpleITK image.
+
+    Parameters
+    ----------
+    image_data : vtkImageData
+        The output of a `vtkboneAIMReader`.
+
+    density_slope : Optional[float]
+        The slope of the density calibration. If `None`, the image is not calibrated or cast. Default is `None`.
+
+    density_intercept : Optional[float]
+        The intercept of the density calibration. Default is `None`.
+
+    Returns
+    -------
+    sitk.Image
+        The image, with the spacing and origin of `image_data`.
+    """
+    from bonelab.util.vtk_util import vtkImageData_to_numpy
+    return aim_array_to_sitk(
+        vtkImageData_to_numpy(image_data).transpose(), image_data.GetSpacing(), image_data.GetOrigin(),
+        density_slope, density_intercept
+    )
+
+
+def read_aim_as_sitk(
+        fn: str,
+        aim_backend: str = "vtk",
+        calibrate: bool = False
+) -> Tuple[sitk.Image, Tuple[int, int, int], str]:
+    """
+    Read an AIM file as a SimpleITK image.
+
+    Parameters
+    ----------
+    fn : str
+        The AIM filename.
+
+    aim_backend : str
+        `vtk` to read the AIM with `vtkboneAIMReader`, or `numpy` to memory-map it with `read_aim`, which does not
+        import vtk and does not support compressed AIMs. Default is `vtk`.
+
+    calibrate : bool
+        If `True`, convert the image to densities with the calibration in the processing log. Default is `False`.
+
+    Returns
+    -------
+    Tuple[sitk.Image, Tuple[int, int, int], str]
+        The image, the position of the AIM in voxels, and the processing log.
+    """
+    from bonelab.util.aim_calibration_header import get_aim_density_equation
+    if aim_backend == "numpy":
+        array, header = read_aim(fn)
+        density = get_aim_density_equation(header.processing_log) if calibrate else (None, None)
+        return aim_array_to_sitk(array, header.spacing, header.origin, *density), header.position, header.processing_log
+    elif aim_backend == "vtk":
+        # imported here so the numpy backend never pays for importing vtk
+        import vtkbone
+        reader = vtkbone.vtkboneAIMReader()
+        reader.DataOnCellsOff()
+        reader.SetFileName(fn)
+        reader.Update()
+        density = get_aim_density_equation(reader.GetProcessingLog()) if calibrate else (None, None)
+        return (
+            vtk_image_data_to_sitk(reader.GetOutput(), *density),
+            tuple(reader.GetPosition()),
+            reader.GetProcessingLog()
+        )
+    raise ValueError(f"`aim_backend` must be one of {AIM_BACKENDS}, got {aim_backend}")
+
+
+def read_aim_array(fn: str, aim_backend: str = "vtk") -> Tuple[np.ndarray, Tuple[int, int, int]]:
+    """
+    Read the voxel data of an AIM file as a (z, y, x) array without copying it, e.g. to align a mask to an image.
+
+    Parameters
+    ----------
+    fn : str
+        The AIM filename.
+
+    aim_backend : str
+        `vtk` to read the AIM with `vtkboneAIMReader` and return a view of the VTK buffer, or `numpy` to return a
+        memory-map of the file. Default is `vtk`.
+
+    Returns
+    -------
+    Tuple[np.ndarray, Tuple[int, int, int]]
+        The voxel data and the position of the AIM in voxels.
+    """
+    if aim_backend == "numpy":
+        array, header = read_aim(fn)
+        return array, header.position
+    elif aim_backend == "vtk":
+        import vtkbone
+        from bonelab.util.vtk_util import vtkImageData_to_numpy
+        reader = vtkbone.vtkboneAIMReader()
+        reader.DataOnCellsOff()
+        reader.SetFileName(fn)
+        reader.Update()
+        return vtkImageData_to_numpy(reader.GetOutput()).transpose(), tuple(reader.GetPosition())
+    raise ValueError(f"`aim_backend` must be one of {AIM_BACKENDS}, got {aim_backend}")
+
+
+def get_nifti_filename(aim_fn: str, output_dir: str, output_format: str = "nii.gz") -> str:
+    """
+    Get the filename an AIM is converted to, the lowercase basename with a NIfTI extension in the output directory.
+
+    Parameters
+    ----------
+    aim_fn : str
+        The AIM filename.
+
+    output_dir : str
+        The output directory.
+
+    output_format : str
+        `nii.gz` or `nii`. Default is `nii.gz`.
+
+    Returns
+    -------
+    str
+    """
+    return os.path.join(output_dir, os.path.basename(aim_fn).lower().replace(".aim", f".{output_format}"))
+
+
 def convert_aim_to_nifti(args: Namespace):
     """
     Convert an AIM file to a NIfTI file.
@@ -76,84 +266,65 @@ def convert_aim_to_nifti(args: Namespace):
     -------
     None
     """
-    print(echo_arguments("Convert AIM to NIfTI", vars(args)))
+    from bonelab.util.echo_arguments import echo_arguments
+    from bonelab.cli.registration import check_inputs_exist, check_for_output_overwrite
+    if not args.silent:
+        print(echo_arguments("Convert AIM to NIfTI", vars(args)))
     # check inputs
     check_inputs_exist([args.image] + (args.masks if args.masks is not None else []), args.silent)
     # create output paths
-    image_output_path = os.path.join(args.output_dir, os.path.basename(args.image).lower().replace(".aim", ".nii.gz"))
+    image_output_path = get_nifti_filename(args.image, args.output_dir, args.output_format)
     if args.masks is not None:
-        mask_output_paths = [
-            os.path.join(args.output_dir, os.path.basename(mask).lower().replace(".aim", ".nii.gz"))
-            for mask in args.masks
-        ]
+        mask_output_paths = [get_nifti_filename(mask, args.output_dir, args.output_format) for mask in args.masks]
     else:
         mask_output_paths = None
+    fingerprint = StepFingerprint(
+        "hrkAIMs2NIIs", args, [args.image] + (args.masks if args.masks is not None else []),
+        [image_output_path] + (mask_output_paths if mask_output_paths is not None else [])
+    )
+    if args.skip_if_unchanged and fingerprint.is_unchanged():
+        message_s("The outputs are up to date with the inputs and arguments, skipping.", args.silent)
+        return
     # check if outputs exist
     check_for_output_overwrite(
         [image_output_path] + (mask_output_paths if mask_output_paths is not None else []),
-        args.overwrite, args.silent
+        args.overwrite or args.skip_if_unchanged, args.silent
     )
+    fingerprint.invalidate()
     # read image
     message_s(f"Reading image AIM file {args.image}", args.silent)
-    reader = vtkbone.vtkboneAIMReader()
-    reader.DataOnCellsOff()
-    reader.SetFileName(args.image)
-    reader.Update()
-    processing_log = reader.GetProcessingLog()
-    density_slope, density_intercept = get_aim_density_equation(processing_log)
-    arr = density_slope * vtkImageData_to_numpy(reader.GetOutput()) + density_intercept
-    # convert to SimpleITK image
-    message_s("Converting image to SimpleITK image", args.silent)
-    img = sitk.GetImageFromArray(np.moveaxis(arr, [0, 1, 2], [2, 1, 0]))
-    img.SetSpacing(reader.GetOutput().GetSpacing())
-    img.SetOrigin(reader.GetOutput().GetOrigin())
+    img, image_position, _ = read_aim_as_sitk(args.image, args.aim_backend, calibrate=True)
     # write image
     message_s(f"Writing NIfTI file {image_output_path}", args.silent)
     sitk.WriteImage(img, image_output_path)
-    image_position = reader.GetPosition()
     image_shape = img.GetSize()
     image_spacing = img.GetSpacing()
     image_origin = img.GetOrigin()
+    image_direction = img.GetDirection()
     message_s(f"IMAGE | Shape: {image_shape}, Position: {image_position}", args.silent)
     if mask_output_paths is not None:
         message_s(f"Reading {len(args.masks)} mask AIM files", args.silent)
         for (mask_path, mask_output_path) in zip(args.masks, mask_output_paths):
             message_s(f"Reading mask AIM file {mask_path}", args.silent)
-            reader.SetFileName(mask_path)
-            reader.Update()
-            arr = vtkImageData_to_numpy(reader.GetOutput())
-            mask_position = reader.GetPosition()
-            #print(pad_lower)
-            #print(pad_upper)
-            message_s("Converting mask to SimpleITK image", args.silent)
-            mask = sitk.GetImageFromArray(np.moveaxis(arr, [0, 1, 2], [2, 1, 0]))
+            mask_array, mask_position = read_aim_array(mask_path, args.aim_backend)
+            message_s(
+                f"MASK (before cropping and padding) | Shape: {mask_array.shape[::-1]}, Position: {mask_position}",
+                args.silent
+            )
+            message_s("Cropping and Padding mask to match up to image", args.silent)
+            mask = sitk.GetImageFromArray(
+                align_mask_to_image(mask_array, mask_position, image_position, image_shape)
+            )
+            del mask_array
             mask.SetSpacing(image_spacing)
             mask.SetOrigin(image_origin)
-            mask_shape = mask.GetSize()
-            message_s(f"MASK (before cropping and padding) | Shape: {mask_shape}, Position: {mask_position}", args.silent)
-            message_s("Cropping and Padding mask to match up to image", args.silent)
-            pad_lower = [max(mp - ip, 0) for (mp, ip) in zip(mask_position, image_position)]
-            crop_lower = [min(mp - ip, 0) for (mp, ip) in zip(mask_position, image_position)]
-            message_s(f"After comparing positions, need to crop lower by {crop_lower} and pad lower by {pad_lower}", args.silent)
-            for i, cl in enumerate(crop_lower):
-                if cl < 0:
-                    crop = [0, 0, 0]
-                    crop[i] = abs(cl)
-                    mask = sitk.Crop(mask, crop, [0, 0, 0])
-            pad_upper = [max(ims - (ms + pl + cl), 0) for (pl, cl, ims, ms) in zip(pad_lower, crop_lower, image_shape, mask_shape)]
-            crop_upper = [min(ims - (ms + pl + cl), 0) for (pl, cl, ims, ms) in zip(pad_lower, crop_lower, image_shape, mask_shape)]
-            message_s(f"After comparing shapes, need to crop upper by {crop_upper} and pad upper by {pad_upper}", args.silent)
-            for i, cu in enumerate(crop_upper):
-                if cu < 0:
-                    crop = [0, 0, 0]
-                    crop[i] = abs(cu)
-                    mask = sitk.Crop(mask, [0, 0, 0], crop)
-            mask = sitk.ConstantPad(mask, pad_lower, pad_upper, 0)
+            mask.SetDirection(image_direction)
             message_s(f"MASK (after cropping and padding) | Shape: {mask.GetSize()}", args.silent)
             message_s(f"Writing NIfTI file to {mask_output_path}", args.silent)
             sitk.WriteImage(mask, mask_output_path)
     else:
         message_s("No masks given, finished.", args.silent)
+    fingerprint.write()
 
 
 def main():
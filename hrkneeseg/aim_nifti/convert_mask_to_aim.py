@@ -1,56 +1,114 @@
 from __future__ import annotations
 
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter, Namespace
-import SimpleITK as sitk
 import numpy as np
-from vtk import VTK_CHAR
-from vtkbone import vtkboneAIMReader, vtkboneAIMWriter
 from datetime import datetime
+from typing import Sequence
 import os
 
-from bonelab.util.echo_arguments import echo_arguments
-from bonelab.util.time_stamp import message
-from bonelab.util.registration_util import check_inputs_exist, check_for_output_overwrite
-from bonelab.util.vtk_util import numpy_to_vtkImageData
-from bonelab.io.vtk_helpers import handle_filetype_writing_special_cases
+from hrkneeseg.aim_nifti.aim_io import AIM_BACKENDS, write_aim
+from hrkneeseg.aim_nifti.aim_index import get_aim_header
+from hrkneeseg.utils.fingerprint import StepFingerprint, add_skip_if_unchanged_argument
+from hrkneeseg.utils.lazy_import import lazy_import
+
+sitk = lazy_import("SimpleITK")
+
+
+def write_mask_aim_vtk(
+        fn: str,
+        mask: np.ndarray,
+        spacing: Sequence[float],
+        origin: Sequence[float],
+        processing_log: str
+) -> None:
+    """
+    Write a binary mask to an AIM with `vtkboneAIMWriter`, with values of 127 inside the mask.
+
+    Parameters
+    ----------
+    fn : str
+        The AIM filename.
+
+    mask : np.ndarray
+        The binary mask, in (x, y, z) order.
+
+    spacing : Sequence[float]
+        The spacing of the reference AIM.
+
+    origin : Sequence[float]
+        The origin of the reference AIM, which the writer converts back to a position.
+
+    processing_log : str
+        The processing log to write.
+    """
+    from vtk import VTK_CHAR
+    from vtkbone import vtkboneAIMWriter
+    from bonelab.util.vtk_util import numpy_to_vtkImageData
+    from bonelab.io.vtk_helpers import handle_filetype_writing_special_cases
+    writer = vtkboneAIMWriter()
+    writer.SetInputData(numpy_to_vtkImageData(
+        127 * mask,
+        spacing=tuple(spacing),
+        origin=tuple(origin),
+        array_type=VTK_CHAR
+    ))
+    handle_filetype_writing_special_cases(
+        writer,
+        processing_log=processing_log
+    )
+    writer.SetFileName(fn)
+    writer.Update()
+
+
+def read_reference_aim_vtk(fn: str):
+    from vtkbone import vtkboneAIMReader
+    reader = vtkboneAIMReader()
+    reader.DataOnCellsOff()
+    reader.SetFileName(fn)
+    reader.Update()
+    return reader
 
 
 def convert_back_to_aim(args: Namespace) -> None:
+    from bonelab.util.echo_arguments import echo_arguments
+    from bonelab.util.time_stamp import message
+    from bonelab.util.registration_util import check_inputs_exist, check_for_output_overwrite
     print(echo_arguments("Convert Back To AIM", vars(args)))
     message("Checking inputs exist")
     check_inputs_exist([args.input_mask, args.reference_aim], False)
+    fingerprint = StepFingerprint("hrkMask2AIM", args, [args.input_mask, args.reference_aim], [args.output_aim])
+    if args.skip_if_unchanged and fingerprint.is_unchanged():
+        message("The output is up to date with the inputs and arguments, skipping.")
+        return
     message("Checking for output overwrite")
-    check_for_output_overwrite(args.output_aim, args.overwrite, False)
+    check_for_output_overwrite(args.output_aim, args.overwrite or args.skip_if_unchanged, False)
+    fingerprint.invalidate()
     message(f"Reading input image from: {args.input_mask}")
     mask = sitk.ReadImage(args.input_mask)
-    message("Converting input image to numpy array")
-    mask = np.transpose(sitk.GetArrayFromImage(mask), (2, 1, 0))
-    message(f"Reading reference AIM from {args.reference_aim}")
-    reader = vtkboneAIMReader()
-    reader.DataOnCellsOff()
-    reader.SetFileName(args.reference_aim)
-    reader.Update()
-    message(f"Converting image back to AIM")
-    mask = numpy_to_vtkImageData(
-        127 * (mask > 0),
-        spacing=reader.GetOutput().GetSpacing(),
-        origin=reader.GetOutput().GetOrigin(),
-        array_type=VTK_CHAR
-    )
-    message(f"Adding to processing log")
-    processing_log = (
-        reader.GetProcessingLog() + os.linesep +
-        f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] {args.log}."
-    )
+    message(f"Reading reference AIM header from {args.reference_aim}")
+    # only the header of the reference is needed, so it is looked up in the AIM index instead of reading the image
+    reference = get_aim_header(args.reference_aim)
+    log_entry = f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] {args.log}."
     message(f"Saving image to {args.output_aim}")
-    writer = vtkboneAIMWriter()
-    writer.SetInputData(mask)
-    handle_filetype_writing_special_cases(
-        writer,
-        processing_log=processing_log
-    )
-    writer.SetFileName(args.output_aim)
-    writer.Update()
+    if args.aim_backend == "numpy":
+        write_aim(
+            args.output_aim,
+            (sitk.GetArrayViewFromImage(mask) > 0) * np.int8(127),
+            reference.element_size,
+            reference.position,
+            reference.processing_log + os.linesep + log_entry,
+            reference.version,
+            reference
+        )
+    else:
+        write_mask_aim_vtk(
+            args.output_aim,
+            np.transpose(sitk.GetArrayFromImage(mask), (2, 1, 0)) > 0,
+            reference.spacing,
+            reference.origin,
+            reference.processing_log + os.linesep + log_entry
+        )
+    fingerprint.write()
 
 
 def create_parser() -> ArgumentParser:
@@ -74,6 +132,12 @@ def create_parser() -> ArgumentParser:
     parser.add_argument(
         "--log", "-l", type=str, default="", help="Message to add to processing log."
     )
+    parser.add_argument(
+        "--aim-backend", "-ab", default="vtk", choices=AIM_BACKENDS,
+        help="How to write the output AIM. `numpy` does not import vtk/vtkbone. Either way, only the header of the "
+             "reference AIM is read, through the AIM index of its directory."
+    )
+    add_skip_if_unchanged_argument(parser)
     parser.add_argument(
         "--overwrite", "-ow", action="store_true", help="Overwrite output without asking."
     )
@@ -1,59 +1,175 @@
 from __future__ import annotations
 
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter, Namespace
-import SimpleITK as sitk
 import numpy as np
-from vtk import VTK_CHAR
-from vtkbone import vtkboneAIMReader, vtkboneAIMWriter
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from typing import List
 import os
 
-from bonelab.util.echo_arguments import echo_arguments
-from bonelab.util.time_stamp import message
-from bonelab.util.registration_util import check_inputs_exist, check_for_output_overwrite
-from bonelab.util.vtk_util import numpy_to_vtkImageData
-from bonelab.io.vtk_helpers import handle_filetype_writing_special_cases
+from hrkneeseg.aim_nifti.aim_io import AIM_BACKENDS, AIMHeader, write_aim
+from hrkneeseg.aim_nifti.aim_index import get_aim_header
+from hrkneeseg.aim_nifti.convert_mask_to_aim import write_mask_aim_vtk
+from hrkneeseg.utils.fingerprint import StepFingerprint, add_skip_if_unchanged_argument
+from hrkneeseg.utils.label_remapping import remap_labels_array
+from hrkneeseg.utils.lazy_import import lazy_import
+
+sitk = lazy_import("SimpleITK")
+
+
+def write_class_aims(
+        mask: np.ndarray,
+        class_values: List[int],
+        output_aims: List[str],
+        reference: AIMHeader,
+        processing_log: str,
+        num_threads: int
+) -> None:
+    """
+    Write one binary AIM per class of a label array, concurrently.
+
+    The label array is read once, to relabel it to a uint8 array of class indices with a lookup table. Each writer
+    thread then builds its own byte mask from the small index array and writes it, so the label array is never
+    compared against every class value and the file writes overlap.
+
+    Parameters
+    ----------
+    mask : np.ndarray
+        The label array, in (z, y, x) order.
+
+    class_values : List[int]
+        The label values, one per output AIM.
+
+    output_aims : List[str]
+        The output AIM filenames.
+
+    reference : AIMHeader
+        The header of the reference AIM, to take the element size, position and version from.
+
+    processing_log : str
+        The processing log to write to every output AIM.
+
+    num_threads : int
+        The number of AIMs to write at once.
+    """
+    from bonelab.util.time_stamp import message
+    unique_values = list(dict.fromkeys(class_values))
+    if len(unique_values) > np.iinfo(np.uint8).max:
+        raise ValueError(f"can only write up to {np.iinfo(np.uint8).max} different classes at once")
+    indices = {cv: i + 1 for i, cv in enumerate(unique_values)}
+    if mask.dtype.kind == "f":
+        # the lookup table needs integer labels
+        mask = mask.astype(np.int64)
+    class_index = remap_labels_array(mask, indices)
+
+    def write_class(cv_output_aim):
+        cv, output_aim = cv_output_aim
+        write_aim(
+            output_aim,
+            (class_index == indices[cv]) * np.int8(127),
+            reference.element_size,
+            reference.position,
+            processing_log,
+            reference.version,
+            reference
+        )
+        return output_aim
+
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        for output_aim in executor.map(write_class, zip(class_values, output_aims)):
+            message(f"Saved image to {output_aim}")
+
+
+def write_mask_aims(
+        mask_image: sitk.Image,
+        reference: AIMHeader,
+        output_aims: List[str],
+        class_values: List[int],
+        log: str,
+        aim_backend: str = "vtk",
+        num_threads: int = 4
+) -> None:
+    """
+    Write one binary AIM per class of a mask image in memory, with the metadata of a reference AIM.
+
+    Parameters
+    ----------
+    mask_image : sitk.Image
+        The mask.
+
+    reference : AIMHeader
+        The header of the reference AIM.
+
+    output_aims : List[str]
+        The output AIM filenames, one per class.
+
+    class_values : List[int]
+        The label values of the classes.
+
+    log : str
+        The message to add to the processing log.
+
+    aim_backend : str
+        `vtk` or `numpy`, see `hrkMasks2AIMs`. Default is `vtk`.
+
+    num_threads : int
+        The number of AIMs to write at once with the `numpy` backend. Default is 4.
+    """
+    from bonelab.util.time_stamp import message
+    if len(class_values) != len(output_aims):
+        raise ValueError("must give the same number of class values and output AIMs")
+    log_entry = f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] {log}."
+    if aim_backend == "numpy":
+        message(f"Converting images back to AIMs with {num_threads} threads")
+        write_class_aims(
+            sitk.GetArrayViewFromImage(mask_image),
+            class_values,
+            output_aims,
+            reference,
+            reference.processing_log + os.linesep + log_entry,
+            num_threads
+        )
+        return
+    message("Converting input image to numpy array")
+    mask = np.transpose(sitk.GetArrayFromImage(mask_image), (2, 1, 0))
+    message(f"Converting images back to AIMs")
+    for cv, output_aim in zip(class_values, output_aims):
+        message(f"Converting class {cv} to AIM")
+        processing_log = reference.processing_log + os.linesep + log_entry
+        message(f"Saving image to {output_aim}")
+        write_mask_aim_vtk(output_aim, mask == cv, reference.spacing, reference.origin, processing_log)
 
 
 def convert_masks_to_aims(args: Namespace) -> None:
+    from bonelab.util.echo_arguments import echo_arguments
+    from bonelab.util.time_stamp import message
+    from bonelab.util.registration_util import check_inputs_exist, check_for_output_overwrite
     print(echo_arguments("Convert Back To AIM", vars(args)))
+    # check the arguments before anything is read, skipped or invalidated
+    if len(args.class_values) != len(args.class_labels):
+        raise ValueError("must give the same number of class values and class labels")
     output_aims = [f"{args.output_base}_{cl}.AIM" for cl in args.class_labels]
     message("Checking inputs exist")
     check_inputs_exist([args.input_mask, args.reference_aim], False)
+    # the number of threads does not change the AIMs
+    fingerprint = StepFingerprint(
+        "hrkMasks2AIMs", args, [args.input_mask, args.reference_aim], output_aims, ignore=["num_threads"]
+    )
+    if args.skip_if_unchanged and fingerprint.is_unchanged():
+        message("The outputs are up to date with the inputs and arguments, skipping.")
+        return
     message("Checking for output overwrite")
-    check_for_output_overwrite(output_aims, args.overwrite, False)
+    check_for_output_overwrite(output_aims, args.overwrite or args.skip_if_unchanged, False)
+    fingerprint.invalidate()
     message(f"Reading input image from: {args.input_mask}")
-    mask = sitk.ReadImage(args.input_mask)
-    message("Converting input image to numpy array")
-    mask = np.transpose(sitk.GetArrayFromImage(mask), (2, 1, 0))
-    message(f"Reading reference AIM from {args.reference_aim}")
-    reader = vtkboneAIMReader()
-    reader.DataOnCellsOff()
-    reader.SetFileName(args.reference_aim)
-    reader.Update()
-    message(f"Converting images back to AIMs")
-    for cl, cv, output_aim in zip(args.class_labels, args.class_values, output_aims):
-        message(f"Converting class {cl} ({cv}) to AIM")
-        mask_cl = numpy_to_vtkImageData(
-            127 * (mask == cv),
-            spacing=reader.GetOutput().GetSpacing(),
-            origin=reader.GetOutput().GetOrigin(),
-            array_type=VTK_CHAR
-        )
-        message(f"Adding to processing log")
-        processing_log = (
-                reader.GetProcessingLog() + os.linesep +
-                f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] {args.log}."
-        )
-        message(f"Saving image to {output_aim}")
-        writer = vtkboneAIMWriter()
-        writer.SetInputData(mask_cl)
-        handle_filetype_writing_special_cases(
-            writer,
-            processing_log=processing_log
-        )
-        writer.SetFileName(output_aim)
-        writer.Update()
+    mask_image = sitk.ReadImage(args.input_mask)
+    message(f"Reading reference AIM header from {args.reference_aim}")
+    # only the header of the reference is needed, so it is looked up in the AIM index instead of reading the image
+    reference = get_aim_header(args.reference_aim)
+    write_mask_aims(
+        mask_image, reference, output_aims, args.class_values, args.log, args.aim_backend, args.num_threads
+    )
+    fingerprint.write()
 
 
 def create_parser() -> ArgumentParser:
@@ -88,6 +204,17 @@ def create_parser() -> ArgumentParser:
     parser.add_argument(
         "--log", "-l", type=str, default="", help="Message to add to processing log."
     )
+    parser.add_argument(
+        "--aim-backend", "-ab", default="vtk", choices=AIM_BACKENDS,
+        help="How to write the output AIMs. `numpy` builds all of the class masks from one pass over the mask and "
+             "writes the AIMs concurrently, without importing vtk/vtkbone. Either way, only the header of the "
+             "reference AIM is read, through the AIM index of its directory."
+    )
+    parser.add_argument(
+        "--num-threads", "-nt", type=int, default=4,
+        help="Number of AIMs to write at once with the `numpy` backend."
+    )
+    add_skip_if_unchanged_argument(parser)
     parser.add_argument(
         "--overwrite", "-ow", action="store_true", help="Overwrite output without asking."
     )
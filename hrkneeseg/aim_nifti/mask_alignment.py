@@ -0,0 +1,85 @@
+from __future__ import annotations
+
+import numpy as np
+from typing import Sequence, Tuple
+
+
+def get_overlap_slices(
+        mask_position: Sequence[int],
+        mask_shape: Sequence[int],
+        image_position: Sequence[int],
+        image_shape: Sequence[int]
+) -> Tuple[Tuple[slice, ...], Tuple[slice, ...]]:
+    """
+    Get the block where a mask and an image overlap, from their AIM positions and shapes.
+
+    Positions and shapes are in AIM (x, y, z) order and in voxels, while the slices are for (z, y, x) arrays, as
+    returned by `read_aim`.
+
+    Parameters
+    ----------
+    mask_position : Sequence[int]
+        The position of the mask, in voxels.
+
+    mask_shape : Sequence[int]
+        The dimensions of the mask.
+
+    image_position : Sequence[int]
+        The position of the image, in voxels.
+
+    image_shape : Sequence[int]
+        The dimensions of the image.
+
+    Returns
+    -------
+    Tuple[Tuple[slice, ...], Tuple[slice, ...]]
+        The slices of the overlap in the image array and in the mask array. The slices are empty along an axis
+        where the mask and the image do not overlap.
+    """
+    image_slices = []
+    mask_slices = []
+    for mp, ms, ip, ims in zip(mask_position, mask_shape, image_position, image_shape):
+        # offset of the mask in the image grid
+        offset = int(mp) - int(ip)
+        start = min(max(offset, 0), ims)
+        stop = max(min(offset + ms, ims), start)
+        image_slices.append(slice(start, stop))
+        mask_slices.append(slice(start - offset, stop - offset))
+    return tuple(image_slices[::-1]), tuple(mask_slices[::-1])
+
+
+def align_mask_to_image(
+        mask: np.ndarray,
+        mask_position: Sequence[int],
+        image_position: Sequence[int],
+        image_shape: Sequence[int]
+) -> np.ndarray:
+    """
+    Crop and pad a mask to the grid of an image.
+
+    The output is allocated once at the image size, in the mask's dtype, and the overlapping block is copied into it
+    with one slice assignment. If `mask` is a memory-map of the AIM file, only the overlapping block is read.
+
+    Parameters
+    ----------
+    mask : np.ndarray
+        The mask, in (z, y, x) order.
+
+    mask_position : Sequence[int]
+        The position of the mask, in voxels, in (x, y, z) order.
+
+    image_position : Sequence[int]
+        The position of the image, in voxels, in (x, y, z) order.
+
+    image_shape : Sequence[int]
+        The dimensions of the image, in (x, y, z) order.
+
+    Returns
+    -------
+    np.ndarray
+        The mask on the image grid, in (z, y, x) order, zero outside of the original mask.
+    """
+    image_slices, mask_slices = get_overlap_slices(mask_position, mask.shape[::-1], image_position, image_shape)
+    aligned = np.zeros(tuple(image_shape)[::-1], dtype=mask.dtype)
+    aligned[image_slices] = mask[mask_slices]
+    return aligned
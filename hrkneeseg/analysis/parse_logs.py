@@ -6,11 +6,14 @@ from glob import glob
 from pathlib import Path
 from typing import Any, Hashable, Optional
 import numpy as np
-import pandas as pd
 import os
-import torch
 import yaml
 
+from hrkneeseg.utils.lazy_import import lazy_import
+
+pd = lazy_import("pandas")
+torch = lazy_import("torch")
+
 
 def create_parser() -> ArgumentParser:
     parser = ArgumentParser(
@@ -1,12 +1,12 @@
 from __future__ import annotations
 
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter, Namespace
-import SimpleITK as sitk
 from typing import Tuple, List
 
-from bonelab.util.echo_arguments import echo_arguments
-from bonelab.util.time_stamp import message
-from bonelab.util.registration_util import read_image
+from hrkneeseg.utils.label_remapping import remap_labels_image, codes_to_mapping
+from hrkneeseg.utils.lazy_import import lazy_import
+
+sitk = lazy_import("SimpleITK")
 
 
 def create_parser() -> ArgumentParser:
@@ -41,6 +41,7 @@ def create_parser() -> ArgumentParser:
 
 
 def message_s(m: str, s: bool):
+    from bonelab.util.time_stamp import message
     if not s:
         message(m)
 
@@ -48,25 +49,26 @@ def message_s(m: str, s: bool):
 def get_medial_and_lateral_masks(
         mask_fn: str, label: str, medial_site_codes: List[int], lateral_site_codes: List[int], silent: bool
 ) -> Tuple[sitk.Image, sitk.Image]:
-    mask = sitk.Cast(read_image(mask_fn, label, silent), sitk.sitkUInt8)
-    medial_mask = sitk.Image(*mask.GetSize(), mask.GetPixelIDValue())
-    medial_mask.CopyInformation(mask)
-    for medial_site_code in medial_site_codes:
-        medial_mask += (mask == medial_site_code)
-    lateral_mask = sitk.Image(*mask.GetSize(), mask.GetPixelIDValue())
-    lateral_mask.CopyInformation(mask)
-    for lateral_site_code in lateral_site_codes:
-        lateral_mask += (mask == lateral_site_code)
+    from bonelab.util.registration_util import read_image
+    mask = read_image(mask_fn, label, silent)
+    medial_mask = remap_labels_image(mask, codes_to_mapping(medial_site_codes, 1))
+    lateral_mask = remap_labels_image(mask, codes_to_mapping(lateral_site_codes, 1))
     return medial_mask, lateral_mask
 
 
 def combine_roi_masks(args: Namespace):
+    from bonelab.util.echo_arguments import echo_arguments
+    from bonelab.util.registration_util import read_image
     print(echo_arguments("VOI mask combining script", vars(args)))
-    medial_mask, lateral_mask = get_medial_and_lateral_masks(
-        args.input_mask, "input mask", args.medial_site_codes, args.lateral_site_codes, args.silent
-    )
+    overlapping_site_codes = sorted(set(args.medial_site_codes) & set(args.lateral_site_codes))
+    if overlapping_site_codes:
+        raise ValueError(f"site codes cannot be both medial and lateral, got {overlapping_site_codes} in both")
+    mask = read_image(args.input_mask, "input mask", args.silent)
     message_s("Combining masks", args.silent)
-    mask = args.lateral_output_code*lateral_mask + args.medial_output_code*medial_mask
+    mask = remap_labels_image(mask, {
+        **codes_to_mapping(args.medial_site_codes, args.medial_output_code),
+        **codes_to_mapping(args.lateral_site_codes, args.lateral_output_code)
+    })
     message_s(f"Writing output mask to {args.output_mask}", args.silent)
     sitk.WriteImage(mask, args.output_mask)
 
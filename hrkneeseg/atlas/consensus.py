@@ -0,0 +1,165 @@
+from __future__ import annotations
+
+import numpy as np
+from typing import Optional, Tuple
+
+from hrkneeseg.utils.lazy_import import lazy_import
+
+sitk = lazy_import("SimpleITK")
+
+CONSENSUS_METHODS = ["STAPLE", "vote-EM", "majority-vote"]
+
+
+class VoteAccumulator:
+    """
+    Streaming accumulator of per-voxel foreground votes from a sequence of binary masks.
+
+    Only a single uint16 vote volume is held in memory, so the peak memory use does not depend on how many masks are
+    accumulated. The vote volume is a sufficient statistic for majority voting and for the vote-EM consensus.
+
+    Parameters
+    ----------
+    foreground_value : int
+        The value of foreground voxels in the accumulated masks, all other values are background. Default is 1, the
+        same as the default for `sitk.STAPLE`.
+    """
+
+    def __init__(self, foreground_value: int = 1):
+        self.foreground_value = foreground_value
+        self.num_raters = 0
+        self._votes: Optional[np.ndarray] = None
+        self._geometry: Optional[Tuple] = None
+
+    def add(self, mask: sitk.Image) -> None:
+        """
+        Add one mask's votes to the accumulator.
+
+        Parameters
+        ----------
+        mask : sitk.Image
+            A mask on the same grid as all other accumulated masks.
+
+        Returns
+        -------
+        None
+        """
+        if self.num_raters == np.iinfo(np.uint16).max:
+            raise ValueError(f"cannot accumulate more than {np.iinfo(np.uint16).max} masks")
+        mask_array = sitk.GetArrayViewFromImage(mask)
+        if self._votes is None:
+            self._votes = np.zeros(mask_array.shape, dtype=np.uint16)
+            self._geometry = (mask.GetOrigin(), mask.GetSpacing(), mask.GetDirection())
+        elif mask_array.shape != self._votes.shape:
+            raise ValueError(f"mask has shape {mask_array.shape}, expected {self._votes.shape}")
+        self._votes += (mask_array == self.foreground_value)
+        self.num_raters += 1
+
+    @property
+    def votes(self) -> np.ndarray:
+        if self._votes is None:
+            raise ValueError("no masks have been accumulated")
+        return self._votes
+
+    def _to_image(self, array: np.ndarray) -> sitk.Image:
+        image = sitk.GetImageFromArray(array)
+        image.SetOrigin(self._geometry[0])
+        image.SetSpacing(self._geometry[1])
+        image.SetDirection(self._geometry[2])
+        return image
+
+    def majority_vote(self) -> sitk.Image:
+        """
+        Get the majority vote consensus, where a voxel is foreground if more than half of the masks say so.
+
+        Returns
+        -------
+        sitk.Image
+            The binary (uint8) consensus mask.
+        """
+        return self._to_image((2 * self.votes.astype(np.uint32) > self.num_raters).astype(np.uint8))
+
+    def vote_em(self, max_iterations: int = 100, tolerance: float = 1e-6) -> sitk.Image:
+        """
+        Get the vote-EM consensus: STAPLE with a single sensitivity and specificity shared by all of the masks.
+
+        When all of the masks share their performance parameters the likelihood of the observations at a voxel only
+        depends on how many masks voted for foreground there, so EM can be run on the histogram of the vote volume
+        instead of on the full set of masks. As in `sitk.STAPLE`, the prior probability of foreground is fixed to the
+        fraction of foreground votes over all voxels and masks.
+
+        Parameters
+        ----------
+        max_iterations : int
+            The maximum number of EM iterations. Default is 100.
+
+        tolerance : float
+            EM stops when the sensitivity and specificity change by less than this between iterations.
+            Default is 1e-6.
+
+        Returns
+        -------
+        sitk.Image
+            The per-voxel probability (float32) of foreground, the same kind of output as `sitk.STAPLE`.
+        """
+        weights, _, _ = vote_em_weights(
+            np.bincount(self.votes.ravel(), minlength=self.num_raters + 1), self.num_raters,
+            max_iterations, tolerance
+        )
+        return self._to_image(weights.astype(np.float32)[self.votes])
+
+
+def vote_em_weights(
+        vote_histogram: np.ndarray, num_raters: int, max_iterations: int = 100, tolerance: float = 1e-6
+) -> Tuple[np.ndarray, float, float]:
+    """
+    Run shared-parameter STAPLE EM on a histogram of vote counts.
+
+    Parameters
+    ----------
+    vote_histogram : np.ndarray
+        The number of voxels with each vote count, `vote_histogram[v]` is the number of voxels where `v` masks voted
+        for foreground.
+
+    num_raters : int
+        The number of masks that voted.
+
+    max_iterations : int
+        The maximum number of EM iterations. Default is 100.
+
+    tolerance : float
+        EM stops when the sensitivity and specificity change by less than this between iterations. Default is 1e-6.
+
+    Returns
+    -------
+    Tuple[np.ndarray, float, float]
+        The probability of foreground for each vote count, the shared sensitivity, and the shared specificity.
+    """
+    counts = vote_histogram[:num_raters + 1].astype(np.float64)
+    v = np.arange(num_raters + 1, dtype=np.float64)
+    prior = (counts * v).sum() / (counts.sum() * num_raters)
+    if prior <= 0 or prior >= 1:
+        # every vote agrees, so there is nothing to estimate
+        return v / num_raters, 1.0, 1.0
+    # same initial performance parameters as sitk.STAPLE
+    sensitivity, specificity = 0.99999, 0.99999
+    weights = np.zeros_like(v)
+    eps = np.finfo(np.float64).tiny
+    for _ in range(max_iterations):
+        # E-step, in log space so that many raters do not underflow
+        log_fg = np.log(prior) + v * np.log(max(sensitivity, eps)) \
+            + (num_raters - v) * np.log(max(1 - sensitivity, eps))
+        log_bg = np.log(1 - prior) + (num_raters - v) * np.log(max(specificity, eps)) \
+            + v * np.log(max(1 - specificity, eps))
+        weights = 1 / (1 + np.exp(np.clip(log_bg - log_fg, -700, 700)))
+        # M-step
+        fg = (counts * weights).sum()
+        bg = (counts * (1 - weights)).sum()
+        new_sensitivity = (counts * weights * v).sum() / max(fg * num_raters, eps)
+        new_specificity = (counts * (1 - weights) * (num_raters - v)).sum() / max(bg * num_raters, eps)
+        converged = (
+            abs(new_sensitivity - sensitivity) < tolerance and abs(new_specificity - specificity) < tolerance
+        )
+        sensitivity, specificity = new_sensitivity, new_specificity
+        if converged:
+            break
+    return weights, sensitivity, specificity
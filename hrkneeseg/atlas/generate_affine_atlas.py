@@ -1,28 +1,28 @@
 from __future__ import annotations
 
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter, Namespace
-import SimpleITK as sitk
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import numpy as np
 import math
-from scipy import stats
-from typing import Tuple, List
-
-from bonelab.util.echo_arguments import echo_arguments
-from bonelab.util.registration_util import (
-    read_image, check_inputs_exist, check_for_output_overwrite, write_args_to_yaml,
-    create_file_extension_checker, create_string_argument_checker,
-    INPUT_EXTENSIONS, get_output_base, write_metrics_to_csv, create_and_save_metrics_plot,
-    setup_optimizer, setup_interpolator, setup_similarity_metric, setup_multiscale_progression,
-    check_percentage, check_image_size_and_shrink_factors, INTERPOLATORS
-)
-from bonelab.util.demons_registration_util import (
-    multiscale_demons, smooth_and_resample,
-    IMAGE_EXTENSIONS, DEMONS_FILTERS, demons_type_checker, construct_multiscale_progression
-)
-from bonelab.util.time_stamp import message
+import os
+import time
+import yaml
+from typing import Tuple, List, Optional, Callable, Iterator, Any, Union
+
+from hrkneeseg.atlas.combine_roi_masks import get_medial_and_lateral_masks
+from hrkneeseg.atlas.consensus import VoteAccumulator, CONSENSUS_METHODS
+from hrkneeseg.registration.demons import multiscale_demons_with_fixed_pyramid
+from hrkneeseg.registration.pyramid import write_atlas_pyramid, load_atlas_pyramid
+from hrkneeseg.utils.lazy_import import lazy_import
+
+sitk = lazy_import("SimpleITK")
 
 
 def create_parser() -> ArgumentParser:
+    from bonelab.util.registration_util import (
+        create_file_extension_checker, create_string_argument_checker, INPUT_EXTENSIONS, check_percentage, INTERPOLATORS
+    )
+    from bonelab.util.demons_registration_util import IMAGE_EXTENSIONS, DEMONS_FILTERS, demons_type_checker
     parser = ArgumentParser(
         description="Affine Atlas Generation Script",
         formatter_class=ArgumentDefaultsHelpFormatter
@@ -195,9 +195,44 @@ def create_parser() -> ArgumentParser:
         "--medial-output-code", "-moc", default=2, type=int, metavar="N",
         help="site code to use in final atlas mask for the combined medial VOI"
     )
+    parser.add_argument(
+        "--consensus-method", "-cm", default="STAPLE", metavar="STR",
+        type=create_string_argument_checker(CONSENSUS_METHODS, "consensus-method"),
+        help=f"method used to get the consensus atlas masks from the transformed masks, options: {CONSENSUS_METHODS}. "
+             f"`STAPLE` holds every transformed mask in memory at once, `vote-EM` (STAPLE with one sensitivity and "
+             f"specificity shared by all masks) and `majority-vote` accumulate per-voxel vote counts as each image "
+             f"finishes so their memory use does not grow with the number of images"
+    )
     parser.add_argument(
         "--STAPLE-binarization-threshold", "-Sbt", type=float, default=0.5, metavar="X",
-        help="threshold to use to binarize STAPLE output masks"
+        help="threshold to use to binarize STAPLE and vote-EM output masks"
+    )
+    parser.add_argument(
+        "--group-wise-iterations", "-gwi", default=1, type=int, metavar="N",
+        help="maximum number of group-wise refinement iterations. in the first iteration every image is affinely "
+             "registered to image 0 and the results are averaged. in each following iteration every image, "
+             "including image 0, is registered to the previous average, starting from its previous transform, "
+             "and the results are averaged again. with the default of 1 only the first iteration is done"
+    )
+    parser.add_argument(
+        "--group-wise-tolerance", "-gwt", default=1e-3, type=float, metavar="X",
+        help="group-wise refinement stops early once the RMS change of the average image between iterations, "
+             "relative to the RMS of the previous average image, is below this value"
+    )
+    parser.add_argument(
+        "--num-workers", "-nw", default=1, type=int, metavar="N",
+        help="number of worker processes to use when registering the images to the atlas. if greater than 1, the "
+             "images are registered in parallel, one image per worker process"
+    )
+    parser.add_argument(
+        "--itk-threads-per-worker", "-itpw", default=None, type=int, metavar="N",
+        help="maximum number of threads each worker process lets ITK use. leave as `None` to use the ITK default, "
+             "but when using several workers you should set this so that (workers x threads) <= available cores"
+    )
+    parser.add_argument(
+        "--checkpoint-dir", "-cd", default=None, type=str, metavar="DIR",
+        help="directory to cache downsampled images and persist per-image transforms and transformed masks in, so "
+             "that a crashed atlas build can be resumed. if `None`, `<atlas_average base>_checkpoints` is used"
     )
     parser.add_argument(
         "--silent", "-s", default=False, action="store_true",
@@ -208,6 +243,7 @@ def create_parser() -> ArgumentParser:
 
 
 def message_s(m: str, s: bool):
+    from bonelab.util.time_stamp import message
     if not s:
         message(m)
 
@@ -252,6 +288,8 @@ def read_and_downsample_image(
     sitk.Image
 
     """
+    from bonelab.util.registration_util import read_image
+    from bonelab.util.demons_registration_util import smooth_and_resample
     # load images, cast to single precision float
     image = sitk.Cast(read_image(image, label, silent), sitk.sitkFloat32)
     # optionally, downsample the fixed and moving images
@@ -276,17 +314,22 @@ def read_and_downsample_image(
     )
 
 
-def affine_registration(atlas: sitk.Image, image: sitk.Image, args: Namespace) -> sitk.Transform:
+def affine_registration(
+        atlas: sitk.Image, image: sitk.Image, args: Namespace, initial_transform: Optional[sitk.Transform] = None
+) -> Tuple[sitk.Transform, float]:
+    from bonelab.util.registration_util import setup_optimizer, setup_interpolator, setup_similarity_metric
     message_s("Affinely registering...", args.silent)
     registration_method = sitk.ImageRegistrationMethod()
-    # hard-code to use the geometry initialization of the transform
-    registration_method.SetInitialTransform(
-        sitk.CenteredTransformInitializer(
+    if initial_transform is None:
+        # hard-code to use the geometry initialization of the transform
+        initial_transform = sitk.CenteredTransformInitializer(
             atlas, image,
             sitk.AffineTransform(atlas.GetDimension()),
             sitk.CenteredTransformInitializerFilter.GEOMETRY
         )
-    )
+    else:
+        message_s("Starting from the given initial transform.", args.silent)
+    registration_method.SetInitialTransform(initial_transform)
     # but set up the optimizer, similarity metric, interpolator, and multiscale progression as normal using args
     registration_method = setup_optimizer(
         registration_method,
@@ -318,20 +361,21 @@ def affine_registration(atlas: sitk.Image, image: sitk.Image, args: Namespace) -
         f"Registration stopping condition: {registration_method.GetOptimizerStopConditionDescription()}",
         args.silent
     )
-    return transform
+    return transform, registration_method.GetMetricValue()
 
 
-def deformable_registration_and_masks_transformation(
-        atlas: sitk.Image, image: sitk.Image, masks: Tuple[sitk.Image, sitk.Image], label: str, args: Namespace
-) -> Tuple[sitk.Image, sitk.Image]:
+def deformable_registration(
+        atlas: sitk.Image, image: sitk.Image, label: str, args: Namespace,
+        atlas_pyramid: Optional[List[sitk.Image]] = None
+) -> sitk.DisplacementFieldTransform:
+    from bonelab.util.demons_registration_util import multiscale_demons, construct_multiscale_progression
     message_s(f"Deformably registering {label}", args.silent)
     transform = sitk.CenteredTransformInitializer(
         atlas, image,
         sitk.Euler3DTransform(), sitk.CenteredTransformInitializerFilter.GEOMETRY
     )
     image = sitk.Resample(image, atlas, transform, sitk.sitkLinear, defaultPixelValue=args.background_value)
-    displacement, _ = multiscale_demons(
-        atlas, image,
+    demons_kwargs = dict(
         demons_type=args.demons_type,
         demons_iterations=args.max_demons_iterations,
         demons_displacement_field_smooth_std=args.displacement_smoothing_std,
@@ -342,7 +386,12 @@ def deformable_registration_and_masks_transformation(
         ),
         silent=args.silent
     )
-    displacement_field_transform = sitk.DisplacementFieldTransform(sitk.Add(
+    if atlas_pyramid is not None:
+        # the atlas is the same for every image, so use its precomputed pyramid instead of rebuilding it
+        displacement, _ = multiscale_demons_with_fixed_pyramid(atlas_pyramid, image, **demons_kwargs)
+    else:
+        displacement, _ = multiscale_demons(atlas, image, **demons_kwargs)
+    return sitk.DisplacementFieldTransform(sitk.Add(
         displacement,
         sitk.TransformToDisplacementField(
             transform,
@@ -353,6 +402,12 @@ def deformable_registration_and_masks_transformation(
             displacement.GetDirection()
         )
     ))
+
+
+def deformable_registration_and_masks_transformation(
+        atlas: sitk.Image, image: sitk.Image, masks: Tuple[sitk.Image, sitk.Image], label: str, args: Namespace
+) -> Tuple[sitk.Image, sitk.Image]:
+    displacement_field_transform = deformable_registration(atlas, image, label, args)
     message_s(f"Transforming mask of {label}", args.silent)
     return (
         sitk.Resample(masks[0], atlas, displacement_field_transform),
@@ -360,104 +415,401 @@ def deformable_registration_and_masks_transformation(
     )
 
 
-def get_medial_and_lateral_masks(
-        mask_fn: str, label: str, medial_site_codes: List[int], lateral_site_codes: List[int], silent: bool
-) -> Tuple[sitk.Image, sitk.Image]:
-    mask = sitk.Cast(read_image(mask_fn, label, silent), sitk.sitkUInt8)
-    medial_mask = sitk.Image(*mask.GetSize(), mask.GetPixelIDValue())
-    medial_mask.CopyInformation(mask)
-    for medial_site_code in medial_site_codes:
-        medial_mask += (mask == medial_site_code)
-    lateral_mask = sitk.Image(*mask.GetSize(), mask.GetPixelIDValue())
-    lateral_mask.CopyInformation(mask)
-    for lateral_site_code in lateral_site_codes:
-        lateral_mask += (mask == lateral_site_code)
-    return medial_mask, lateral_mask
+# arguments that do not affect the contents of the checkpoints, so can change when resuming an atlas build
+EXECUTION_ARGUMENTS = [
+    "overwrite", "silent", "num_workers", "itk_threads_per_worker", "checkpoint_dir", "consensus_method"
+]
+
+
+def get_checkpoint_filenames(checkpoint_dir: str, i: int, iteration: int = 0) -> dict:
+    """
+    Get the filenames of all of the files that are persisted for a single image during an atlas build.
+
+    Parameters
+    ----------
+    checkpoint_dir : str
+        The checkpoint directory.
+
+    i : int
+        The index of the image.
+
+    iteration : int
+        The group-wise iteration the affine transform belongs to. Default is 0.
+
+    Returns
+    -------
+    dict
+        Filenames of the cached downsampled image, the affine transform, the deformable (displacement field)
+        transform, and the transformed medial and lateral masks.
+    """
+    return {
+        "image": os.path.join(checkpoint_dir, f"image_{i}_downsampled.nii"),
+        "affine": os.path.join(
+            checkpoint_dir, f"image_{i}_affine.tfm" if iteration == 0 else f"image_{i}_affine_iter{iteration}.tfm"
+        ),
+        "displacement": os.path.join(checkpoint_dir, f"image_{i}_displacement.nii"),
+        "medial_mask": os.path.join(checkpoint_dir, f"image_{i}_medial_mask.nii.gz"),
+        "lateral_mask": os.path.join(checkpoint_dir, f"image_{i}_lateral_mask.nii.gz")
+    }
+
+
+def get_average_checkpoint_filename(checkpoint_dir: str, iteration: int) -> str:
+    return os.path.join(checkpoint_dir, f"average_iter{iteration}.nii")
+
+
+def get_atlas_pyramid_manifest_filename(checkpoint_dir: str) -> str:
+    return os.path.join(checkpoint_dir, "atlas_pyramid.yaml")
+
+
+def write_checkpoint(checkpoint: Union[sitk.Image, sitk.Transform], fn: str) -> None:
+    """
+    Write an image or transform checkpoint to a temporary file next to it and move it into place once it is written,
+    so that a job stopped while writing a checkpoint does not leave a truncated file that a resumed build would take
+    as finished.
+
+    Parameters
+    ----------
+    checkpoint : Union[sitk.Image, sitk.Transform]
+        The image or transform.
+
+    fn : str
+        The checkpoint filename.
+    """
+    tmp_fn = os.path.join(os.path.dirname(fn), f"tmp{os.getpid()}_{os.path.basename(fn)}")
+    try:
+        if isinstance(checkpoint, sitk.Transform):
+            sitk.WriteTransform(checkpoint, tmp_fn)
+        else:
+            sitk.WriteImage(checkpoint, tmp_fn)
+        os.replace(tmp_fn, fn)
+    finally:
+        if os.path.isfile(tmp_fn):
+            os.remove(tmp_fn)
+
+
+def setup_checkpoint_dir(checkpoint_dir: str, args: Namespace) -> None:
+    """
+    Create the checkpoint directory if it does not exist, and make sure that any checkpoints already in it were
+    created with the same parameters as the current atlas build.
+
+    Parameters
+    ----------
+    checkpoint_dir : str
+        The checkpoint directory.
+
+    args : Namespace
+        The command line arguments.
+
+    Returns
+    -------
+    None
+    """
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    checkpoint_yaml = os.path.join(checkpoint_dir, "checkpoint.yaml")
+    params = {k: v for k, v in vars(args).items() if k not in EXECUTION_ARGUMENTS}
+    if os.path.isfile(checkpoint_yaml):
+        with open(checkpoint_yaml, "r") as f:
+            checkpoint_params = yaml.safe_load(f)
+        if checkpoint_params != params:
+            raise ValueError(
+                f"the checkpoints in {checkpoint_dir} were created with different parameters than were given, "
+                f"delete the directory or provide a different `checkpoint-dir`"
+            )
+        message_s(f"Resuming atlas build from checkpoints in {checkpoint_dir}", args.silent)
+    else:
+        with open(checkpoint_yaml, "w") as f:
+            yaml.dump(params, f)
+
+
+def initialize_worker(itk_threads: Optional[int]) -> None:
+    if itk_threads is not None:
+        sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(itk_threads)
+
+
+def map_over_images(
+        func: Callable, tasks: List[Tuple], num_workers: int, itk_threads: Optional[int]
+) -> Iterator[Any]:
+    """
+    Apply a function to a list of per-image tasks, either sequentially or with a process pool, yielding the results
+    as the tasks finish.
+
+    Parameters
+    ----------
+    func : Callable
+        The function to apply, must be defined at the top level of a module so it can be sent to worker processes.
+
+    tasks : List[Tuple]
+        The positional arguments for each call of `func`.
+
+    num_workers : int
+        The number of worker processes. If 1, the tasks are run sequentially in this process.
+
+    itk_threads : Optional[int]
+        The maximum number of threads ITK can use in each worker.
+
+    Returns
+    -------
+    Iterator[Any]
+    """
+    if num_workers > 1:
+        with ProcessPoolExecutor(
+                max_workers=num_workers, initializer=initialize_worker, initargs=(itk_threads,)
+        ) as executor:
+            futures = [executor.submit(func, *task) for task in tasks]
+            for future in as_completed(futures):
+                yield future.result()
+    else:
+        initialize_worker(itk_threads)
+        for task in tasks:
+            yield func(*task)
+
+
+def get_downsampled_image(img_fn: str, i: int, checkpoint_dir: str, args: Namespace) -> sitk.Image:
+    cached_fn = get_checkpoint_filenames(checkpoint_dir, i)["image"]
+    if os.path.isfile(cached_fn):
+        message_s(f"Reading cached downsampled image {i} from {cached_fn}", args.silent)
+        return sitk.ReadImage(cached_fn)
+    image = read_and_downsample_image(
+        img_fn, f"image {i}",
+        args.downsampling_shrink_factor,
+        args.downsampling_smoothing_sigma,
+        args.pad_amount, args.background_value,
+        args.silent
+    )
+    write_checkpoint(image, cached_fn)
+    return image
+
+
+def affinely_register_image(
+        i: int, img_fn: str, fixed_fn: str, checkpoint_dir: str, iteration: int, args: Namespace
+) -> Tuple[int, Optional[float]]:
+    checkpoint_fns = get_checkpoint_filenames(checkpoint_dir, i, iteration)
+    if os.path.isfile(checkpoint_fns["affine"]) and os.path.isfile(checkpoint_fns["image"]):
+        message_s(f"-- Image {i}: affine transform found in checkpoints, skipping.", args.silent)
+        return i, None
+    message_s(f"-- Image {i}.", args.silent)
+    image = get_downsampled_image(img_fn, i, checkpoint_dir, args)
+    atlas = sitk.ReadImage(fixed_fn)
+    initial_transform = None
+    if iteration > 0:
+        # warm-start from the previous iteration, image 0 was the reference in the first iteration so has no transform
+        previous_fn = get_checkpoint_filenames(checkpoint_dir, i, iteration - 1)["affine"]
+        if os.path.isfile(previous_fn):
+            initial_transform = sitk.AffineTransform(sitk.ReadTransform(previous_fn))
+        else:
+            initial_transform = sitk.AffineTransform(atlas.GetDimension())
+    transform, metric_value = affine_registration(atlas, image, args, initial_transform)
+    write_checkpoint(transform, checkpoint_fns["affine"])
+    return i, metric_value
+
+
+def compute_average_image(
+        reference: sitk.Image, checkpoint_dir: str, num_images: int, iteration: int, args: Namespace
+) -> sitk.Image:
+    """
+    Average the cached downsampled images after transforming them with their affine transforms from one group-wise
+    iteration.
+
+    Parameters
+    ----------
+    reference : sitk.Image
+        The image defining the atlas grid, i.e. the downsampled image 0.
+
+    checkpoint_dir : str
+        The checkpoint directory.
+
+    num_images : int
+        The number of images in the atlas.
+
+    iteration : int
+        The group-wise iteration whose transforms to use. In iteration 0, image 0 is the reference and is added to the
+        average without being transformed.
+
+    args : Namespace
+        The command line arguments.
+
+    Returns
+    -------
+    sitk.Image
+        The average image.
+    """
+    average_image = sitk.Image(*reference.GetSize(), reference.GetPixelID())
+    average_image.CopyInformation(reference)
+    for i in range(num_images):
+        if iteration == 0 and i == 0:
+            average_image = sitk.Add(average_image, reference)
+            continue
+        message_s(f"Adding transformed image {i} to average image...", args.silent)
+        checkpoint_fns = get_checkpoint_filenames(checkpoint_dir, i, iteration)
+        average_image = sitk.Add(
+            average_image,
+            sitk.Resample(
+                sitk.ReadImage(checkpoint_fns["image"]), reference, sitk.ReadTransform(checkpoint_fns["affine"]),
+                sitk.sitkLinear, defaultPixelValue=args.background_value
+            )
+        )
+    message_s("Dividing accumulated average image by number of images...", args.silent)
+    return sitk.Divide(average_image, num_images)
+
+
+def get_relative_change(average: sitk.Image, previous_average: sitk.Image) -> float:
+    previous = sitk.GetArrayViewFromImage(previous_average).astype(np.float64)
+    difference = sitk.GetArrayViewFromImage(average) - previous
+    return float(np.sqrt(np.mean(difference ** 2)) / max(np.sqrt(np.mean(previous ** 2)), np.finfo(float).eps))
+
+
+def deformably_register_image(
+        i: int, img_fn: str, mask_fn: str, checkpoint_dir: str, args: Namespace
+) -> int:
+    from bonelab.util.demons_registration_util import construct_multiscale_progression
+    checkpoint_fns = get_checkpoint_filenames(checkpoint_dir, i)
+    if os.path.isfile(checkpoint_fns["medial_mask"]) and os.path.isfile(checkpoint_fns["lateral_mask"]):
+        message_s(f"-- Image {i}: transformed masks found in checkpoints, skipping.", args.silent)
+        return i
+    message_s(f"-- Image {i}", args.silent)
+    atlas_pyramid = load_atlas_pyramid(
+        get_atlas_pyramid_manifest_filename(checkpoint_dir),
+        construct_multiscale_progression(args.shrink_factors, args.smoothing_sigmas, args.silent)
+    )
+    atlas = atlas_pyramid[0]
+    if os.path.isfile(checkpoint_fns["displacement"]):
+        message_s(f"Reading deformable transform of image {i} from checkpoints", args.silent)
+        displacement_field_transform = sitk.DisplacementFieldTransform(
+            sitk.Cast(sitk.ReadImage(checkpoint_fns["displacement"]), sitk.sitkVectorFloat64)
+        )
+    else:
+        image = get_downsampled_image(img_fn, i, checkpoint_dir, args)
+        displacement_field_transform = deformable_registration(atlas, image, f"image {i}", args, atlas_pyramid)
+        write_checkpoint(displacement_field_transform.GetDisplacementField(), checkpoint_fns["displacement"])
+    masks = get_medial_and_lateral_masks(
+        mask_fn, f"mask {i}", args.medial_site_codes, args.lateral_site_codes, args.silent
+    )
+    message_s(f"Transforming mask of image {i}", args.silent)
+    write_checkpoint(sitk.Resample(masks[0], atlas, displacement_field_transform), checkpoint_fns["medial_mask"])
+    write_checkpoint(sitk.Resample(masks[1], atlas, displacement_field_transform), checkpoint_fns["lateral_mask"])
+    return i
 
 
 def generate_affine_atlas(args: Namespace) -> None:
+    from bonelab.util.echo_arguments import echo_arguments
+    from bonelab.util.registration_util import (
+        check_inputs_exist, check_for_output_overwrite, write_args_to_yaml, INPUT_EXTENSIONS, get_output_base
+    )
+    from bonelab.util.demons_registration_util import construct_multiscale_progression
     print(echo_arguments("Generate Affine Atlas", vars(args)))
     # error checking
     output_base = get_output_base(args.atlas_average, INPUT_EXTENSIONS, args.silent)
     output_yaml = f"{output_base}.yaml"
+    checkpoint_dir = args.checkpoint_dir if args.checkpoint_dir is not None else f"{output_base}_checkpoints"
     if len(args.images) < 2:
         raise ValueError(f"Cannot construct an average atlas with less than 2 reference images, "
                          f"given {len(args.images)}")
     if len(args.images) != len(args.masks):
         raise ValueError(f"must be same number of images and masks, got {len(args.images)} and {args.masks}")
+    if args.num_workers < 1:
+        raise ValueError(f"`num-workers` must be at least 1, given {args.num_workers}")
+    if args.group_wise_iterations < 1:
+        raise ValueError(f"`group-wise-iterations` must be at least 1, given {args.group_wise_iterations}")
     check_inputs_exist(args.images + args.masks, args.silent)
-    check_for_output_overwrite(
-        [args.atlas_average, args.atlas_mask, output_yaml],
-        args.overwrite, args.silent
-    )
-    # write args to yaml file
-    write_args_to_yaml(output_yaml, args, args.silent)
+    # the outputs are only written once the atlas is built, so a build resumed from its checkpoints does not find them
+    check_for_output_overwrite([args.atlas_average, args.atlas_mask], args.overwrite, args.silent)
+    setup_checkpoint_dir(checkpoint_dir, args)
     # create the atlas
     message_s("Atlas creation starting..", args.silent)
-    atlas = read_and_downsample_image(
-        args.images[0], f"image 0",
-        args.downsampling_shrink_factor,
-        args.downsampling_smoothing_sigma,
-        args.pad_amount, args.background_value,
-        args.silent
-    )
-    average_image = sitk.Image(*atlas.GetSize(), atlas.GetPixelID())
-    average_image.CopyInformation(atlas)
-    average_image = sitk.Add(average_image, atlas)
-    for i, img_fn in enumerate(args.images[1:]):
-        message_s(f"-- Image {i+1}.", args.silent)
-        image = read_and_downsample_image(
-            img_fn, f"image {i+1}",
-            args.downsampling_shrink_factor,
-            args.downsampling_smoothing_sigma,
-            args.pad_amount, args.background_value,
+    reference = get_downsampled_image(args.images[0], 0, checkpoint_dir, args)
+    fixed_fn = get_checkpoint_filenames(checkpoint_dir, 0)["image"]
+    atlas = None
+    history = []
+    for iteration in range(args.group_wise_iterations):
+        start_time = time.time()
+        if iteration == 0:
+            message_s(f"Affinely registering images to image 0 with {args.num_workers} worker(s)...", args.silent)
+        else:
+            message_s(
+                f"Group-wise iteration {iteration}: affinely registering all images to the average image with "
+                f"{args.num_workers} worker(s)...",
+                args.silent
+            )
+        metric_values = {}
+        for i, metric_value in map_over_images(
+            affinely_register_image,
+            [
+                (i, img_fn, fixed_fn, checkpoint_dir, iteration, args)
+                for i, img_fn in enumerate(args.images) if (iteration > 0 or i > 0)
+            ],
+            args.num_workers, args.itk_threads_per_worker
+        ):
+            metric_values[i] = metric_value
+        average = compute_average_image(reference, checkpoint_dir, len(args.images), iteration, args)
+        fixed_fn = get_average_checkpoint_filename(checkpoint_dir, iteration)
+        write_checkpoint(average, fixed_fn)
+        relative_change = get_relative_change(average, atlas) if atlas is not None else None
+        atlas = average
+        computed_metric_values = [v for v in metric_values.values() if v is not None]
+        history.append({
+            "iteration": iteration,
+            "wall_time": time.time() - start_time,
+            "metric_values": {i: metric_values[i] for i in sorted(metric_values.keys())},
+            "mean_metric_value": float(np.mean(computed_metric_values)) if computed_metric_values else None,
+            "relative_change": relative_change
+        })
+        message_s(
+            f"Iteration {iteration} finished in {history[-1]['wall_time']:.1f}s, "
+            f"mean metric value: {history[-1]['mean_metric_value']}, "
+            f"relative change of average image: {relative_change}",
             args.silent
         )
-        transform = affine_registration(atlas, image, args)
-        message_s("Adding transformed image to average image...", args.silent)
-        average_image = sitk.Add(
-            average_image,
-            sitk.Resample(image, atlas, transform, sitk.sitkLinear, defaultPixelValue=args.background_value)
-        )
-    message_s("Dividing accumulated average image by number of images...", args.silent)
-    atlas = sitk.Divide(average_image, len(args.images))
-    message_s(f"Saving atlas to {args.atlas_average}", args.silent)
-    sitk.WriteImage(atlas, args.atlas_average)
+        with open(os.path.join(checkpoint_dir, "group_wise_history.yaml"), "w") as f:
+            yaml.dump(history, f)
+        if relative_change is not None and relative_change < args.group_wise_tolerance:
+            message_s(
+                f"Group-wise refinement converged after {iteration + 1} iteration(s), relative change "
+                f"{relative_change} < tolerance {args.group_wise_tolerance}",
+                args.silent
+            )
+            break
+    message_s("Building the atlas pyramid once, for every deformable registration to use", args.silent)
+    # from the checkpoint of the last average image, which is the atlas
+    write_atlas_pyramid(
+        fixed_fn,
+        construct_multiscale_progression(args.shrink_factors, args.smoothing_sigmas, args.silent),
+        manifest_fn=get_atlas_pyramid_manifest_filename(checkpoint_dir)
+    )
     message_s(f"Deformably registering images and transforming masks to atlas space...", args.silent)
-    transformed_masks = []
-    for i, (img_fn, mask_fn) in enumerate(zip(args.images, args.masks)):
-        message_s(f"-- Image {i}", args.silent)
-        image = read_and_downsample_image(
-            img_fn, f"image {i}",
-            args.downsampling_shrink_factor,
-            args.downsampling_smoothing_sigma,
-            args.pad_amount, args.background_value,
-            args.silent
-        )
-        masks = get_medial_and_lateral_masks(
-            mask_fn, f"mask {i}", args.medial_site_codes, args.lateral_site_codes, args.silent
-        )
-        transformed_masks.append(
-            deformable_registration_and_masks_transformation(atlas, image, masks, f"image {i}", args)
-        )
+    votes = {"medial_mask": VoteAccumulator(), "lateral_mask": VoteAccumulator()}
+    for i in map_over_images(
+        deformably_register_image,
+        [(i, img_fn, mask_fn, checkpoint_dir, args) for i, (img_fn, mask_fn) in enumerate(zip(args.images, args.masks))],
+        args.num_workers, args.itk_threads_per_worker
+    ):
+        if args.consensus_method != "STAPLE":
+            for side, accumulator in votes.items():
+                accumulator.add(sitk.ReadImage(get_checkpoint_filenames(checkpoint_dir, i)[side]))
     message_s("Initializing the atlas mask", args.silent)
     atlas_mask = sitk.Image(*atlas.GetSize(), atlas.GetPixelIDValue())
     atlas_mask.CopyInformation(atlas)
     atlas_mask = sitk.Cast(atlas_mask, sitk.sitkUInt8)
-    message_s("Using STAPLE to get a consensus medial mask for the atlas", args.silent)
-    atlas_mask += (
-        args.medial_output_code * sitk.BinaryThreshold(
-            sitk.STAPLE([masks[0] for masks in transformed_masks]), args.STAPLE_binarization_threshold, 1e6
-        )
-    )
-    message_s("Using STAPLE to get a consensus lateral mask for the atlas", args.silent)
-    atlas_mask += (
-        args.lateral_output_code * sitk.BinaryThreshold(
-            sitk.STAPLE([masks[1] for masks in transformed_masks]), args.STAPLE_binarization_threshold, 1e6
-        )
-    )
+    for side, output_code in [("medial_mask", args.medial_output_code), ("lateral_mask", args.lateral_output_code)]:
+        label = side.replace("_", " ")
+        message_s(f"Using {args.consensus_method} to get a consensus {label} for the atlas", args.silent)
+        if args.consensus_method == "STAPLE":
+            consensus = sitk.BinaryThreshold(
+                sitk.STAPLE([
+                    sitk.ReadImage(get_checkpoint_filenames(checkpoint_dir, i)[side]) for i in range(len(args.images))
+                ]),
+                args.STAPLE_binarization_threshold, 1e6
+            )
+        elif args.consensus_method == "vote-EM":
+            consensus = sitk.BinaryThreshold(votes[side].vote_em(), args.STAPLE_binarization_threshold, 1e6)
+        else:
+            consensus = votes[side].majority_vote()
+        atlas_mask += output_code * consensus
+    message_s(f"Saving atlas to {args.atlas_average}", args.silent)
+    sitk.WriteImage(atlas, args.atlas_average)
     message_s(f"Writing atlas mask to {args.atlas_mask}", args.silent)
     sitk.WriteImage(atlas_mask, args.atlas_mask)
+    # write args to yaml file
+    write_args_to_yaml(output_yaml, args, args.silent)
 
 
 def main() -> None:
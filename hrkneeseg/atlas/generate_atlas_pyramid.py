@@ -0,0 +1,84 @@
+from __future__ import annotations
+
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter, Namespace
+
+from hrkneeseg.registration.pyramid import get_pyramid_manifest_filename, write_atlas_pyramid
+
+
+def create_parser() -> ArgumentParser:
+    from bonelab.util.registration_util import create_file_extension_checker
+    from bonelab.util.demons_registration_util import IMAGE_EXTENSIONS
+    parser = ArgumentParser(
+        description="Precompute the smoothed and downsampled multi-resolution pyramid of an atlas and store it next to "
+                    "the atlas, so that registrations to the atlas can load the fixed image pyramid instead of "
+                    "rebuilding it. The levels are written next to a `<atlas base>_pyramid.yaml` manifest that "
+                    "records the parameters they were built with.",
+        formatter_class=ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        "atlas", type=create_file_extension_checker(IMAGE_EXTENSIONS, "atlas"), metavar="ATLAS",
+        help=f"the atlas image ({', '.join(IMAGE_EXTENSIONS)})"
+    )
+    parser.add_argument(
+        "--manifest", "-m", type=str, default=None, metavar="FN",
+        help="filename of the pyramid manifest, the levels are written next to it. if `None`, "
+             "`<atlas base>_pyramid.yaml` next to the atlas is used"
+    )
+    parser.add_argument(
+        "--downsampling-shrink-factor", "-dsf", default=None, type=float, metavar="X",
+        help="factor by which to shrink the atlas before building the pyramid, must match the registration's "
+             "`downsampling-shrink-factor`"
+    )
+    parser.add_argument(
+        "--downsampling-smoothing-sigma", "-dss", default=None, type=float, metavar="X",
+        help="variance for the Gaussian filter used to smooth the atlas before building the pyramid, must match the "
+             "registration's `downsampling-smoothing-sigma`"
+    )
+    parser.add_argument(
+        "--shrink-factors", "-sf", default=None, type=float, nargs="+", metavar="X",
+        help="factors by which to shrink the atlas at each stage of the multiscale progression. you must give the "
+             "same number of arguments here as you do for `smoothing-sigmas`"
+    )
+    parser.add_argument(
+        "--smoothing-sigmas", "-ss", default=None, type=float, nargs="+", metavar="X",
+        help="variances for the Gaussians used to smooth the atlas at each stage of the multiscale progression. you "
+             "must give the same number of arguments here as you do for `shrink-factors`"
+    )
+    parser.add_argument(
+        "--overwrite", "-ow", default=False, action="store_true",
+        help="enable this flag to overwrite an existing pyramid"
+    )
+    parser.add_argument(
+        "--silent", "-s", default=False, action="store_true",
+        help="enable this flag to suppress terminal output"
+    )
+    return parser
+
+
+def generate_atlas_pyramid(args: Namespace) -> None:
+    from bonelab.util.echo_arguments import echo_arguments
+    from bonelab.util.registration_util import check_inputs_exist, check_for_output_overwrite, message_s
+    from bonelab.util.demons_registration_util import construct_multiscale_progression
+    if not args.silent:
+        print(echo_arguments("Generate Atlas Pyramid", vars(args)))
+    manifest_fn = get_pyramid_manifest_filename(args.atlas) if args.manifest is None else args.manifest
+    check_inputs_exist([args.atlas], args.silent)
+    check_for_output_overwrite([manifest_fn], args.overwrite, args.silent)
+    message_s(f"Building the pyramid of {args.atlas}", args.silent)
+    write_atlas_pyramid(
+        args.atlas,
+        construct_multiscale_progression(args.shrink_factors, args.smoothing_sigmas, args.silent),
+        args.downsampling_shrink_factor,
+        args.downsampling_smoothing_sigma,
+        manifest_fn
+    )
+    message_s(f"Wrote the pyramid manifest to {manifest_fn}", args.silent)
+
+
+def main() -> None:
+    args = create_parser().parse_args()
+    generate_atlas_pyramid(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,173 @@
 from __future__ import annotations
 
-from typing import List, Optional
+from typing import Dict, List, Optional
+import math
+import numpy as np
 import os
 
+from hrkneeseg.aim_nifti.aim_io import AIMHeader
+from hrkneeseg.aim_nifti.aim_index import AIMIndex
+from hrkneeseg.aim_nifti.batch_convert_aims_to_nifti import IMAGE_BYTES_PER_VOXEL
 from hrkneeseg.automation.write_slurm_script import write_slurm_script
+from hrkneeseg.utils.nifti_format import DELIVERABLE_FORMAT
 
 ROI_CODES = {
     "femur": [10, 11, 12, 13, 14, 15, 16, 17],
     "tibia": [30, 31, 32, 33, 34, 35, 36, 37],
 }
 
+# memory request for converting an AIM to NIfTI when the AIM dimensions are not known
+DEFAULT_CONVERSION_MEMORY = "32G"
+# the estimate is scaled by this and rounded up to whole GB, plus the memory of the interpreter and libraries
+CONVERSION_MEMORY_HEADROOM = 1.5
+CONVERSION_MEMORY_OVERHEAD_GB = 2
+
+
+def get_aim_headers(working_dir: str, images: List[str]) -> Dict[str, AIMHeader]:
+    '''
+    Look up the headers of the AIMs of the images in the AIM index of
+    the `aims` directory, so that missing or unreadable AIMs are found
+    before any scripts are written, without reading the images.
+
+    Parameters
+    ----------
+    working_dir : str
+        Path to the working directory.
+
+    images : List[str]
+        Names of the images.
+
+    Returns
+    -------
+    Dict[str, AIMHeader]
+        The header of the AIM of each image.
+    '''
+    index = AIMIndex(os.path.join(working_dir, "aims"))
+    headers = {}
+    problems = []
+    for image in images:
+        fn = os.path.join(working_dir, "aims", f"{image}.AIM")
+        try:
+            headers[image] = index.get(fn)
+        except FileNotFoundError:
+            problems.append(f"{fn} does not exist")
+        except ValueError as e:
+            problems.append(f"{fn} cannot be read: {e}")
+    index.save()
+    if problems:
+        raise ValueError("Problems with the input AIMs:\n" + "\n".join(problems))
+    return headers
+
+
+def get_conversion_memory(aim_header: Optional[AIMHeader] = None) -> str:
+    '''
+    Get the memory request for converting an AIM to NIfTI, from the
+    dimensions in its header.
+
+    Parameters
+    ----------
+    aim_header : Optional[AIMHeader], optional
+        The header of the AIM. If `None`, the default request is returned.
+        Defaults to `None`.
+
+    Returns
+    -------
+    str
+        The memory request, e.g. `20G`.
+    '''
+    if aim_header is None:
+        return DEFAULT_CONVERSION_MEMORY
+    estimate_gb = IMAGE_BYTES_PER_VOXEL * int(np.prod(aim_header.dimensions)) / 1024 ** 3
+    return f"{math.ceil(CONVERSION_MEMORY_HEADROOM * estimate_gb) + CONVERSION_MEMORY_OVERHEAD_GB}G"
+
+
+def wrap_with_transform_cache(
+    command_lines: List[str],
+    inputs: List[str],
+    outputs: List[str],
+    transform_cache_dir: Optional[str] = None
+) -> List[str]:
+    '''
+    Wrap the lines of a registration command so that it is run through
+    `hrkTransformCache`, which restores the outputs instead of running
+    the registration if the same registration has already been done.
+
+    Parameters
+    ----------
+    command_lines : List[str]
+        The lines of the registration command, all but the last ending
+        in a line continuation.
+
+    inputs : List[str]
+        The input files of the registration.
+
+    outputs : List[str]
+        The output files of the registration.
+
+    transform_cache_dir : Optional[str], optional
+        The transform cache directory. If `None`, the command lines are
+        returned unchanged. Defaults to `None`.
+
+    Returns
+    -------
+    List[str]
+        The wrapped command lines.
+    '''
+    if transform_cache_dir is None:
+        return command_lines
+    return [
+        f"hrkTransformCache --cache-dir {transform_cache_dir} run \\",
+        f"--inputs {' '.join(inputs)} \\",
+        f"--outputs {' '.join(outputs)} -- \\",
+    ] + command_lines
+
+
+def create_segmentation_visualization_slurm_file(
+    slurm_dir: str,
+    image: str,
+    working_dir: str,
+    conda_dir: str,
+    conda_env: str,
+    last_jid_var: str,
+    email: Optional[str] = None,
+    intermediate_format: str = DELIVERABLE_FORMAT
+) -> str:
+    '''
+    Create the slurm script of the visualizations of the inference and
+    post-processed masks of an image, and return the line that submits it
+    once the segmentation is done. See `create_segmentation_slurm_files`
+    for the parameters.
+
+    Returns
+    -------
+    str
+        The line to add to the shell batch submit script.
+    '''
+    slurm_visualizations = os.path.join(slurm_dir, "4_segmentation_visualizations.slurm")
+    write_slurm_script(
+        slurm_visualizations,
+        [
+            f"hrkVisualize2DPanning \\",
+            f"{os.path.join(working_dir, 'niftis', f'{image.lower()}.{intermediate_format}')} \\",
+            f"{os.path.join(working_dir, 'model_masks', f'{image.lower()}_ensemble_inference_mask.{intermediate_format}')} \\",
+            f"{os.path.join(working_dir, 'visualizations', f'{image.lower()}_inference')} \\",
+            f"-ib -400 1400 -pd 1 -ri -cens 10",
+            f"hrkVisualize2DPanning \\",
+            f"{os.path.join(working_dir, 'niftis', f'{image.lower()}.{intermediate_format}')} \\",
+            f"{os.path.join(working_dir, 'model_masks', f'{image.lower()}_postprocessed_mask.nii.gz')} \\",
+            f"{os.path.join(working_dir, 'visualizations', f'{image.lower()}_postprocessed')} \\",
+            f"-ib -400 1400 -pd 1 -ri -cens 10"
+        ],
+        f"{image}_4_segmentation_visualizations",
+        "1:00:00",
+        "100G",
+        1,
+        conda_dir,
+        conda_env,
+        email=email
+    )
+    return f"sbatch --dependency=afterok:${{{last_jid_var}}} {slurm_visualizations}"
+
 
 def create_segmentation_slurm_files(
     slurm_dir: str,
@@ -21,7 +179,10 @@ def create_segmentation_slurm_files(
     segmentation_models: List[dict],
     last_jid_var: str,
     email: Optional[str] = None,
-    timecode: Optional[str] = None
+    timecode: Optional[str] = None,
+    intermediate_format: str = DELIVERABLE_FORMAT,
+    aim_header: Optional[AIMHeader] = None,
+    pipeline_jobs: bool = False
 ) -> List[str]:
     '''
     Create slurm scripts and shell batch submit script
@@ -68,6 +229,22 @@ def create_segmentation_slurm_files(
     timecode : Optional[str]
         The timecode to create a subdirectory for the slurm scripts.
 
+    intermediate_format : str, optional
+        The format of the intermediate NIfTI images, `nii.gz` or `nii`.
+        The post-processed mask is always `nii.gz`.
+        Defaults to `nii.gz`.
+
+    aim_header : Optional[AIMHeader], optional
+        The header of the image AIM, to size the memory request of the
+        conversion to NIfTI. If `None`, 32G is requested.
+        Defaults to `None`.
+
+    pipeline_jobs : bool, optional
+        Whether to run the conversion, inference, post-processing and
+        conversion to AIMs in one `hrkPipeline` job, which passes the
+        images between the steps in memory, instead of a job per step.
+        Defaults to `False`.
+
     Returns
     -------
     List[str]
@@ -80,6 +257,49 @@ def create_segmentation_slurm_files(
             pass
         slurm_dir = os.path.join(slurm_dir, timecode)
     shell_submit_script_lines = []
+    if pipeline_jobs:
+        # Steps 0-3 in one job, the nifti and the inference mask are written for the visualizations
+        slurm_pipeline = os.path.join(slurm_dir, "0_segmentation_pipeline.slurm")
+        write_slurm_script(
+            slurm_pipeline,
+            (
+                [
+                    f"hrkPipeline \\",
+                    f"{os.path.join(working_dir, 'aims', f'{image}.AIM')} {working_dir} \\",
+                    f"--stages convert infer postprocess mask_aims {'--postsurgery ' if postsurgery else ''}\\",
+                    f"-hf \\"
+                ]
+                + [
+                    f"{sm['hyperparameters']} \\"
+                    for sm in segmentation_models
+                ] + [
+                    f"-cf \\"
+                ] + [
+                    f"{sm['checkpoint']} \\"
+                    for sm in segmentation_models
+                ] + [
+                    f"-mt {' '.join([sm['type'] for sm in segmentation_models])} \\",
+                    f"--inference-options=\"-pw 128 -bs 2 --cuda -o 0.25\" \\",
+                    f"-if {intermediate_format} -wi convert infer -siu"
+                ]
+            ),
+            f"{image}_0_segmentation_pipeline",
+            "8:00:00",
+            "200G",
+            2,
+            conda_dir,
+            conda_env,
+            email=email,
+            partition="gpu-v100",
+            num_gpus=1
+        )
+        shell_submit_script_lines.append(
+            f"{last_jid_var}=$(sbatch {slurm_pipeline} | tr -dc \"0-9\")"
+        )
+        shell_submit_script_lines.append(create_segmentation_visualization_slurm_file(
+            slurm_dir, image, working_dir, conda_dir, conda_env, last_jid_var, email, intermediate_format
+        ))
+        return shell_submit_script_lines
     # Step 0: Convert to Nifti
     slurm_convert_to_nifti = os.path.join(slurm_dir, "0_convert_to_nifti.slurm")
     write_slurm_script(
@@ -89,12 +309,12 @@ def create_segmentation_slurm_files(
                 f"hrkAIMs2NIIs "
                 f"{os.path.join(working_dir, 'aims', f'{image}.AIM')} "
                 f"{os.path.join(working_dir, 'niftis')} "
-                f"-ow"
+                f"-of {intermediate_format} -siu"
             ),
         ],
         f"{image}_0_convert_to_nii",
         "2:00:00",
-        "64G",
+        get_conversion_memory(aim_header),
         1,
         conda_dir,
         conda_env,
@@ -110,7 +330,7 @@ def create_segmentation_slurm_files(
         (
             [
                 f"hrkInferenceEnsemble \\",
-                f"{os.path.join(working_dir, 'niftis', f'{image.lower()}.nii.gz')} \\",
+                f"{os.path.join(working_dir, 'niftis', f'{image.lower()}.{intermediate_format}')} \\",
                 f"{os.path.join(working_dir, 'model_masks')} {image.lower()} \\",
                 f"-hf \\"
             ]
@@ -124,7 +344,7 @@ def create_segmentation_slurm_files(
                 for sm in segmentation_models
             ] + [
                 f"-mt {' '.join([sm['type'] for sm in segmentation_models])} \\",
-                f"-pw 128 -bs 2 -ow --cuda -o 0.25"
+                f"-pw 128 -bs 2 -siu --cuda -o 0.25 -of {intermediate_format}"
             ]
         ),
         f"{image}_1_inference",
@@ -146,9 +366,9 @@ def create_segmentation_slurm_files(
         slurm_post_processing,
         [
             f"hrkPostProcessSegmentation \\",
-            f"{os.path.join(working_dir, 'model_masks', f'{image.lower()}_ensemble_inference_mask.nii.gz')} \\",
+            f"{os.path.join(working_dir, 'model_masks', f'{image.lower()}_ensemble_inference_mask.{intermediate_format}')} \\",
             f"{os.path.join(working_dir, 'model_masks')} {image.lower()} \\",
-            f"{'-t' if postsurgery else ''} -ow \\"
+            f"{'-t' if postsurgery else ''} -siu \\"
         ],
         f"{image}_2_post_processing",
         "3:00:00",
@@ -173,7 +393,7 @@ def create_segmentation_slurm_files(
             f"-cv 1 2 {'3' if postsurgery else ''} \\",
             f"-cl CORT_MASK TRAB_MASK {'TUNNEL_MASK' if postsurgery else ''} \\",
             f"-l \"Generated using the code at: https://github.com/Bonelab/HRpQCT-Knee-Seg\" \\",
-            f"-ow \\",
+            f"-siu \\",
         ],
         f"{image}_3_convert_to_aim",
         "2:00:00",
@@ -187,32 +407,9 @@ def create_segmentation_slurm_files(
         f"sbatch --dependency=afterok:${{{last_jid_var}}} {slurm_convert_to_aim}"
     )
     # Step 4: Visualizations
-    slurm_visualizations = os.path.join(slurm_dir, "4_segmentation_visualizations.slurm")
-    write_slurm_script(
-        slurm_visualizations,
-        [
-            f"hrkVisualize2DPanning \\",
-            f"{os.path.join(working_dir, 'niftis', f'{image.lower()}.nii.gz')} \\",
-            f"{os.path.join(working_dir, 'model_masks', f'{image.lower()}_ensemble_inference_mask.nii.gz')} \\",
-            f"{os.path.join(working_dir, 'visualizations', f'{image.lower()}_inference')} \\",
-            f"-ib -400 1400 -pd 1 -ri -cens 10",
-            f"hrkVisualize2DPanning \\",
-            f"{os.path.join(working_dir, 'niftis', f'{image.lower()}.nii.gz')} \\",
-            f"{os.path.join(working_dir, 'model_masks', f'{image.lower()}_postprocessed_mask.nii.gz')} \\",
-            f"{os.path.join(working_dir, 'visualizations', f'{image.lower()}_postprocessed')} \\",
-            f"-ib -400 1400 -pd 1 -ri -cens 10"
-        ],
-        f"{image}_4_segmentation_visualizations",
-        "1:00:00",
-        "100G",
-        1,
-        conda_dir,
-        conda_env,
-        email=email
-    )
-    shell_submit_script_lines.append(
-        f"sbatch --dependency=afterok:${{{last_jid_var}}} {slurm_visualizations}"
-    )
+    shell_submit_script_lines.append(create_segmentation_visualization_slurm_file(
+        slurm_dir, image, working_dir, conda_dir, conda_env, last_jid_var, email, intermediate_format
+    ))
 
     return shell_submit_script_lines
 
@@ -231,6 +428,9 @@ def create_atlas_registration_slurm_files(
     last_jid_var: str,
     email: Optional[str] = None,
     timecode: Optional[str] = None,
+    transform_cache_dir: Optional[str] = None,
+    downsampled_atlas_registration: bool = False,
+    intermediate_format: str = DELIVERABLE_FORMAT
 ) -> List[str]:
     '''
     Create slurm scripts and shell batch submit script
@@ -277,6 +477,21 @@ def create_atlas_registration_slurm_files(
 
     timecode : Optional[str]
         The timecode to create a subdirectory for the slurm scripts.
+
+    transform_cache_dir : Optional[str]
+        The transform cache directory. If given, the atlas registration is
+        run through `hrkTransformCache` so it is skipped when resubmitted
+        with unchanged inputs.
+
+    downsampled_atlas_registration : bool
+        Whether to do the atlas registration with `hrkAtlasRegistration`,
+        which crops the image to the bone and registers in the downsampled
+        domain, instead of the masking, mirroring, registration and
+        transformation steps with the full size images. Needs much less
+        time and memory.
+
+    intermediate_format : str
+        The format of the intermediate NIfTI images, `nii.gz` or `nii`.
     '''
     if timecode is not None:
         try:
@@ -287,54 +502,102 @@ def create_atlas_registration_slurm_files(
     shell_submit_script_lines = []
     # Step 5: Atlas Registration
     slurm_atlas_registration = os.path.join(slurm_dir, "5_atlas_registration.slurm")
+    if downsampled_atlas_registration:
+        write_slurm_script(
+            slurm_atlas_registration,
+            [
+                f"echo \"Register the image to the atlas and transform the atlas mask to the image\"",
+            ] + wrap_with_transform_cache(
+                [
+                    f"hrkAtlasRegistration \\",
+                    f"{os.path.join(working_dir, 'niftis', f'{image.lower()}.{intermediate_format}')} \\",
+                    f"{os.path.join(working_dir, 'model_masks', f'{image.lower()}_postprocessed_mask.nii.gz')} \\",
+                    f"{os.path.join(atlas_dir, bone.lower(), 'atlas.nii')} \\",
+                    f"{os.path.join(atlas_dir, bone.lower(), 'atlas_mask.nii.gz')} \\",
+                    f"{os.path.join(working_dir, 'atlas_registrations', f'{image.lower()}_atlas_mask_transformed.{intermediate_format}')} \\",
+                    f"--dilate-amount 35 --background-class 0 --background-value -1000 \\",
+                    f"-dsf 8 -dss 0.5 -dt diffeomorphic -mi 200 -ds 2 -us 2 -sf 16 8 4 2 -ss 8 4 2 1 \\",
+                    f"{'--mirror ' if side.lower() == 'left' else ''}-ow",
+                ],
+                [
+                    os.path.join(working_dir, 'niftis', f'{image.lower()}.{intermediate_format}'),
+                    os.path.join(working_dir, 'model_masks', f'{image.lower()}_postprocessed_mask.nii.gz'),
+                    os.path.join(atlas_dir, bone.lower(), 'atlas.nii'),
+                    os.path.join(atlas_dir, bone.lower(), 'atlas_mask.nii.gz')
+                ],
+                [os.path.join(working_dir, 'atlas_registrations', f'{image.lower()}_atlas_mask_transformed.{intermediate_format}')],
+                transform_cache_dir
+            ),
+            f"{image}_5_atlas_registration",
+            "1:00:00",
+            "16G",
+            1,
+            conda_dir,
+            conda_env,
+            email=email
+        )
+        shell_submit_script_lines.append(
+            f"{last_jid_var}=$(sbatch --dependency=afterok:${{{dependent_jid_var}}} {slurm_atlas_registration} | tr -dc \"0-9\")"
+        )
+        return shell_submit_script_lines
     write_slurm_script(
         slurm_atlas_registration,
         [
             f"echo \"Step 1: mask the image with the postprocessed model mask\"",
             f"hrkMaskImage \\",
-            f"{os.path.join(working_dir, 'niftis', f'{image.lower()}.nii.gz')} \\",
+            f"{os.path.join(working_dir, 'niftis', f'{image.lower()}.{intermediate_format}')} \\",
             f"{os.path.join(working_dir, 'model_masks', f'{image.lower()}_postprocessed_mask.nii.gz')} \\",
-            f"{os.path.join(working_dir, 'niftis', f'{image.lower()}_masked.nii.gz')} \\",
-            f"--dilate-amount 35 --background-class 0 --background-value -1000 -ow"
+            f"{os.path.join(working_dir, 'niftis', f'{image.lower()}_masked.{intermediate_format}')} \\",
+            f"--dilate-amount 35 --background-class 0 --background-value -1000 -siu"
         ] + (
             [
                 f"echo \"Step 2: LEFT knee, need to mirror it\"",
                 f"blImageMirror \\",
-                f"{os.path.join(working_dir, 'niftis', f'{image.lower()}_masked.nii.gz')} \\",
+                f"{os.path.join(working_dir, 'niftis', f'{image.lower()}_masked.{intermediate_format}')} \\",
                 f"0 \\",
-                f"{os.path.join(working_dir, 'niftis', f'{image.lower()}_masked.nii.gz')} -ow",
+                f"{os.path.join(working_dir, 'niftis', f'{image.lower()}_masked.{intermediate_format}')} -ow",
             ] if side.lower() == "left" else [
                 f"echo \"Step 2: not LEFT knee, don't need to mirror it\""
             ]
         ) + [
             f"echo \"Step 3: register the nifti to the atlas\"",
-            f"blRegistrationDemons \\",
-            f"{os.path.join(working_dir, 'niftis', f'{image.lower()}_masked.nii.gz')} \\",
-            f"{os.path.join(atlas_dir, bone.lower(), 'atlas.nii')} \\"
-            f"{os.path.join(working_dir, 'atlas_registrations', f'{image.lower()}_atlas_transform.nii.gz')} \\",
-            f"-mida -dsf 8 -dss 0.5 -ci Geometry -dt diffeomorphic \\",
-            f"-mi 200 -ds 2 -us 2 -sf 16 8 4 2 -ss 8 4 2 1 -pmh -ow",
+        ] + wrap_with_transform_cache(
+            [
+                f"blRegistrationDemons \\",
+                f"{os.path.join(working_dir, 'niftis', f'{image.lower()}_masked.{intermediate_format}')} \\",
+                f"{os.path.join(atlas_dir, bone.lower(), 'atlas.nii')} \\",
+                f"{os.path.join(working_dir, 'atlas_registrations', f'{image.lower()}_atlas_transform.{intermediate_format}')} \\",
+                f"-mida -dsf 8 -dss 0.5 -ci Geometry -dt diffeomorphic \\",
+                f"-mi 200 -ds 2 -us 2 -sf 16 8 4 2 -ss 8 4 2 1 -pmh -ow",
+            ],
+            [
+                os.path.join(working_dir, 'niftis', f'{image.lower()}_masked.{intermediate_format}'),
+                os.path.join(atlas_dir, bone.lower(), 'atlas.nii')
+            ],
+            [os.path.join(working_dir, 'atlas_registrations', f'{image.lower()}_atlas_transform.{intermediate_format}')],
+            transform_cache_dir
+        ) + [
             f"echo \"Step 4: transform the atlas mask to the image\"",
             f"blRegistrationApplyTransform \\",
             f"{os.path.join(atlas_dir, bone.lower(), 'atlas_mask.nii.gz')} \\",
-            f"{os.path.join(working_dir, 'atlas_registrations', f'{image.lower()}_atlas_transform.nii.gz')} \\",
-            f"{os.path.join(working_dir, 'atlas_registrations', f'{image.lower()}_atlas_mask_transformed.nii.gz')} \\",
-            f"--fixed-image {os.path.join(working_dir, 'niftis', f'{image.lower()}_masked.nii.gz')} \\",
+            f"{os.path.join(working_dir, 'atlas_registrations', f'{image.lower()}_atlas_transform.{intermediate_format}')} \\",
+            f"{os.path.join(working_dir, 'atlas_registrations', f'{image.lower()}_atlas_mask_transformed.{intermediate_format}')} \\",
+            f"--fixed-image {os.path.join(working_dir, 'niftis', f'{image.lower()}_masked.{intermediate_format}')} \\",
             f"-int NearestNeighbour -ow",
         ] + (
             [
                 f"echo \"Step 5: LEFT knee, need to mirror the image and transformed mask back\"",
                 f"blImageMirror \\",
-                f"{os.path.join(working_dir, 'atlas_registrations', f'{image.lower()}_atlas_mask_transformed.nii.gz')} \\",
+                f"{os.path.join(working_dir, 'atlas_registrations', f'{image.lower()}_atlas_mask_transformed.{intermediate_format}')} \\",
                 f"0 \\",
-                f"{os.path.join(working_dir, 'atlas_registrations', f'{image.lower()}_atlas_mask_transformed.nii.gz')} \\",
+                f"{os.path.join(working_dir, 'atlas_registrations', f'{image.lower()}_atlas_mask_transformed.{intermediate_format}')} \\",
                 f"-int NearestNeighbour -ow"
             ] if side.lower() == "left" else [
                 f"echo \"Step 5: not LEFT knee, don't need to mirror the image and transformed mask back\""
             ]
         ) + [
             f"echo \"Step 6: remove the masked image\"",
-            f"rm {os.path.join(working_dir, 'niftis', f'{image.lower()}_masked.nii.gz')}",
+            f"rm {os.path.join(working_dir, 'niftis', f'{image.lower()}_masked.{intermediate_format}')}",
         ],
         f"{image}_5_atlas_registration",
         "3:00:00",
@@ -348,3 +611,24 @@ def create_atlas_registration_slurm_files(
         f"{last_jid_var}=$(sbatch --dependency=afterok:${{{dependent_jid_var}}} {slurm_atlas_registration} | tr -dc \"0-9\")"
     )
     return shell_submit_script_lines
+
+
+def create_shell_files(automation_dir: str) -> None:
+    '''
+    Create the script that runs all of the jobs on the local machine in
+    `shell` mode. The jobs are the same slurm scripts and submit scripts
+    as in `slurm` mode, and `hrkRunJobs` runs them with the dependencies
+    of the submit scripts and the resources in the `#SBATCH` headers, so
+    the arguments of the script, e.g. `--num-gpus 1` or `--resume`, are
+    passed on to `hrkRunJobs`.
+
+    Parameters
+    ----------
+    automation_dir : str
+        Path to the automation directory.
+    '''
+    with open(os.path.join(automation_dir, "run_all.sh"), "w") as f:
+        f.write("\n".join([
+            "#!/bin/bash",
+            f"hrkRunJobs {os.path.join(automation_dir, 'submit_all.sh')} \"$@\""
+        ]))
@@ -6,22 +6,18 @@ from argparse import Namespace
 import yaml
 import os
 
-# bonelab imports
-from bonelab.util.echo_arguments import echo_arguments
-from bonelab.util.time_stamp import message
-
 # internal imports
 from hrkneeseg.automation.parser import create_parser
 from hrkneeseg.automation.write_slurm_script import write_slurm_script
+from hrkneeseg.aim_nifti.aim_io import AIMHeader
+from hrkneeseg.automation.job_arrays import create_job_array_files
 from hrkneeseg.automation.common import (
     ROI_CODES, create_segmentation_slurm_files,
-    create_atlas_registration_slurm_files
+    create_atlas_registration_slurm_files, create_shell_files, get_aim_headers
 )
+from hrkneeseg.utils.nifti_format import DELIVERABLE_FORMAT, NIFTI_FORMATS
 
 
-def create_shell_files() -> None:
-    raise NotImplementedError
-
 
 def create_slurm_files(
     automation_subdir: str,
@@ -35,7 +31,12 @@ def create_slurm_files(
     conda_env: str,
     segmentation_models: List[dict],
     email: Optional[str] = None,
-    segmentation_only: bool = False
+    segmentation_only: bool = False,
+    transform_cache_dir: Optional[str] = None,
+    downsampled_atlas_registration: bool = False,
+    intermediate_format: str = DELIVERABLE_FORMAT,
+    aim_header: Optional[AIMHeader] = None,
+    pipeline_jobs: bool = False
 ) -> str:
     '''
     Create slurm scripts and shell batch submit script
@@ -84,6 +85,39 @@ def create_slurm_files(
         Email address to send notifications to.
         Defaults to `None`.
 
+    segmentation_only : bool, optional
+        Whether to only do the segmentation steps.
+        Defaults to `False`.
+
+    transform_cache_dir : Optional[str], optional
+        The transform cache directory. If given, the atlas registration is
+        run through `hrkTransformCache` so it is skipped when resubmitted
+        with unchanged inputs.
+        Defaults to `None`.
+
+    downsampled_atlas_registration : bool, optional
+        Whether to do the atlas registration in the downsampled domain with
+        `hrkAtlasRegistration`.
+        Defaults to `False`.
+
+    intermediate_format : str, optional
+        The format of the intermediate NIfTI images, `nii.gz` or `nii`.
+        Only the post-processed mask and the AIMs are kept as results, so
+        the rest of the images do not need to be compressed.
+        Defaults to `nii.gz`.
+
+    aim_header : Optional[AIMHeader], optional
+        The header of the image AIM, to size the memory request of the
+        conversion to NIfTI.
+        Defaults to `None`.
+
+    pipeline_jobs : bool, optional
+        Whether to run the segmentation steps, and then the ROI generation
+        and conversion of the ROIs to AIMs, in one `hrkPipeline` job each,
+        which passes the images between the steps in memory, instead of a
+        job per step.
+        Defaults to `False`.
+
     Returns
     -------
     str
@@ -105,7 +139,10 @@ def create_slurm_files(
         conda_env,
         segmentation_models,
         "JID_PP",
-        email=email
+        email=email,
+        intermediate_format=intermediate_format,
+        aim_header=aim_header,
+        pipeline_jobs=pipeline_jobs
     )
 
     if segmentation_only:
@@ -126,64 +163,91 @@ def create_slurm_files(
             conda_env,
             "JID_PP",
             "JID_REG",
-            email=email
+            email=email,
+            transform_cache_dir=transform_cache_dir,
+            downsampled_atlas_registration=downsampled_atlas_registration,
+            intermediate_format=intermediate_format
         )
 
-    # generate ROIS
-
-    generate_rois_slurm = os.path.join(slurm_dir, "6_generate_rois.sh")
-
-    generate_rois_commands = [
-        f"hrkGenerateROIs \\",
-        f"{os.path.join(working_dir, 'model_masks', f'{image.lower()}_postprocessed_mask.nii.gz')} \\",
-        f"{bone} \\",
-        f"{os.path.join(working_dir, 'atlas_registrations', f'{image.lower()}_atlas_mask_transformed.nii.gz')} \\",
-        f"{os.path.join(working_dir, 'roi_masks')} \\",
-        f"{image.lower()} \\",
-        f"--axial-dilation-footprint 40 -ow"
-    ]
+    if pipeline_jobs:
+        # generate ROIs and convert them to AIMs in one job, the all ROIs mask is written for the visualization
+        roi_pipeline_slurm = os.path.join(slurm_dir, "6_roi_pipeline.slurm")
+        write_slurm_script(
+            roi_pipeline_slurm,
+            [
+                f"hrkPipeline \\",
+                f"{os.path.join(working_dir, 'aims', f'{image}.AIM')} {working_dir} \\",
+                f"--bone {bone} --stages rois roi_aims \\",
+                f"--roi-options=\"--axial-dilation-footprint 40\" \\",
+                f"-if {intermediate_format} -wi rois -siu"
+            ],
+            f"{image}_7_roi_pipeline",
+            "12:00:00",
+            "150GB",
+            2,
+            conda_dir,
+            conda_env,
+            email=email
+        )
+        shell_submit_script_lines.append(
+            f"JID_ROIS=$(sbatch --dependency=afterok:${{JID_REG}} {roi_pipeline_slurm} | tr -dc \"0-9\")"
+        )
+    else:
+        # generate ROIS
+
+        generate_rois_slurm = os.path.join(slurm_dir, "6_generate_rois.sh")
+
+        generate_rois_commands = [
+            f"hrkGenerateROIs \\",
+            f"{os.path.join(working_dir, 'model_masks', f'{image.lower()}_postprocessed_mask.nii.gz')} \\",
+            f"{bone} \\",
+            f"{os.path.join(working_dir, 'atlas_registrations', f'{image.lower()}_atlas_mask_transformed.{intermediate_format}')} \\",
+            f"{os.path.join(working_dir, 'roi_masks')} \\",
+            f"{image.lower()} \\",
+            f"--axial-dilation-footprint 40 -of {intermediate_format} -siu"
+        ]
 
-    write_slurm_script(
-        generate_rois_slurm,
-        generate_rois_commands,
-        f"{image}_7_generate_rois",
-        "8:00:00",
-        "150GB",
-        1,
-        conda_dir,
-        conda_env,
-        email=email,
-    )
+        write_slurm_script(
+            generate_rois_slurm,
+            generate_rois_commands,
+            f"{image}_7_generate_rois",
+            "8:00:00",
+            "150GB",
+            1,
+            conda_dir,
+            conda_env,
+            email=email,
+        )
 
-    shell_submit_script_lines.append(
-        f"JID_ROIS=$(sbatch --dependency=afterok:${{JID_REG}} {generate_rois_slurm} | tr -dc \"0-9\")"
-    )
-    # ROIs to AIMs
-
-    rois_to_aims_slurm = os.path.join(slurm_dir, "7_rois_to_aims.slurm")
-    rois_to_aims_commands = []
-    for roi_code in ROI_CODES[bone]:
-        rois_to_aims_commands += [
-            f"hrkMask2AIM \\",
-            f"{os.path.join(working_dir, 'roi_masks', f'{image.lower()}_roi{roi_code}_mask.nii.gz')} \\",
-            f"{os.path.join(working_dir, 'aims', f'{image}.AIM')} \\",
-            f"{os.path.join(working_dir, 'roi_masks', f'{image}_ROI{roi_code}_MASK.AIM')} \\",
-            f"-l \"Generated using the code at: https://github.com/Bonelab/HRpQCT-Knee-Seg\" -ow",
-        ]
-    write_slurm_script(
-        rois_to_aims_slurm,
-        rois_to_aims_commands,
-        f"{image}_8_rois_to_aims",
-        "8:00:00",
-        "100GB",
-        2,
-        conda_dir,
-        conda_env,
-        email=email
-    )
-    shell_submit_script_lines.append(
-        f"sbatch --dependency=afterok:${{JID_ROIS}} {rois_to_aims_slurm}"
-    )
+        shell_submit_script_lines.append(
+            f"JID_ROIS=$(sbatch --dependency=afterok:${{JID_REG}} {generate_rois_slurm} | tr -dc \"0-9\")"
+        )
+        # ROIs to AIMs
+
+        rois_to_aims_slurm = os.path.join(slurm_dir, "7_rois_to_aims.slurm")
+        rois_to_aims_commands = []
+        for roi_code in ROI_CODES[bone]:
+            rois_to_aims_commands += [
+                f"hrkMask2AIM \\",
+                f"{os.path.join(working_dir, 'roi_masks', f'{image.lower()}_roi{roi_code}_mask.{intermediate_format}')} \\",
+                f"{os.path.join(working_dir, 'aims', f'{image}.AIM')} \\",
+                f"{os.path.join(working_dir, 'roi_masks', f'{image}_ROI{roi_code}_MASK.AIM')} \\",
+                f"-l \"Generated using the code at: https://github.com/Bonelab/HRpQCT-Knee-Seg\" -siu",
+            ]
+        write_slurm_script(
+            rois_to_aims_slurm,
+            rois_to_aims_commands,
+            f"{image}_8_rois_to_aims",
+            "8:00:00",
+            "100GB",
+            2,
+            conda_dir,
+            conda_env,
+            email=email
+        )
+        shell_submit_script_lines.append(
+            f"sbatch --dependency=afterok:${{JID_ROIS}} {rois_to_aims_slurm}"
+        )
 
     # ROIs to gifs
 
@@ -191,8 +255,8 @@ def create_slurm_files(
     visualize_commands = []
     visualize_commands += [
         f"hrkVisualize2DPanning \\",
-        f"{os.path.join(working_dir, 'niftis', f'{image.lower()}.nii.gz')} \\",
-        f"{os.path.join(working_dir, 'roi_masks', f'{image.lower()}_allrois_mask.nii.gz')} \\",
+        f"{os.path.join(working_dir, 'niftis', f'{image.lower()}.{intermediate_format}')} \\",
+        f"{os.path.join(working_dir, 'roi_masks', f'{image.lower()}_allrois_mask.{intermediate_format}')} \\",
         f"{os.path.join(working_dir, 'visualizations', f'{image.lower()}_rois_reg')} \\",
         "-ib -400 1400 -pd 1 -ri -cens 10",
     ]
@@ -219,12 +283,19 @@ def create_slurm_files(
 
 
 def crossectional(args: Namespace) -> None:
+    from bonelab.util.echo_arguments import echo_arguments
 
     params = vars(args)
     with open(args.yaml, "r") as file:
         config = yaml.safe_load(file)
     params = {**params, **config}
     print(echo_arguments("Cross-Sectional Automation", params))
+    if params["intermediate_format"] not in NIFTI_FORMATS:
+        raise ValueError(f"`intermediate_format` must be one of {NIFTI_FORMATS}, got {params['intermediate_format']}")
+    aim_headers = (
+        get_aim_headers(params["working_directory"], [data["image"] for data in params["data"]])
+        if params.get("index_aims", False) else {}
+    )
     try:
         os.mkdir(params["automation_dir"])
     except FileExistsError:
@@ -240,7 +311,8 @@ def crossectional(args: Namespace) -> None:
             ))
         except FileExistsError:
             pass
-        if params["mode"] == "slurm":
+        # in shell mode, `hrkRunJobs` runs the same scripts as slurm would
+        if params["mode"] in ["slurm", "shell"]:
             batch_submit_lines.append(
                 create_slurm_files(
                     params["automation_dir"],
@@ -254,15 +326,22 @@ def crossectional(args: Namespace) -> None:
                     params["environment"],
                     params["segmentation_models"],
                     params["email"],
-                    params["segmentation_only"]
+                    params["segmentation_only"],
+                    params.get("transform_cache_directory"),
+                    params.get("downsampled_atlas_registration", False),
+                    params["intermediate_format"],
+                    aim_headers.get(data["image"]),
+                    params.get("pipeline_jobs", False)
                 )
             )
-        elif params["mode"] == "shell":
-            raise NotImplementedError("Shell mode not implemented yet.")
         else:
             raise ValueError(f"Invalid mode: {params['mode']}")
+    if params.get("job_arrays", False):
+        batch_submit_lines = create_job_array_files(params["automation_dir"], batch_submit_lines[1:])
     with open(os.path.join(params["automation_dir"], "submit_all.sh"), "w") as f:
         f.write("\n".join(batch_submit_lines))
+    if params["mode"] == "shell":
+        create_shell_files(params["automation_dir"])
 
 
 
@@ -0,0 +1,141 @@
+from __future__ import annotations
+
+import os
+from typing import Dict, List, Tuple
+
+from hrkneeseg.automation.job_graph import (
+    SBATCH_OPTION, SUBMIT_SCRIPT_LINE, Job, JobGraph, format_array_indices, parse_time, read_submit_script
+)
+
+ARRAYS_DIR = "arrays"
+MANIFEST_SUFFIX = ".manifest"
+# the options of the array scripts that are set from all of the tasks instead of copied from the first task
+ARRAY_OPTIONS = ["cpus-per-task", "mem", "time", "gres", "job-name", "array"]
+
+
+def get_stage_label(stage: str) -> str:
+    ''' Get the label of a step, e.g. `1_inference` for `slurm/1_inference.slurm`. '''
+    parts = os.path.splitext(stage)[0].split(os.sep)
+    return "_".join(parts[1:] if parts[0] == "slurm" else parts)
+
+
+def write_job_array_script(fn: str, manifest: str, job_name: str, tasks: Dict[int, Job]) -> None:
+    '''
+    Write the slurm script of a job array, which runs the script on line
+    `SLURM_ARRAY_TASK_ID + 1` of the manifest. The tasks reserve the most
+    CPUs, memory, GPUs and time of any of the task scripts, and the other
+    `#SBATCH` options are copied from the first task script.
+
+    Parameters
+    ----------
+    fn : str
+        Path to the file to write the script to.
+
+    manifest : str
+        Path to the manifest, with the script of each task on the line of
+        its index.
+
+    job_name : str
+        Name of the job array.
+
+    tasks : Dict[int, Job]
+        The task scripts, by index.
+    '''
+    with open(tasks[min(tasks)].script, "r") as f:
+        options = [
+            line.strip() for line in f
+            if SBATCH_OPTION.match(line.strip()) and SBATCH_OPTION.match(line.strip())["option"] not in ARRAY_OPTIONS
+        ]
+    jobs = list(tasks.values())
+    times = [job.time for job in jobs if job.time is not None]
+    with open(fn, "w") as f:
+        f.write('#!/bin/bash\n')
+        f.write('####### Reserve computing resources for each task #######\n')
+        for option in options:
+            f.write(f'{option}\n')
+        f.write(f'#SBATCH --cpus-per-task={max(job.num_cpus for job in jobs)}\n')
+        if times:
+            f.write(f'#SBATCH --time={max(times, key=parse_time)}\n')
+        if any(job.memory_gb > 0 for job in jobs):
+            f.write(f'#SBATCH --mem={max(job.memory_gb for job in jobs):g}G\n')
+        if any(job.num_gpus > 0 for job in jobs):
+            f.write(f'#SBATCH --gres=gpu:{max(job.num_gpus for job in jobs)}\n')
+        f.write(f'#SBATCH --job-name={job_name}\n')
+        f.write(f'#SBATCH --array={format_array_indices(list(tasks))}\n')
+        f.write('\n')
+        f.write('####### Run the script of this task ###############\n')
+        f.write(f'bash "$(sed -n "$((SLURM_ARRAY_TASK_ID + 1))p" {manifest})"\n')
+
+
+def create_job_array_files(automation_dir: str, submit_script_lines: List[str]) -> List[str]:
+    '''
+    Create a slurm job array for each step of the workflow, from the slurm
+    scripts and submit scripts of the images or participants, and return
+    the lines of a batch submit script that submits the job arrays instead
+    of the jobs of each image or participant.
+
+    The task with index `i` of each job array runs the script of the step
+    for image or participant `i`, as listed in the manifest of the job
+    array. A job array waits for the job arrays of the steps it depends on
+    with `aftercorr`, so each task only waits for the corresponding tasks,
+    if every task depends on the corresponding task and no other task of
+    the step; otherwise it waits for all of the tasks with `afterok`.
+    The job arrays and manifests are written to `{automation_dir}/arrays`.
+
+    Parameters
+    ----------
+    automation_dir : str
+        Path to the automation directory.
+
+    submit_script_lines : List[str]
+        The lines of the batch submit script that run the submit script of
+        each image or participant, e.g. `./automation/IMAGE/submit_all.sh`.
+
+    Returns
+    -------
+    List[str]
+        The lines of the batch submit script.
+    '''
+    arrays_dir = os.path.join(automation_dir, ARRAYS_DIR)
+    os.makedirs(arrays_dir, exist_ok=True)
+    # the task scripts of each step, by the index of the image or participant
+    tasks: Dict[str, Dict[int, Job]] = {}
+    steps: Dict[str, Tuple[str, int]] = {}
+    for index, line in enumerate(submit_script_lines):
+        match = SUBMIT_SCRIPT_LINE.match(line)
+        if match is None:
+            raise ValueError(f"cannot read `{line}`, expected a submit script")
+        for job in read_submit_script(match["script"]):
+            stage = os.path.relpath(job.script, os.path.dirname(match["script"]))
+            tasks.setdefault(stage, {})[index] = job
+            steps[job.name] = (stage, index)
+    # whether each step can wait for each step it depends on with `aftercorr`
+    corresponding: Dict[str, Dict[str, bool]] = {stage: {} for stage in tasks}
+    for stage, stage_tasks in tasks.items():
+        for index, job in stage_tasks.items():
+            for dependency in job.dependencies:
+                dependency_stage, dependency_index = steps[dependency]
+                corresponding[stage][dependency_stage] = (
+                    corresponding[stage].get(dependency_stage, True) and dependency_index == index
+                    and set(stage_tasks) <= set(tasks[dependency_stage])
+                )
+    stage_graph = JobGraph([Job(stage, list(dependencies)) for stage, dependencies in corresponding.items()])
+    lines = ["#!/bin/bash"]
+    variables = {}
+    for number, stage in enumerate(stage_graph.order):
+        label = get_stage_label(stage)
+        manifest = os.path.join(arrays_dir, f"{label}{MANIFEST_SUFFIX}")
+        script = os.path.join(arrays_dir, f"{label}.slurm")
+        with open(manifest, "w") as f:
+            f.write("\n".join(
+                tasks[stage][index].script if index in tasks[stage] else "" for index in range(max(tasks[stage]) + 1)
+            ) + "\n")
+        write_job_array_script(script, manifest, label, tasks[stage])
+        conditions = [
+            f"{'aftercorr' if corresponding[stage][dependency] else 'afterok'}:${{{variables[dependency]}}}"
+            for dependency in corresponding[stage]
+        ]
+        variables[stage] = f"JID_ARRAY_{number}"
+        dependency_option = f"--dependency={','.join(conditions)} " if conditions else ""
+        lines.append(f"{variables[stage]}=$(sbatch {dependency_option}{script} | tr -dc \"0-9\")")
+    return lines
@@ -0,0 +1,342 @@
+from __future__ import annotations
+
+import math
+import re
+from typing import Dict, List, Optional, Tuple
+
+# the lines that `hrkCrossSectional` and `hrkLongitudinal` write to the submit scripts, e.g.
+# `JID_INF=$(sbatch --dependency=afterok:${JID_NII} automation/IMAGE/slurm/1_inference.slurm | tr -dc "0-9")`
+SUBMIT_LINE = re.compile(
+    r'^(?:(?P<variable>\w+)=\$\()?sbatch (?:--dependency=(?P<dependencies>\S+) )?(?P<script>\S+)'
+    r'(?: \| tr -dc "0-9"\))?$'
+)
+# the lines of the batch submit script that run the submit script of an image, e.g. `./automation/IMAGE/submit_all.sh`
+SUBMIT_SCRIPT_LINE = re.compile(r'^\./(?P<script>\S+\.sh)$')
+# `afterok` waits for all of the tasks of a job array, `aftercorr` for the task with the same index
+DEPENDENCY_CONDITION = re.compile(r'^(?P<condition>afterok|aftercorr):(?P<variables>\$\{\w+\}(?::\$\{\w+\})*)$')
+DEPENDENCY = re.compile(r'^\$\{(?P<variable>\w+)\}$')
+SBATCH_OPTION = re.compile(r'^#SBATCH --(?P<option>[\w-]+)=(?P<value>\S+)$')
+# memory units of `#SBATCH --mem`, in GB. a number without a unit is in MB
+MEMORY_UNITS_GB = {"K": 1 / 1024 ** 2, "M": 1 / 1024, "G": 1, "T": 1024}
+
+
+def parse_memory(memory: str) -> float:
+    """
+    Parse a slurm memory request, e.g. `150G`, `24GB` or `2000`, to GB.
+
+    Parameters
+    ----------
+    memory : str
+
+    Returns
+    -------
+    float
+    """
+    match = re.fullmatch(r'(?P<amount>\d+(?:\.\d+)?)(?:(?P<unit>[KMGT])B?)?', memory.strip().upper())
+    if match is None:
+        raise ValueError(f"cannot read the memory request `{memory}`")
+    return float(match["amount"]) * MEMORY_UNITS_GB[match["unit"] or "M"]
+
+
+def parse_time(time: str) -> int:
+    """
+    Parse a slurm time limit, e.g. `4:00:00`, `1-12:00:00`, `1-12` or `30`, to seconds.
+
+    Parameters
+    ----------
+    time : str
+
+    Returns
+    -------
+    int
+    """
+    match = re.fullmatch(r'(?:(?P<days>\d+)-)?(?P<clock>\d+(?::\d+){0,2})', time.strip())
+    if match is None:
+        raise ValueError(f"cannot read the time limit `{time}`")
+    fields = [int(field) for field in match["clock"].split(":")]
+    if match["days"] is not None:
+        # with days, the fields are hours, minutes and seconds
+        fields += [0] * (3 - len(fields))
+        hours, minutes, seconds = fields
+        return ((int(match["days"]) * 24 + hours) * 60 + minutes) * 60 + seconds
+    # without days, the fields are minutes, or minutes and seconds, or hours, minutes and seconds
+    seconds = 0
+    for field, scale in zip(reversed(fields), [1, 60, 3600] if len(fields) > 1 else [60]):
+        seconds += field * scale
+    return seconds
+
+
+def format_time(seconds: float) -> str:
+    """ Format a time in seconds as a slurm time, e.g. `1-12:00:00`, rounded up to whole seconds. """
+    minutes, seconds = divmod(math.ceil(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    days, hours = divmod(hours, 24)
+    return f"{f'{days}-' if days else ''}{hours:d}:{minutes:02d}:{seconds:02d}"
+
+
+def parse_array_indices(array: str) -> List[int]:
+    """
+    Parse the indices of a slurm job array, e.g. `0-3,7` or `0-99%10`, where `%10` limits the tasks that run at a time.
+
+    Parameters
+    ----------
+    array : str
+
+    Returns
+    -------
+    List[int]
+    """
+    indices = []
+    for part in array.split("%")[0].split(","):
+        match = re.fullmatch(r'(?P<first>\d+)(?:-(?P<last>\d+))?', part)
+        if match is None:
+            raise ValueError(f"cannot read the job array indices `{array}`")
+        indices += list(range(int(match["first"]), int(match["last"] or match["first"]) + 1))
+    return sorted(set(indices))
+
+
+def format_array_indices(indices: List[int]) -> str:
+    """ Format the indices of a slurm job array with ranges of consecutive indices, e.g. `0-3,7`. """
+    ranges: List[List[int]] = []
+    for index in sorted(set(indices)):
+        if ranges and index == ranges[-1][1] + 1:
+            ranges[-1][1] = index
+        else:
+            ranges.append([index, index])
+    return ",".join(f"{first}" if first == last else f"{first}-{last}" for first, last in ranges)
+
+
+def read_sbatch_options(script: str) -> Dict[str, str]:
+    """ Read the options in the `#SBATCH` header of a slurm script. """
+    options = {}
+    with open(script, "r") as f:
+        for line in f:
+            match = SBATCH_OPTION.match(line.strip())
+            if match is not None:
+                options[match["option"]] = match["value"]
+    return options
+
+
+class Job:
+    """
+    A step of the workflow: a script, the resources it reserves, and the jobs that must finish successfully first.
+
+    Parameters
+    ----------
+    script : str
+        The script of the job.
+
+    dependencies : List[str]
+        The names of the jobs that must finish successfully before this one starts.
+
+    num_cpus : int
+        The number of CPUs the job reserves. Default is 1.
+
+    memory_gb : float
+        The memory the job reserves, in GB. Default is 0.
+
+    num_gpus : int
+        The number of GPUs the job reserves. Default is 0.
+
+    time : Optional[str]
+        The time limit of the job, as given to slurm. Default is `None`.
+
+    array_index : Optional[int]
+        The index of the task, if the job is a task of a job array, given to the script in `SLURM_ARRAY_TASK_ID`.
+        Default is `None`.
+    """
+
+    def __init__(
+            self,
+            script: str,
+            dependencies: List[str],
+            num_cpus: int = 1,
+            memory_gb: float = 0.0,
+            num_gpus: int = 0,
+            time: Optional[str] = None,
+            array_index: Optional[int] = None
+    ):
+        self.script = script
+        self.dependencies = dependencies
+        self.num_cpus = num_cpus
+        self.memory_gb = memory_gb
+        self.num_gpus = num_gpus
+        self.time = time
+        self.array_index = array_index
+
+    @property
+    def name(self) -> str:
+        """ The script, with the index of the task for a task of a job array, e.g. `arrays/1_inference.slurm.3`. """
+        return self.script if self.array_index is None else f"{self.script}.{self.array_index}"
+
+    @classmethod
+    def from_sbatch_options(
+            cls,
+            script: str,
+            dependencies: List[str],
+            options: Dict[str, str],
+            array_index: Optional[int] = None
+    ) -> Job:
+        """
+        Create a job with the resources in the `#SBATCH` header of its script, see `read_sbatch_options`.
+
+        Parameters
+        ----------
+        script : str
+            The script.
+
+        dependencies : List[str]
+            The names of the jobs that must finish successfully first.
+
+        options : Dict[str, str]
+            The `#SBATCH` options of the script.
+
+        array_index : Optional[int]
+            The index of the task, for a task of a job array. Default is `None`.
+
+        Returns
+        -------
+        Job
+        """
+        return cls(
+            script,
+            dependencies,
+            num_cpus=int(options.get("cpus-per-task", 1)),
+            memory_gb=parse_memory(options["mem"]) if "mem" in options else 0.0,
+            num_gpus=int(options["gres"].split(":")[-1]) if options.get("gres", "").startswith("gpu:") else 0,
+            time=options.get("time"),
+            array_index=array_index
+        )
+
+    def __repr__(self) -> str:
+        return (
+            f"Job({self.name}, cpus={self.num_cpus}, memory={self.memory_gb:g}G, gpus={self.num_gpus}, "
+            f"dependencies={self.dependencies})"
+        )
+
+
+def parse_dependencies(fn: str, line: str, dependencies: Optional[str]) -> List[Tuple[str, str]]:
+    """ Parse the `--dependency` of a submit line to pairs of a condition and the variable of a job ID. """
+    if dependencies is None:
+        return []
+    conditions = []
+    # conditions separated by commas must all be met
+    for condition in dependencies.split(","):
+        match = DEPENDENCY_CONDITION.match(condition)
+        if match is None:
+            raise ValueError(f"{fn}: cannot read the dependency `{condition}` of `{line}`")
+        for variable in match["variables"].split(":"):
+            conditions.append((match["condition"], DEPENDENCY.match(variable)["variable"]))
+    return conditions
+
+
+def read_submit_script(fn: str) -> List[Job]:
+    """
+    Read the jobs of a submit script written by `hrkCrossSectional` or `hrkLongitudinal`, with the dependencies that
+    the script gives to `sbatch`. The batch submit script of a study, which runs the submit script of each image,
+    gives the jobs of all of the images. A job array gives a job for each of its tasks, where `afterok` on a job array
+    waits for all of its tasks and `aftercorr` waits for the task with the same index, which must exist. The scripts
+    are resolved from the current directory, as when the submit script is run.
+
+    Parameters
+    ----------
+    fn : str
+        The submit script.
+
+    Returns
+    -------
+    List[Job]
+        The jobs, in the order they are submitted.
+    """
+    jobs = []
+    # the job ID variables are local to each submit script, as each one runs in its own shell. each variable maps
+    # the array indices of the tasks of its job to their names, with an index of `None` for a job that is not an array
+    variables: Dict[str, Dict[Optional[int], str]] = {}
+    with open(fn, "r") as f:
+        lines = [line.strip() for line in f]
+    for line in lines:
+        if not line or line.startswith("#"):
+            continue
+        match = SUBMIT_SCRIPT_LINE.match(line)
+        if match is not None:
+            jobs += read_submit_script(match["script"])
+            continue
+        match = SUBMIT_LINE.match(line)
+        if match is None:
+            raise ValueError(f"{fn}: cannot read `{line}`, expected an `sbatch` line or a submit script")
+        conditions = parse_dependencies(fn, line, match["dependencies"])
+        for _, variable in conditions:
+            if variable not in variables:
+                raise ValueError(f"{fn}: `{line}` depends on `${{{variable}}}`, which is not the ID of an earlier job")
+        options = read_sbatch_options(match["script"])
+        tasks = {}
+        for index in parse_array_indices(options["array"]) if "array" in options else [None]:
+            dependencies = []
+            for condition, variable in conditions:
+                if condition == "afterok":
+                    dependencies += list(variables[variable].values())
+                elif index is None or None in variables[variable]:
+                    raise ValueError(f"{fn}: `{line}` uses `aftercorr`, which is only for a job array on a job array")
+                elif index not in variables[variable]:
+                    raise ValueError(
+                        f"{fn}: task {index} of `{line}` has no corresponding task in the job array `${{{variable}}}`"
+                    )
+                else:
+                    dependencies.append(variables[variable][index])
+            job = Job.from_sbatch_options(match["script"], dependencies, options, index)
+            jobs.append(job)
+            tasks[index] = job.name
+        if match["variable"] is not None:
+            variables[match["variable"]] = tasks
+    return jobs
+
+
+class JobGraph:
+    """
+    The jobs of a workflow and their dependencies, e.g. conversion, inference, post-processing, atlas registration,
+    ROI generation, conversion to AIMs and visualizations for each image.
+
+    Parameters
+    ----------
+    jobs : List[Job]
+        The jobs. Every dependency must be one of the jobs, and there must not be cycles.
+    """
+
+    def __init__(self, jobs: List[Job]):
+        self.jobs: Dict[str, Job] = {}
+        for job in jobs:
+            if job.name in self.jobs:
+                raise ValueError(f"job {job.name} is given more than once")
+            self.jobs[job.name] = job
+        for job in jobs:
+            for dependency in job.dependencies:
+                if dependency not in self.jobs:
+                    raise ValueError(f"job {job.name} depends on {dependency}, which is not a job")
+        self.dependents: Dict[str, List[str]] = {name: [] for name in self.jobs}
+        for job in jobs:
+            for dependency in job.dependencies:
+                self.dependents[dependency].append(job.name)
+        self.order = self.get_topological_order()
+
+    @classmethod
+    def from_submit_script(cls, fn: str) -> JobGraph:
+        return cls(read_submit_script(fn))
+
+    def get_topological_order(self) -> List[str]:
+        """ Get the jobs in an order where every job comes after its dependencies, otherwise in the given order. """
+        remaining = {name: len(set(job.dependencies)) for name, job in self.jobs.items()}
+        ready = [name for name, count in remaining.items() if count == 0]
+        order = []
+        while ready:
+            name = ready.pop(0)
+            order.append(name)
+            for dependent in dict.fromkeys(self.dependents[name]):
+                remaining[dependent] -= 1
+                if remaining[dependent] == 0:
+                    ready.append(dependent)
+        if len(order) != len(self.jobs):
+            raise ValueError(f"the jobs have a dependency cycle through {[n for n in self.jobs if n not in order]}")
+        return order
+
+    def __len__(self) -> int:
+        return len(self.jobs)
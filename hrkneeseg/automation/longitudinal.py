@@ -1,27 +1,23 @@
 from __future__ import annotations
 
 # external imports
-from typing import List, Optional
+from typing import Dict, List, Optional
 from argparse import Namespace
 import yaml
 import os
 
-# bonelab imports
-from bonelab.util.echo_arguments import echo_arguments
-from bonelab.util.time_stamp import message
-
 # internal imports
 from hrkneeseg.automation.parser import create_parser
 from hrkneeseg.automation.write_slurm_script import write_slurm_script
+from hrkneeseg.aim_nifti.aim_io import AIMHeader
+from hrkneeseg.automation.job_arrays import create_job_array_files
 from hrkneeseg.automation.common import (
     ROI_CODES, create_segmentation_slurm_files,
-    create_atlas_registration_slurm_files
+    create_atlas_registration_slurm_files, create_shell_files, get_aim_headers, wrap_with_transform_cache
 )
+from hrkneeseg.utils.nifti_format import DELIVERABLE_FORMAT, NIFTI_FORMATS
 
 
-def create_shell_files() -> None:
-    raise NotImplementedError
-
 
 def create_slurm_files(
     automation_subdir: str,
@@ -37,7 +33,12 @@ def create_slurm_files(
     conda_dir: str,
     conda_env: str,
     segmentation_models: List[dict],
-    email: Optional[str] = None
+    email: Optional[str] = None,
+    transform_cache_dir: Optional[str] = None,
+    downsampled_atlas_registration: bool = False,
+    intermediate_format: str = DELIVERABLE_FORMAT,
+    aim_headers: Optional[Dict[str, AIMHeader]] = None,
+    pipeline_jobs: bool = False
 ) -> str:
     '''
     Create slurm scripts and shell batch submit script
@@ -92,6 +93,34 @@ def create_slurm_files(
         Email address to send notifications to.
         Defaults to `None`.
 
+    transform_cache_dir : Optional[str], optional
+        The transform cache directory. If given, the atlas and longitudinal
+        registrations are run through `hrkTransformCache` so they are
+        skipped when resubmitted with unchanged inputs.
+        Defaults to `None`.
+
+    downsampled_atlas_registration : bool, optional
+        Whether to do the atlas registration in the downsampled domain with
+        `hrkAtlasRegistration`.
+        Defaults to `False`.
+
+    intermediate_format : str, optional
+        The format of the intermediate NIfTI images, `nii.gz` or `nii`.
+        The post-processed masks are always `nii.gz`.
+        Defaults to `nii.gz`.
+
+    aim_headers : Optional[Dict[str, AIMHeader]], optional
+        The headers of the image AIMs, by image name, to size the memory
+        requests of the conversions to NIfTI.
+        Defaults to `None`.
+
+    pipeline_jobs : bool, optional
+        Whether to run the segmentation steps of each image in one
+        `hrkPipeline` job, which passes the images between the steps in
+        memory, instead of a job per step. The ROIs are generated in the
+        baseline domain, so they keep a job per step.
+        Defaults to `False`.
+
     Returns
     -------
     str
@@ -119,7 +148,10 @@ def create_slurm_files(
             segmentation_models,
             seg_jid_var,
             email,
-            timecode=t
+            timecode=t,
+            intermediate_format=intermediate_format,
+            aim_header=(aim_headers or {}).get(image),
+            pipeline_jobs=pipeline_jobs
         )
         if (bone == "tibia") or (bone == "femur"):
             shell_submit_script_lines += create_atlas_registration_slurm_files(
@@ -135,7 +167,10 @@ def create_slurm_files(
                 seg_jid_var,
                 atlas_jid_var,
                 email,
-                timecode=t
+                timecode=t,
+                transform_cache_dir=transform_cache_dir,
+                downsampled_atlas_registration=downsampled_atlas_registration,
+                intermediate_format=intermediate_format
             )
     if bone == "patella":
         # if we have been given a patella, just do the segmentation and then
@@ -152,28 +187,30 @@ def create_slurm_files(
     for image in [baseline] + followups:
         longitudinal_registration_commands += [
             f"hrkMaskImage \\",
-            f"{os.path.join(working_dir, 'niftis', f'{image.lower()}.nii.gz')} \\",
+            f"{os.path.join(working_dir, 'niftis', f'{image.lower()}.{intermediate_format}')} \\",
             f"{os.path.join(working_dir, 'model_masks', f'{image.lower()}_postprocessed_mask.nii.gz')} \\",
-            f"{os.path.join(working_dir, 'niftis', f'{image.lower()}_masked.nii.gz')} \\",
-            f"--dilate-amount 35 --background-class 0 --background-value -1000 -ow"
+            f"{os.path.join(working_dir, 'niftis', f'{image.lower()}_masked.{intermediate_format}')} \\",
+            f"--dilate-amount 35 --background-class 0 --background-value -1000 -siu"
         ]
     longitudinal_registration_commands.append(
         "echo \"Step 2: longitudinal registration\""
     )
     longitudinal_registration_commands += [
         f"mkdir {os.path.join(working_dir, 'registrations', baseline)}",
+    ]
+    longitudinal_registration_lines = [
         f"blRegistrationLongitudinal \\",
         f"{os.path.join(working_dir, 'registrations', baseline)} {name.lower()} \\",
-        f"{os.path.join(working_dir, 'niftis', f'{baseline.lower()}_masked.nii.gz')} \\",
+        f"{os.path.join(working_dir, 'niftis', f'{baseline.lower()}_masked.{intermediate_format}')} \\",
     ]
     for followup in followups:
-        longitudinal_registration_commands += [
-            f"{os.path.join(working_dir, 'niftis', f'{followup.lower()}_masked.nii.gz')} \\"
+        longitudinal_registration_lines += [
+            f"{os.path.join(working_dir, 'niftis', f'{followup.lower()}_masked.{intermediate_format}')} \\"
         ]
-    longitudinal_registration_commands += [
+    longitudinal_registration_lines += [
         f"--baseline-label {timecodes[0]} --follow-up-labels {' '.join(timecodes[1:])} \\"
     ]
-    longitudinal_registration_commands += [
+    longitudinal_registration_lines += [
         "--max-iterations 1000 \\",
         "--downsampling-shrink-factor 4 \\",
         "--downsampling-smoothing-sigma 1 \\",
@@ -186,12 +223,24 @@ def create_slurm_files(
         "--centering-initialization Geometry \\",
         "--overwrite"
     ]
+    longitudinal_registration_commands += wrap_with_transform_cache(
+        longitudinal_registration_lines,
+        [
+            os.path.join(working_dir, 'niftis', f'{image.lower()}_masked.{intermediate_format}')
+            for image in [baseline] + followups
+        ],
+        [
+            os.path.join(working_dir, 'registrations', baseline, f'{name.lower()}_{timecode}_transform.txt')
+            for timecode in timecodes[1:]
+        ],
+        transform_cache_dir
+    )
     longitudinal_registration_commands.append(
         "echo \"Step 3: remove masked images\""
     )
     for image in [baseline] + followups:
         longitudinal_registration_commands.append(
-            f"rm {os.path.join(working_dir, 'niftis', f'{image.lower()}_masked.nii.gz')}"
+            f"rm {os.path.join(working_dir, 'niftis', f'{image.lower()}_masked.{intermediate_format}')}"
         )
     write_slurm_script(
         longitudinal_registration_slurm,
@@ -220,7 +269,7 @@ def create_slurm_files(
             f"blRegistrationApplyTransform \\",
             f"{os.path.join(working_dir, 'model_masks', f'{followup.lower()}_postprocessed_mask.nii.gz')} \\",
             f"{os.path.join(working_dir, 'registrations', baseline, f'{name.lower()}_{timecode}_transform.txt')} \\",
-            f"{os.path.join(working_dir, 'registrations', baseline, f'{name.lower()}_{timecode}_bone_mask_baseline.nii.gz')} \\",
+            f"{os.path.join(working_dir, 'registrations', baseline, f'{name.lower()}_{timecode}_bone_mask_baseline.{intermediate_format}')} \\",
             f"-fi {os.path.join(working_dir, 'model_masks', f'{baseline.lower()}_postprocessed_mask.nii.gz')} \\",
             "-int NearestNeighbour -ow"
         ]
@@ -230,9 +279,9 @@ def create_slurm_files(
     for followup, timecode in zip(followups, timecodes[1:]):
         generate_rois_commands += [
             f"blRegistrationApplyTransform \\",
-            f"{os.path.join(working_dir, 'atlas_registrations', f'{followup.lower()}_atlas_mask_transformed.nii.gz')} \\",
+            f"{os.path.join(working_dir, 'atlas_registrations', f'{followup.lower()}_atlas_mask_transformed.{intermediate_format}')} \\",
             f"{os.path.join(working_dir, 'registrations', baseline, f'{name.lower()}_{timecode}_transform.txt')} \\",
-            f"{os.path.join(working_dir, 'registrations', baseline, f'{name.lower()}_{timecode}_atlas_mask_baseline.nii.gz')} \\",
+            f"{os.path.join(working_dir, 'registrations', baseline, f'{name.lower()}_{timecode}_atlas_mask_baseline.{intermediate_format}')} \\",
             f"-fi {os.path.join(working_dir, 'model_masks', f'{baseline.lower()}_postprocessed_mask.nii.gz')} \\",
             "-int NearestNeighbour -ow"
         ]
@@ -242,14 +291,14 @@ def create_slurm_files(
     generate_rois_commands += [
         f"hrkIntersectMasks \\",
         f"-i \\"
-        f"{os.path.join(working_dir, 'atlas_registrations', f'{baseline.lower()}_atlas_mask_transformed.nii.gz')} \\"
+        f"{os.path.join(working_dir, 'atlas_registrations', f'{baseline.lower()}_atlas_mask_transformed.{intermediate_format}')} \\"
     ]
     for followup, timecode in zip(followups, timecodes[1:]):
         generate_rois_commands += [
-            f"{os.path.join(working_dir, 'registrations', baseline, f'{name.lower()}_{timecode}_atlas_mask_baseline.nii.gz')} \\"
+            f"{os.path.join(working_dir, 'registrations', baseline, f'{name.lower()}_{timecode}_atlas_mask_baseline.{intermediate_format}')} \\"
         ]
     generate_rois_commands += [
-        f"-o {os.path.join(working_dir, 'registrations', baseline, f'{name.lower()}_atlas_masks_overlapped_baseline.nii.gz')} \\",
+        f"-o {os.path.join(working_dir, 'registrations', baseline, f'{name.lower()}_atlas_masks_overlapped_baseline.{intermediate_format}')} \\",
         f"-c 1 2 -ow"
     ]
     generate_rois_commands += [
@@ -257,20 +306,20 @@ def create_slurm_files(
         f"hrkGenerateROIs \\",
         f"{os.path.join(working_dir, 'model_masks', f'{baseline.lower()}_postprocessed_mask.nii.gz')} \\",
         f"{bone} \\",
-        f"{os.path.join(working_dir, 'registrations', baseline, f'{name.lower()}_atlas_masks_overlapped_baseline.nii.gz')} \\",
+        f"{os.path.join(working_dir, 'registrations', baseline, f'{name.lower()}_atlas_masks_overlapped_baseline.{intermediate_format}')} \\",
         f"{os.path.join(working_dir, 'roi_masks')} \\",
         f"{baseline.lower()} \\",
-        f"--axial-dilation-footprint 40 -ow"
+        f"--axial-dilation-footprint 40 -of {intermediate_format} -siu"
     ]
     for followup, timecode in zip(followups, timecodes[1:]):
         generate_rois_commands += [
             f"hrkGenerateROIs \\",
-            f"{os.path.join(working_dir, 'registrations', baseline, f'{name.lower()}_{timecode}_bone_mask_baseline.nii.gz')} \\",
+            f"{os.path.join(working_dir, 'registrations', baseline, f'{name.lower()}_{timecode}_bone_mask_baseline.{intermediate_format}')} \\",
             f"{bone} \\",
-            f"{os.path.join(working_dir, 'registrations', baseline, f'{name.lower()}_atlas_masks_overlapped_baseline.nii.gz')} \\",
+            f"{os.path.join(working_dir, 'registrations', baseline, f'{name.lower()}_atlas_masks_overlapped_baseline.{intermediate_format}')} \\",
             f"{os.path.join(working_dir, 'roi_masks')} \\",
             f"{followup.lower()}_baseline \\",
-            f"--axial-dilation-footprint 40 -ow"
+            f"--axial-dilation-footprint 40 -of {intermediate_format} -siu"
         ]
     generate_rois_commands.append(
         "echo \"Step 5: Transform the followup ROIs to the followup reference frames\""
@@ -278,9 +327,9 @@ def create_slurm_files(
     for followup, timecode in zip(followups, timecodes[1:]):
         generate_rois_commands += [
             f"blRegistrationApplyTransform \\",
-            f"{os.path.join(working_dir, 'roi_masks', f'{followup.lower()}_baseline_allrois_mask.nii.gz')} \\",
+            f"{os.path.join(working_dir, 'roi_masks', f'{followup.lower()}_baseline_allrois_mask.{intermediate_format}')} \\",
             f"{os.path.join(working_dir, 'registrations', baseline, f'{name.lower()}_{timecode}_transform.txt')} \\",
-            f"{os.path.join(working_dir, 'roi_masks', f'{followup.lower()}_allrois_mask.nii.gz')} \\",
+            f"{os.path.join(working_dir, 'roi_masks', f'{followup.lower()}_allrois_mask.{intermediate_format}')} \\",
             f"-fi {os.path.join(working_dir, 'model_masks', f'{followup.lower()}_postprocessed_mask.nii.gz')} \\",
             "-int NearestNeighbour -it -ow"
         ]
@@ -291,9 +340,9 @@ def create_slurm_files(
     for followup, timecode in zip(followups, timecodes[1:]):
         generate_rois_commands += [
             f"  blRegistrationApplyTransform \\",
-            f"  {os.path.join(working_dir, 'roi_masks', f'{followup.lower()}_baseline_roi${{ROI_CODE}}_mask.nii.gz')} \\",
+            f"  {os.path.join(working_dir, 'roi_masks', f'{followup.lower()}_baseline_roi${{ROI_CODE}}_mask.{intermediate_format}')} \\",
             f"  {os.path.join(working_dir, 'registrations', baseline, f'{name.lower()}_{timecode}_transform.txt')} \\",
-            f"  {os.path.join(working_dir, 'roi_masks', f'{followup.lower()}_roi${{ROI_CODE}}_mask.nii.gz')} \\",
+            f"  {os.path.join(working_dir, 'roi_masks', f'{followup.lower()}_roi${{ROI_CODE}}_mask.{intermediate_format}')} \\",
             f"  -fi {os.path.join(working_dir, 'model_masks', f'{followup.lower()}_postprocessed_mask.nii.gz')} \\",
             "  -int NearestNeighbour -it -ow"
         ]
@@ -318,10 +367,10 @@ def create_slurm_files(
         for roi_code in ROI_CODES[bone]:
             rois_to_aims_commands += [
                 f"hrkMask2AIM \\",
-                f"{os.path.join(working_dir, 'roi_masks', f'{image.lower()}_roi{roi_code}_mask.nii.gz')} \\",
+                f"{os.path.join(working_dir, 'roi_masks', f'{image.lower()}_roi{roi_code}_mask.{intermediate_format}')} \\",
                 f"{os.path.join(working_dir, 'aims', f'{image}.AIM')} \\",
                 f"{os.path.join(working_dir, 'roi_masks', f'{image}_ROI{roi_code}_MASK.AIM')} \\",
-                f"-l \"Generated using the code at: https://github.com/Bonelab/HRpQCT-Knee-Seg\" -ow",
+                f"-l \"Generated using the code at: https://github.com/Bonelab/HRpQCT-Knee-Seg\" -siu",
             ]
     write_slurm_script(
         rois_to_aims_slurm,
@@ -343,8 +392,8 @@ def create_slurm_files(
     for image in [baseline] + followups:
         visualize_commands += [
             f"hrkVisualize2DPanning \\",
-            f"{os.path.join(working_dir, 'niftis', f'{image.lower()}.nii.gz')} \\",
-            f"{os.path.join(working_dir, 'roi_masks', f'{image.lower()}_allrois_mask.nii.gz')} \\",
+            f"{os.path.join(working_dir, 'niftis', f'{image.lower()}.{intermediate_format}')} \\",
+            f"{os.path.join(working_dir, 'roi_masks', f'{image.lower()}_allrois_mask.{intermediate_format}')} \\",
             f"{os.path.join(working_dir, 'visualizations', f'{image.lower()}_rois_reg')} \\",
             "-ib -400 1400 -pd 1 -ri -cens 10",
         ]
@@ -368,11 +417,21 @@ def create_slurm_files(
 
 
 def longitudinal(args: Namespace) -> None:
+    from bonelab.util.echo_arguments import echo_arguments
     params = vars(args)
     with open(args.yaml, "r") as file:
         config = yaml.safe_load(file)
     params = {**params, **config}
     print(echo_arguments("Longitudinal Automation", params))
+    if params["intermediate_format"] not in NIFTI_FORMATS:
+        raise ValueError(f"`intermediate_format` must be one of {NIFTI_FORMATS}, got {params['intermediate_format']}")
+    aim_headers = (
+        get_aim_headers(
+            params["working_directory"],
+            [image for data in params["data"] for image in [data["baseline"]] + data["followups"]]
+        )
+        if params.get("index_aims", False) else {}
+    )
     try:
         os.mkdir(args.automation_dir)
     except FileExistsError:
@@ -392,7 +451,8 @@ def longitudinal(args: Namespace) -> None:
             ))
         except FileExistsError:
             pass
-        if params["mode"] == "slurm":
+        # in shell mode, `hrkRunJobs` runs the same scripts as slurm would
+        if params["mode"] in ["slurm", "shell"]:
             batch_submit_lines.append(
                 create_slurm_files(
                     params["automation_dir"],
@@ -408,15 +468,22 @@ def longitudinal(args: Namespace) -> None:
                     params["conda_directory"],
                     params["environment"],
                     params["segmentation_models"],
-                    params["email"]
+                    params["email"],
+                    params.get("transform_cache_directory"),
+                    params.get("downsampled_atlas_registration", False),
+                    params["intermediate_format"],
+                    aim_headers,
+                    params.get("pipeline_jobs", False)
                 )
             )
-        elif params["mode"] == "shell":
-            raise NotImplementedError("Shell mode not implemented yet.")
         else:
             raise ValueError(f"Invalid mode: {params['mode']}")
+    if params.get("job_arrays", False):
+        batch_submit_lines = create_job_array_files(params["automation_dir"], batch_submit_lines[1:])
     with open(os.path.join(params["automation_dir"], "submit_all.sh"), "w") as f:
         f.write("\n".join(batch_submit_lines))
+    if params["mode"] == "shell":
+        create_shell_files(params["automation_dir"])
 
 
 def main():
@@ -2,6 +2,8 @@ from __future__ import annotations
 
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
 
+from hrkneeseg.utils.nifti_format import NIFTI_FORMATS, get_intermediate_format
+
 def create_parser(analysis_type: str) -> ArgumentParser:
     parser = ArgumentParser(
         description=f'{analysis_type} analysis',
@@ -21,14 +23,64 @@ def create_parser(analysis_type: str) -> ArgumentParser:
     parser.add_argument(
         "--mode", "-m", type=str, choices=["shell", "slurm"], default="slurm",
         help=(
-            "Mode of automation. `shell` will create shell scripts that can be "
-            "run on a local machine. `slurm` will create slurm scripts that can "
+            "Mode of automation. `slurm` will create slurm scripts that can "
             "be submitted to a slurm cluster, along with a shell script to "
-            "submit the slurm scripts with the correct dependency structure."
+            "submit the slurm scripts with the correct dependency structure. "
+            "`shell` will create the same scripts, along with a `run_all.sh` "
+            "script that runs them on a local machine with `hrkRunJobs`, with "
+            "the same dependency structure and as many at a time as the CPUs, "
+            "memory and GPUs allow."
         )
     )
     parser.add_argument(
         "--email", "-e", type=str, default=None,
         help="Email address to send notifications to. Only applies to `slurm` mode."
     )
+    parser.add_argument(
+        "--intermediate-format", "-if", type=str, choices=NIFTI_FORMATS, default=get_intermediate_format(),
+        help=(
+            "Format of the intermediate NIfTI images that the steps pass to "
+            "each other. `nii` is not compressed, which saves the time spent "
+            "in gzip when writing large images but uses more disk space. The "
+            "post-processed masks are always written as `nii.gz`. The default "
+            "is set by the `HRKNEESEG_INTERMEDIATE_FORMAT` environment variable, "
+            "and can be overridden with `intermediate_format` in the YAML file."
+        )
+    )
+    parser.add_argument(
+        "--index-aims", "-ia", action="store_true", default=False,
+        help=(
+            "Look up the headers of the AIMs in the AIM index of the `aims` "
+            "directory before writing any scripts, to stop early if any AIM is "
+            "missing or unreadable and to size the memory requests of the "
+            "conversions to NIfTI from the image dimensions. Only the AIM "
+            "headers are read."
+        )
+    )
+    parser.add_argument(
+        "--pipeline-jobs", "-pj", action="store_true", default=False,
+        help=(
+            "Run the segmentation steps of each image, from the conversion "
+            "of the AIM to the conversion of the tissue masks to AIMs, in one "
+            "`hrkPipeline` job that passes the images between the steps in "
+            "memory, instead of a job per step. In cross-sectional analyses, "
+            "the ROI generation and conversion to AIMs also run in one job. "
+            "Can also be set with `pipeline_jobs` in the YAML file."
+        )
+    )
+    parser.add_argument(
+        "--job-arrays", "-ja", action="store_true", default=False,
+        help=(
+            "Submit one slurm job array per step for all of the images, or "
+            "participants in longitudinal analyses, instead of a chain of "
+            "jobs for each one, so that the scheduler handles a few arrays "
+            "instead of thousands of jobs. The task of each image runs its "
+            "script of the step, listed in a manifest in `arrays` in the "
+            "automation directory, and waits for the tasks of the same image "
+            "with `--dependency=aftercorr`. The scripts of each image are "
+            "still written, to resubmit one image. `hrkRunJobs --dry-run` "
+            "checks the job arrays without submitting them. Can also be set "
+            "with `job_arrays` in the YAML file."
+        )
+    )
     return parser
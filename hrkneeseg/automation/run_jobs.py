@@ -0,0 +1,355 @@
+from __future__ import annotations
+
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter, Namespace
+import hashlib
+import os
+import subprocess
+import sys
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from hrkneeseg.automation.job_graph import Job, JobGraph, format_time, parse_memory, parse_time
+
+DONE_SUFFIX = ".done"
+LOG_SUFFIX = ".log"
+# the thread pools of the tools are limited to the CPUs that the job reserves
+THREAD_ENVIRONMENT_VARIABLES = ["OMP_NUM_THREADS", "ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS"]
+# the states of a job once the run is over
+DONE, FAILED, SKIPPED = "done", "failed", "skipped"
+# the time that a job without a time limit takes in a simulated run
+DEFAULT_SIMULATED_TIME = "1:00:00"
+
+
+def get_physical_memory_gb() -> float:
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 1024 ** 3
+
+
+def get_script_hash(script: str) -> str:
+    with open(script, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+class LocalExecutor:
+    """
+    Run the jobs of a job graph on this machine, with as many jobs at a time as the CPUs, memory and GPUs allow,
+    using the resources that each job would reserve on slurm. A job starts once its dependencies have finished
+    successfully, and the jobs that depend on a failed job are skipped while the others go on. A job that needs more
+    than the whole machine is given the whole machine and runs alone. Time limits are not applied.
+
+    Each job runs its script with `bash -e`, writes its output to `{name}.log`, and when it succeeds, records the
+    hash of its script in `{name}.done`, where the name of a task of a job array ends with its index. With `resume`,
+    the jobs with a record for their current script are not run again. `simulate` checks the order and duration of
+    a run without running the jobs.
+
+    Parameters
+    ----------
+    graph : JobGraph
+        The jobs.
+
+    num_cpus : int
+        The CPUs to use.
+
+    memory_gb : float
+        The memory to use, in GB.
+
+    num_gpus : int
+        The GPUs to use, given to the jobs in `CUDA_VISIBLE_DEVICES`. With no GPUs, the jobs that request GPUs run
+        without them, e.g. inference falls back to the CPU. Default is 0.
+
+    max_jobs : Optional[int]
+        The most jobs to run at a time, no limit other than the resources if `None`. Default is `None`.
+
+    resume : bool
+        Do not run the jobs that finished successfully in an earlier run. Default is `False`.
+
+    poll_interval : float
+        How often to check the running jobs, in seconds. Default is 1.
+
+    silent : bool
+        Do not print progress messages. Default is `False`.
+    """
+
+    def __init__(
+            self,
+            graph: JobGraph,
+            num_cpus: int,
+            memory_gb: float,
+            num_gpus: int = 0,
+            max_jobs: Optional[int] = None,
+            resume: bool = False,
+            poll_interval: float = 1.0,
+            silent: bool = False
+    ):
+        if num_cpus < 1:
+            raise ValueError(f"`num_cpus` must be at least 1, got {num_cpus}")
+        if memory_gb <= 0:
+            raise ValueError(f"`memory_gb` must be positive, got {memory_gb}")
+        if num_gpus < 0:
+            raise ValueError(f"`num_gpus` must not be negative, got {num_gpus}")
+        if max_jobs is not None and max_jobs < 1:
+            raise ValueError(f"`max_jobs` must be at least 1, got {max_jobs}")
+        self.graph = graph
+        self.num_cpus = num_cpus
+        self.memory_gb = memory_gb
+        self.num_gpus = num_gpus
+        self.max_jobs = max_jobs
+        self.resume = resume
+        self.poll_interval = poll_interval
+        self.silent = silent
+
+    def is_done(self, job: Job) -> bool:
+        """ Check whether the job finished successfully in an earlier run, with the same script. """
+        try:
+            with open(f"{job.name}{DONE_SUFFIX}", "r") as f:
+                return f.read().strip() == get_script_hash(job.script)
+        except OSError:
+            return False
+
+    def get_resources(self, job: Job) -> Tuple[int, float, int]:
+        """ Get the CPUs, memory and GPUs to reserve for the job, at most the whole machine. """
+        return (
+            min(max(job.num_cpus, 1), self.num_cpus),
+            min(job.memory_gb, self.memory_gb),
+            min(job.num_gpus, self.num_gpus)
+        )
+
+    def reserve_resources(
+            self,
+            pending: List[str],
+            states: Dict[str, str],
+            num_running: int,
+            free: Dict[str, Any]
+    ) -> List[Tuple[str, Tuple[int, float, int], List[int]]]:
+        """
+        Skip the pending jobs that depend on a failed or skipped job, then reserve the resources of the pending jobs
+        that are ready and fit in the free resources, in order. The jobs that are skipped or reserved are removed from
+        `pending` and their resources from `free`, which has the free `cpus`, `memory_gb` and `gpus`.
+
+        Returns
+        -------
+        List[Tuple[str, Tuple[int, float, int], List[int]]]
+            The name of each job to start, its CPUs, memory and GPUs, and the indices of its GPUs.
+        """
+        reserved = []
+        for name in list(pending):
+            if any(states.get(d) in (FAILED, SKIPPED) for d in self.graph.jobs[name].dependencies):
+                states[name] = SKIPPED
+                pending.remove(name)
+        for name in list(pending):
+            if self.max_jobs is not None and num_running + len(reserved) >= self.max_jobs:
+                break
+            job = self.graph.jobs[name]
+            if not all(states.get(d) == DONE for d in job.dependencies):
+                continue
+            num_cpus, memory_gb, num_gpus = resources = self.get_resources(job)
+            if num_cpus > free["cpus"] or memory_gb > free["memory_gb"] or num_gpus > len(free["gpus"]):
+                continue
+            gpus, free["gpus"] = free["gpus"][:num_gpus], free["gpus"][num_gpus:]
+            free["cpus"] -= num_cpus
+            free["memory_gb"] -= memory_gb
+            pending.remove(name)
+            reserved.append((name, resources, gpus))
+        return reserved
+
+    def release_resources(self, free: Dict[str, Any], resources: Tuple[int, float, int], gpus: List[int]) -> None:
+        free["cpus"] += resources[0]
+        free["memory_gb"] += resources[1]
+        free["gpus"] = sorted(free["gpus"] + gpus)
+
+    def get_pending(self) -> Tuple[List[str], Dict[str, str]]:
+        """ Get the jobs to run, in order, and the states of the jobs that finished in an earlier run. """
+        states: Dict[str, str] = {}
+        pending = []
+        for name in self.graph.order:
+            if self.resume and self.is_done(self.graph.jobs[name]):
+                states[name] = DONE
+            else:
+                pending.append(name)
+        return pending, states
+
+    def start(self, job: Job, num_cpus: int, gpus: List[int]) -> subprocess.Popen:
+        env = dict(os.environ)
+        for variable in THREAD_ENVIRONMENT_VARIABLES:
+            env[variable] = str(num_cpus)
+        env["CUDA_VISIBLE_DEVICES"] = ",".join(str(gpu) for gpu in gpus)
+        if job.array_index is not None:
+            env["SLURM_ARRAY_TASK_ID"] = str(job.array_index)
+        with open(f"{job.name}{LOG_SUFFIX}", "w") as log:
+            return subprocess.Popen(["bash", "-e", job.script], stdout=log, stderr=subprocess.STDOUT, env=env)
+
+    def run(self) -> Dict[str, str]:
+        """
+        Run the jobs.
+
+        Returns
+        -------
+        Dict[str, str]
+            The state of each job: `done`, `failed`, or `skipped` if a dependency failed.
+        """
+        from bonelab.util.registration_util import message_s
+
+        pending, states = self.get_pending()
+        for name in pending:
+            if self.graph.jobs[name].num_gpus > 0 and self.num_gpus == 0:
+                message_s(f"{name} requests GPUs and will run without one", self.silent)
+        message_s(
+            f"Running {len(pending)} of {len(self.graph)} jobs with {self.num_cpus} CPUs, {self.memory_gb:g} GB "
+            f"and {self.num_gpus} GPUs", self.silent
+        )
+        free = {"cpus": self.num_cpus, "memory_gb": self.memory_gb, "gpus": list(range(self.num_gpus))}
+        running: Dict[str, Tuple[subprocess.Popen, Tuple[int, float, int], List[int], float]] = {}
+        try:
+            while pending or running:
+                waiting = list(pending)
+                for name, resources, gpus in self.reserve_resources(pending, states, len(running), free):
+                    job = self.graph.jobs[name]
+                    running[name] = (self.start(job, resources[0], gpus), resources, gpus, time.perf_counter())
+                    message_s(f"Started {name}", self.silent)
+                for name in waiting:
+                    if states.get(name) == SKIPPED:
+                        message_s(f"Skipping {name}, a dependency failed", self.silent)
+                if not running:
+                    continue
+                time.sleep(self.poll_interval)
+                for name, (process, resources, gpus, start) in list(running.items()):
+                    if process.poll() is None:
+                        continue
+                    del running[name]
+                    self.release_resources(free, resources, gpus)
+                    if process.returncode == 0:
+                        states[name] = DONE
+                        with open(f"{name}{DONE_SUFFIX}", "w") as f:
+                            f.write(get_script_hash(self.graph.jobs[name].script))
+                        message_s(f"Finished {name} in {time.perf_counter() - start:.1f} s", self.silent)
+                    else:
+                        states[name] = FAILED
+                        if os.path.isfile(f"{name}{DONE_SUFFIX}"):
+                            os.remove(f"{name}{DONE_SUFFIX}")
+                        message_s(
+                            f"{name} failed with exit code {process.returncode}, see {name}{LOG_SUFFIX}", self.silent
+                        )
+        except KeyboardInterrupt:
+            for process, _, _, _ in running.values():
+                process.terminate()
+            raise
+        return states
+
+    def simulate(self, default_time: str = DEFAULT_SIMULATED_TIME) -> List[Tuple[str, float, float]]:
+        """
+        Simulate the run without running any jobs, with each job taking its time limit, to check the order the jobs
+        would run in and how long the run would take at most with the resources.
+
+        Parameters
+        ----------
+        default_time : str
+            The time taken by the jobs without a time limit. Default is `DEFAULT_SIMULATED_TIME`.
+
+        Returns
+        -------
+        List[Tuple[str, float, float]]
+            The name of each job that would run, with the times it would start and finish, in seconds.
+        """
+        pending, states = self.get_pending()
+        free = {"cpus": self.num_cpus, "memory_gb": self.memory_gb, "gpus": list(range(self.num_gpus))}
+        schedule = []
+        # the finish time, name, resources and GPUs of each running job
+        running: List[Tuple[float, str, Tuple[int, float, int], List[int]]] = []
+        now = 0.0
+        while pending or running:
+            for name, resources, gpus in self.reserve_resources(pending, states, len(running), free):
+                duration = parse_time(self.graph.jobs[name].time or default_time)
+                running.append((now + duration, name, resources, gpus))
+                schedule.append((name, now, now + duration))
+            if not running:
+                continue
+            running.sort(key=lambda r: r[0])
+            now = running[0][0]
+            while running and running[0][0] == now:
+                _, name, resources, gpus = running.pop(0)
+                self.release_resources(free, resources, gpus)
+                states[name] = DONE
+        return schedule
+
+
+def run_jobs(args: Namespace) -> None:
+    from bonelab.util.echo_arguments import echo_arguments
+    from bonelab.util.registration_util import check_inputs_exist
+
+    print(echo_arguments("Run Jobs", vars(args)))
+    check_inputs_exist([args.submit_script], args.silent)
+    graph = JobGraph.from_submit_script(args.submit_script)
+    executor = LocalExecutor(
+        graph,
+        args.num_cpus,
+        parse_memory(args.memory) if args.memory is not None else get_physical_memory_gb(),
+        args.num_gpus,
+        args.max_jobs,
+        args.resume,
+        silent=args.silent
+    )
+    if args.dry_run:
+        num_dependencies = sum(len(job.dependencies) for job in graph.jobs.values())
+        print(f"The submit script has {len(graph)} jobs with {num_dependencies} dependencies and no cycles")
+        schedule = executor.simulate()
+        for name, start, end in schedule:
+            print(f"{format_time(start):>12} - {format_time(end):>12}  {name}")
+        end = max([end for _, _, end in schedule], default=0)
+        print(f"{len(schedule)} jobs would take at most {format_time(end)}, if each one takes its time limit")
+        return
+    states = executor.run()
+    failed = [name for name, state in states.items() if state == FAILED]
+    skipped = [name for name, state in states.items() if state == SKIPPED]
+    if failed:
+        print(f"{len(failed)} job(s) failed: {failed}")
+        print(f"{len(skipped)} job(s) were skipped because a dependency failed")
+        sys.exit(1)
+
+
+def create_parser() -> ArgumentParser:
+    parser = ArgumentParser(
+        description="Run the jobs of a submit script written by `hrkCrossSectional` or `hrkLongitudinal` on this "
+                    "machine instead of submitting them to slurm, with the same dependencies and as many jobs at a "
+                    "time as the CPUs, memory and GPUs allow, given the resources each job requests in its `#SBATCH` "
+                    "header. A job that fails stops the jobs that depend on it but not the others. Each job writes "
+                    "its output to `{script}.log` and, when it succeeds, a `{script}.done` record, so a run can be "
+                    "resumed with `--resume`. Each task of a job array runs as a job with `SLURM_ARRAY_TASK_ID` set. "
+                    "Run it from the directory the submit script would be run from.",
+        formatter_class=ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        "submit_script", type=str, metavar="SUBMIT_SCRIPT",
+        help="the submit script, e.g. `automation/submit_all.sh` for all of the images or the one of an image"
+    )
+    parser.add_argument(
+        "--num-cpus", "-nc", type=int, default=os.cpu_count() or 1, help="the number of CPUs to use"
+    )
+    parser.add_argument(
+        "--memory", "-mem", type=str, default=None,
+        help="the memory to use, e.g. `64G`, all of the physical memory if not given"
+    )
+    parser.add_argument(
+        "--num-gpus", "-ng", type=int, default=0,
+        help="the number of GPUs to use. with none, the jobs that request GPUs run on the CPU"
+    )
+    parser.add_argument(
+        "--max-jobs", "-mj", type=int, default=None, help="the most jobs to run at a time, no limit if not given"
+    )
+    parser.add_argument(
+        "--resume", "-r", action="store_true", help="do not run the jobs that finished successfully in an earlier run"
+    )
+    parser.add_argument(
+        "--dry-run", "-dr", action="store_true",
+        help="check the job graph and print the times each job would start and finish with the resources, if each "
+             "one took its time limit, without running any jobs"
+    )
+    parser.add_argument("--silent", "-s", action="store_true", help="silence all terminal output")
+    return parser
+
+
+def main() -> None:
+    args = create_parser().parse_args()
+    run_jobs(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+from __future__ import annotations
+
+from typing import Optional, Sequence, Tuple
+
+import numpy as np
+
+
+def get_foreground(labels: np.ndarray, spatial_ndim: int, foreground_channel: int = 0) -> np.ndarray:
+    """
+    Get the foreground of the labels of a volume: the `foreground_channel` channel if the labels have a channel
+    dimension, otherwise the non-zero labels.
+
+    Parameters
+    ----------
+    labels : np.ndarray
+        The labels, with or without a leading channel dimension.
+
+    spatial_ndim : int
+        The number of spatial dimensions.
+
+    foreground_channel : int
+        The channel of the labels to use as the foreground. Default is 0.
+
+    Returns
+    -------
+    np.ndarray
+        The boolean foreground.
+    """
+    if labels.ndim == spatial_ndim + 1:
+        return labels[foreground_channel] > 0
+    if labels.ndim == spatial_ndim:
+        return labels > 0
+    raise ValueError(f"labels must have {spatial_ndim} or {spatial_ndim + 1} dimensions, got {labels.ndim}")
+
+
+class ForegroundIndex:
+    """
+    The flat indices of the foreground voxels of a volume, so that a random foreground voxel can be drawn in
+    constant time instead of searching the labels for every draw.
+
+    The indices are stored as `uint32` when the volume has fewer than 2^32 voxels, and can be saved next to the
+    volume and memory-mapped back, in which case a draw only reads the one index it picks.
+
+    Parameters
+    ----------
+    indices : np.ndarray
+        The flat indices of the foreground voxels, in ascending order.
+
+    spatial_shape : Sequence[int]
+        The shape of the volume.
+    """
+
+    def __init__(self, indices: np.ndarray, spatial_shape: Sequence[int]):
+        self.indices = indices
+        self.spatial_shape = tuple(int(s) for s in spatial_shape)
+        self._slab_offsets: Optional[np.ndarray] = None
+
+    @classmethod
+    def from_foreground(cls, foreground: np.ndarray) -> ForegroundIndex:
+        """
+        Build the index of a boolean foreground.
+
+        Parameters
+        ----------
+        foreground : np.ndarray
+            The boolean foreground.
+
+        Returns
+        -------
+        ForegroundIndex
+        """
+        dtype = np.uint32 if foreground.size <= np.iinfo(np.uint32).max else np.int64
+        return cls(np.flatnonzero(foreground).astype(dtype, copy=False), foreground.shape)
+
+    @classmethod
+    def from_labels(cls, labels: np.ndarray, spatial_ndim: int, foreground_channel: int = 0) -> ForegroundIndex:
+        """
+        Build the index of the foreground of some labels, see `get_foreground`.
+
+        Parameters
+        ----------
+        labels : np.ndarray
+            The labels, with or without a leading channel dimension.
+
+        spatial_ndim : int
+            The number of spatial dimensions.
+
+        foreground_channel : int
+            The channel of the labels to use as the foreground. Default is 0.
+
+        Returns
+        -------
+        ForegroundIndex
+        """
+        return cls.from_foreground(get_foreground(labels, spatial_ndim, foreground_channel))
+
+    def save(self, fn: str) -> None:
+        np.save(fn, self.indices)
+
+    @classmethod
+    def load(cls, fn: str, spatial_shape: Sequence[int], mmap_mode: Optional[str] = "r") -> ForegroundIndex:
+        """
+        Load an index saved with `save`.
+
+        Parameters
+        ----------
+        fn : str
+            The `.npy` file of the index.
+
+        spatial_shape : Sequence[int]
+            The shape of the volume.
+
+        mmap_mode : Optional[str]
+            The mode to memory-map the indices with, or `None` to read them into memory. Default is `"r"`.
+
+        Returns
+        -------
+        ForegroundIndex
+        """
+        return cls(np.load(fn, mmap_mode=mmap_mode), spatial_shape)
+
+    def __len__(self) -> int:
+        return int(self.indices.size)
+
+    def draw(self, rng: np.random.Generator) -> Tuple[int, ...]:
+        """
+        Draw a random foreground voxel.
+
+        Parameters
+        ----------
+        rng : np.random.Generator
+            The random number generator.
+
+        Returns
+        -------
+        Tuple[int, ...]
+            The position of the voxel.
+        """
+        if len(self) == 0:
+            raise ValueError("cannot draw from an empty foreground")
+        return tuple(int(i) for i in np.unravel_index(int(self.indices[rng.integers(len(self))]), self.spatial_shape))
+
+    def draw_many(self, rng: np.random.Generator, n: int) -> np.ndarray:
+        """
+        Draw `n` random foreground voxels, with replacement.
+
+        Parameters
+        ----------
+        rng : np.random.Generator
+            The random number generator.
+
+        n : int
+            The number of voxels.
+
+        Returns
+        -------
+        np.ndarray
+            The (n, ndim) positions of the voxels.
+        """
+        if len(self) == 0:
+            raise ValueError("cannot draw from an empty foreground")
+        picks = np.sort(rng.integers(len(self), size=n))
+        # sorted picks read the memory-mapped indices in order, the draws are shuffled back afterwards
+        positions = np.stack(np.unravel_index(self.indices[picks], self.spatial_shape), axis=-1)
+        return positions[rng.permutation(n)]
+
+    def get_slab_offsets(self) -> np.ndarray:
+        """
+        Get the offsets of the foreground voxels of each slab of the volume along its first axis, e.g. each slice
+        of a (z, y, x) volume. The indices are in ascending order, so the voxels of slab `i` are
+        `indices[offsets[i]:offsets[i + 1]]`.
+
+        Returns
+        -------
+        np.ndarray
+            The `spatial_shape[0] + 1` offsets.
+        """
+        if self._slab_offsets is None:
+            slab_size = int(np.prod(self.spatial_shape[1:], dtype=np.int64))
+            bounds = np.arange(self.spatial_shape[0] + 1, dtype=np.int64) * slab_size
+            self._slab_offsets = np.searchsorted(self.indices, bounds).astype(np.int64)
+        return self._slab_offsets
+
+    def draw_in_slabs(self, rng: np.random.Generator, slabs: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Draw a random foreground voxel in each of the given slabs along the first axis, see `get_slab_offsets`.
+
+        Parameters
+        ----------
+        rng : np.random.Generator
+            The random number generator.
+
+        slabs : np.ndarray
+            The (n,) slabs to draw from, with repetition.
+
+        Returns
+        -------
+        Tuple[np.ndarray, np.ndarray]
+            The (n, ndim) positions of the voxels, and the (n,) boolean mask of the slabs that have foreground. The
+            positions of slabs without foreground are zeros.
+        """
+        slabs = np.asarray(slabs, dtype=np.int64)
+        offsets = self.get_slab_offsets()
+        counts = offsets[slabs + 1] - offsets[slabs]
+        has_foreground = counts > 0
+        positions = np.zeros((len(slabs), len(self.spatial_shape)), dtype=np.int64)
+        picks = offsets[slabs[has_foreground]] + (rng.random(int(has_foreground.sum())) * counts[has_foreground])
+        picks = np.minimum(picks.astype(np.int64), offsets[slabs[has_foreground] + 1] - 1)
+        if len(picks) > 0:
+            positions[has_foreground] = np.stack(np.unravel_index(self.indices[picks], self.spatial_shape), axis=-1)
+        return positions, has_foreground
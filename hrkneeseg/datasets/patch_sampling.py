@@ -0,0 +1,129 @@
+from __future__ import annotations
+
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from hrkneeseg.datasets.foreground_index import ForegroundIndex
+
+
+def get_patch_slices(
+        center: Tuple[int, ...], spatial_shape: Tuple[int, ...], patch_width: int
+) -> Tuple[Tuple[slice, ...], List[Tuple[int, int]]]:
+    """
+    Get the slices of a patch centered on a voxel, shifted to lie inside the volume, and the padding needed along
+    each axis where the volume is narrower than the patch.
+    """
+    slices = []
+    padding = []
+    for c, s in zip(center, spatial_shape):
+        start = min(max(int(c) - patch_width // 2, 0), max(s - patch_width, 0))
+        stop = min(start + patch_width, s)
+        slices.append(slice(start, stop))
+        padding.append((0, patch_width - (stop - start)))
+    return tuple(slices), padding
+
+
+def sample_patch(
+        image: np.ndarray,
+        labels: np.ndarray,
+        foreground: ForegroundIndex,
+        patch_width: int,
+        probability: float,
+        rng: np.random.Generator
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Draw a random patch from a volume, mirroring `ForegroundPatchSampler`: with probability `probability` the patch
+    is centered on a random foreground voxel, otherwise on a random voxel, and it is shifted to lie inside the
+    volume. Finding a foreground voxel takes one lookup in the foreground index.
+
+    Parameters
+    ----------
+    image : np.ndarray
+        The image, with a leading channel dimension. Can be a memory-map, only the patch is read.
+
+    labels : np.ndarray
+        The labels, with or without a leading channel dimension.
+
+    foreground : ForegroundIndex
+        The index of the foreground voxels.
+
+    patch_width : int
+        The width of the patch.
+
+    probability : float
+        The probability of centering the patch on a foreground voxel.
+
+    rng : np.random.Generator
+        The random number generator.
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray]
+        The image and labels patches, as contiguous arrays. Volumes narrower than the patch are padded with zeros.
+    """
+    spatial_shape = image.shape[1:]
+    if len(foreground) > 0 and rng.random() < probability:
+        center = foreground.draw(rng)
+    else:
+        center = tuple(int(rng.integers(s)) for s in spatial_shape)
+    slices, padding = get_patch_slices(center, spatial_shape, patch_width)
+    image_patch = np.array(image[(slice(None),) + slices])
+    labels_patch = np.array(labels[(slice(None),) * (labels.ndim - len(spatial_shape)) + slices])
+    if any(p for _, p in padding):
+        image_patch = np.pad(image_patch, [(0, 0)] + padding)
+        labels_patch = np.pad(labels_patch, [(0, 0)] * (labels.ndim - len(spatial_shape)) + padding)
+    return image_patch, labels_patch
+
+
+class IndexedForegroundPatchSampler:
+    """
+    A drop-in for `ForegroundPatchSampler` that builds the foreground index of an image the first time it samples
+    the image and reuses it for the following samples, so when all of the samples of an image are drawn in a row,
+    as `write_samples_by_image` does, the labels are only searched once per image instead of once per sample.
+
+    Parameters
+    ----------
+    patch_width : int
+        The width of the patches. Default is 64.
+
+    foreground_channel : int
+        The channel of the labels to center foreground patches on. Default is 0.
+
+    prob : float
+        The probability of centering a patch on a foreground voxel. Default is 0.5.
+
+    seed : Optional[int]
+        The seed of the random number generator. If `None`, the generator is seeded from the OS the first time it is
+        used in a process, so worker processes draw different patches. Default is `None`.
+    """
+
+    def __init__(
+            self,
+            patch_width: int = 64,
+            foreground_channel: int = 0,
+            prob: float = 0.5,
+            seed: Optional[int] = None
+    ):
+        self.patch_width = patch_width
+        self.foreground_channel = foreground_channel
+        self.prob = prob
+        self.seed = seed
+        self._rng = None
+        self._labels = None
+        self._index = None
+
+    def __call__(self, sample: Tuple[np.ndarray, np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+        image, labels = sample
+        if self._rng is None:
+            self._rng = np.random.default_rng(self.seed)
+        if labels is not self._labels:
+            self._index = ForegroundIndex.from_labels(labels, image.ndim - 1, self.foreground_channel)
+            self._labels = labels
+        return sample_patch(image, labels, self._index, self.patch_width, self.prob, self._rng)
+
+    def __getstate__(self):
+        # a pickled sampler, e.g. sent to a worker process, starts with a fresh generator and no cached image
+        state = self.__dict__.copy()
+        state.update(_rng=None, _labels=None, _index=None)
+        return state
@@ -0,0 +1,430 @@
+from __future__ import annotations
+
+from argparse import Namespace
+from glob import glob
+import json
+import os
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+# bump this if the layout of the store changes, so that old stores are rejected instead of misread
+SAMPLE_STORE_FORMAT_VERSION = 1
+# samples per shard, each shard holds one `.npy` file per field of the samples
+DEFAULT_SHARD_SIZE = 64
+SAMPLE_FORMATS = ["store", "pickle"]
+
+
+def get_manifest_filename(store_dir: str, part: str) -> str:
+    return os.path.join(store_dir, f"part-{part}.json")
+
+
+def get_shard_filename(store_dir: str, part: str, shard: int, field: int) -> str:
+    return os.path.join(store_dir, f"part-{part}-{shard:05d}-{field}.npy")
+
+
+def is_sample_store(store_dir: str) -> bool:
+    """
+    Check whether a directory contains a sample store, i.e. at least one part with a manifest.
+
+    Parameters
+    ----------
+    store_dir : str
+        The directory.
+
+    Returns
+    -------
+    bool
+        Whether the directory contains a sample store.
+    """
+    return len(glob(get_manifest_filename(store_dir, "*"))) > 0
+
+
+def _is_tensor(x: Any) -> bool:
+    return type(x).__module__.split(".")[0] == "torch"
+
+
+def _to_array(x: Any) -> np.ndarray:
+    if _is_tensor(x):
+        x = x.detach().cpu()
+    return np.asarray(x)
+
+
+class SampleStoreWriter:
+    """
+    Write samples to a part of a sample store: shards of fixed-size records in `.npy` files, and a JSON manifest.
+
+    A sample is an array or tensor, or a tuple of them, e.g. `(image, masks)`. Each element of the sample is a
+    field, and each field of every sample must have the same shape and dtype, so that the samples of a shard can be
+    stacked in one array per field. Tensors are stored as arrays and given back as tensors by `SampleStoreDataset`.
+
+    Several writers can write to one directory, e.g. jobs preprocessing different ranges of images, as long as each
+    has its own `part`. The manifest of a part is written last, when the writer is closed, so a part that was not
+    finished is ignored by `SampleStore`.
+
+    Parameters
+    ----------
+    store_dir : str
+        The directory of the store. It is created if it does not exist.
+
+    part : str
+        The name of the part. A part with the same name in the directory is replaced. Default is `"0"`.
+
+    shard_size : int
+        The number of samples per shard. Default is `64`.
+
+    args : Optional[Namespace]
+        The arguments the samples were created with, saved in the manifest. Default is `None`.
+    """
+
+    def __init__(
+            self,
+            store_dir: str,
+            part: str = "0",
+            shard_size: int = DEFAULT_SHARD_SIZE,
+            args: Optional[Namespace] = None
+    ):
+        if shard_size < 1:
+            raise ValueError(f"`shard_size` must be at least 1, got {shard_size}")
+        self.store_dir = store_dir
+        self.part = part
+        self.shard_size = shard_size
+        self.args = vars(args) if args is not None else {}
+        self.fields: Optional[List[Dict]] = None
+        self.is_tuple: Optional[bool] = None
+        self.shard_counts: List[int] = []
+        self._shard: Optional[List[np.memmap]] = None
+        os.makedirs(store_dir, exist_ok=True)
+        # the old part, if any, is replaced, so it must not be readable while its shards are overwritten
+        if os.path.isfile(get_manifest_filename(store_dir, part)):
+            os.remove(get_manifest_filename(store_dir, part))
+
+    def __len__(self) -> int:
+        return sum(self.shard_counts)
+
+    def _split(self, sample: Any) -> Tuple[bool, List[Any]]:
+        if isinstance(sample, (tuple, list)):
+            return True, list(sample)
+        return False, [sample]
+
+    def _check_fields(self, fields: List[Dict], is_tuple: bool) -> None:
+        if self.fields is None:
+            self.fields = fields
+            self.is_tuple = is_tuple
+        elif fields != self.fields or is_tuple != self.is_tuple:
+            raise ValueError(
+                f"every sample in a store must have the same fields, sample {len(self)} has {fields} "
+                f"but the store has {self.fields}"
+            )
+
+    def _write_rows(self, arrays: List[np.ndarray]) -> None:
+        # write samples stacked along the first axis, filling the open shard and starting new ones as needed
+        done = 0
+        while done < len(arrays[0]):
+            if self._shard is None:
+                self._shard = [
+                    np.lib.format.open_memmap(
+                        get_shard_filename(self.store_dir, self.part, len(self.shard_counts), i),
+                        mode="w+", dtype=np.dtype(f["dtype"]), shape=(self.shard_size, *f["shape"])
+                    )
+                    for i, f in enumerate(self.fields)
+                ]
+                self.shard_counts.append(0)
+            row = self.shard_counts[-1]
+            count = min(len(arrays[0]) - done, self.shard_size - row)
+            for shard_array, array in zip(self._shard, arrays):
+                shard_array[row:row + count] = array[done:done + count]
+            self.shard_counts[-1] += count
+            done += count
+            if self.shard_counts[-1] == self.shard_size:
+                self._close_shard()
+
+    def add(self, sample: Any) -> None:
+        """
+        Add a sample to the store.
+
+        Parameters
+        ----------
+        sample : Any
+            An array or tensor, or a tuple of them.
+        """
+        is_tuple, elements = self._split(sample)
+        arrays = [_to_array(e) for e in elements]
+        fields = [
+            {"shape": list(a.shape), "dtype": a.dtype.str, "tensor": _is_tensor(e)}
+            for a, e in zip(arrays, elements)
+        ]
+        self._check_fields(fields, is_tuple)
+        self._write_rows([a[np.newaxis] for a in arrays])
+
+    def add_batch(self, batch: Sequence[np.ndarray], tensor: bool = False) -> None:
+        """
+        Add a batch of samples to the store, given as one array per field with the samples stacked along the first
+        axis, e.g. `(images, masks)`. The batch is copied into the shards with one slice assignment per field and
+        shard instead of one per sample.
+
+        Parameters
+        ----------
+        batch : Sequence[np.ndarray]
+            The arrays of the fields of the samples, each with the same length.
+
+        tensor : bool
+            Whether the fields are given back as tensors by `SampleStoreDataset`, as if the samples had been added
+            as tensors. Default is `False`.
+        """
+        arrays = [_to_array(a) for a in batch]
+        if len(arrays) == 0 or any(a.ndim == 0 for a in arrays):
+            raise ValueError("a batch must have at least one field, each with the samples along the first axis")
+        if any(len(a) != len(arrays[0]) for a in arrays):
+            raise ValueError(f"every field of a batch must have the same length, got {[len(a) for a in arrays]}")
+        self._check_fields(
+            [{"shape": list(a.shape[1:]), "dtype": a.dtype.str, "tensor": tensor} for a in arrays],
+            True
+        )
+        self._write_rows(arrays)
+
+    def _close_shard(self) -> None:
+        if self._shard is None:
+            return
+        count = self.shard_counts[-1]
+        for i, shard_array in enumerate(self._shard):
+            shard_array.flush()
+            if count < self.shard_size:
+                # the last shard is rewritten at its actual size, so that every shard file is self-describing
+                fn = get_shard_filename(self.store_dir, self.part, len(self.shard_counts) - 1, i)
+                np.save(f"{fn}.tmp.npy", shard_array[:count])
+                os.replace(f"{fn}.tmp.npy", fn)
+        self._shard = None
+
+    def close(self) -> None:
+        """
+        Finish the last shard and write the manifest of the part.
+        """
+        self._close_shard()
+        manifest = {
+            "format_version": SAMPLE_STORE_FORMAT_VERSION,
+            "fields": self.fields if self.fields is not None else [],
+            "tuple": self.is_tuple if self.is_tuple is not None else True,
+            "shard_size": self.shard_size,
+            "shard_counts": self.shard_counts,
+            "args": self.args
+        }
+        manifest_fn = get_manifest_filename(self.store_dir, self.part)
+        with open(f"{manifest_fn}.tmp", "w") as f:
+            json.dump(manifest, f, indent=2, default=str)
+        os.replace(f"{manifest_fn}.tmp", manifest_fn)
+
+    def __enter__(self) -> SampleStoreWriter:
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            # leave no manifest, so the unfinished part is ignored
+            self._shard = None
+
+
+def get_shard_references(manifest_fn: str, manifest: Dict) -> List[Tuple[str, int]]:
+    """
+    Get the (part, shard) of each shard of a part. A part written by `SampleStoreWriter` holds its own shards,
+    while a part written by `merge_parts` lists the shards of the parts it merged.
+    """
+    if "shards" in manifest:
+        return [(part, int(shard)) for part, shard in manifest["shards"]]
+    part = os.path.basename(manifest_fn)[len("part-"):-len(".json")]
+    return [(part, shard) for shard in range(len(manifest["shard_counts"]))]
+
+
+def merge_parts(store_dir: str, parts: Sequence[str], part: str, args: Optional[Namespace] = None) -> int:
+    """
+    Merge parts of a store into one part, e.g. the parts written by workers, without moving their shards. The
+    manifest of the merged part lists the shards of the parts, which are removed from the store afterwards.
+
+    Parameters
+    ----------
+    store_dir : str
+        The directory of the store.
+
+    parts : Sequence[str]
+        The parts to merge, in order.
+
+    part : str
+        The name of the merged part. A part with the same name in the directory is replaced.
+
+    args : Optional[Namespace]
+        The arguments the samples were created with, saved in the manifest. Default is `None`.
+
+    Returns
+    -------
+    int
+        The number of samples in the merged part.
+    """
+    merged = {
+        "format_version": SAMPLE_STORE_FORMAT_VERSION,
+        "fields": [],
+        "tuple": True,
+        "shard_size": 0,
+        "shard_counts": [],
+        "shards": [],
+        "args": vars(args) if args is not None else {}
+    }
+    manifest_fns = [get_manifest_filename(store_dir, p) for p in parts]
+    for manifest_fn in manifest_fns:
+        with open(manifest_fn, "r") as f:
+            manifest = json.load(f)
+        if sum(manifest["shard_counts"]) == 0:
+            continue
+        if len(merged["shard_counts"]) == 0:
+            merged["fields"] = manifest["fields"]
+            merged["tuple"] = manifest["tuple"]
+        elif manifest["fields"] != merged["fields"] or manifest["tuple"] != merged["tuple"]:
+            raise ValueError(
+                f"every part of a store must have the same fields, {manifest_fn} has {manifest['fields']} "
+                f"but the merged part has {merged['fields']}"
+            )
+        merged["shard_size"] = max(merged["shard_size"], manifest["shard_size"])
+        merged["shard_counts"] += manifest["shard_counts"]
+        merged["shards"] += [list(shard) for shard in get_shard_references(manifest_fn, manifest)]
+    merged_fn = get_manifest_filename(store_dir, part)
+    with open(f"{merged_fn}.tmp", "w") as f:
+        json.dump(merged, f, indent=2, default=str)
+    os.replace(f"{merged_fn}.tmp", merged_fn)
+    for manifest_fn in manifest_fns:
+        if manifest_fn != merged_fn:
+            os.remove(manifest_fn)
+    return sum(merged["shard_counts"])
+
+
+class SampleStore:
+    """
+    Read the samples of all parts of a sample store, with no copies: each field of a sample is a view of a
+    memory-mapped shard.
+
+    Shards are memory-mapped the first time one of their samples is read, and the maps are not pickled, so a store
+    can be handed to `DataLoader` workers and each worker maps the shards it reads itself.
+
+    Parameters
+    ----------
+    store_dir : str
+        The directory of the store.
+
+    mmap_mode : str
+        The mode to memory-map the shards with, `"r"` for read-only views or `"c"` for copy-on-write views that can
+        be modified in memory without changing the shards. Default is `"r"`.
+    """
+
+    def __init__(self, store_dir: str, mmap_mode: str = "r"):
+        self.store_dir = store_dir
+        self.mmap_mode = mmap_mode
+        manifest_fns = sorted(glob(get_manifest_filename(store_dir, "*")))
+        if len(manifest_fns) == 0:
+            raise FileNotFoundError(f"{store_dir} does not contain a sample store")
+        self.fields: Optional[List[Dict]] = None
+        self.is_tuple = True
+        # (part, shard) of each shard, in order
+        self._shards: List[Tuple[str, int]] = []
+        seen = set()
+        counts = []
+        for manifest_fn in manifest_fns:
+            with open(manifest_fn, "r") as f:
+                manifest = json.load(f)
+            if manifest.get("format_version") != SAMPLE_STORE_FORMAT_VERSION:
+                raise ValueError(
+                    f"{manifest_fn} has format version {manifest.get('format_version')}, "
+                    f"expected {SAMPLE_STORE_FORMAT_VERSION}"
+                )
+            if sum(manifest["shard_counts"]) == 0:
+                continue
+            if self.fields is None:
+                self.fields = manifest["fields"]
+                self.is_tuple = manifest["tuple"]
+            elif manifest["fields"] != self.fields or manifest["tuple"] != self.is_tuple:
+                raise ValueError(
+                    f"every part of a store must have the same fields, {manifest_fn} has {manifest['fields']} "
+                    f"but the store has {self.fields}"
+                )
+            for shard, count in zip(get_shard_references(manifest_fn, manifest), manifest["shard_counts"]):
+                # a shard can be listed twice if a merge was interrupted before the merged parts were removed
+                if shard in seen:
+                    continue
+                seen.add(shard)
+                self._shards.append(shard)
+                counts.append(count)
+        if self.fields is None:
+            self.fields = []
+        self._starts = np.concatenate([[0], np.cumsum(counts, dtype=int)])
+        self._open_shards: Dict[int, List[np.ndarray]] = {}
+
+    def __len__(self) -> int:
+        return int(self._starts[-1])
+
+    def _get_shard(self, shard: int) -> List[np.ndarray]:
+        if shard not in self._open_shards:
+            part, part_shard = self._shards[shard]
+            self._open_shards[shard] = [
+                np.load(get_shard_filename(self.store_dir, part, part_shard, i), mmap_mode=self.mmap_mode)
+                for i in range(len(self.fields))
+            ]
+        return self._open_shards[shard]
+
+    def __getitem__(self, idx: int) -> Any:
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(f"sample {idx} is out of range for a store of {len(self)} samples")
+        shard = int(np.searchsorted(self._starts, idx, side="right")) - 1
+        row = idx - int(self._starts[shard])
+        sample = tuple(shard_array[row] for shard_array in self._get_shard(shard))
+        return sample if self.is_tuple else sample[0]
+
+    def __getstate__(self) -> Dict:
+        state = self.__dict__.copy()
+        state["_open_shards"] = {}
+        return state
+
+
+def write_samples(
+        dataset: Sequence,
+        store_dir: str,
+        idxs: Sequence[int],
+        epochs: int,
+        shard_size: int = DEFAULT_SHARD_SIZE,
+        args: Optional[Namespace] = None
+) -> int:
+    """
+    Sample a dataset `epochs` times at each index and write the samples to a store. This is the store counterpart
+    of `ComposedDataset.pickle_dataset`, writing shards instead of one pickle file per sample.
+
+    Parameters
+    ----------
+    dataset : Sequence
+        The dataset to sample, e.g. a `ComposedDataset`.
+
+    store_dir : str
+        The directory of the store.
+
+    idxs : Sequence[int]
+        The indices of the dataset to sample. The part of the store is named after the first and last index, so jobs
+        sampling different ranges of a dataset can write to the same store.
+
+    epochs : int
+        The number of times to sample each index.
+
+    shard_size : int
+        The number of samples per shard. Default is `64`.
+
+    args : Optional[Namespace]
+        The arguments the samples were created with, saved in the manifest. Default is `None`.
+
+    Returns
+    -------
+    int
+        The number of samples written.
+    """
+    part = f"{idxs[0]:06d}-{idxs[-1]:06d}" if len(idxs) > 0 else "empty"
+    with SampleStoreWriter(store_dir, part=part, shard_size=shard_size, args=args) as writer:
+        for _ in range(epochs):
+            for idx in idxs:
+                writer.add(dataset[idx])
+    return len(writer)
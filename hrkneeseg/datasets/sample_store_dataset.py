@@ -0,0 +1,95 @@
+from __future__ import annotations
+
+from typing import Any, Callable, Dict, Optional
+
+import torch
+from torch.utils.data import Dataset
+from blpytorchlightning.dataset_components.datasets.PickledDataset import PickledDataset
+
+from hrkneeseg.datasets.sample_store import SampleStore, is_sample_store
+from hrkneeseg.datasets.volume_patch_dataset import VolumePatchDataset
+from hrkneeseg.datasets.volume_store import is_volume_store
+
+
+class SampleStoreDataset(Dataset):
+    """
+    A dataset of the samples in a sample store, the store counterpart of `PickledDataset`.
+
+    Fields that were tensors when they were written are given back as tensors that share memory with the
+    memory-mapped shards, so reading a sample opens no files once its shard is mapped and copies nothing.
+
+    Parameters
+    ----------
+    store_dir : str
+        The directory of the store.
+
+    transformer : Optional[Callable]
+        A transformer to apply to each sample. Default is `None`.
+    """
+
+    def __init__(self, store_dir: str, transformer: Optional[Callable] = None):
+        # copy-on-write, so that tensors can be made from the views and transformed in place
+        self.store = SampleStore(store_dir, mmap_mode="c")
+        self.transformer = transformer
+
+    def __len__(self) -> int:
+        return len(self.store)
+
+    def __getitem__(self, idx: int) -> Any:
+        sample = self.store[idx]
+        elements = sample if self.store.is_tuple else (sample,)
+        elements = tuple(
+            torch.from_numpy(e) if field["tensor"] else e
+            for e, field in zip(elements, self.store.fields)
+        )
+        sample = elements if self.store.is_tuple else elements[0]
+        if self.transformer is not None:
+            sample = self.transformer(sample)
+        return sample
+
+
+def load_sample_dataset(
+        data_dir: str,
+        is_3d: bool,
+        transformer: Optional[Callable] = None,
+        volume_sampling: Optional[Dict] = None
+) -> Dataset:
+    """
+    Load preprocessed samples from a directory: as a `VolumePatchDataset` if the directory contains a volume store,
+    as a `SampleStoreDataset` if it contains a sample store, and as a `PickledDataset` otherwise.
+
+    Parameters
+    ----------
+    data_dir : str
+        The directory of samples.
+
+    is_3d : bool
+        Whether the model being trained is 3D. A volume store gives 3D patches, so it cannot be used to train a 2D or
+        2.5D model.
+
+    transformer : Optional[Callable]
+        A transformer to apply to each sample. Default is `None`.
+
+    volume_sampling : Optional[Dict]
+        Overrides of the patch sampling of a volume store, see `VolumePatchDataset`. Default is `None`.
+
+    Returns
+    -------
+    Dataset
+        The dataset.
+
+    Raises
+    ------
+    ValueError
+        If the directory contains a volume store and the model is not 3D.
+    """
+    if is_volume_store(data_dir):
+        if not is_3d:
+            raise ValueError(
+                f"{data_dir} is a volume store, which gives 3D patches and cannot be used to train a 2D or 2.5D "
+                f"model. Use the samples of `hrkPreProcess2DSlices` or `hrkPreProcess2dot5DSliceStacks` instead."
+            )
+        return VolumePatchDataset(data_dir, transformer=transformer, sampling=volume_sampling)
+    if is_sample_store(data_dir):
+        return SampleStoreDataset(data_dir, transformer=transformer)
+    return PickledDataset(data_dir, transformer=transformer)
@@ -0,0 +1,150 @@
+from __future__ import annotations
+
+from typing import Optional, Tuple
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from hrkneeseg.datasets.foreground_index import ForegroundIndex
+
+
+def gather_slice_stacks(
+        image: np.ndarray,
+        labels: np.ndarray,
+        slices: np.ndarray,
+        starts: np.ndarray,
+        patch_width: int,
+        num_adjacent_slices: int = 0
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Gather a batch of in-plane patches of slice stacks from a volume with one fancy-indexing operation per array,
+    straight into contiguous output blocks. The arrays are indexed through a `sliding_window_view` of their in-plane
+    patches, so each patch row is copied as a block instead of voxel by voxel.
+
+    Slices are taken along the first spatial axis, i.e. the slices of the (z, y, x) arrays of the file loaders. The
+    `2 * num_adjacent_slices + 1` slices of a stack are stacked with the channels of the image, channel-major, and the
+    labels are taken at the central slice only. Neighbours past the ends of the volume repeat the end slice.
+
+    Parameters
+    ----------
+    image : np.ndarray
+        The (C, Z, Y, X) image. Can be a memory-map, only the gathered voxels are read.
+
+    labels : np.ndarray
+        The labels, with or without a leading channel dimension.
+
+    slices : np.ndarray
+        The (K,) central slices of the stacks.
+
+    starts : np.ndarray
+        The (K, 2) in-plane starts of the patches, such that the patches lie inside the volume.
+
+    patch_width : int
+        The in-plane width of the patches.
+
+    num_adjacent_slices : int
+        The number of slices on each side of the central slice, 0 for single slices. Default is 0.
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray]
+        The (K, C * (2 * num_adjacent_slices + 1), W, W) image stacks and the (K, [L,] W, W) labels.
+    """
+    num_channels = image.shape[0]
+    k = len(slices)
+    offsets = np.arange(-num_adjacent_slices, num_adjacent_slices + 1)
+    zs = np.clip(slices[:, np.newaxis] + offsets, 0, image.shape[1] - 1)
+    rows, cols = starts[:, 0], starts[:, 1]
+    # (C, Z, Y - W + 1, X - W + 1, W, W) views, no data is read until the stacks are gathered
+    image_windows = sliding_window_view(image, (patch_width, patch_width), axis=(2, 3))
+    image_stacks = image_windows[
+        np.arange(num_channels)[np.newaxis, :, np.newaxis],
+        zs[:, np.newaxis, :],
+        rows[:, np.newaxis, np.newaxis],
+        cols[:, np.newaxis, np.newaxis]
+    ].reshape(k, num_channels * len(offsets), patch_width, patch_width)
+    labels_windows = sliding_window_view(labels, (patch_width, patch_width), axis=(-2, -1))
+    if labels.ndim == image.ndim:
+        labels_stacks = labels_windows[
+            np.arange(labels.shape[0])[np.newaxis, :],
+            slices[:, np.newaxis],
+            rows[:, np.newaxis],
+            cols[:, np.newaxis]
+        ]
+    else:
+        labels_stacks = labels_windows[slices, rows, cols]
+    return image_stacks, labels_stacks
+
+
+def draw_slice_stacks(
+        image: np.ndarray,
+        labels: np.ndarray,
+        foreground: ForegroundIndex,
+        num_samples: int,
+        patch_width: int,
+        num_adjacent_slices: int = 0,
+        probability: float = 0.5,
+        rng: Optional[np.random.Generator] = None
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Draw a batch of random slice stack patches from a volume at once, mirroring `SliceSampler` or
+    `MultisliceSampler` composed with `ForegroundPatchSampler`: each stack is centered on a random slice, and with
+    probability `probability` its patch is centered on a random foreground pixel of that slice, otherwise on a
+    random pixel, shifted to lie inside the slice. The slices and in-plane offsets of all of the samples are drawn
+    together and the stacks are gathered with `gather_slice_stacks`, so the Python overhead is paid once per batch.
+
+    Parameters
+    ----------
+    image : np.ndarray
+        The (C, Z, Y, X) image. Can be a memory-map.
+
+    labels : np.ndarray
+        The labels, with or without a leading channel dimension.
+
+    foreground : ForegroundIndex
+        The index of the foreground voxels.
+
+    num_samples : int
+        The number of samples to draw.
+
+    patch_width : int
+        The in-plane width of the patches.
+
+    num_adjacent_slices : int
+        The number of slices on each side of the central slice, 0 for single slices. Default is 0.
+
+    probability : float
+        The probability of centering a patch on a foreground pixel. Default is 0.5.
+
+    rng : np.random.Generator
+        The random number generator. If `None`, one is seeded from the OS. Default is `None`.
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray]
+        The image stacks and labels, see `gather_slice_stacks`. Slices narrower than the patch are padded with zeros.
+    """
+    if image.ndim != 4:
+        raise ValueError(f"image must have a channel and three spatial dimensions, got shape {image.shape}")
+    if rng is None:
+        rng = np.random.default_rng()
+    spatial_shape = image.shape[1:]
+    num_adjacent_slices = int(num_adjacent_slices)
+    # central slices are drawn away from the ends, so that every stack has all of its neighbours when it can
+    if spatial_shape[0] > 2 * num_adjacent_slices:
+        slices = rng.integers(num_adjacent_slices, spatial_shape[0] - num_adjacent_slices, size=num_samples)
+    else:
+        slices = rng.integers(0, spatial_shape[0], size=num_samples)
+    centers = rng.integers(0, spatial_shape[1:], size=(num_samples, 2))
+    on_foreground = np.flatnonzero(rng.random(num_samples) < probability)
+    if len(on_foreground) > 0 and len(foreground) > 0:
+        positions, has_foreground = foreground.draw_in_slabs(rng, slices[on_foreground])
+        centers[on_foreground[has_foreground]] = positions[has_foreground, 1:]
+
+    padding = [max(patch_width - s, 0) for s in spatial_shape[1:]]
+    if any(padding):
+        image = np.pad(image, [(0, 0), (0, 0)] + [(0, p) for p in padding])
+        labels = np.pad(labels, [(0, 0)] * (labels.ndim - 2) + [(0, p) for p in padding])
+    max_starts = np.array([max(s - patch_width, 0) for s in spatial_shape[1:]])
+    starts = np.clip(centers - patch_width // 2, 0, max_starts)
+    return gather_slice_stacks(image, labels, slices, starts, patch_width, num_adjacent_slices)
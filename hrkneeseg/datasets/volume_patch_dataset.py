@@ -0,0 +1,71 @@
+from __future__ import annotations
+
+import os
+from typing import Any, Callable, Dict, Optional
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+from hrkneeseg.datasets.patch_sampling import sample_patch
+from hrkneeseg.datasets.volume_store import VolumeStore, read_sampling
+
+
+class VolumePatchDataset(Dataset):
+    """
+    A dataset of random patches drawn on the fly from the volumes of a volume store, instead of patches drawn once
+    at preprocessing and saved. The patches are drawn in the `DataLoader` workers, reading only the patch from the
+    memory-mapped volumes, so the patch width, foreground probability and number of patches can be changed without
+    preprocessing the images again.
+
+    Each volume is sampled `samples_per_volume` times per pass through the dataset, so the dataset has as many
+    samples as a pickled dataset preprocessed with that many epochs.
+
+    Parameters
+    ----------
+    store_dir : str
+        The directory of the volume store.
+
+    transformer : Optional[Callable]
+        A transformer to apply to each sample. Default is `None`.
+
+    sampling : Optional[Dict]
+        Overrides of the `patch_width`, `probability` and `samples_per_volume` the store was preprocessed with.
+        Default is `None`.
+    """
+
+    def __init__(
+            self,
+            store_dir: str,
+            transformer: Optional[Callable] = None,
+            sampling: Optional[Dict] = None
+    ):
+        self.store = VolumeStore(store_dir)
+        self.sampling = read_sampling(store_dir, sampling)
+        self.transformer = transformer
+        self._rng = None
+        self._rng_key = None
+
+    def __len__(self) -> int:
+        return len(self.store) * self.sampling["samples_per_volume"]
+
+    def _get_rng(self) -> np.random.Generator:
+        # every DataLoader worker has its own torch seed, so the workers draw different patches
+        key = (os.getpid(), torch.initial_seed())
+        if self._rng_key != key:
+            self._rng = np.random.default_rng(torch.initial_seed())
+            self._rng_key = key
+        return self._rng
+
+    def __getitem__(self, idx: int) -> Any:
+        image, labels, foreground = self.store[idx % len(self.store)]
+        image_patch, labels_patch = sample_patch(
+            image, labels, foreground, self.sampling["patch_width"], self.sampling["probability"], self._get_rng()
+        )
+        sample = (
+            torch.from_numpy(image_patch.astype(np.float32, copy=False)),
+            torch.from_numpy(labels_patch.astype(np.int64, copy=False))
+        )
+        if self.transformer is not None:
+            sample = self.transformer(sample)
+        return sample
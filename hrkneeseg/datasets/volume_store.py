@@ -0,0 +1,241 @@
+from __future__ import annotations
+
+from argparse import ArgumentParser, Namespace
+from glob import glob
+import json
+import os
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from hrkneeseg.datasets.foreground_index import ForegroundIndex
+
+# bump this if the layout of the store changes, so that old stores are rejected instead of misread
+VOLUME_STORE_FORMAT_VERSION = 1
+# the default patch sampling of a store, set when it is preprocessed and overridable when training
+SAMPLING_FILENAME = "sampling.json"
+SAMPLING_KEYS = ["patch_width", "probability", "samples_per_volume"]
+
+
+def get_volume_filenames(store_dir: str, name: str) -> Dict[str, str]:
+    fns = {key: os.path.join(store_dir, f"volume-{name}-{key}.npy") for key in ["image", "labels", "foreground"]}
+    fns["manifest"] = os.path.join(store_dir, f"volume-{name}.json")
+    return fns
+
+
+def is_volume_store(store_dir: str) -> bool:
+    """
+    Check whether a directory contains a volume store, i.e. its sampling parameters.
+
+    Parameters
+    ----------
+    store_dir : str
+        The directory.
+
+    Returns
+    -------
+    bool
+        Whether the directory contains a volume store.
+    """
+    return os.path.isfile(os.path.join(store_dir, SAMPLING_FILENAME))
+
+
+def write_volume(
+        store_dir: str,
+        name: str,
+        image: np.ndarray,
+        labels: np.ndarray,
+        foreground_channel: int = 0
+) -> int:
+    """
+    Write a preprocessed image and its labels to a volume store, with the index of its foreground voxels so that
+    foreground patches can be drawn without searching the labels.
+
+    Parameters
+    ----------
+    store_dir : str
+        The directory of the store. It is created if it does not exist.
+
+    name : str
+        The name of the volume. A volume with the same name is replaced.
+
+    image : np.ndarray
+        The image, with a leading channel dimension.
+
+    labels : np.ndarray
+        The labels, with or without a leading channel dimension. Integer labels from 0 to 255 are stored as `uint8`.
+
+    foreground_channel : int
+        The channel of the labels to center foreground patches on. Default is 0.
+
+    Returns
+    -------
+    int
+        The number of foreground voxels.
+    """
+    image = np.asarray(image)
+    labels = np.asarray(labels)
+    spatial_shape = image.shape[1:]
+    if labels.shape[-len(spatial_shape):] != spatial_shape:
+        raise ValueError(f"labels of shape {labels.shape} do not match an image of shape {image.shape}")
+    if np.issubdtype(labels.dtype, np.integer) and labels.size > 0 and labels.min() >= 0 and labels.max() <= 255:
+        labels = labels.astype(np.uint8)
+    foreground = ForegroundIndex.from_labels(labels, len(spatial_shape), foreground_channel)
+    os.makedirs(store_dir, exist_ok=True)
+    fns = get_volume_filenames(store_dir, name)
+    # the manifest is written last, so that a volume that was not finished is ignored
+    if os.path.isfile(fns["manifest"]):
+        os.remove(fns["manifest"])
+    np.save(fns["image"], image)
+    np.save(fns["labels"], labels)
+    foreground.save(fns["foreground"])
+    manifest = {
+        "format_version": VOLUME_STORE_FORMAT_VERSION,
+        "spatial_shape": list(spatial_shape),
+        "foreground_channel": foreground_channel,
+        "num_foreground": len(foreground)
+    }
+    with open(f"{fns['manifest']}.tmp", "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(f"{fns['manifest']}.tmp", fns["manifest"])
+    return len(foreground)
+
+
+def write_sampling(store_dir: str, patch_width: int, probability: float, samples_per_volume: int) -> None:
+    """
+    Write the default patch sampling of a volume store.
+
+    Parameters
+    ----------
+    store_dir : str
+        The directory of the store.
+
+    patch_width : int
+        The width of the patches.
+
+    probability : float
+        The probability of centering a patch on a foreground voxel.
+
+    samples_per_volume : int
+        The number of patches to draw from each volume per pass through the dataset.
+    """
+    check_sampling(patch_width, probability, samples_per_volume)
+    os.makedirs(store_dir, exist_ok=True)
+    with open(os.path.join(store_dir, SAMPLING_FILENAME), "w") as f:
+        json.dump(
+            {"patch_width": patch_width, "probability": probability, "samples_per_volume": samples_per_volume},
+            f, indent=2
+        )
+
+
+def read_sampling(store_dir: str, overrides: Optional[Dict] = None) -> Dict:
+    """
+    Read the default patch sampling of a volume store, with any overrides.
+
+    Parameters
+    ----------
+    store_dir : str
+        The directory of the store.
+
+    overrides : Optional[Dict]
+        Sampling parameters to use instead of the defaults. Parameters that are `None` are not overridden.
+        Default is `None`.
+
+    Returns
+    -------
+    Dict
+        The `patch_width`, `probability` and `samples_per_volume`.
+    """
+    with open(os.path.join(store_dir, SAMPLING_FILENAME), "r") as f:
+        sampling = json.load(f)
+    sampling.update({k: v for k, v in (overrides or {}).items() if k in SAMPLING_KEYS and v is not None})
+    check_sampling(**sampling)
+    return sampling
+
+
+def check_sampling(patch_width: int, probability: float, samples_per_volume: int) -> None:
+    if patch_width < 1:
+        raise ValueError(f"`patch_width` must be at least 1, got {patch_width}")
+    if not 0 <= probability <= 1:
+        raise ValueError(f"`probability` must be between 0 and 1, got {probability}")
+    if samples_per_volume < 1:
+        raise ValueError(f"`samples_per_volume` must be at least 1, got {samples_per_volume}")
+
+
+def add_volume_sampling_arguments(parser: ArgumentParser) -> ArgumentParser:
+    """
+    Add the arguments that override the patch sampling of volume stores to a training parser.
+    """
+    parser.add_argument(
+        "--volume-patch-width", "-vpw", type=int, default=None, metavar="N",
+        help="width of the patches drawn from volume stores in the data directories. if not given, the patch width "
+             "the stores were preprocessed with"
+    )
+    parser.add_argument(
+        "--volume-probability", "-vp", type=float, default=None, metavar="P",
+        help="probability of centering a patch drawn from a volume store on a foreground voxel. if not given, the "
+             "probability the stores were preprocessed with"
+    )
+    parser.add_argument(
+        "--volume-samples", "-vs", type=int, default=None, metavar="N",
+        help="number of patches drawn from each volume of a volume store per epoch. if not given, the number of "
+             "epochs the stores were preprocessed with"
+    )
+    return parser
+
+
+def get_volume_sampling(args: Namespace) -> Dict:
+    return {
+        "patch_width": getattr(args, "volume_patch_width", None),
+        "probability": getattr(args, "volume_probability", None),
+        "samples_per_volume": getattr(args, "volume_samples", None)
+    }
+
+
+class VolumeStore:
+    """
+    Read the volumes of a volume store as memory-maps. The maps are opened the first time a volume is read and are
+    not pickled, so a store can be handed to `DataLoader` workers.
+
+    Parameters
+    ----------
+    store_dir : str
+        The directory of the store.
+    """
+
+    def __init__(self, store_dir: str):
+        self.store_dir = store_dir
+        manifest_fns = sorted(glob(os.path.join(store_dir, "volume-*.json")))
+        self.names: List[str] = []
+        self.spatial_shapes: List[Tuple[int, ...]] = []
+        for manifest_fn in manifest_fns:
+            with open(manifest_fn, "r") as f:
+                manifest = json.load(f)
+            if manifest.get("format_version") != VOLUME_STORE_FORMAT_VERSION:
+                raise ValueError(
+                    f"{manifest_fn} has format version {manifest.get('format_version')}, "
+                    f"expected {VOLUME_STORE_FORMAT_VERSION}"
+                )
+            self.names.append(os.path.basename(manifest_fn)[len("volume-"):-len(".json")])
+            self.spatial_shapes.append(tuple(manifest["spatial_shape"]))
+        if len(self.names) == 0:
+            raise FileNotFoundError(f"{store_dir} does not contain any volumes")
+        self._open_volumes: Dict[int, Tuple[np.ndarray, np.ndarray, ForegroundIndex]] = {}
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def __getitem__(self, idx: int) -> Tuple[np.ndarray, np.ndarray, ForegroundIndex]:
+        if idx not in self._open_volumes:
+            fns = get_volume_filenames(self.store_dir, self.names[idx])
+            self._open_volumes[idx] = (
+                np.load(fns["image"], mmap_mode="r"),
+                np.load(fns["labels"], mmap_mode="r"),
+                ForegroundIndex.load(fns["foreground"], self.spatial_shapes[idx])
+            )
+        return self._open_volumes[idx]
+
+    def __getstate__(self) -> Dict:
+        state = self.__dict__.copy()
+        state["_open_volumes"] = {}
+        return state
@@ -2,17 +2,17 @@ from __future__ import annotations
 
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter, Namespace
 
-from bonelab.util.echo_arguments import echo_arguments
-from bonelab.util.registration_util import check_inputs_exist, check_for_output_overwrite, message_s
-
 import numpy as np
-import SimpleITK as sitk
 import yaml
 import os
+from typing import Dict, List, Tuple
 from tqdm import tqdm, trange
-from skimage.morphology import binary_dilation, binary_erosion, binary_closing
-from skimage.measure import label as sklabel
-from skimage.filters import gaussian, median
+
+from hrkneeseg.utils.fingerprint import StepFingerprint, add_skip_if_unchanged_argument
+from hrkneeseg.utils.nifti_format import NIFTI_FORMATS, get_intermediate_format, nifti_filename
+from hrkneeseg.utils.lazy_import import lazy_import
+
+sitk = lazy_import("SimpleITK")
 
 
 def expand_array_to_3d(array: np.ndarray, dim: int) -> np.ndarray:
@@ -35,10 +35,12 @@ def create_efficient_3d_binary_operation(func: callable) -> callable:
 
 
 def efficient_3d_dilation(mask: np.ndarray, radius: int) -> np.ndarray:
+    from skimage.morphology import binary_dilation
     return create_efficient_3d_binary_operation(binary_dilation)(mask, radius)
 
 
 def keep_largest_connected_component_skimage(mask: np.ndarray, background: bool = False) -> np.ndarray:
+    from skimage.measure import label as sklabel
     if not(isinstance(mask, np.ndarray)) or (len(mask.shape) != 3):
         raise ValueError("`mask` must be a 3D numpy array")
     mask = ~mask if background else mask
@@ -58,6 +60,9 @@ def get_regional_subchondral_bone_plate_mask(
         regional_subchondral_bone_plate_dilation_footprint: int,
         silent: bool
 ) -> np.ndarray:
+    from bonelab.util.registration_util import message_s
+    from skimage.morphology import binary_dilation
+    from skimage.filters import gaussian
     if not isinstance(subchondral_bone_plate_mask, np.ndarray):
         raise ValueError("`subchondral_bone_plate_mask` must be a numpy array")
     if not isinstance(roi_mask, np.ndarray):
@@ -114,6 +119,8 @@ def generate_periarticular_rois_from_bone_plate_and_trabecular_masks(
         silent: bool
 ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
     # get the original shape of the image
+    from bonelab.util.registration_util import message_s
+    from skimage.morphology import binary_dilation
     original_shape = subchondral_bone_plate_mask.shape
     # get the bounds of the bone voxels
     bounds_min, bounds_max = get_bounding_box_limits(subchondral_bone_plate_mask)
@@ -198,45 +205,78 @@ def generate_periarticular_rois_from_bone_plate_and_trabecular_masks(
     )
 
 
-def generate_rois(args: Namespace):
-    print(echo_arguments("ROI Generation", vars(args)))
-    # check inputs exist
-    check_inputs_exist(
-        [args.mask, args.atlas_mask],
-        args.silent
-    )
-    # generate filenames for outputs
-    yaml_fn = os.path.join(args.output_dir, f"{args.output_label}_roi_generation.yaml")
-    allrois_mask_fn = os.path.join(args.output_dir, f"{args.output_label}_allrois_mask.nii.gz")
+def get_site_codes(args: Namespace) -> Tuple[List[int], List[int]]:
+    """
+    Get the medial and lateral site codes of the bone of `hrkGenerateROIs`.
+
+    Parameters
+    ----------
+    args : Namespace
+        The arguments of `hrkGenerateROIs`.
+
+    Returns
+    -------
+    Tuple[List[int], List[int]]
+        The medial and lateral site codes, in the order bone plate, shallow, mid, deep.
+    """
     if args.bone == "femur":
-        medial_site_codes = args.femur_medial_site_codes
-        lateral_site_codes = args.femur_lateral_site_codes
+        return args.femur_medial_site_codes, args.femur_lateral_site_codes
     elif args.bone == "tibia":
-        medial_site_codes = args.tibia_medial_site_codes
-        lateral_site_codes = args.tibia_lateral_site_codes
-    else:
-        raise ValueError(f"bone must be `femur` or `tibia`, given {args.bone}")
-    medial_roi_mask_fns = [
-        os.path.join(args.output_dir, f"{args.output_label}_roi{code}_mask.nii.gz")
-        for code in medial_site_codes
-    ]
-    lateral_roi_mask_fns = [
-        os.path.join(args.output_dir, f"{args.output_label}_roi{code}_mask.nii.gz")
-        for code in lateral_site_codes
-    ]
-    # check for output overwrite
-    check_for_output_overwrite(
-        [yaml_fn, allrois_mask_fn] + medial_roi_mask_fns + lateral_roi_mask_fns,
-        args.overwrite, args.silent
+        return args.tibia_medial_site_codes, args.tibia_lateral_site_codes
+    raise ValueError(f"bone must be `femur` or `tibia`, given {args.bone}")
+
+
+def get_output_filenames(args: Namespace) -> Tuple[str, str, Dict[int, str]]:
+    """
+    Get the filenames of the yaml, the all ROIs mask and the ROI masks written by `hrkGenerateROIs`.
+
+    Parameters
+    ----------
+    args : Namespace
+        The arguments of `hrkGenerateROIs`.
+
+    Returns
+    -------
+    Tuple[str, str, Dict[int, str]]
+        The yaml and all ROIs mask filenames, and the filename of the mask of each site code.
+    """
+    yaml_fn = os.path.join(args.output_dir, f"{args.output_label}_roi_generation.yaml")
+    allrois_mask_fn = nifti_filename(
+        os.path.join(args.output_dir, f"{args.output_label}_allrois_mask"), args.output_format
     )
-    # write yaml
-    message_s("Writing yaml...", args.silent)
-    with open(yaml_fn, "w") as f:
-        yaml.dump(vars(args), f)
-    # read in the mask and the atlas mask
-    message_s("Reading in mask and atlas mask...", args.silent)
-    mask_sitk = sitk.ReadImage(args.mask)
-    atlas_mask_sitk = sitk.ReadImage(args.atlas_mask)
+    medial_site_codes, lateral_site_codes = get_site_codes(args)
+    roi_mask_fns = {
+        code: nifti_filename(os.path.join(args.output_dir, f"{args.output_label}_roi{code}_mask"), args.output_format)
+        for code in medial_site_codes + lateral_site_codes
+    }
+    return yaml_fn, allrois_mask_fn, roi_mask_fns
+
+
+def generate_roi_masks(
+        mask_sitk: sitk.Image, atlas_mask_sitk: sitk.Image, args: Namespace
+) -> Tuple[Dict[int, sitk.Image], sitk.Image]:
+    """
+    Generate the ROI masks of a post-processed mask and the atlas mask transformed to it, in memory.
+
+    Parameters
+    ----------
+    mask_sitk : sitk.Image
+        The post-processed mask.
+
+    atlas_mask_sitk : sitk.Image
+        The atlas mask, transformed to the mask.
+
+    args : Namespace
+        The arguments of `hrkGenerateROIs`.
+
+    Returns
+    -------
+    Tuple[Dict[int, sitk.Image], sitk.Image]
+        The int32 mask of each site code, medial then lateral, and the int32 mask of all of the ROIs labelled with
+        their site codes.
+    """
+    from bonelab.util.registration_util import message_s
+    medial_site_codes, lateral_site_codes = get_site_codes(args)
     # dilate the atlas mask in the axial direction to ensure that it contains the subchondral bone plate, for both
     # the lateral and medial sides
     message_s("Dilating atlas mask...", args.silent)
@@ -306,20 +346,56 @@ def generate_rois(args: Namespace):
     all_rois_mask = sitk.Image(*mask_sitk.GetSize(), mask_sitk.GetPixelID())
     all_rois_mask = sitk.Cast(all_rois_mask, sitk.sitkInt32)
     all_rois_mask.CopyInformation(mask_sitk)
-    message_s("Writing medial ROI masks...", args.silent)
-    for mask, fn, msc in zip(medial_roi_masks, medial_roi_mask_fns, medial_site_codes):
-        mask_sitk = sitk.GetImageFromArray(mask)
-        mask_sitk.CopyInformation(atlas_mask_sitk)
-        sitk.WriteImage(sitk.Cast(mask_sitk, sitk.sitkInt32), fn)
-        all_rois_mask += msc * sitk.Cast(mask_sitk, sitk.sitkInt32)
-    message_s("Writing lateral ROI masks...", args.silent)
-    for mask, fn, msc in zip(lateral_roi_masks, lateral_roi_mask_fns, lateral_site_codes):
-        mask_sitk = sitk.GetImageFromArray(mask)
-        mask_sitk.CopyInformation(atlas_mask_sitk)
-        sitk.WriteImage(sitk.Cast(mask_sitk, sitk.sitkInt32), fn)
-        all_rois_mask += msc * sitk.Cast(mask_sitk, sitk.sitkInt32)
+    roi_masks = {}
+    for roi_mask, code in zip(
+            list(medial_roi_masks) + list(lateral_roi_masks), medial_site_codes + lateral_site_codes
+    ):
+        roi_mask_sitk = sitk.GetImageFromArray(roi_mask)
+        roi_mask_sitk.CopyInformation(atlas_mask_sitk)
+        roi_masks[code] = sitk.Cast(roi_mask_sitk, sitk.sitkInt32)
+        all_rois_mask += code * roi_masks[code]
+    return roi_masks, all_rois_mask
+
+
+def generate_rois(args: Namespace):
+    from bonelab.util.echo_arguments import echo_arguments
+    from bonelab.util.registration_util import check_inputs_exist, check_for_output_overwrite, message_s
+    print(echo_arguments("ROI Generation", vars(args)))
+    # check inputs exist
+    check_inputs_exist(
+        [args.mask, args.atlas_mask],
+        args.silent
+    )
+    # generate filenames for outputs
+    yaml_fn, allrois_mask_fn, roi_mask_fns = get_output_filenames(args)
+    fingerprint = StepFingerprint(
+        "hrkGenerateROIs", args, [args.mask, args.atlas_mask],
+        [allrois_mask_fn] + list(roi_mask_fns.values()) + [yaml_fn]
+    )
+    if args.skip_if_unchanged and fingerprint.is_unchanged():
+        message_s("The outputs are up to date with the inputs and arguments, skipping.", args.silent)
+        return
+    # check for output overwrite
+    check_for_output_overwrite(
+        [yaml_fn, allrois_mask_fn] + list(roi_mask_fns.values()),
+        args.overwrite or args.skip_if_unchanged, args.silent
+    )
+    fingerprint.invalidate()
+    # write yaml
+    message_s("Writing yaml...", args.silent)
+    with open(yaml_fn, "w") as f:
+        yaml.dump(vars(args), f)
+    # read in the mask and the atlas mask
+    message_s("Reading in mask and atlas mask...", args.silent)
+    mask_sitk = sitk.ReadImage(args.mask)
+    atlas_mask_sitk = sitk.ReadImage(args.atlas_mask)
+    roi_masks, all_rois_mask = generate_roi_masks(mask_sitk, atlas_mask_sitk, args)
+    message_s("Writing ROI masks...", args.silent)
+    for code, roi_mask in roi_masks.items():
+        sitk.WriteImage(roi_mask, roi_mask_fns[code])
     message_s("Writing all ROIs mask...", args.silent)
     sitk.WriteImage(all_rois_mask, allrois_mask_fn)
+    fingerprint.write()
 
 
 def create_parser() -> ArgumentParser:
@@ -329,10 +405,11 @@ def create_parser() -> ArgumentParser:
                     'the periarticular microarchitectural analysis. The output is a set of masks, one for each ROI, '
                     'and a yaml file containing the parameters used to generate the masks.'
                     'Outputs will be mask files saved to {output_dir} with filenames of the format: '
-                    '{output_label}_roi{site_code}_mask.nii.gz, where site_code is the site code for the ROI. The '
-                    'output yaml file will be saved to {output_dir} with filename {output_label}_roi_generation.yaml. '
-                    'An additional mask, {output_label}_allrois_mask.nii.gz, will be generated that contains all of '
-                    'the ROIs in a single mask, with each ROI labelled with its site code, for visualization purposes.',
+                    '{output_label}_roi{site_code}_mask.{output_format}, where site_code is the site code for the '
+                    'ROI. The output yaml file will be saved to {output_dir} with filename '
+                    '{output_label}_roi_generation.yaml. An additional mask, '
+                    '{output_label}_allrois_mask.{output_format}, will be generated that contains all of the ROIs in a '
+                    'single mask, with each ROI labelled with its site code, for visualization purposes.',
         formatter_class=ArgumentDefaultsHelpFormatter
     )
     parser.add_argument("mask", type=str, help="The input mask file.")
@@ -411,6 +488,12 @@ def create_parser() -> ArgumentParser:
         help="the footprint to use for the dilation of the tunnel mask to ensure the ROIs do not include "
              "cortical bone at the border of the tunnel"
     )
+    parser.add_argument(
+        "--output-format", "-of", default=get_intermediate_format(), choices=NIFTI_FORMATS,
+        help="format of the ROI masks. they are converted to AIMs afterwards, so `nii` avoids compressing them. the "
+             "default is set by the `HRKNEESEG_INTERMEDIATE_FORMAT` environment variable"
+    )
+    add_skip_if_unchanged_argument(parser)
     parser.add_argument("--overwrite", "-ow", action="store_true", help="Overwrite output files if they exist.")
     parser.add_argument("--silent", "-s", action="store_true", help="Silence all terminal output.")
     return parser
@@ -2,26 +2,20 @@ from __future__ import annotations
 
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter, Namespace
 
-from bonelab.util.echo_arguments import echo_arguments
-from bonelab.util.registration_util import check_inputs_exist, check_for_output_overwrite, message_s
-from blpytorchlightning.tasks.SegmentationTask import SegmentationTask
-from blpytorchlightning.tasks.SegResNetVAETask import SegResNetVAETask
-from blpytorchlightning.tasks.SeGANTask import SeGANTask
-from blpytorchlightning.models.SeGAN import get_segmentor_and_discriminators
-
 import math
 import numpy as np
-import SimpleITK as sitk
-import torch
 import yaml
 import os
+from typing import List, Optional, Tuple, Union
 from tqdm import tqdm, trange
-from torch.nn import L1Loss, CrossEntropyLoss
-from monai.networks.nets.unet import UNet
-from monai.networks.nets.unetr import UNETR
-from monai.networks.nets.basic_unetplusplus import BasicUNetPlusPlus
-from monai.networks.nets.segresnet import SegResNetVAE
-from monai.inferers import SlidingWindowInferer
+
+from hrkneeseg.models.registry import add_model_cache_argument, create_model, get_model_architecture
+from hrkneeseg.utils.fingerprint import StepFingerprint, add_skip_if_unchanged_argument
+from hrkneeseg.utils.nifti_format import NIFTI_FORMATS, get_intermediate_format, nifti_filename
+from hrkneeseg.utils.lazy_import import lazy_import
+
+sitk = lazy_import("SimpleITK")
+torch = lazy_import("torch")
 
 
 class EnsembleSegmentationModel:
@@ -47,6 +41,7 @@ class EnsembleSegmentationModel:
         return self._silent
 
     def __call__(self, image: np.ndarray) -> np.ndarray:
+        from bonelab.util.registration_util import message_s
         image = torch.from_numpy(image).unsqueeze(0).unsqueeze(0).float()
         y_hat = 0
         for i, model in enumerate(self.models):
@@ -68,70 +63,27 @@ def create_unetplusplus_loss_function(loss_function):
     return unetplusplus_loss_function
 
 
-def create_unet(hparams: dict) -> torch.nn.Module:
-    model_kwargs = {
-        "spatial_dims": 3 if hparams["is_3d"] else 2,
-        "in_channels": hparams["input_channels"],
-        "out_channels": hparams["output_channels"],
-    }
-    if hparams["dropout"] < 0 or hparams["dropout"] > 1:
-        raise ValueError("dropout must be between 0 and 1")
-    if hparams.get("model_architecture") == "unet" or hparams.get("model_architecture") is None:
-        if len(hparams["model_channels"]) < 2:
-            raise ValueError("model channels must be sequence of integers of at least length 2")
-        model_kwargs["channels"] = hparams["model_channels"]
-        model_kwargs["strides"] = [1 for _ in range(len(hparams["model_channels"]) - 1)]
-        model_kwargs["dropout"] = hparams["dropout"]
-        model = UNet(**model_kwargs)
-    elif hparams.get("model_architecture") == "attention-unet":
-        if len(hparams["model_channels"]) < 2:
-            raise ValueError("model channels must be sequence of integers of at least length 2")
-        model_kwargs["channels"] = hparams["model_channels"]
-        model_kwargs["strides"] = [1 for _ in range(len(hparams["model_channels"]) - 1)]
-        model_kwargs["dropout"] = hparams["dropout"]
-        model = AttentionUnet(**model_kwargs)
-    elif hparams.get("model_architecture") == "unet-r":
-        if hparams["image_size"] is None:
-            raise ValueError("if model architecture set to `unet-r`, you must specify image size")
-        if hparams["is_3d"] and len(hparams["image_size"]) != 3:
-            raise ValueError("if 3D, image_size must be integer or length-3 sequence of integers")
-        if not hparams["is_3d"] and len(hparams["image_size"]) != 2:
-            raise ValueError("if not 3D, image_size must be integer or length-2 sequence of integers")
-        model_kwargs["img_size"] = hparams["image_size"]
-        model_kwargs["dropout_rate"] = hparams["dropout"]
-        model_kwargs["feature_size"] = hparams["unet_r_feature_size"]
-        model_kwargs["hidden_size"] = hparams["unet_r_hidden_size"]
-        model_kwargs["mlp_dim"] = hparams["unet_r_mlp_dim"]
-        model_kwargs["num_heads"] = hparams["unet_r_num_heads"]
-        model = UNETR(**model_kwargs)
-    elif hparams.get("model_architecture") == "unet++":
-        if len(hparams["model_channels"]) != 6:
-            raise ValueError("if model architecture set to `unet++`, model channels must be length-6 sequence of "
-                             "integers")
-        model_kwargs["features"] = hparams["model_channels"]
-        model_kwargs["dropout"] = hparams["dropout"]
-        model = BasicUNetPlusPlus(**model_kwargs)
-    else:
-        raise ValueError(f"model architecture must be `unet`, `attention-unet`, `unet++`, or `unet-r`, "
-                         f"given {hparams['model_architecture']}")
-    model.float()
-    return model
-
-
 def load_task(
         hparams_fn: str,
         checkpoint_fn: str,
         model_type: str,
-        device: torch.device
+        device: torch.device,
+        model_cache_dir: Optional[str] = None
 ) -> Union[SegmentationTask, SeGANTask, SegResNetVAETask]:
+    from blpytorchlightning.tasks.SegmentationTask import SegmentationTask
+    from blpytorchlightning.tasks.SegResNetVAETask import SegResNetVAETask
+    from blpytorchlightning.tasks.SeGANTask import SeGANTask
+    from blpytorchlightning.models.SeGAN import get_segmentor_and_discriminators
+    from torch.nn import L1Loss, CrossEntropyLoss
+    from monai.networks.nets.segresnet import SegResNetVAE
 
     with open(hparams_fn) as f:
         hparams = yaml.safe_load(f)
 
     if model_type == "unet":
-        model = create_unet(hparams)
+        model = create_model(hparams, model_cache_dir)
         loss_function = CrossEntropyLoss()
-        if hparams.get("model_architecture") == "unet++":
+        if get_model_architecture(hparams) == "unet++":
             loss_function = create_unetplusplus_loss_function(loss_function)
         task = SegmentationTask(
             model=model, loss_function=loss_function,
@@ -193,43 +145,56 @@ def load_task(
         raise ValueError(f"model type must be `unet`, `segan`, or `segresnetvae`, given {model_type}")
 
 
-def inference_ensemble(args: Namespace):
-    print(echo_arguments("Ensemble model inference", vars(args)))
-    message_s("Checking if cuda was requested and available...", args.silent)
-    if args.cuda:
+def get_device(cuda: bool, silent: bool) -> torch.device:
+    """
+    Get the device to run inference on, cuda if it was requested and is available, otherwise the cpu.
+
+    Parameters
+    ----------
+    cuda : bool
+        Whether cuda was requested.
+
+    silent : bool
+        Whether to silence terminal output.
+
+    Returns
+    -------
+    torch.device
+    """
+    from bonelab.util.registration_util import message_s
+    message_s("Checking if cuda was requested and available...", silent)
+    if cuda:
         if torch.cuda.is_available():
-            message_s("cuda requested and available, using cuda...", args.silent)
-            device = torch.device("cuda")
-        else:
-            message_s("cuda requested but unavailable, using cpu...", args.silent)
-            device = torch.device("cpu")
-    else:
-        message_s("cuda not requested, using cpu...", args.silent)
-        device = torch.device("cpu")
-    check_inputs_exist(
-        [args.image] + args.hparams_filenames + args.checkpoint_filenames,
-        args.silent
-    )
-    yaml_fn = os.path.join(args.output_dir, f"{args.output_label}_ensemble_inference.yaml")
-    model_mask_fn = os.path.join(args.output_dir, f"{args.output_label}_ensemble_inference_mask.nii.gz")
-    check_for_output_overwrite(
-        [yaml_fn, model_mask_fn],
-        args.overwrite, args.silent
-    )
-    message_s("Writing yaml...", args.silent)
-    with open(yaml_fn, "w") as f:
-        yaml.dump(vars(args), f)
-    message_s("Reading in image...", args.silent)
-    image_sitk = sitk.ReadImage(args.image)
-    message_s("Converting image to a numpy array...", args.silent)
-    image = sitk.GetArrayFromImage(image_sitk)
-    message_s("Rescaling image from densities to [-1, +1] range...", args.silent)
-    image = np.minimum(np.maximum(image, args.min_density), args.max_density)
-    image = (2 * image - args.max_density - args.min_density) / (args.max_density - args.min_density)
+            message_s("cuda requested and available, using cuda...", silent)
+            return torch.device("cuda")
+        message_s("cuda requested but unavailable, using cpu...", silent)
+        return torch.device("cpu")
+    message_s("cuda not requested, using cpu...", silent)
+    return torch.device("cpu")
+
+
+def create_ensemble_model(args: Namespace, device: torch.device) -> EnsembleSegmentationModel:
+    """
+    Load the models of the ensemble and the sliding window inferer from the arguments of `hrkInferenceEnsemble`.
+
+    Parameters
+    ----------
+    args : Namespace
+        The arguments of `hrkInferenceEnsemble`.
+
+    device : torch.device
+        The device to run the models on.
+
+    Returns
+    -------
+    EnsembleSegmentationModel
+    """
+    from bonelab.util.registration_util import message_s
+    from monai.inferers import SlidingWindowInferer
     message_s("Constructing ensemble model...", args.silent)
-    ensemble_model = EnsembleSegmentationModel(
+    return EnsembleSegmentationModel(
         [
-            load_task(hparams_fn, checkpoint_fn, model_type, device)
+            load_task(hparams_fn, checkpoint_fn, model_type, device, args.model_cache_dir)
             for hparams_fn, checkpoint_fn, model_type in zip(
                 args.hparams_filenames, args.checkpoint_filenames, args.model_types,
             )
@@ -245,12 +210,97 @@ def inference_ensemble(args: Namespace):
         ),
         args.silent
     )
+
+
+def segment_image(
+        image_sitk: sitk.Image, ensemble_model: EnsembleSegmentationModel, args: Namespace
+) -> sitk.Image:
+    """
+    Segment a density image with an ensemble model, in memory.
+
+    Parameters
+    ----------
+    image_sitk : sitk.Image
+        The density image.
+
+    ensemble_model : EnsembleSegmentationModel
+        The ensemble model, see `create_ensemble_model`.
+
+    args : Namespace
+        The arguments of `hrkInferenceEnsemble`, for the density range and `silent`.
+
+    Returns
+    -------
+    sitk.Image
+        The int32 model mask, with the geometry of the image.
+    """
+    from bonelab.util.registration_util import message_s
+    message_s("Converting image to a numpy array...", args.silent)
+    image = sitk.GetArrayFromImage(image_sitk)
+    message_s("Rescaling image from densities to [-1, +1] range...", args.silent)
+    image = np.minimum(np.maximum(image, args.min_density), args.max_density)
+    image = (2 * image - args.max_density - args.min_density) / (args.max_density - args.min_density)
     message_s("Performing inference on image...", args.silent)
     model_mask = ensemble_model(image)
-    message_s("Writing model mask...", args.silent)
     model_mask_sitk = sitk.GetImageFromArray(model_mask)
     model_mask_sitk.CopyInformation(image_sitk)
-    sitk.WriteImage(sitk.Cast(model_mask_sitk, sitk.sitkInt32), model_mask_fn)
+    return sitk.Cast(model_mask_sitk, sitk.sitkInt32)
+
+
+def get_output_filenames(args: Namespace) -> Tuple[str, str]:
+    """
+    Get the filenames of the yaml and the model mask written by `hrkInferenceEnsemble`.
+
+    Parameters
+    ----------
+    args : Namespace
+        The arguments of `hrkInferenceEnsemble`.
+
+    Returns
+    -------
+    Tuple[str, str]
+        The yaml and model mask filenames.
+    """
+    yaml_fn = os.path.join(args.output_dir, f"{args.output_label}_ensemble_inference.yaml")
+    model_mask_fn = nifti_filename(
+        os.path.join(args.output_dir, f"{args.output_label}_ensemble_inference_mask"), args.output_format
+    )
+    return yaml_fn, model_mask_fn
+
+
+def inference_ensemble(args: Namespace):
+    from bonelab.util.echo_arguments import echo_arguments
+    from bonelab.util.registration_util import check_inputs_exist, check_for_output_overwrite, message_s
+    print(echo_arguments("Ensemble model inference", vars(args)))
+    check_inputs_exist(
+        [args.image] + args.hparams_filenames + args.checkpoint_filenames,
+        args.silent
+    )
+    yaml_fn, model_mask_fn = get_output_filenames(args)
+    # the device and the compiled graph cache do not change the mask
+    fingerprint = StepFingerprint(
+        "hrkInferenceEnsemble", args, [args.image] + args.hparams_filenames + args.checkpoint_filenames,
+        [model_mask_fn, yaml_fn], ignore=["cuda", "model_cache_dir"]
+    )
+    if args.skip_if_unchanged and fingerprint.is_unchanged():
+        message_s("The outputs are up to date with the inputs and arguments, skipping.", args.silent)
+        return
+    check_for_output_overwrite(
+        [yaml_fn, model_mask_fn],
+        args.overwrite or args.skip_if_unchanged, args.silent
+    )
+    fingerprint.invalidate()
+    device = get_device(args.cuda, args.silent)
+    message_s("Writing yaml...", args.silent)
+    with open(yaml_fn, "w") as f:
+        yaml.dump(vars(args), f)
+    message_s("Reading in image...", args.silent)
+    image_sitk = sitk.ReadImage(args.image)
+    ensemble_model = create_ensemble_model(args, device)
+    model_mask_sitk = segment_image(image_sitk, ensemble_model, args)
+    message_s("Writing model mask...", args.silent)
+    sitk.WriteImage(model_mask_sitk, model_mask_fn)
+    fingerprint.write()
 
 
 def create_parser() -> ArgumentParser:
@@ -263,7 +313,7 @@ def create_parser() -> ArgumentParser:
                     "input range. "
                     "The models can be of different types, but must all be able to accept the same input image size "
                     "and have the same output mask size. The out put mask will be saved to "
-                    "{output_dir}/{output_label}_ensemble_inference.nii.gz, along with a yaml file, "
+                    "{output_dir}/{output_label}_ensemble_inference_mask.{output_format}, along with a yaml file, "
                     "{output_dir}/{output_label}_ensemble_inference.yaml, that contains all arguments supplied to "
                     "this script. The mask will contain the raw output from the model."
                     "It is highly recommended to run this on a server or workstation with a GPU and to use the --cuda "
@@ -309,7 +359,14 @@ def create_parser() -> ArgumentParser:
         "--batch-size", "-bs", type=int, default=32, metavar="BS",
         help="batch size to use for inference"
     )
+    parser.add_argument(
+        "--output-format", "-of", default=get_intermediate_format(), choices=NIFTI_FORMATS,
+        help="Format of the output mask. The mask is an intermediate that is post-processed next, so `nii` saves the "
+             "time to compress it. The default is set by the `HRKNEESEG_INTERMEDIATE_FORMAT` environment variable."
+    )
+    add_model_cache_argument(parser)
     parser.add_argument("--cuda", "-c", action="store_true", help="Use CUDA if available.")
+    add_skip_if_unchanged_argument(parser)
     parser.add_argument("--overwrite", "-ow", action="store_true", help="Overwrite output files if they exist.")
     parser.add_argument("--silent", "-s", action="store_true", help="Silence all terminal output.")
     return parser
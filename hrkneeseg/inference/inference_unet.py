@@ -2,18 +2,14 @@
 from __future__ import annotations
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter, Namespace
 import numpy as np
-import vtk
-import vtkbone
 import pytorch_lightning as pl
 from bonelab.util.echo_arguments import echo_arguments
-from bonelab.util.vtk_util import vtkImageData_to_numpy, numpy_to_vtkImageData
 from bonelab.util.aim_calibration_header import get_aim_density_equation
-from bonelab.io.vtk_helpers import handle_filetype_writing_special_cases
+from hrkneeseg.aim_nifti.aim_io import AIM_BACKENDS, AIMHeader, read_aim, write_aim
+from hrkneeseg.aim_nifti.aim_index import get_aim_header
+from hrkneeseg.aim_nifti.convert_mask_to_aim import read_reference_aim_vtk, write_mask_aim_vtk
+from hrkneeseg.models.registry import add_model_cache_argument, create_model, get_model_architecture
 from blpytorchlightning.tasks.SegmentationTask import SegmentationTask
-from monai.networks.nets.unet import UNet
-from monai.networks.nets.attentionunet import AttentionUnet
-from monai.networks.nets.unetr import UNETR
-from monai.networks.nets.basic_unetplusplus import BasicUNetPlusPlus
 from torch.nn import CrossEntropyLoss
 from glob import glob
 from tqdm import tqdm
@@ -21,6 +17,7 @@ from datetime import datetime
 
 import torch
 import os
+from typing import List
 import yaml
 
 #TODO: Add option for patch overlap so padding doesn't influence segmentation accuracy at edges of patches
@@ -50,6 +47,12 @@ def create_parser() -> ArgumentParser:
         '--max-density', '-maxd', type=float, default=1400, metavar='D',
         help='maximum physiologically relevant density in the image [mg HA/ccm]'
     )
+    parser.add_argument(
+        '--aim-backend', '-ab', default='vtk', choices=AIM_BACKENDS,
+        help='how to read the image AIM and write the mask AIMs. `numpy` does not import vtk/vtkbone, but cannot read '
+             'compressed AIMs'
+    )
+    add_model_cache_argument(parser)
     return parser
 
 
@@ -63,70 +66,16 @@ def create_unetplusplus_loss_function(loss_function):
     return unetplusplus_loss_function
 
 
-# model creation got a bit crazy, separate into function for readability
-def create_model(hparams: dict) -> torch.nn.Module():
-    # create the model
-    model_kwargs = {
-        "spatial_dims": 3 if hparams["is_3d"] else 2,
-        "in_channels": hparams["input_channels"],
-        "out_channels": hparams["output_channels"],
-    }
-    if hparams["dropout"] < 0 or hparams["dropout"] > 1:
-        raise ValueError("dropout must be between 0 and 1")
-    if hparams.get("model_architecture") == "unet" or hparams.get("model_architecture") is None:
-        if len(hparams["model_channels"]) < 2:
-            raise ValueError("model channels must be sequence of integers of at least length 2")
-        model_kwargs["channels"] = hparams["model_channels"]
-        model_kwargs["strides"] = [1 for _ in range(len(hparams["model_channels"]) - 1)]
-        model_kwargs["dropout"] = hparams["dropout"]
-        model = UNet(**model_kwargs)
-    elif hparams.get("model_architecture") == "attention-unet":
-        if len(hparams["model_channels"]) < 2:
-            raise ValueError("model channels must be sequence of integers of at least length 2")
-        model_kwargs["channels"] = hparams["model_channels"]
-        model_kwargs["strides"] = [1 for _ in range(len(hparams["model_channels"]) - 1)]
-        model_kwargs["dropout"] = hparams["dropout"]
-        model = AttentionUnet(**model_kwargs)
-    elif hparams.get("model_architecture") == "unet-r":
-        if hparams["image_size"] is None:
-            raise ValueError("if model architecture set to `unet-r`, you must specify image size")
-        if hparams["is_3d"] and len(hparams["image_size"]) != 3:
-            raise ValueError("if 3D, image_size must be integer or length-3 sequence of integers")
-        if not hparams["is_3d"] and len(hparams["image_size"]) != 2:
-            raise ValueError("if not 3D, image_size must be integer or length-2 sequence of integers")
-        model_kwargs["img_size"] = hparams["image_size"]
-        model_kwargs["dropout_rate"] = hparams["dropout"]
-        model_kwargs["feature_size"] = hparams["unet_r_feature_size"]
-        model_kwargs["hidden_size"] = hparams["unet_r_hidden_size"]
-        model_kwargs["mlp_dim"] = hparams["unet_r_mlp_dim"]
-        model_kwargs["num_heads"] = hparams["unet_r_num_heads"]
-        model = UNETR(**model_kwargs)
-    elif hparams.get("model_architecture") == "unet++":
-        if len(hparams["model_channels"]) != 6:
-            raise ValueError("if model architecture set to `unet++`, model channels must be length-6 sequence of "
-                             "integers")
-        model_kwargs["features"] = hparams["model_channels"]
-        model_kwargs["dropout"] = hparams["dropout"]
-        model = BasicUNetPlusPlus(**model_kwargs)
-    else:
-        raise ValueError(f"model architecture must be `unet`, `attention-unet`, `unet++`, or `unet-r`, "
-                         f"given {hparams['model_architecture']}")
-
-    model.float()
-
-    return model
-
-
-def get_task(hparams_fn, checkpoint_fn):
+def get_task(hparams_fn, checkpoint_fn, model_cache_dir=None):
 
     with open(hparams_fn) as f:
         hparams = yaml.safe_load(f)
 
-    model = create_model(hparams)
+    model = create_model(hparams, model_cache_dir)
 
     # create loss function
     loss_function = CrossEntropyLoss()
-    if hparams.get("model_architecture") == "unet++":
+    if get_model_architecture(hparams) == "unet++":
         loss_function = create_unetplusplus_loss_function(loss_function)
 
     # create the task
@@ -144,27 +93,24 @@ def get_task(hparams_fn, checkpoint_fn):
     return task
 
 
-def write_mask(fn: str, mask: np.ndarray, reader: vtkbone.vtkboneAIMReader, label: str):
+def write_mask(fn: str, mask: np.ndarray, reference: AIMHeader, label: str, aim_backend: str = "vtk"):
     print(f"Updating processing log for {label} mask.")
-    processing_log = (
-        reader.GetProcessingLog()
-        + os.linesep
-        + f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] Initial {label} mask created."
-    )
+    log_entry = f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] Initial {label} mask created."
     print(f"Writing mask to {fn}")
-    writer = vtkbone.vtkboneAIMWriter()
-    writer.SetFileName(fn)
-    writer.SetInputData(numpy_to_vtkImageData(
-        127 * mask,
-        spacing=reader.GetOutput().GetSpacing(),
-        origin=reader.GetOutput().GetOrigin(),
-        array_type=vtk.VTK_CHAR
-    ))
-    handle_filetype_writing_special_cases(
-        writer,
-        processing_log=processing_log
-    )
-    writer.Update()
+    if aim_backend == "numpy":
+        write_aim(
+            fn,
+            mask.transpose() * np.int8(127),
+            reference.element_size,
+            reference.position,
+            reference.processing_log + os.linesep + log_entry,
+            reference.version,
+            reference
+        )
+    else:
+        write_mask_aim_vtk(
+            fn, mask, reference.spacing, reference.origin, reference.processing_log + os.linesep + log_entry
+        )
 
 
 def infer_segmentation(
@@ -174,21 +120,29 @@ def infer_segmentation(
         trab_fn: str,
         patch_width: int,
         min_density: float,
-        max_density: float
+        max_density: float,
+        aim_backend: str = "vtk"
 ):
     # step 1: read image
     print(f"Reading image from {img_fn}")
-    reader = vtkbone.vtkboneAIMReader()
-    reader.DataOnCellsOff()
-    reader.SetFileName(img_fn)
-    reader.Update()
+    if aim_backend == "numpy":
+        image, reference = read_aim(img_fn)
+
+        # step 2: convert image to numpy array
+        print("Converting to numpy.")
+        image = image.transpose()
+    else:
+        from bonelab.util.vtk_util import vtkImageData_to_numpy
+        reader = read_reference_aim_vtk(img_fn)
+        # the metadata for the output masks comes from the header, the reader is only needed for the voxel data
+        reference = get_aim_header(img_fn)
 
-    # step 2: convert image to numpy array
-    print("Converting to numpy.")
-    image = vtkImageData_to_numpy(reader.GetOutput())
+        # step 2: convert image to numpy array
+        print("Converting to numpy.")
+        image = vtkImageData_to_numpy(reader.GetOutput())
 
     # step 3: convert image to densities
-    m, b = get_aim_density_equation(reader.GetProcessingLog())
+    m, b = get_aim_density_equation(reference.processing_log)
     image = (m * image + b).astype(float)
 
     # step 4: rescale from densities to normalized range the model expects
@@ -225,8 +179,8 @@ def infer_segmentation(
     print(f"Trimmed mask has shape: {mask.shape}")
 
     # step 8: write masks
-    write_mask(scbp_fn, mask == 0, reader, "subchondral bone plate")
-    write_mask(trab_fn, mask == 1, reader, "trabecular bone")
+    write_mask(scbp_fn, mask == 0, reference, "subchondral bone plate", aim_backend)
+    write_mask(trab_fn, mask == 1, reference, "trabecular bone", aim_backend)
 
 
 def main() -> None:
@@ -234,12 +188,13 @@ def main() -> None:
     args = create_parser().parse_args()
     print()
     print(echo_arguments("Inference - UNet", vars(args)))
-    task = get_task(args.hparams_filename, args.checkpoint_filename)
+    task = get_task(args.hparams_filename, args.checkpoint_filename, args.model_cache_dir)
     print("Loaded model from checkpoint successfully. Starting inference.")
     infer_segmentation(
         task,
         args.image_filename, args.scbp_filename, args.trab_filename,
-        args.patch_width, args.min_density, args.max_density
+        args.patch_width, args.min_density, args.max_density,
+        args.aim_backend
     )
     
     
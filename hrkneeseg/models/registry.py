@@ -0,0 +1,242 @@
+from __future__ import annotations
+
+from argparse import ArgumentParser, Namespace
+import hashlib
+from importlib import import_module
+import json
+import os
+from typing import Any, Dict, Mapping, Optional, Tuple, Union
+import warnings
+
+# the monai network of each architecture, imported only when a model of that architecture is created
+MODEL_ARCHITECTURES = {
+    "unet": ("monai.networks.nets.unet", "UNet"),
+    "attention-unet": ("monai.networks.nets.attentionunet", "AttentionUnet"),
+    "unet-r": ("monai.networks.nets.unetr", "UNETR"),
+    "unet++": ("monai.networks.nets.basic_unetplusplus", "BasicUNetPlusPlus"),
+}
+DEFAULT_MODEL_ARCHITECTURE = "unet"
+# bump this if the construction of a model changes, so that cached graphs of the old construction are not reused
+MODEL_CACHE_VERSION = 1
+
+
+def get_hparams(hparams: Union[Mapping, Namespace]) -> Dict[str, Any]:
+    return dict(vars(hparams)) if isinstance(hparams, Namespace) else dict(hparams)
+
+
+def get_model_architecture(hparams: Union[Mapping, Namespace]) -> str:
+    """
+    Get the architecture of a model, defaulting to `unet` for hparams saved before the architecture was an option.
+
+    Parameters
+    ----------
+    hparams : Union[Mapping, Namespace]
+        The hyperparameters of the model, e.g. the loaded `hparams.yaml` of a checkpoint or the training arguments.
+
+    Returns
+    -------
+    str
+        The architecture.
+    """
+    architecture = get_hparams(hparams).get("model_architecture")
+    return DEFAULT_MODEL_ARCHITECTURE if architecture is None else architecture
+
+
+def get_model_class(architecture: str) -> type:
+    """
+    Import the network class of an architecture.
+
+    Parameters
+    ----------
+    architecture : str
+        The architecture, one of `MODEL_ARCHITECTURES`.
+
+    Returns
+    -------
+    type
+        The network class.
+    """
+    if architecture not in MODEL_ARCHITECTURES:
+        raise ValueError(
+            f"model architecture must be `unet`, `attention-unet`, `unet++`, or `unet-r`, given {architecture}"
+        )
+    module, name = MODEL_ARCHITECTURES[architecture]
+    return getattr(import_module(module), name)
+
+
+def get_model_kwargs(hparams: Union[Mapping, Namespace]) -> Dict[str, Any]:
+    """
+    Validate the hyperparameters of a model and get the keyword arguments of its network class.
+
+    Parameters
+    ----------
+    hparams : Union[Mapping, Namespace]
+        The hyperparameters of the model, e.g. the loaded `hparams.yaml` of a checkpoint or the training arguments.
+
+    Returns
+    -------
+    Dict[str, Any]
+        The keyword arguments.
+    """
+    hparams = get_hparams(hparams)
+    architecture = get_model_architecture(hparams)
+    model_kwargs = {
+        "spatial_dims": 3 if hparams["is_3d"] else 2,
+        "in_channels": hparams["input_channels"],
+        "out_channels": hparams["output_channels"],
+    }
+    if hparams["dropout"] < 0 or hparams["dropout"] > 1:
+        raise ValueError("dropout must be between 0 and 1")
+    if architecture in ["unet", "attention-unet"]:
+        if len(hparams["model_channels"]) < 2:
+            raise ValueError("model channels must be sequence of integers of at least length 2")
+        model_kwargs["channels"] = hparams["model_channels"]
+        model_kwargs["strides"] = [1 for _ in range(len(hparams["model_channels"]) - 1)]
+        model_kwargs["dropout"] = hparams["dropout"]
+    elif architecture == "unet-r":
+        if hparams["image_size"] is None:
+            raise ValueError("if model architecture set to `unet-r`, you must specify image size")
+        if hparams["is_3d"] and len(hparams["image_size"]) != 3:
+            raise ValueError("if 3D, image_size must be integer or length-3 sequence of integers")
+        if not hparams["is_3d"] and len(hparams["image_size"]) != 2:
+            raise ValueError("if not 3D, image_size must be integer or length-2 sequence of integers")
+        model_kwargs["img_size"] = hparams["image_size"]
+        model_kwargs["dropout_rate"] = hparams["dropout"]
+        model_kwargs["feature_size"] = hparams["unet_r_feature_size"]
+        model_kwargs["hidden_size"] = hparams["unet_r_hidden_size"]
+        model_kwargs["mlp_dim"] = hparams["unet_r_mlp_dim"]
+        model_kwargs["num_heads"] = hparams["unet_r_num_heads"]
+    elif architecture == "unet++":
+        if len(hparams["model_channels"]) != 6:
+            raise ValueError("if model architecture set to `unet++`, model channels must be length-6 sequence of "
+                             "integers")
+        model_kwargs["features"] = hparams["model_channels"]
+        model_kwargs["dropout"] = hparams["dropout"]
+    else:
+        raise ValueError(f"model architecture must be `unet`, `attention-unet`, `unet++`, or `unet-r`, "
+                         f"given {architecture}")
+    return model_kwargs
+
+
+def get_model_hash(hparams: Union[Mapping, Namespace]) -> str:
+    """
+    Get a hash of the graph of a model: its architecture and the keyword arguments of its network class, so that
+    hyperparameters that do not change the network, e.g. the learning rate, do not change the hash.
+
+    Parameters
+    ----------
+    hparams : Union[Mapping, Namespace]
+        The hyperparameters of the model.
+
+    Returns
+    -------
+    str
+        The hex digest of the hash.
+    """
+    key = {
+        "version": MODEL_CACHE_VERSION,
+        "architecture": get_model_architecture(hparams),
+        "kwargs": get_model_kwargs(hparams)
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True, default=list).encode()).hexdigest()[:16]
+
+
+def create_model(hparams: Union[Mapping, Namespace], cache_dir: Optional[str] = None) -> Any:
+    """
+    Create the network of a model from its hyperparameters, importing only the network class of its architecture.
+
+    If `cache_dir` is given, the network is compiled with TorchScript and the compiled graph is saved in the
+    directory, keyed by `get_model_hash`, and loaded from there the next time a model with the same graph is created,
+    e.g. by each job running inference. The cached graph keeps the weights it was first created with, so it is meant
+    for networks whose weights are then loaded from a checkpoint; the compiled graph has the same parameters as the
+    network, so checkpoints load into either. A network that TorchScript cannot compile is returned uncompiled.
+
+    Parameters
+    ----------
+    hparams : Union[Mapping, Namespace]
+        The hyperparameters of the model, e.g. the loaded `hparams.yaml` of a checkpoint or the training arguments.
+
+    cache_dir : Optional[str]
+        The directory of the compiled graph cache, or `None` to not compile the network. Default is `None`.
+
+    Returns
+    -------
+    torch.nn.Module
+        The network, in float32.
+    """
+    import torch
+
+    model_kwargs = get_model_kwargs(hparams)
+    architecture = get_model_architecture(hparams)
+    if cache_dir is not None:
+        cache_fn = get_model_cache_filename(cache_dir, hparams)
+        if os.path.isfile(cache_fn):
+            return torch.jit.load(cache_fn).float()
+    model = get_model_class(architecture)(**model_kwargs)
+    model.float()
+    if cache_dir is None:
+        return model
+    try:
+        scripted = torch.jit.script(model)
+    except Exception as err:
+        warnings.warn(f"could not compile the `{architecture}` model with TorchScript, using it uncompiled: {err}")
+        return model
+    os.makedirs(cache_dir, exist_ok=True)
+    # written to a temporary file first, so that jobs sharing the cache never load a partial graph
+    tmp_fn = f"{cache_fn}.{os.getpid()}.tmp"
+    torch.jit.save(scripted, tmp_fn)
+    os.replace(tmp_fn, cache_fn)
+    return scripted
+
+
+def get_model_cache_filename(cache_dir: str, hparams: Union[Mapping, Namespace]) -> str:
+    return os.path.join(cache_dir, f"{get_model_architecture(hparams)}-{get_model_hash(hparams)}.pt")
+
+
+def create_training_model(hparams: Union[Mapping, Namespace], strategy: Optional[str]) -> Tuple[Any, Optional[str]]:
+    """
+    Create the network of a model for training, with the training strategy it needs: `unet++` is trained with `ddp`
+    instead of `ddp_find_unused_parameters_false`. The network is never taken from the compiled graph cache, whose
+    graphs hold the weights they were first created with, so that every fold and job is initialized independently.
+
+    Parameters
+    ----------
+    hparams : Union[Mapping, Namespace]
+        The hyperparameters of the model.
+
+    strategy : Optional[str]
+        The training strategy.
+
+    Returns
+    -------
+    Tuple[torch.nn.Module, Optional[str]]
+        The network and the strategy to train it with.
+    """
+    model = create_model(hparams)
+    if get_model_architecture(hparams) == "unet++" and strategy == "ddp_find_unused_parameters_false":
+        strategy = "ddp"
+        print(f"using `unet++`, so changing strategy to {strategy}")
+    return model, strategy
+
+
+def add_model_cache_argument(parser: ArgumentParser) -> ArgumentParser:
+    """
+    Add the `--model-cache-dir` option of `create_model` to the parser of an inference tool.
+
+    Parameters
+    ----------
+    parser : ArgumentParser
+        The parser.
+
+    Returns
+    -------
+    ArgumentParser
+        The parser.
+    """
+    parser.add_argument(
+        "--model-cache-dir", "-mcd", type=str, default=None, metavar="DIR",
+        help="directory of compiled model graphs. if given, models are compiled with TorchScript and the graphs are "
+             "cached in the directory, keyed by the hyperparameters that define the network, and reused by later "
+             "inference jobs with the same network"
+    )
+    return parser
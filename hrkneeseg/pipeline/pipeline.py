@@ -0,0 +1,586 @@
+from __future__ import annotations
+
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter, Namespace
+import os
+import shlex
+import time
+import yaml
+from typing import Any, Dict, List, Optional, Tuple
+
+from hrkneeseg.aim_nifti.aim_index import get_aim_header
+from hrkneeseg.aim_nifti.aim_io import AIM_BACKENDS
+from hrkneeseg.aim_nifti.convert_aims_to_nifti import get_nifti_filename, read_aim_as_sitk
+from hrkneeseg.aim_nifti.convert_masks_to_aims import write_mask_aims
+from hrkneeseg.generate_rois import generate_rois
+from hrkneeseg.inference import inference_ensemble
+from hrkneeseg.models.registry import add_model_cache_argument
+from hrkneeseg.postprocessing import postprocess_segmentation
+from hrkneeseg.utils.fingerprint import IGNORED_ARGUMENTS, StepFingerprint, add_skip_if_unchanged_argument
+from hrkneeseg.utils.nifti_format import NIFTI_FORMATS, get_intermediate_format, nifti_filename
+from hrkneeseg.utils.lazy_import import lazy_import
+
+sitk = lazy_import("SimpleITK")
+
+# the per-scan stages, in the order they run, and the stages whose outputs each of them reads
+STAGES = ["convert", "infer", "postprocess", "mask_aims", "rois", "roi_aims"]
+STAGE_INPUTS = {
+    "convert": [],
+    "infer": ["convert"],
+    "postprocess": ["infer"],
+    "mask_aims": ["postprocess"],
+    "rois": ["postprocess"],
+    "roi_aims": ["rois"],
+}
+SEGMENTATION_STAGES = ["convert", "infer", "postprocess", "mask_aims"]
+ROI_STAGES = ["rois", "roi_aims"]
+# the outputs of these stages are only read by later stages, so they are only written when requested
+INTERMEDIATE_STAGES = ["convert", "infer", "rois"]
+AIM_LOG = "Generated using the code at: https://github.com/Bonelab/HRpQCT-Knee-Seg"
+# arguments of the stages that do not change their outputs
+STAGE_IGNORED_ARGUMENTS = set(IGNORED_ARGUMENTS) | {"cuda", "model_cache_dir"}
+
+
+def get_stages(stages: Optional[List[str]], bone: Optional[str]) -> List[str]:
+    """
+    Get the stages to run, in pipeline order.
+
+    Parameters
+    ----------
+    stages : Optional[List[str]]
+        The requested stages. If `None`, all of the stages if a bone is given, otherwise the segmentation stages.
+
+    bone : Optional[str]
+        The bone, `femur` or `tibia`, which the ROI stages need.
+
+    Returns
+    -------
+    List[str]
+    """
+    if stages is None:
+        stages = STAGES if bone is not None else SEGMENTATION_STAGES
+    unknown = [s for s in stages if s not in STAGES]
+    if unknown:
+        raise ValueError(f"stages must be in {STAGES}, got {unknown}")
+    if bone is None and any(s in ROI_STAGES for s in stages):
+        raise ValueError(f"the {ROI_STAGES} stages need a bone")
+    return [s for s in STAGES if s in stages]
+
+
+class ScanPipeline:
+    """
+    The per-scan stages of the segmentation workflow, run in one process: conversion of the image AIM, ensemble
+    inference, post-processing and export of the tissue masks to AIMs, then ROI generation and export of the ROI
+    masks to AIMs.
+
+    The output of each stage is kept in memory and passed to the stages that read it, and dropped once no later
+    stage needs it. Intermediate outputs are only written when requested, the post-processed mask and the AIMs are
+    always written. A stage whose input was not produced in the same run reads it from the file the producing stage
+    writes, in the same layout of the working directory as the separate command line tools, so any stage can be
+    rerun on its own from the outputs on disk.
+
+    Each stage that writes its outputs records a fingerprint of the files and arguments they are made from in a
+    `.fingerprint.yaml` sidecar of its first output, see `StepFingerprint`, so that with `skip_if_unchanged` the
+    stages whose outputs are up to date are not run again.
+
+    Parameters
+    ----------
+    args : Namespace
+        The arguments of `hrkPipeline`.
+    """
+
+    def __init__(self, args: Namespace):
+        self.args = args
+        self.image = os.path.splitext(os.path.basename(args.aim))[0]
+        self.label = args.output_label if args.output_label is not None else self.image.lower()
+        self.stages = get_stages(args.stages, args.bone)
+        if "infer" in self.stages and not (args.hparams_filenames and args.checkpoint_filenames and args.model_types):
+            raise ValueError("the `infer` stage needs the hparams filenames, checkpoint filenames and model types")
+        self._stage_args: Dict[str, Namespace] = {}
+        self._outputs: Dict[str, Any] = {}
+
+    def get_directory(self, name: str) -> str:
+        return os.path.join(self.args.working_dir, name)
+
+    def get_stage_args(self, stage: str) -> Namespace:
+        """
+        Get the arguments of the command line tool of a stage, parsed with the parser of the tool, so that the
+        stage runs with the same defaults as the tool.
+
+        Parameters
+        ----------
+        stage : str
+            `infer`, `postprocess` or `rois`.
+
+        Returns
+        -------
+        Namespace
+        """
+        if stage in self._stage_args:
+            return self._stage_args[stage]
+        args = self.args
+        silent = ["--silent"] if args.silent else []
+        if stage == "infer":
+            parser = inference_ensemble.create_parser()
+            argv = [
+                self.get_output_filenames("convert")[0], self.get_directory("model_masks"), self.label,
+                "-hf", *args.hparams_filenames, "-cf", *args.checkpoint_filenames, "-mt", *args.model_types,
+                "-of", args.intermediate_format
+            ] + (["-mcd", args.model_cache_dir] if args.model_cache_dir is not None else [])
+            argv += silent + shlex.split(args.inference_options)
+        elif stage == "postprocess":
+            parser = postprocess_segmentation.create_parser()
+            argv = [self.get_output_filenames("infer")[0], self.get_directory("model_masks"), self.label]
+            argv += ["--detect-tunnel"] if args.postsurgery else []
+            argv += silent + shlex.split(args.postprocessing_options)
+        elif stage == "rois":
+            parser = generate_rois.create_parser()
+            atlas_mask = args.atlas_mask if args.atlas_mask is not None else nifti_filename(
+                os.path.join(self.get_directory("atlas_registrations"), f"{self.label}_atlas_mask_transformed"),
+                args.intermediate_format
+            )
+            argv = [
+                self.get_output_filenames("postprocess")[0], args.bone, atlas_mask, self.get_directory("roi_masks"),
+                self.label, "-of", args.intermediate_format
+            ]
+            argv += silent + shlex.split(args.roi_options)
+        else:
+            raise ValueError(f"the `{stage}` stage does not have a command line tool")
+        self._stage_args[stage] = parser.parse_args(argv)
+        return self._stage_args[stage]
+
+    def get_mask_classes(self) -> Dict[str, int]:
+        """ Get the class values of the post-processed mask to export to AIMs, by the label of their AIM. """
+        postprocess_args = self.get_stage_args("postprocess")
+        classes = {
+            "CORT_MASK": postprocess_args.output_subchondral_bone_plate_class,
+            "TRAB_MASK": postprocess_args.output_trabecular_bone_class,
+        }
+        if self.args.postsurgery:
+            classes["TUNNEL_MASK"] = postprocess_args.output_tunnel_class
+        return classes
+
+    def get_site_codes(self) -> List[int]:
+        medial_site_codes, lateral_site_codes = generate_rois.get_site_codes(self.get_stage_args("rois"))
+        return medial_site_codes + lateral_site_codes
+
+    def get_output_filenames(self, stage: str) -> List[str]:
+        """
+        Get the files a stage writes its output to, which are also the files it is read from when the stage does not
+        run. For `rois`, the all ROIs mask comes first.
+
+        Parameters
+        ----------
+        stage : str
+
+        Returns
+        -------
+        List[str]
+        """
+        if stage == "convert":
+            return [get_nifti_filename(self.args.aim, self.get_directory("niftis"), self.args.intermediate_format)]
+        elif stage == "infer":
+            # the arguments of the stage need the models, which are only given when it runs
+            infer_args = self.get_stage_args("infer") if "infer" in self.stages else Namespace(
+                output_dir=self.get_directory("model_masks"), output_label=self.label,
+                output_format=self.args.intermediate_format
+            )
+            return [inference_ensemble.get_output_filenames(infer_args)[1]]
+        elif stage == "postprocess":
+            return [postprocess_segmentation.get_output_filenames(self.get_stage_args("postprocess"))[1]]
+        elif stage == "mask_aims":
+            return [
+                os.path.join(self.get_directory("roi_masks"), f"{self.image}_{cl}.AIM")
+                for cl in self.get_mask_classes()
+            ]
+        elif stage == "rois":
+            _, allrois_mask_fn, roi_mask_fns = generate_rois.get_output_filenames(self.get_stage_args("rois"))
+            return [allrois_mask_fn] + list(roi_mask_fns.values())
+        elif stage == "roi_aims":
+            return [
+                os.path.join(self.get_directory("roi_masks"), f"{self.image}_ROI{code}_MASK.AIM")
+                for code in self.get_site_codes()
+            ]
+        raise ValueError(f"stage must be in {STAGES}, got {stage}")
+
+    def get_yaml_filename(self, stage: str) -> Optional[str]:
+        if stage == "infer":
+            return inference_ensemble.get_output_filenames(self.get_stage_args("infer"))[0]
+        elif stage == "postprocess":
+            return postprocess_segmentation.get_output_filenames(self.get_stage_args("postprocess"))[0]
+        elif stage == "rois":
+            return generate_rois.get_output_filenames(self.get_stage_args("rois"))[0]
+        return None
+
+    def is_written(self, stage: str) -> bool:
+        return stage not in INTERMEDIATE_STAGES or stage in self.args.write_intermediates
+
+    def is_done(self, stage: str) -> bool:
+        return all(os.path.isfile(fn) for fn in self.get_output_filenames(stage))
+
+    def get_stages_to_run(self) -> List[str]:
+        """
+        Get the stages to run. Without `resume` or `skip_if_unchanged`, all of the stages run. Otherwise, the stages
+        that write their outputs run if the outputs are not up to date, see `is_up_to_date`, and with
+        `skip_if_unchanged` also if a stage whose output they read runs, since their fingerprints are checked
+        against the outputs on disk before it runs. Then the stages are walked back from the last one, and an
+        intermediate stage whose outputs are not written runs only if a later stage that runs reads them and they
+        are not up to date. So it is skipped when every later stage that reads them is done or skipped.
+
+        Returns
+        -------
+        List[str]
+        """
+        if not (self.args.resume or self.args.skip_if_unchanged):
+            return list(self.stages)
+        out_of_date = set()
+        for stage in self.stages:
+            reads_out_of_date = self.args.skip_if_unchanged and any(s in out_of_date for s in STAGE_INPUTS[stage])
+            if reads_out_of_date or (self.is_written(stage) and not self.is_up_to_date(stage)):
+                out_of_date.add(stage)
+        to_run: List[str] = []
+        for stage in reversed(self.stages):
+            if self.is_written(stage):
+                if stage in out_of_date:
+                    to_run.insert(0, stage)
+            elif any(stage in STAGE_INPUTS[s] for s in to_run) and (
+                stage in out_of_date or not self.is_up_to_date(stage)
+            ):
+                to_run.insert(0, stage)
+        return to_run
+
+    def get_fingerprint_arguments(self, stage: str) -> Dict[str, Any]:
+        """ Get the arguments that change the output of a stage. """
+        if stage in ["infer", "postprocess", "rois"]:
+            return {
+                k: v for k, v in vars(self.get_stage_args(stage)).items() if k not in STAGE_IGNORED_ARGUMENTS
+            }
+        elif stage == "mask_aims":
+            return {"classes": self.get_mask_classes(), "log": AIM_LOG}
+        elif stage == "roi_aims":
+            return {"site_codes": self.get_site_codes(), "log": AIM_LOG}
+        return {}
+
+    def get_input_filenames(self, stage: str) -> List[str]:
+        """ Get the files given to the pipeline that a stage reads. """
+        if stage in ["convert", "mask_aims", "roi_aims"]:
+            return [self.args.aim]
+        elif stage == "infer":
+            return self.args.hparams_filenames + self.args.checkpoint_filenames
+        elif stage == "rois":
+            return [self.get_stage_args("rois").atlas_mask]
+        return []
+
+    def get_provenance(self, stage: str) -> Tuple[List[str], Dict[str, Dict[str, Any]]]:
+        """
+        Get the files and arguments the output of a stage is made from: the files the stage reads and its
+        arguments, and for each stage whose output it is passed in memory, the files and arguments that output is
+        made from.
+
+        Parameters
+        ----------
+        stage : str
+
+        Returns
+        -------
+        Tuple[List[str], Dict[str, Dict[str, Any]]]
+            The files, and the arguments by stage.
+        """
+        inputs = self.get_input_filenames(stage)
+        arguments = {stage: self.get_fingerprint_arguments(stage)}
+        for producer in STAGE_INPUTS[stage]:
+            if producer in self.stages and not self.is_written(producer):
+                producer_inputs, producer_arguments = self.get_provenance(producer)
+                inputs += producer_inputs
+                arguments.update(producer_arguments)
+            else:
+                inputs += self.get_output_filenames(producer)
+        return inputs, arguments
+
+    def get_fingerprint(self, stage: str) -> StepFingerprint:
+        """ Get the fingerprint of a stage that writes its outputs, kept next to its first output. """
+        inputs, arguments = self.get_provenance(stage)
+        yaml_fn = self.get_yaml_filename(stage)
+        return StepFingerprint(
+            f"hrkPipeline {stage}", Namespace(**arguments), inputs,
+            self.get_output_filenames(stage) + ([yaml_fn] if yaml_fn is not None else [])
+        )
+
+    def is_up_to_date(self, stage: str) -> bool:
+        """
+        Check whether the outputs of a stage can be used as they are: with `resume`, if they all exist, and with
+        `skip_if_unchanged`, if the stage writes them and its fingerprint is unchanged.
+
+        Parameters
+        ----------
+        stage : str
+
+        Returns
+        -------
+        bool
+        """
+        if self.args.resume and self.is_done(stage):
+            return True
+        return self.args.skip_if_unchanged and self.is_written(stage) and self.get_fingerprint(stage).is_unchanged()
+
+    def get_written_filenames(self, stage: str) -> List[str]:
+        yaml_fn = self.get_yaml_filename(stage)
+        return (
+            ([yaml_fn] if yaml_fn is not None else [])
+            + (self.get_output_filenames(stage) if self.is_written(stage) else [])
+        )
+
+    def check_output_exists(self, stage: str) -> None:
+        missing = [fn for fn in self.get_output_filenames(stage) if not os.path.isfile(fn)]
+        if missing:
+            raise FileNotFoundError(
+                f"the `{stage}` stage is not run and its output {missing[0]} does not exist, run the stage with "
+                f"`--write-intermediates {stage}` first"
+            )
+
+    def get_output(self, stage: str) -> Any:
+        """
+        Get the output of a stage, from memory if the stage ran, otherwise from the files it writes.
+
+        Parameters
+        ----------
+        stage : str
+            `convert`, `infer`, `postprocess` or `rois`.
+
+        Returns
+        -------
+        Any
+            The image of the stage, or for `rois`, the mask of each site code and `None` in place of the all ROIs
+            mask.
+        """
+        from bonelab.util.registration_util import message_s
+        if stage in self._outputs:
+            return self._outputs[stage]
+        self.check_output_exists(stage)
+        fns = self.get_output_filenames(stage)
+        message_s(f"Reading the output of the `{stage}` stage from {fns[0]}", self.args.silent)
+        if stage == "rois":
+            roi_masks = {code: sitk.ReadImage(fn) for code, fn in zip(self.get_site_codes(), fns[1:])}
+            self._outputs[stage] = (roi_masks, None)
+        else:
+            self._outputs[stage] = sitk.ReadImage(fns[0])
+        return self._outputs[stage]
+
+    def write_output(self, stage: str, output: Any) -> None:
+        from bonelab.util.registration_util import message_s
+        fns = self.get_output_filenames(stage)
+        message_s(f"Writing the output of the `{stage}` stage to {fns[0]}", self.args.silent)
+        if stage == "rois":
+            roi_masks, all_rois_mask = output
+            sitk.WriteImage(all_rois_mask, fns[0])
+            for code, fn in zip(self.get_site_codes(), fns[1:]):
+                sitk.WriteImage(roi_masks[code], fn)
+        else:
+            sitk.WriteImage(output, fns[0])
+
+    def write_stage_yaml(self, stage: str) -> None:
+        with open(self.get_yaml_filename(stage), "w") as f:
+            yaml.dump(vars(self.get_stage_args(stage)), f)
+
+    def run_convert(self) -> sitk.Image:
+        image, _, _ = read_aim_as_sitk(self.args.aim, self.args.aim_backend, calibrate=True)
+        return image
+
+    def run_infer(self) -> sitk.Image:
+        args = self.get_stage_args("infer")
+        ensemble_model = inference_ensemble.create_ensemble_model(
+            args, inference_ensemble.get_device(args.cuda, args.silent)
+        )
+        return inference_ensemble.segment_image(self.get_output("convert"), ensemble_model, args)
+
+    def run_postprocess(self) -> sitk.Image:
+        return postprocess_segmentation.postprocess_mask(self.get_output("infer"), self.get_stage_args("postprocess"))
+
+    def run_mask_aims(self) -> None:
+        write_mask_aims(
+            self.get_output("postprocess"),
+            get_aim_header(self.args.aim),
+            self.get_output_filenames("mask_aims"),
+            list(self.get_mask_classes().values()),
+            AIM_LOG,
+            self.args.aim_backend,
+            self.args.num_threads
+        )
+
+    def run_rois(self) -> Any:
+        args = self.get_stage_args("rois")
+        return generate_rois.generate_roi_masks(self.get_output("postprocess"), sitk.ReadImage(args.atlas_mask), args)
+
+    def run_roi_aims(self) -> None:
+        roi_masks, _ = self.get_output("rois")
+        reference = get_aim_header(self.args.aim)
+        for code, fn in zip(self.get_site_codes(), self.get_output_filenames("roi_aims")):
+            # the ROI masks are binary, as `hrkMask2AIM` expects
+            write_mask_aims(roi_masks[code], reference, [fn], [1], AIM_LOG, self.args.aim_backend, 1)
+
+    def check_inputs(self, stages: List[str]) -> None:
+        """
+        Check that the inputs of the stages to run exist before running any of them, both the files given to the
+        pipeline and the outputs of the stages that are not run.
+
+        Parameters
+        ----------
+        stages : List[str]
+            The stages to run.
+        """
+        from bonelab.util.registration_util import check_inputs_exist
+        inputs = [self.args.aim]
+        if "infer" in stages:
+            inputs += self.args.hparams_filenames + self.args.checkpoint_filenames
+        if "rois" in stages:
+            inputs.append(self.get_stage_args("rois").atlas_mask)
+        check_inputs_exist(inputs, self.args.silent)
+        for stage in stages:
+            for producer in STAGE_INPUTS[stage]:
+                if producer not in stages:
+                    self.check_output_exists(producer)
+
+    def run(self) -> None:
+        """
+        Run the stages. With `resume` or `skip_if_unchanged`, the stages that are not needed are skipped, see
+        `get_stages_to_run`, and the outputs of the skipped stages are read back if a later stage needs them.
+        """
+        from bonelab.util.registration_util import check_for_output_overwrite, message_s
+        to_run = self.get_stages_to_run()
+        self.check_inputs(to_run)
+        written = [fn for s in to_run for fn in self.get_written_filenames(s)]
+        # the stages that run again with `resume` or `skip_if_unchanged` replace the outputs of an earlier run
+        check_for_output_overwrite(
+            written, self.args.overwrite or self.args.resume or self.args.skip_if_unchanged, self.args.silent
+        )
+        for directory in {os.path.dirname(fn) for fn in written}:
+            os.makedirs(directory, exist_ok=True)
+        for i, stage in enumerate(self.stages):
+            if stage not in to_run:
+                message_s(f"Skipping the `{stage}` stage, its outputs exist or are not needed", self.args.silent)
+                continue
+            message_s(f"Running the `{stage}` stage...", self.args.silent)
+            start = time.perf_counter()
+            if self.is_written(stage):
+                self.get_fingerprint(stage).invalidate()
+            if self.get_yaml_filename(stage) is not None:
+                self.write_stage_yaml(stage)
+            output = getattr(self, f"run_{stage}")()
+            if output is not None:
+                self._outputs[stage] = output
+                if self.is_written(stage):
+                    self.write_output(stage, output)
+            if self.is_written(stage):
+                # a new fingerprint, the outputs of the stages it reads may have been written again in this run
+                self.get_fingerprint(stage).write()
+            # release the outputs no later stage reads, a full-size image or mask takes gigabytes
+            needed = {s for later in self.stages[i + 1:] for s in STAGE_INPUTS[later]}
+            for s in [s for s in self._outputs if s not in needed]:
+                del self._outputs[s]
+            message_s(f"Finished the `{stage}` stage in {time.perf_counter() - start:.1f} s", self.args.silent)
+
+
+def pipeline(args: Namespace) -> None:
+    from bonelab.util.echo_arguments import echo_arguments
+    if not args.silent:
+        print(echo_arguments("Pipeline", vars(args)))
+    ScanPipeline(args).run()
+
+
+def create_parser() -> ArgumentParser:
+    parser = ArgumentParser(
+        description="Run the per-scan steps of the segmentation workflow in one process: convert the image AIM to a "
+                    "density image, segment it with the model ensemble, post-process the segmentation and write the "
+                    "tissue masks to AIMs, then generate the periarticular ROIs and write them to AIMs. Images are "
+                    "passed between the steps in memory instead of being written and read back. The files are laid "
+                    "out in the working directory as the separate tools lay them out (niftis, model_masks, "
+                    "atlas_registrations, roi_masks), and each step reads its input from there if the step that "
+                    "produces it is not run, so the steps can be rerun one at a time. The ROI steps need the atlas "
+                    "mask transformed to the image, e.g. by `hrkAtlasRegistration`.",
+        formatter_class=ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("aim", type=str, metavar="AIM", help="the image AIM")
+    parser.add_argument("working_dir", type=str, metavar="WORKING_DIR", help="the working directory of the study")
+    parser.add_argument(
+        "--stages", "-st", type=str, nargs="+", choices=STAGES, default=None, metavar="STAGE",
+        help=f"the stages to run, from {STAGES}. all of them if a bone is given, otherwise the segmentation stages"
+    )
+    parser.add_argument(
+        "--output-label", "-ol", type=str, default=None, metavar="LABEL",
+        help="the label of the output files, the lowercase name of the AIM if not given"
+    )
+    parser.add_argument(
+        "--bone", "-b", type=str, choices=["femur", "tibia"], default=None, help="the bone, for the ROI stages"
+    )
+    parser.add_argument(
+        "--postsurgery", "-ps", action="store_true",
+        help="the image is post-surgical, so the tunnel is detected in post-processing and exported to an AIM"
+    )
+    parser.add_argument(
+        "--atlas-mask", "-am", type=str, default=None, metavar="FN",
+        help="the atlas mask transformed to the image, for the `rois` stage. if not given, "
+             "`atlas_registrations/{label}_atlas_mask_transformed.{intermediate_format}` in the working directory"
+    )
+    parser.add_argument(
+        "--hparams-filenames", "-hf", type=str, nargs="+", default=None, metavar="FN",
+        help="the hparams files of the models, for the `infer` stage"
+    )
+    parser.add_argument(
+        "--checkpoint-filenames", "-cf", type=str, nargs="+", default=None, metavar="FN",
+        help="the checkpoint files of the models, for the `infer` stage"
+    )
+    parser.add_argument(
+        "--model-types", "-mt", choices=["unet", "segan", "segresnetvae"], nargs="+", default=None, metavar="MT",
+        help="the types of the models, for the `infer` stage"
+    )
+    add_model_cache_argument(parser)
+    parser.add_argument(
+        "--inference-options", "-io", type=str, default="", metavar="OPTIONS",
+        help="more options of `hrkInferenceEnsemble` for the `infer` stage, e.g. `--inference-options=\"-pw 128 "
+             "--cuda\"`"
+    )
+    parser.add_argument(
+        "--postprocessing-options", "-po", type=str, default="", metavar="OPTIONS",
+        help="more options of `hrkPostProcessSegmentation` for the `postprocess` stage"
+    )
+    parser.add_argument(
+        "--roi-options", "-ro", type=str, default="", metavar="OPTIONS",
+        help="more options of `hrkGenerateROIs` for the `rois` stage"
+    )
+    parser.add_argument(
+        "--intermediate-format", "-if", type=str, choices=NIFTI_FORMATS, default=get_intermediate_format(),
+        help="format of the intermediate images. the default is set by the `HRKNEESEG_INTERMEDIATE_FORMAT` "
+             "environment variable"
+    )
+    parser.add_argument(
+        "--write-intermediates", "-wi", type=str, nargs="*", choices=INTERMEDIATE_STAGES, default=[],
+        metavar="STAGE",
+        help=f"the stages, from {INTERMEDIATE_STAGES}, whose intermediate outputs to write, e.g. for later steps of "
+             f"the workflow or to rerun the following stages from them. the post-processed mask and the AIMs are "
+             f"always written"
+    )
+    parser.add_argument(
+        "--aim-backend", "-ab", default="vtk", choices=AIM_BACKENDS,
+        help="how to read and write the AIMs. `numpy` does not import vtk/vtkbone and does not read compressed AIMs"
+    )
+    parser.add_argument(
+        "--num-threads", "-nt", type=int, default=4, metavar="N",
+        help="number of tissue mask AIMs to write at once with the `numpy` backend"
+    )
+    parser.add_argument(
+        "--resume", "-r", action="store_true",
+        help="skip the stages whose outputs all exist, and the intermediate stages whose outputs are not written "
+             "when the stages that read them are skipped, e.g. to restart a pipeline that stopped part of the way"
+    )
+    add_skip_if_unchanged_argument(parser)
+    parser.add_argument("--overwrite", "-ow", action="store_true", help="Overwrite output files if they exist.")
+    parser.add_argument("--silent", "-s", action="store_true", help="Silence all terminal output.")
+    return parser
+
+
+def main() -> None:
+    args = create_parser().parse_args()
+    pipeline(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,14 +2,15 @@ from __future__ import annotations
 
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter, Namespace
 
-import numpy as np
-from bonelab.util.echo_arguments import echo_arguments
-from bonelab.util.registration_util import check_inputs_exist, check_for_output_overwrite, message_s
+from hrkneeseg.utils.label_remapping import remap_labels_array
+from hrkneeseg.utils.lazy_import import lazy_import
 
-import SimpleITK as sitk
+sitk = lazy_import("SimpleITK")
 
 
 def intersect_masks(args: Namespace) -> None:
+    from bonelab.util.echo_arguments import echo_arguments
+    from bonelab.util.registration_util import check_inputs_exist, check_for_output_overwrite, message_s
     if not args.silent:
         print(echo_arguments("Intersect Masks", vars(args)))
 
@@ -17,34 +18,23 @@ def intersect_masks(args: Namespace) -> None:
     check_for_output_overwrite(args.output, args.overwrite, args.silent)
 
     if len(args.inputs) == 1:
-        if not silent:
-            print(message_s("Only one input mask provided, copying to output", args.silent))
+        message_s("Only one input mask provided, copying to output", args.silent)
         sitk.WriteImage(sitk.ReadImage(args.inputs[0]), args.output)
         return
 
-    message_s("Reading in masks", args.silent)
-    input_masks = [sitk.ReadImage(fn) for fn in args.inputs]
-    message_s("Converting masks to arrays", args.silent)
-    input_arrays = [sitk.GetArrayFromImage(mask) for mask in input_masks]
-    message_s("Initializing output array", args.silent)
-    output_array = np.zeros_like(input_arrays[0], dtype=np.uint8)
-
-    message_s("Beginning iteration over classes", args.silent)
-    for c in args.classes:
-        message_s(f"Intersecting class {c}", args.silent)
-        message_s("Generating list of binary class arrays", args.silent)
-        class_arrays = [(arr == c) for arr in input_arrays]
-        message_s("Initializing intersected class array", args.silent)
-        class_intersection = np.ones_like(class_arrays[0], dtype=np.uint8)
-        message_s("Iterating over binary class arrays", args.silent)
-        for arr in class_arrays:
-            class_intersection = class_intersection & arr
-        message_s("Adding intersected class array to output array", args.silent)
-        output_array += c * class_intersection
+    # relabel each mask so only the given classes are left, then a voxel keeps its class only if every mask agrees
+    mapping = {c: c for c in args.classes}
+    message_s(f"Reading in and relabelling mask 0", args.silent)
+    reference_mask = sitk.ReadImage(args.inputs[0])
+    output_array = remap_labels_array(sitk.GetArrayViewFromImage(reference_mask), mapping)
+    for i, fn in enumerate(args.inputs[1:], start=1):
+        message_s(f"Reading in and relabelling mask {i}, intersecting with the output", args.silent)
+        mask = sitk.ReadImage(fn)
+        output_array[remap_labels_array(sitk.GetArrayViewFromImage(mask), mapping) != output_array] = 0
 
     message_s("Converting output array to SimpleITK image", args.silent)
     output_mask = sitk.GetImageFromArray(output_array)
-    output_mask.CopyInformation(input_masks[0])
+    output_mask.CopyInformation(reference_mask)
     message_s("Writing output mask", args.silent)
     sitk.WriteImage(output_mask, args.output)
 
@@ -2,17 +2,16 @@ from __future__ import annotations
 
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter, Namespace
 
-from bonelab.util.echo_arguments import echo_arguments
-from bonelab.util.registration_util import check_inputs_exist, check_for_output_overwrite, message_s
-
 import numpy as np
-import SimpleITK as sitk
 import os
 import yaml
+from typing import List, Tuple
+
+from hrkneeseg.utils.fingerprint import StepFingerprint, add_skip_if_unchanged_argument
+from hrkneeseg.utils.nifti_format import DELIVERABLE_FORMAT, NIFTI_FORMATS, nifti_filename
+from hrkneeseg.utils.lazy_import import lazy_import
 
-from skimage.morphology import binary_dilation, binary_erosion, binary_closing, ball
-from skimage.measure import label as sklabel
-from skimage.filters import gaussian, median
+sitk = lazy_import("SimpleITK")
 
 
 def expand_array_to_3d(array: np.ndarray, dim: int) -> np.ndarray:
@@ -35,10 +34,12 @@ def create_efficient_3d_binary_operation(func: callable) -> callable:
 
 
 def efficient_3d_dilation(mask: np.ndarray, radius: int) -> np.ndarray:
+    from skimage.morphology import binary_dilation
     return create_efficient_3d_binary_operation(binary_dilation)(mask, radius)
 
 
 def efficient_3d_erosion(mask: np.ndarray, radius: int) -> np.ndarray:
+    from skimage.morphology import binary_erosion
     return create_efficient_3d_binary_operation(binary_erosion)(mask, radius)
 
 
@@ -51,6 +52,7 @@ def efficient_3d_opening(mask: np.ndarray, radius: int) -> np.ndarray:
 
 
 def keep_largest_connected_component_skimage(mask: np.ndarray, background: bool = False) -> np.ndarray:
+    from skimage.measure import label as sklabel
     if not(isinstance(mask, np.ndarray)):
         raise ValueError("`mask` must be a 3D numpy array")
     mask = (1 - mask) if background else mask
@@ -140,6 +142,7 @@ def postprocess_model_masks(
         trab_fill_gaps_radius: int = 5,
         silent: bool = False
 ) -> np.ndarray:
+    from bonelab.util.registration_util import message_s
     message_s("", silent)
     message_s(f"B <- Tb ∪ Sc", silent)
     bone_mask = trabecular_bone_mask | subchondral_bone_plate_mask
@@ -203,6 +206,7 @@ def segment_tunnel(
         tunnel_min_size: int = 0,
         silent: bool = False
 ) -> np.ndarray:
+    from bonelab.util.registration_util import message_s
     message_s("", silent)
     message_s(f"Step 1: B <- ¬(Sc ∪ Tb)", silent)
     background_mask = np.logical_not(np.logical_or(cortical_mask, trabecular_mask))
@@ -219,26 +223,24 @@ def segment_tunnel(
         return tunnel_mask.astype(int)
 
 
-def postprocess_segmentation(args: Namespace):
-    print(echo_arguments("Post-process segmentation", vars(args)))
-    # check inputs exist
-    check_inputs_exist(
-        [args.mask],
-        args.silent
-    )
-    # generate filenames for outputs
-    yaml_fn = os.path.join(args.output_dir, f"{args.output_label}_postprocessed_mask.yaml")
-    post_model_mask_fn = os.path.join(args.output_dir, f"{args.output_label}_postprocessed_mask.nii.gz")
-    # check for output overwrite
-    check_for_output_overwrite(
-        [yaml_fn, post_model_mask_fn],
-        args.overwrite, args.silent
-    )
-    message_s("Writing yaml...", args.silent)
-    with open(yaml_fn, "w") as f:
-        yaml.dump(vars(args), f)
-    message_s("Reading in mask...", args.silent)
-    mask_sitk = sitk.ReadImage(args.mask)
+def postprocess_mask(mask_sitk: sitk.Image, args: Namespace) -> sitk.Image:
+    """
+    Post-process a model mask in memory.
+
+    Parameters
+    ----------
+    mask_sitk : sitk.Image
+        The model mask.
+
+    args : Namespace
+        The arguments of `hrkPostProcessSegmentation`.
+
+    Returns
+    -------
+    sitk.Image
+        The int32 post-processed mask, with the geometry of the model mask.
+    """
+    from bonelab.util.registration_util import message_s
     message_s("Converting mask to a numpy array...", args.silent)
     mask = sitk.GetArrayFromImage(mask_sitk)
     subchondral_bone_plate_mask = (mask == args.model_subchondral_bone_plate_class).astype(int)
@@ -270,11 +272,62 @@ def postprocess_segmentation(args: Namespace):
             + args.output_trabecular_bone_class * post_trabecular_bone_mask
             + args.output_tunnel_class * tunnel_mask
     )
-
-    message_s("Writing post-processed mask...", args.silent)
     post_model_mask_sitk = sitk.GetImageFromArray(post_model_mask)
     post_model_mask_sitk.CopyInformation(mask_sitk)
-    sitk.WriteImage(sitk.Cast(post_model_mask_sitk, sitk.sitkInt32), post_model_mask_fn)
+    return sitk.Cast(post_model_mask_sitk, sitk.sitkInt32)
+
+
+def get_output_filenames(args: Namespace) -> Tuple[str, str]:
+    """
+    Get the filenames of the yaml and the post-processed mask written by `hrkPostProcessSegmentation`.
+
+    Parameters
+    ----------
+    args : Namespace
+        The arguments of `hrkPostProcessSegmentation`.
+
+    Returns
+    -------
+    Tuple[str, str]
+        The yaml and post-processed mask filenames.
+    """
+    yaml_fn = os.path.join(args.output_dir, f"{args.output_label}_postprocessed_mask.yaml")
+    post_model_mask_fn = nifti_filename(
+        os.path.join(args.output_dir, f"{args.output_label}_postprocessed_mask"), args.output_format
+    )
+    return yaml_fn, post_model_mask_fn
+
+
+def postprocess_segmentation(args: Namespace):
+    from bonelab.util.echo_arguments import echo_arguments
+    from bonelab.util.registration_util import check_inputs_exist, check_for_output_overwrite, message_s
+    print(echo_arguments("Post-process segmentation", vars(args)))
+    # check inputs exist
+    check_inputs_exist(
+        [args.mask],
+        args.silent
+    )
+    # generate filenames for outputs
+    yaml_fn, post_model_mask_fn = get_output_filenames(args)
+    fingerprint = StepFingerprint("hrkPostProcessSegmentation", args, [args.mask], [post_model_mask_fn, yaml_fn])
+    if args.skip_if_unchanged and fingerprint.is_unchanged():
+        message_s("The outputs are up to date with the inputs and arguments, skipping.", args.silent)
+        return
+    # check for output overwrite
+    check_for_output_overwrite(
+        [yaml_fn, post_model_mask_fn],
+        args.overwrite or args.skip_if_unchanged, args.silent
+    )
+    fingerprint.invalidate()
+    message_s("Writing yaml...", args.silent)
+    with open(yaml_fn, "w") as f:
+        yaml.dump(vars(args), f)
+    message_s("Reading in mask...", args.silent)
+    mask_sitk = sitk.ReadImage(args.mask)
+    post_model_mask_sitk = postprocess_mask(mask_sitk, args)
+    message_s("Writing post-processed mask...", args.silent)
+    sitk.WriteImage(post_model_mask_sitk, post_model_mask_fn)
+    fingerprint.write()
 
 
 def create_parser() -> ArgumentParser:
@@ -285,8 +338,9 @@ def create_parser() -> ArgumentParser:
                     'specify the class labels for the subchondral bone plate and trabecular bone in the mask. '
                     'The output mask will have the following class labels: 0-background, 1-subchondral bone plate, '
                     '2-trabecular bone. The output mask will be saved to '
-                    '{output_dir}/{output_label}_postprocessed_mask.nii.gz and a yaml file containing the arguments '
-                    'supplied to this script will be saved to {output_dir}/{output_label}_postprocessed_mask.yaml.'
+                    '{output_dir}/{output_label}_postprocessed_mask.{output_format} and a yaml file containing the '
+                    'arguments supplied to this script will be saved to '
+                    '{output_dir}/{output_label}_postprocessed_mask.yaml.'
                     'Optionally, you can tell this script to try to autodetect an ACLR tunnel using the final '
                     'cortical and trabecular masks. In this case you will want to set the optional parameter '
                     '{tunnel-min-size} to the minimum number of voxels you expect a tunnel to occupy.',
@@ -338,6 +392,12 @@ def create_parser() -> ArgumentParser:
         "--tunnel-min-size", "-tms", type=int, default=0, metavar="N",
         help="minimum number of voxels a tunnel must occupy to be detected"
     )
+    parser.add_argument(
+        "--output-format", "-of", default=DELIVERABLE_FORMAT, choices=NIFTI_FORMATS,
+        help="format of the output mask. the post-processed mask is kept as a result of the pipeline, so it is "
+             "compressed by default regardless of the `HRKNEESEG_INTERMEDIATE_FORMAT` environment variable"
+    )
+    add_skip_if_unchanged_argument(parser)
     parser.add_argument("--overwrite", "-ow", action="store_true", help="Overwrite output files if they exist.")
     parser.add_argument("--silent", "-s", action="store_true", help="Silence all terminal output.")
     return parser
@@ -2,14 +2,13 @@ from __future__ import annotations
 
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter, Namespace, ArgumentTypeError
 import SimpleITK as sitk
-import numpy as np
-import vtkbone
 
 from bonelab.util.time_stamp import message
-from bonelab.util.vtk_util import vtkImageData_to_numpy
-from bonelab.util.aim_calibration_header import get_aim_density_equation
 from bonelab.cli.registration import check_inputs_exist, check_for_output_overwrite
 
+from hrkneeseg.aim_nifti.aim_io import AIM_BACKENDS
+from hrkneeseg.aim_nifti.convert_aims_to_nifti import read_aim_as_sitk
+
 
 def create_parser() -> ArgumentParser:
     """
@@ -33,6 +32,10 @@ def create_parser() -> ArgumentParser:
     parser.add_argument(
         "image_type", choices=["density", "mask"], help="The type of image to convert."
     )
+    parser.add_argument(
+        "--aim-backend", "-ab", default="vtk", choices=AIM_BACKENDS,
+        help="How to read the AIM. `numpy` reads uncompressed AIMs directly without importing vtk/vtkbone."
+    )
     parser.add_argument(
         "--overwrite", "-ow", action="store_true", help="Overwrite output file if it exists."
     )
@@ -80,23 +83,9 @@ def convert_aim_to_nifti(args: Namespace):
     check_for_output_overwrite([args.output], args.overwrite, args.silent)
     # read image
     message_s(f"Reading AIM file {args.input}", args.silent)
-    reader = vtkbone.vtkboneAIMReader()
-    reader.DataOnCellsOff()
-    reader.SetFileName(args.input)
-    reader.Update()
-    if args.image_type == "density":
-        processing_log = reader.GetProcessingLog()
-        density_slope, density_intercept = get_aim_density_equation(processing_log)
-        arr = density_slope * vtkImageData_to_numpy(reader.GetOutput()) + density_intercept
-    elif args.image_type == "mask":
-        arr = vtkImageData_to_numpy(reader.GetOutput())
-    else:
+    if args.image_type not in ["density", "mask"]:
         raise ArgumentTypeError(f"Image type {args.image_type} not recognized.")
-    # convert to SimpleITK image
-    message_s("Converting to SimpleITK image", args.silent)
-    img = sitk.GetImageFromArray(np.moveaxis(arr, [0, 1, 2], [2, 1, 0]))
-    img.SetSpacing(reader.GetOutput().GetSpacing())
-    img.SetOrigin(reader.GetOutput().GetOrigin())
+    img, _, _ = read_aim_as_sitk(args.input, args.aim_backend, calibrate=(args.image_type == "density"))
     # write image
     message_s(f"Writing NIfTI file {args.output}", args.silent)
     sitk.WriteImage(img, args.output)
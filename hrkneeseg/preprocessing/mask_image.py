@@ -1,13 +1,12 @@
 from __future__ import annotations
 
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter, Namespace, ArgumentTypeError
-import SimpleITK as sitk
 import numpy as np
-from skimage.morphology import binary_dilation
 
-from bonelab.util.time_stamp import message
-from bonelab.util.echo_arguments import echo_arguments
-from bonelab.cli.registration import check_inputs_exist, check_for_output_overwrite
+from hrkneeseg.utils.fingerprint import StepFingerprint, add_skip_if_unchanged_argument
+from hrkneeseg.utils.lazy_import import lazy_import
+
+sitk = lazy_import("SimpleITK")
 
 
 def expand_array_to_3d(array: np.ndarray, dim: int) -> np.ndarray:
@@ -30,6 +29,7 @@ def create_efficient_3d_binary_operation(func: callable) -> callable:
 
 
 def efficient_3d_dilation(mask: np.ndarray, radius: int) -> np.ndarray:
+    from skimage.morphology import binary_dilation
     return create_efficient_3d_binary_operation(binary_dilation)(mask, radius)
 
 
@@ -48,14 +48,22 @@ def message_s(m: str, s: bool):
     -------
     None
     """
+    from bonelab.util.time_stamp import message
     if not s:
         message(m)
 
 
 def mask_image(args: Namespace) -> None:
+    from bonelab.util.echo_arguments import echo_arguments
+    from bonelab.cli.registration import check_inputs_exist, check_for_output_overwrite
     print(echo_arguments("Mask image", vars(args)))
     check_inputs_exist([args.input, args.mask], args.silent)
-    check_for_output_overwrite(args.output, args.overwrite, args.silent)
+    fingerprint = StepFingerprint("hrkMaskImage", args, [args.input, args.mask], [args.output])
+    if args.skip_if_unchanged and fingerprint.is_unchanged():
+        message_s("The output is up to date with the inputs and arguments, skipping.", args.silent)
+        return
+    check_for_output_overwrite(args.output, args.overwrite or args.skip_if_unchanged, args.silent)
+    fingerprint.invalidate()
     message_s("Reading input image...", args.silent)
     image, mask = sitk.ReadImage(args.input), sitk.ReadImage(args.mask)
     image_array, mask_array = sitk.GetArrayFromImage(image), sitk.GetArrayFromImage(mask)
@@ -69,6 +77,7 @@ def mask_image(args: Namespace) -> None:
     output = sitk.GetImageFromArray(image_array)
     output.CopyInformation(image)
     sitk.WriteImage(output, args.output)
+    fingerprint.write()
 
 
 def create_parser() -> ArgumentParser:
@@ -97,6 +106,7 @@ def create_parser() -> ArgumentParser:
         "--background-value", "-bv", type=int, default=0, metavar="N",
         help="The value to use for the background."
     )
+    add_skip_if_unchanged_argument(parser)
     parser.add_argument(
         "--overwrite", "-ow", action="store_true", help="Overwrite output file if it exists."
     )
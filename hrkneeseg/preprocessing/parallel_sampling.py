@@ -0,0 +1,303 @@
+from __future__ import annotations
+
+from argparse import Namespace
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from hrkneeseg.datasets.foreground_index import ForegroundIndex
+from hrkneeseg.datasets.sample_store import DEFAULT_SHARD_SIZE, SampleStoreWriter, merge_parts
+from hrkneeseg.datasets.slice_sampling import draw_slice_stacks
+
+# slice samples drawn and written at once, 256 stacks of 5 128x128 slices are 80 MB of float32
+SLICE_BATCH_SIZE = 256
+
+
+def get_image_part(idx: int) -> str:
+    return f"image-{idx:06d}"
+
+
+def write_image_samples(
+        file_loader: Sequence,
+        sampler: Callable,
+        transformer: Optional[Callable],
+        store_dir: str,
+        idx: int,
+        epochs: int,
+        shard_size: int = DEFAULT_SHARD_SIZE,
+        args: Optional[Namespace] = None
+) -> int:
+    """
+    Load one image and draw all of its samples from it, writing them to their own part of a store.
+
+    Parameters
+    ----------
+    file_loader : Sequence
+        The file loader of the dataset, e.g. an `AIMLoader`.
+
+    sampler : Callable
+        The sampler of the dataset.
+
+    transformer : Optional[Callable]
+        The transformer of the dataset, applied to each sample.
+
+    store_dir : str
+        The directory of the store.
+
+    idx : int
+        The index of the image in `file_loader`.
+
+    epochs : int
+        The number of samples to draw from the image.
+
+    shard_size : int
+        The number of samples per shard. Default is `64`.
+
+    args : Optional[Namespace]
+        The arguments the samples were created with, saved in the manifest. Default is `None`.
+
+    Returns
+    -------
+    int
+        The number of samples written.
+    """
+    data = file_loader[idx]
+    with SampleStoreWriter(store_dir, part=get_image_part(idx), shard_size=shard_size, args=args) as writer:
+        for _ in range(epochs):
+            sample = sampler(data)
+            if transformer is not None:
+                sample = transformer(sample)
+            writer.add(sample)
+    return len(writer)
+
+
+def write_samples_by_image(
+        file_loader: Sequence,
+        sampler: Callable,
+        transformer: Optional[Callable],
+        store_dir: str,
+        idxs: Sequence[int],
+        epochs: int,
+        num_workers: int = 1,
+        shard_size: int = DEFAULT_SHARD_SIZE,
+        args: Optional[Namespace] = None
+) -> int:
+    """
+    Write `epochs` samples of each image to a store, loading each image once instead of once per epoch as
+    `ComposedDataset.pickle_dataset` and `write_samples` do. The images are assigned to a pool of worker processes
+    that each write the samples of their images to their own shards, and the parts of the images are then merged
+    into one part named after the first and last index.
+
+    Parameters
+    ----------
+    file_loader : Sequence
+        The file loader of the dataset, e.g. an `AIMLoader`.
+
+    sampler : Callable
+        The sampler of the dataset.
+
+    transformer : Optional[Callable]
+        The transformer of the dataset, applied to each sample.
+
+    store_dir : str
+        The directory of the store.
+
+    idxs : Sequence[int]
+        The indices of the images in `file_loader`.
+
+    epochs : int
+        The number of samples to draw from each image.
+
+    num_workers : int
+        The number of images to load and sample at once. Each worker holds one loaded image in memory. If 1, the
+        images are sampled in this process. Default is 1.
+
+    shard_size : int
+        The number of samples per shard. Default is `64`.
+
+    args : Optional[Namespace]
+        The arguments the samples were created with, saved in the manifest. Default is `None`.
+
+    Returns
+    -------
+    int
+        The number of samples written.
+    """
+    idxs = [int(idx) for idx in idxs]
+    task_args = [(file_loader, sampler, transformer, store_dir, idx, epochs, shard_size, args) for idx in idxs]
+    return _write_parts(write_image_samples, task_args, store_dir, idxs, num_workers, args)
+
+
+def _write_parts(
+        func: Callable,
+        task_args: List[Tuple],
+        store_dir: str,
+        idxs: List[int],
+        num_workers: int,
+        args: Optional[Namespace]
+) -> int:
+    if num_workers < 1:
+        raise ValueError(f"`num_workers` must be at least 1, given {num_workers}")
+    if num_workers == 1:
+        for task in task_args:
+            func(*task)
+    else:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            # wait for every image, raising the first error, before merging
+            futures = [executor.submit(func, *task) for task in task_args]
+            for future in futures:
+                future.result()
+    part = f"{idxs[0]:06d}-{idxs[-1]:06d}" if len(idxs) > 0 else "empty"
+    return merge_parts(store_dir, [get_image_part(idx) for idx in idxs], part, args=args)
+
+
+def write_image_slice_samples(
+        file_loader: Sequence,
+        transformer: Optional[Callable],
+        store_dir: str,
+        idx: int,
+        epochs: int,
+        patch_width: int,
+        num_adjacent_slices: int = 0,
+        probability: float = 0.5,
+        foreground_channel: int = 0,
+        shard_size: int = DEFAULT_SHARD_SIZE,
+        args: Optional[Namespace] = None
+) -> int:
+    """
+    Load one image and draw all of its slice or slice stack samples from it in batches with `draw_slice_stacks`,
+    writing each batch to its own part of a store with `SampleStoreWriter.add_batch`. The samples are written as
+    float32 images and int64 labels, given back as tensors by `SampleStoreDataset`.
+
+    Parameters
+    ----------
+    file_loader : Sequence
+        The file loader of the dataset, e.g. an `AIMLoader`.
+
+    transformer : Optional[Callable]
+        A transformer applied to each batch of `(images, labels)`, so it must work on stacked samples, e.g. a
+        `Rescaler`.
+
+    store_dir : str
+        The directory of the store.
+
+    idx : int
+        The index of the image in `file_loader`.
+
+    epochs : int
+        The number of samples to draw from the image.
+
+    patch_width : int
+        The in-plane width of the patches.
+
+    num_adjacent_slices : int
+        The number of slices on each side of the central slice, 0 for single slices. Default is 0.
+
+    probability : float
+        The probability of centering a patch on a foreground pixel. Default is 0.5.
+
+    foreground_channel : int
+        The channel of the labels to center foreground patches on. Default is 0.
+
+    shard_size : int
+        The number of samples per shard. Default is `64`.
+
+    args : Optional[Namespace]
+        The arguments the samples were created with, saved in the manifest. Default is `None`.
+
+    Returns
+    -------
+    int
+        The number of samples written.
+    """
+    image, labels = file_loader[idx]
+    image, labels = np.asarray(image), np.asarray(labels)
+    foreground = ForegroundIndex.from_labels(labels, image.ndim - 1, foreground_channel)
+    rng = np.random.default_rng()
+    with SampleStoreWriter(store_dir, part=get_image_part(idx), shard_size=shard_size, args=args) as writer:
+        for start in range(0, epochs, SLICE_BATCH_SIZE):
+            batch = draw_slice_stacks(
+                image, labels, foreground, min(SLICE_BATCH_SIZE, epochs - start), patch_width,
+                num_adjacent_slices, probability, rng
+            )
+            if transformer is not None:
+                batch = transformer(batch)
+            images, batch_labels = batch
+            writer.add_batch(
+                (np.asarray(images, dtype=np.float32), np.asarray(batch_labels, dtype=np.int64)), tensor=True
+            )
+    return len(writer)
+
+
+def write_slice_samples_by_image(
+        file_loader: Sequence,
+        transformer: Optional[Callable],
+        store_dir: str,
+        idxs: Sequence[int],
+        epochs: int,
+        patch_width: int,
+        num_adjacent_slices: int = 0,
+        probability: float = 0.5,
+        foreground_channel: int = 0,
+        num_workers: int = 1,
+        shard_size: int = DEFAULT_SHARD_SIZE,
+        args: Optional[Namespace] = None
+) -> int:
+    """
+    Write `epochs` slice or slice stack samples of each image to a store, as `write_samples_by_image` does but with
+    the samples of an image drawn and written in batches by `write_image_slice_samples`, instead of one sampler call
+    and one record per sample.
+
+    Parameters
+    ----------
+    file_loader : Sequence
+        The file loader of the dataset, e.g. an `AIMLoader`.
+
+    transformer : Optional[Callable]
+        A transformer applied to each batch of `(images, labels)`, e.g. a `Rescaler`.
+
+    store_dir : str
+        The directory of the store.
+
+    idxs : Sequence[int]
+        The indices of the images in `file_loader`.
+
+    epochs : int
+        The number of samples to draw from each image.
+
+    patch_width : int
+        The in-plane width of the patches.
+
+    num_adjacent_slices : int
+        The number of slices on each side of the central slice, 0 for single slices. Default is 0.
+
+    probability : float
+        The probability of centering a patch on a foreground pixel. Default is 0.5.
+
+    foreground_channel : int
+        The channel of the labels to center foreground patches on. Default is 0.
+
+    num_workers : int
+        The number of images to load and sample at once. If 1, the images are sampled in this process. Default is 1.
+
+    shard_size : int
+        The number of samples per shard. Default is `64`.
+
+    args : Optional[Namespace]
+        The arguments the samples were created with, saved in the manifest. Default is `None`.
+
+    Returns
+    -------
+    int
+        The number of samples written.
+    """
+    idxs = [int(idx) for idx in idxs]
+    task_args = [
+        (
+            file_loader, transformer, store_dir, idx, epochs, patch_width, num_adjacent_slices, probability,
+            foreground_channel, shard_size, args
+        )
+        for idx in idxs
+    ]
+    return _write_parts(write_image_slice_samples, task_args, store_dir, idxs, num_workers, args)
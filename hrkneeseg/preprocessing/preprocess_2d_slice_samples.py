@@ -1,14 +1,8 @@
 import numpy as np
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
 
-from blpytorchlightning.dataset_components.file_loaders.AIMLoader import AIMLoader
-from blpytorchlightning.dataset_components.samplers.SliceSampler import SliceSampler
-from blpytorchlightning.dataset_components.samplers.ForegroundPatchSampler import ForegroundPatchSampler
-from blpytorchlightning.dataset_components.samplers.ComposedSampler import ComposedSampler
-from blpytorchlightning.dataset_components.transformers.Rescaler import Rescaler
-from blpytorchlightning.dataset_components.transformers.TensorConverter import TensorConverter
-from blpytorchlightning.dataset_components.transformers.ComposedTransformers import ComposedTransformers
-from blpytorchlightning.dataset_components.datasets.ComposedDataset import ComposedDataset
+from hrkneeseg.datasets.sample_store import DEFAULT_SHARD_SIZE, SAMPLE_FORMATS
+from hrkneeseg.preprocessing.parallel_sampling import write_slice_samples_by_image
 
 
 def create_parser():
@@ -23,7 +17,7 @@ def create_parser():
     )
     parser.add_argument(
         'pickle_dir', type=str, metavar='PICKLED_DIR',
-        help='main directory to save the pickled dataset to'
+        help='main directory to save the sample store or pickled dataset to'
     )
     parser.add_argument(
         '--idx-start', '-is', type=int, default=0, metavar='N',
@@ -49,6 +43,20 @@ def create_parser():
         '--patch-width', '-pw', type=int, default=128, metavar='N',
         help='width of slice patch to use in training'
     )
+    parser.add_argument(
+        '--sample-format', '-sf', type=str, choices=SAMPLE_FORMATS, default='store',
+        help='`store` writes the samples to memory-mappable shards of `--shard-size` samples each, read with '
+             '`SampleStoreDataset`; `pickle` writes one pickle file per sample, read with `PickledDataset`'
+    )
+    parser.add_argument(
+        '--shard-size', '-ss', type=int, default=DEFAULT_SHARD_SIZE, metavar='N',
+        help='number of samples per shard of the sample store'
+    )
+    parser.add_argument(
+        '--num-workers', '-nw', type=int, default=1, metavar='N',
+        help='number of images to load and sample at once when writing a sample store. each image is loaded once '
+             'and all `--epochs` samples are drawn from it in batches, so each worker holds one image in memory'
+    )
 
     return parser
 
@@ -56,6 +64,14 @@ def create_parser():
 def main():
     # get parameters from command line
     args = create_parser().parse_args()
+    from blpytorchlightning.dataset_components.file_loaders.AIMLoader import AIMLoader
+    from blpytorchlightning.dataset_components.samplers.SliceSampler import SliceSampler
+    from blpytorchlightning.dataset_components.samplers.ForegroundPatchSampler import ForegroundPatchSampler
+    from blpytorchlightning.dataset_components.samplers.ComposedSampler import ComposedSampler
+    from blpytorchlightning.dataset_components.transformers.Rescaler import Rescaler
+    from blpytorchlightning.dataset_components.transformers.TensorConverter import TensorConverter
+    from blpytorchlightning.dataset_components.transformers.ComposedTransformers import ComposedTransformers
+    from blpytorchlightning.dataset_components.datasets.ComposedDataset import ComposedDataset
 
     # create dataset
     file_loader = AIMLoader(args.data_dir, '*_*_??.AIM')
@@ -63,17 +79,23 @@ def main():
         SliceSampler(),
         ForegroundPatchSampler(patch_width=args.patch_width, prob=0.5)
     ])
-    transformer = ComposedTransformers([
-        Rescaler(intensity_bounds=[args.min_density, args.max_density]),
-        TensorConverter()
-    ])
+    rescaler = Rescaler(intensity_bounds=[args.min_density, args.max_density])
+    transformer = ComposedTransformers([rescaler, TensorConverter()])
     dataset = ComposedDataset(file_loader, sampler, transformer)
 
-    # pickle the samples
+    # save the samples
     if args.idx_end is None:
         args.idx_end = len(dataset)
     idxs = np.arange(args.idx_start, args.idx_end, dtype=int)
-    dataset.pickle_dataset(args.pickle_dir, idxs, args.epochs, args=args)
+    if args.sample_format == 'pickle':
+        dataset.pickle_dataset(args.pickle_dir, idxs, args.epochs, args=args)
+    else:
+        # the slices are drawn and written in batches, the rescaler works on the stacked samples as on one sample
+        write_slice_samples_by_image(
+            file_loader, rescaler, args.pickle_dir, idxs, args.epochs, args.patch_width,
+            num_adjacent_slices=0, probability=0.5,
+            num_workers=args.num_workers, shard_size=args.shard_size, args=args
+        )
 
 
 if __name__ == '__main__':
@@ -1,12 +1,9 @@
 import numpy as np
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
 
-from blpytorchlightning.dataset_components.file_loaders.AIMLoader import AIMLoader
-from blpytorchlightning.dataset_components.samplers.ForegroundPatchSampler import ForegroundPatchSampler
-from blpytorchlightning.dataset_components.transformers.Rescaler import Rescaler
-from blpytorchlightning.dataset_components.transformers.TensorConverter import TensorConverter
-from blpytorchlightning.dataset_components.transformers.ComposedTransformers import ComposedTransformers
-from blpytorchlightning.dataset_components.datasets.ComposedDataset import ComposedDataset
+from hrkneeseg.datasets.patch_sampling import IndexedForegroundPatchSampler
+from hrkneeseg.datasets.sample_store import DEFAULT_SHARD_SIZE, SAMPLE_FORMATS
+from hrkneeseg.preprocessing.parallel_sampling import write_samples_by_image
 
 
 def create_parser():
@@ -21,7 +18,7 @@ def create_parser():
     )
     parser.add_argument(
         'pickle_dir', type=str, metavar='STR',
-        help='main directory to save the pickled dataset to'
+        help='main directory to save the sample store or pickled dataset to'
     )
     parser.add_argument(
         '--idx-start', '-is', type=int, default=0, metavar='N',
@@ -55,6 +52,20 @@ def create_parser():
         '--probability', '-p', type=float, default=0.5, metavar='P',
         help='probability of sampling a foreground patch'
     )
+    parser.add_argument(
+        '--sample-format', '-sf', type=str, choices=SAMPLE_FORMATS, default='store',
+        help='`store` writes the samples to memory-mappable shards of `--shard-size` samples each, read with '
+             '`SampleStoreDataset`; `pickle` writes one pickle file per sample, read with `PickledDataset`'
+    )
+    parser.add_argument(
+        '--shard-size', '-ss', type=int, default=DEFAULT_SHARD_SIZE, metavar='N',
+        help='number of samples per shard of the sample store'
+    )
+    parser.add_argument(
+        '--num-workers', '-nw', type=int, default=1, metavar='N',
+        help='number of images to load and sample at once when writing a sample store. each image is loaded once '
+             'and all `--epochs` samples are drawn from it, so each worker holds one image in memory'
+    )
 
     return parser
 
@@ -62,10 +73,15 @@ def create_parser():
 def main():
     # get parameters from command line
     args = create_parser().parse_args()
+    from blpytorchlightning.dataset_components.file_loaders.AIMLoader import AIMLoader
+    from blpytorchlightning.dataset_components.transformers.Rescaler import Rescaler
+    from blpytorchlightning.dataset_components.transformers.TensorConverter import TensorConverter
+    from blpytorchlightning.dataset_components.transformers.ComposedTransformers import ComposedTransformers
+    from blpytorchlightning.dataset_components.datasets.ComposedDataset import ComposedDataset
 
     # create dataset
     file_loader = AIMLoader(args.data_dir, '*_*_??.AIM')
-    sampler = ForegroundPatchSampler(
+    sampler = IndexedForegroundPatchSampler(
         patch_width=args.patch_width,
         foreground_channel=args.foreground_channel,
         prob=args.probability
@@ -76,11 +92,17 @@ def main():
     ])
     dataset = ComposedDataset(file_loader, sampler, transformer)
 
-    # pickle the samples
+    # save the samples
     if not args.idx_end:
         args.idx_end = len(dataset)
     idxs = np.arange(args.idx_start, args.idx_end, dtype=int)
-    dataset.pickle_dataset(args.pickle_dir, idxs, args.epochs, args=args)
+    if args.sample_format == 'pickle':
+        dataset.pickle_dataset(args.pickle_dir, idxs, args.epochs, args=args)
+    else:
+        write_samples_by_image(
+            file_loader, sampler, transformer, args.pickle_dir, idxs, args.epochs,
+            num_workers=args.num_workers, shard_size=args.shard_size, args=args
+        )
 
 
 if __name__ == '__main__':
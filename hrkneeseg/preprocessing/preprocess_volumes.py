@@ -0,0 +1,123 @@
+import numpy as np
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter, Namespace
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Sequence
+
+from hrkneeseg.datasets.volume_store import write_sampling, write_volume
+
+
+def create_parser():
+    parser = ArgumentParser(
+        description='HRpQCT Segmentation Volume Preprocessing Script. Rescales each image once and saves it with its '
+                    'labels as memory-mappable arrays, so that training can draw random patches from the volumes on '
+                    'the fly instead of from patches drawn at preprocessing. Pass the output directory to the '
+                    'training tools as a data directory.',
+        formatter_class=ArgumentDefaultsHelpFormatter
+    )
+
+    parser.add_argument(
+        'data_dir', type=str, metavar='STR',
+        help='main directory of the raw dataset'
+    )
+    parser.add_argument(
+        'volume_dir', type=str, metavar='STR',
+        help='main directory to save the volume store to'
+    )
+    parser.add_argument(
+        '--file-type', '-ft', type=str, choices=['aim', 'npz'], default='aim',
+        help='`aim` reads `*_*_??.AIM` images and masks, `npz` reads `*.npz` files with `image`, `cort_mask` and '
+             '`trab_mask` arrays'
+    )
+    parser.add_argument(
+        '--idx-start', '-is', type=int, default=0, metavar='N',
+        help='index to start preprocessing at'
+    )
+    parser.add_argument(
+        '--idx-end', '-ie', type=int, default=None, metavar='N',
+        help='index to end preprocessing at'
+    )
+    parser.add_argument(
+        '--min-density', '-mind', type=float, default=-400, metavar='D',
+        help='minimum physiologically relevant density in the image [mg HA/ccm]'
+    )
+    parser.add_argument(
+        '--max-density', '-maxd', type=float, default=1400, metavar='D',
+        help='maximum physiologically relevant density in the image [mg HA/ccm]'
+    )
+    parser.add_argument(
+        '--foreground-channel', '-fc', type=int, default=0, metavar='N',
+        help='channel to use for centering patches'
+    )
+    parser.add_argument(
+        '--epochs', '-e', type=int, default=200, metavar='N',
+        help='default number of patches to draw from each volume per training epoch'
+    )
+    parser.add_argument(
+        '--patch-width', '-pw', type=int, default=128, metavar='N',
+        help='default width of the patches to draw'
+    )
+    parser.add_argument(
+        '--probability', '-p', type=float, default=0.5, metavar='P',
+        help='default probability of drawing a foreground patch'
+    )
+    parser.add_argument(
+        '--num-workers', '-nw', type=int, default=1, metavar='N',
+        help='number of images to preprocess at once, each worker holds one image in memory'
+    )
+
+    return parser
+
+
+def preprocess_volume(
+        file_loader: Sequence,
+        rescaler: Callable,
+        volume_dir: str,
+        idx: int,
+        foreground_channel: int
+) -> int:
+    image, labels = rescaler(file_loader[idx])
+    return write_volume(
+        volume_dir, f"{idx:06d}", np.asarray(image, dtype=np.float32), np.asarray(labels), foreground_channel
+    )
+
+
+def preprocess_volumes(args: Namespace) -> None:
+    from blpytorchlightning.dataset_components.file_loaders.AIMLoader import AIMLoader
+    from blpytorchlightning.dataset_components.file_loaders.NPZLoader import NPZLoader
+    from blpytorchlightning.dataset_components.transformers.Rescaler import Rescaler
+    if args.num_workers < 1:
+        raise ValueError(f"`num-workers` must be at least 1, given {args.num_workers}")
+    if args.file_type == 'aim':
+        file_loader = AIMLoader(args.data_dir, '*_*_??.AIM')
+    else:
+        file_loader = NPZLoader(
+            args.data_dir, '*.npz',
+            inputs_keys=["image"], targets_keys=["cort_mask", "trab_mask"],
+            inputs_type=float, targets_type=int, binarize_targets=True, add_null_class_to_targets=True
+        )
+    rescaler = Rescaler(intensity_bounds=[args.min_density, args.max_density])
+
+    # the sampling is written first, it is only the default and is the same for every job writing to the store
+    write_sampling(args.volume_dir, args.patch_width, args.probability, args.epochs)
+    if args.idx_end is None:
+        args.idx_end = len(file_loader)
+    idxs = np.arange(args.idx_start, args.idx_end, dtype=int)
+    task_args = [(file_loader, rescaler, args.volume_dir, int(idx), args.foreground_channel) for idx in idxs]
+    if args.num_workers == 1:
+        for task in task_args:
+            preprocess_volume(*task)
+    else:
+        with ProcessPoolExecutor(max_workers=args.num_workers) as executor:
+            futures = [executor.submit(preprocess_volume, *task) for task in task_args]
+            for future in futures:
+                future.result()
+
+
+def main():
+    # get parameters from command line
+    args = create_parser().parse_args()
+    preprocess_volumes(args)
+
+
+if __name__ == '__main__':
+    main()
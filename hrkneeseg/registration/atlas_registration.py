@@ -0,0 +1,394 @@
+from __future__ import annotations
+
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter, Namespace
+import numpy as np
+import os
+from typing import List, Optional, Tuple
+
+from hrkneeseg.preprocessing.mask_image import efficient_3d_dilation
+from hrkneeseg.registration.demons import multiscale_demons_with_pyramids
+from hrkneeseg.registration.pyramid import build_pyramid, load_atlas_pyramid, get_pyramid_manifest_filename
+from hrkneeseg.utils.lazy_import import lazy_import
+
+sitk = lazy_import("SimpleITK")
+
+
+def create_parser() -> ArgumentParser:
+    from bonelab.util.demons_registration_util import DEMONS_FILTERS, demons_type_checker
+    parser = ArgumentParser(
+        description="Register an image to an atlas and transform the atlas mask to the image. The image is masked "
+                    "with the dilated bone mask (as `hrkMaskImage`), cropped to the bone, mirrored if it is a LEFT "
+                    "knee, and downsampled, and the displacement field is found with multiscale demons on the "
+                    "downsampled image. The atlas mask is then transformed with the composed initial and "
+                    "displacement field transforms at the full resolution of the image, in slabs, and mirrored back "
+                    "if needed. If the atlas has a precomputed pyramid from `hrkGenerateAtlasPyramid` with matching "
+                    "parameters, it is loaded instead of being rebuilt.",
+        formatter_class=ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("image", type=str, metavar="IMAGE", help="the image to register to the atlas")
+    parser.add_argument(
+        "mask", type=str, metavar="MASK", help="the bone mask of the image, e.g. the postprocessed model mask"
+    )
+    parser.add_argument("atlas", type=str, metavar="ATLAS", help="the atlas image")
+    parser.add_argument("atlas_mask", type=str, metavar="ATLAS_MASK", help="the atlas mask")
+    parser.add_argument(
+        "output", type=str, metavar="OUTPUT", help="filename to write the atlas mask transformed to the image to"
+    )
+    parser.add_argument(
+        "--mirror", "-mir", default=False, action="store_true",
+        help="enable this flag for LEFT knees, so the image is mirrored along the x axis before registration and the "
+             "transformed atlas mask is mirrored back"
+    )
+    parser.add_argument(
+        "--dilate-amount", "-da", type=int, default=35, metavar="N",
+        help="the amount to dilate the bone mask by before masking the image"
+    )
+    parser.add_argument(
+        "--background-class", "-bc", type=int, default=0, metavar="N",
+        help="the class of the background in the bone mask"
+    )
+    parser.add_argument(
+        "--background-value", "-bv", type=float, default=-1000, metavar="X",
+        help="the value to set the image to outside of the dilated bone mask, and to use when resampling"
+    )
+    parser.add_argument(
+        "--crop-padding", "-cp", type=int, default=10, metavar="N",
+        help="number of voxels to pad the crop around the dilated bone mask by"
+    )
+    parser.add_argument(
+        "--atlas-pyramid", "-ap", type=str, default=None, metavar="FN",
+        help="manifest of a precomputed pyramid of the atlas from `hrkGenerateAtlasPyramid`. if `None`, "
+             "`<atlas base>_pyramid.yaml` is used if it exists and was built with the same parameters, otherwise "
+             "the atlas pyramid is built here"
+    )
+    parser.add_argument(
+        "--downsampling-shrink-factor", "-dsf", type=float, default=8, metavar="X",
+        help="factor by which to shrink the cropped image and the atlas before registration"
+    )
+    parser.add_argument(
+        "--downsampling-smoothing-sigma", "-dss", type=float, default=0.5, metavar="X",
+        help="variance for the Gaussian filter used to smooth the cropped image and the atlas before downsampling"
+    )
+    parser.add_argument(
+        "--shrink-factors", "-sf", type=float, nargs="+", default=[16, 8, 4, 2], metavar="X",
+        help="factors by which to shrink the downsampled images at each stage of the multiscale progression"
+    )
+    parser.add_argument(
+        "--smoothing-sigmas", "-ss", type=float, nargs="+", default=[8, 4, 2, 1], metavar="X",
+        help="variances for the Gaussians used to smooth the downsampled images at each stage of the multiscale "
+             "progression"
+    )
+    parser.add_argument(
+        "--demons-type", "-dt", default="diffeomorphic", type=demons_type_checker, metavar="STR",
+        help=f"type of demons algorithm to use. options: {list(DEMONS_FILTERS.keys())}"
+    )
+    parser.add_argument(
+        "--max-demons-iterations", "-mi", default=200, type=int, metavar="N",
+        help="number of demons iterations at each stage of the multiscale progression"
+    )
+    parser.add_argument(
+        "--displacement-smoothing-std", "-ds", default=2.0, type=float, metavar="X",
+        help="standard deviation for the Gaussian smoothing applied to the displacement field at each step"
+    )
+    parser.add_argument(
+        "--update-smoothing-std", "-us", default=2.0, type=float, metavar="X",
+        help="standard deviation for the Gaussian smoothing applied to the update field at each step"
+    )
+    parser.add_argument(
+        "--slab-thickness", "-st", default=32, type=int, metavar="N",
+        help="number of slices of the full resolution output to transform the atlas mask into at a time, lower this "
+             "to use less memory"
+    )
+    parser.add_argument(
+        "--output-transform", "-ot", default=None, type=str, metavar="FN",
+        help="if given, write the composed transform to this file. note that the transform maps points in the "
+             "cropped (and mirrored, if `mirror` is enabled) image to the atlas"
+    )
+    parser.add_argument(
+        "--overwrite", "-ow", default=False, action="store_true",
+        help="enable this flag to overwrite existing files, if they exist at output targets"
+    )
+    parser.add_argument(
+        "--silent", "-s", default=False, action="store_true",
+        help="enable this flag to suppress terminal output"
+    )
+    return parser
+
+
+def get_bounding_box(mask_array: np.ndarray, padding: int) -> Tuple[slice, slice, slice]:
+    """
+    Get the bounding box of the foreground of a binary mask array, padded and clipped to the array.
+
+    Parameters
+    ----------
+    mask_array : np.ndarray
+        The binary mask array, in (z, y, x) order.
+
+    padding : int
+        The number of voxels to pad the bounding box by on every side.
+
+    Returns
+    -------
+    Tuple[slice, slice, slice]
+        The (z, y, x) slices of the bounding box.
+    """
+    if not mask_array.any():
+        raise ValueError("the bone mask is empty")
+    bounding_box = []
+    for axis in range(3):
+        nonzero = np.flatnonzero(mask_array.any(axis=tuple(a for a in range(3) if a != axis)))
+        bounding_box.append(slice(
+            max(int(nonzero[0]) - padding, 0), min(int(nonzero[-1]) + padding + 1, mask_array.shape[axis])
+        ))
+    return tuple(bounding_box)
+
+
+def crop_and_mask_image(
+        image: sitk.Image, mask: sitk.Image, args: Namespace
+) -> Tuple[sitk.Image, Tuple[slice, slice, slice]]:
+    """
+    Crop the image to the dilated bone mask, set it to the background value outside of the dilated bone mask, and
+    mirror it along the x axis if needed.
+
+    Parameters
+    ----------
+    image : sitk.Image
+        The image.
+
+    mask : sitk.Image
+        The bone mask of the image.
+
+    args : Namespace
+        The command line arguments.
+
+    Returns
+    -------
+    Tuple[sitk.Image, Tuple[slice, slice, slice]]
+        The cropped float32 image, and the (z, y, x) slices of the crop in the full image.
+    """
+    from bonelab.util.registration_util import message_s
+    mask_array = sitk.GetArrayViewFromImage(mask) != args.background_class
+    crop = get_bounding_box(mask_array, args.dilate_amount + args.crop_padding)
+    mask_array = mask_array[crop]
+    if args.dilate_amount > 0:
+        message_s("Dilating the bone mask...", args.silent)
+        mask_array = efficient_3d_dilation(mask_array, args.dilate_amount)
+    image_array = sitk.GetArrayViewFromImage(image)[crop].astype(np.float32)
+    image_array[~mask_array] = args.background_value
+    if args.mirror:
+        image_array = image_array[:, :, ::-1]
+    cropped_image = sitk.GetImageFromArray(np.ascontiguousarray(image_array))
+    cropped_image.SetOrigin(image.TransformIndexToPhysicalPoint((crop[2].start, crop[1].start, crop[0].start)))
+    cropped_image.SetSpacing(image.GetSpacing())
+    cropped_image.SetDirection(image.GetDirection())
+    return cropped_image, crop
+
+
+def get_atlas_pyramid(args: Namespace, multiscale_progression: Optional[List[Tuple[float, float]]]) -> List[sitk.Image]:
+    """
+    Load the atlas pyramid from its manifest, or build it if there is no usable precomputed pyramid.
+
+    Parameters
+    ----------
+    args : Namespace
+        The command line arguments.
+
+    multiscale_progression : Optional[List[Tuple[float, float]]]
+        The (shrink factor, smoothing sigma) pairs of the multiscale progression.
+
+    Returns
+    -------
+    List[sitk.Image]
+    """
+    from bonelab.util.registration_util import message_s
+    manifest_fn = args.atlas_pyramid
+    if manifest_fn is None and os.path.isfile(get_pyramid_manifest_filename(args.atlas)):
+        manifest_fn = get_pyramid_manifest_filename(args.atlas)
+        try:
+            pyramid = load_atlas_pyramid(
+                manifest_fn, multiscale_progression,
+                args.downsampling_shrink_factor, args.downsampling_smoothing_sigma, args.atlas
+            )
+            message_s(f"Loaded the atlas pyramid from {manifest_fn}", args.silent)
+            return pyramid
+        except ValueError as e:
+            message_s(f"Not using the atlas pyramid in {manifest_fn}: {e}", args.silent)
+    elif manifest_fn is not None:
+        message_s(f"Loading the atlas pyramid from {manifest_fn}", args.silent)
+        return load_atlas_pyramid(
+            manifest_fn, multiscale_progression,
+            args.downsampling_shrink_factor, args.downsampling_smoothing_sigma, args.atlas
+        )
+    message_s("Building the atlas pyramid", args.silent)
+    return build_pyramid(
+        sitk.Cast(sitk.ReadImage(args.atlas), sitk.sitkFloat32), multiscale_progression,
+        args.downsampling_shrink_factor, args.downsampling_smoothing_sigma
+    )
+
+
+def register_to_atlas(
+        fixed_pyramid: List[sitk.Image], atlas_pyramid: List[sitk.Image], args: Namespace
+) -> sitk.Transform:
+    """
+    Register the image pyramid to the atlas pyramid, with a geometric centering initialization followed by
+    multiscale demons.
+
+    Parameters
+    ----------
+    fixed_pyramid : List[sitk.Image]
+        The pyramid of the cropped image.
+
+    atlas_pyramid : List[sitk.Image]
+        The pyramid of the atlas, with the same number of levels.
+
+    args : Namespace
+        The command line arguments.
+
+    Returns
+    -------
+    sitk.Transform
+        The composite transform, mapping points in the cropped image to the atlas.
+    """
+    from bonelab.util.registration_util import message_s
+    initial_transform = sitk.CenteredTransformInitializer(
+        fixed_pyramid[0], atlas_pyramid[0], sitk.Euler3DTransform(), sitk.CenteredTransformInitializerFilter.GEOMETRY
+    )
+    # demons needs the moving image on the fixed grid, the atlas levels are small so this is cheap
+    moving_pyramid = [
+        sitk.Resample(
+            sitk.Cast(atlas_level, sitk.sitkFloat32), fixed_level, initial_transform,
+            sitk.sitkLinear, args.background_value
+        )
+        for fixed_level, atlas_level in zip(fixed_pyramid, atlas_pyramid)
+    ]
+    displacement, metric_history = multiscale_demons_with_pyramids(
+        fixed_pyramid, moving_pyramid,
+        demons_type=args.demons_type,
+        demons_iterations=args.max_demons_iterations,
+        demons_displacement_field_smooth_std=args.displacement_smoothing_std,
+        demons_update_field_smooth_std=args.update_smoothing_std,
+        silent=args.silent
+    )
+    if metric_history:
+        message_s(f"Final demons metric: {metric_history[-1]}", args.silent)
+    # the displacement field is applied first, then the initial transform
+    return sitk.CompositeTransform([initial_transform, sitk.DisplacementFieldTransform(displacement)])
+
+
+def resample_in_slabs(
+        image: sitk.Image, reference: sitk.Image, transform: sitk.Transform, slab_thickness: int
+) -> np.ndarray:
+    """
+    Resample an image with nearest neighbour interpolation onto the grid of a reference image, a slab of slices at a
+    time, so the transform is never evaluated on more than one slab at once.
+
+    Parameters
+    ----------
+    image : sitk.Image
+        The image to resample, e.g. the atlas mask.
+
+    reference : sitk.Image
+        The image whose grid to resample onto.
+
+    transform : sitk.Transform
+        The transform from the reference to the image.
+
+    slab_thickness : int
+        The number of slices in a slab.
+
+    Returns
+    -------
+    np.ndarray
+        The resampled array, in (z, y, x) order and the pixel type of `image`.
+    """
+    size = reference.GetSize()
+    output = None
+    for z0 in range(0, size[2], slab_thickness):
+        slab_size = (size[0], size[1], min(slab_thickness, size[2] - z0))
+        slab = sitk.Resample(
+            image, slab_size, transform, sitk.sitkNearestNeighbor,
+            reference.TransformIndexToPhysicalPoint((0, 0, z0)), reference.GetSpacing(), reference.GetDirection(),
+            0, image.GetPixelID()
+        )
+        slab_array = sitk.GetArrayViewFromImage(slab)
+        if output is None:
+            output = np.zeros(size[::-1], dtype=slab_array.dtype)
+        output[z0:z0 + slab_size[2]] = slab_array
+    return output
+
+
+def uncrop_array(
+        cropped_array: np.ndarray, image: sitk.Image, crop: Tuple[slice, slice, slice], mirror: bool
+) -> sitk.Image:
+    """
+    Put an array on the grid of the cropped image back into the grid of the full image, mirroring it back along the x
+    axis if the cropped image was mirrored. The output is 0 outside of the crop.
+
+    Parameters
+    ----------
+    cropped_array : np.ndarray
+        The array on the grid of the cropped image, in (z, y, x) order.
+
+    image : sitk.Image
+        The full image.
+
+    crop : Tuple[slice, slice, slice]
+        The (z, y, x) slices of the crop in the full image, as from `crop_and_mask_image`.
+
+    mirror : bool
+        Whether the cropped image was mirrored.
+
+    Returns
+    -------
+    sitk.Image
+        The image on the grid of the full image.
+    """
+    if mirror:
+        cropped_array = cropped_array[:, :, ::-1]
+    output_array = np.zeros(image.GetSize()[::-1], dtype=cropped_array.dtype)
+    output_array[crop] = cropped_array
+    output = sitk.GetImageFromArray(output_array)
+    output.CopyInformation(image)
+    return output
+
+
+def atlas_registration(args: Namespace) -> None:
+    from bonelab.util.echo_arguments import echo_arguments
+    from bonelab.util.registration_util import check_inputs_exist, check_for_output_overwrite, message_s
+    from bonelab.util.demons_registration_util import construct_multiscale_progression
+    if not args.silent:
+        print(echo_arguments("Atlas Registration", vars(args)))
+    check_inputs_exist([args.image, args.mask, args.atlas, args.atlas_mask], args.silent)
+    outputs = [args.output] + ([args.output_transform] if args.output_transform is not None else [])
+    check_for_output_overwrite(outputs, args.overwrite, args.silent)
+    multiscale_progression = construct_multiscale_progression(args.shrink_factors, args.smoothing_sigmas, args.silent)
+    message_s(f"Reading {args.image} and {args.mask}", args.silent)
+    image = sitk.ReadImage(args.image)
+    mask = sitk.ReadImage(args.mask)
+    message_s("Masking and cropping the image to the bone", args.silent)
+    cropped_image, crop = crop_and_mask_image(image, mask, args)
+    del mask
+    message_s(f"Cropped image size: {cropped_image.GetSize()}", args.silent)
+    fixed_pyramid = build_pyramid(
+        cropped_image, multiscale_progression, args.downsampling_shrink_factor, args.downsampling_smoothing_sigma
+    )
+    atlas_pyramid = get_atlas_pyramid(args, multiscale_progression)
+    message_s("Registering the downsampled image to the atlas", args.silent)
+    transform = register_to_atlas(fixed_pyramid, atlas_pyramid, args)
+    if args.output_transform is not None:
+        message_s(f"Writing transform to {args.output_transform}", args.silent)
+        sitk.WriteTransform(transform, args.output_transform)
+    message_s("Transforming the atlas mask to the image at full resolution", args.silent)
+    cropped_output = resample_in_slabs(sitk.ReadImage(args.atlas_mask), cropped_image, transform, args.slab_thickness)
+    output = uncrop_array(cropped_output, image, crop, args.mirror)
+    message_s(f"Writing transformed atlas mask to {args.output}", args.silent)
+    sitk.WriteImage(output, args.output)
+
+
+def main() -> None:
+    args = create_parser().parse_args()
+    atlas_registration(args)
+
+
+if __name__ == "__main__":
+    main()
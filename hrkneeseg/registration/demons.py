@@ -0,0 +1,153 @@
+from __future__ import annotations
+
+from typing import List, Optional, Tuple
+
+from hrkneeseg.utils.lazy_import import lazy_import
+
+sitk = lazy_import("SimpleITK")
+
+
+def multiscale_demons_with_pyramids(
+        fixed_pyramid: List[sitk.Image],
+        moving_pyramid: List[sitk.Image],
+        demons_type: str,
+        demons_iterations: int,
+        demons_displacement_field_smooth_std: float,
+        demons_update_field_smooth_std: float,
+        initial_transform: Optional[sitk.Transform] = None,
+        silent: bool = True
+) -> Tuple[sitk.Image, List[float]]:
+    """
+    Multiscale demons registration on precomputed fixed and moving pyramids, coarse to fine, in the same way as
+    `multiscale_demons` does on the pyramids it builds.
+
+    Parameters
+    ----------
+    fixed_pyramid : List[sitk.Image]
+        The fixed image pyramid, as returned by `build_pyramid` or `load_atlas_pyramid`. The first level is the
+        finest.
+
+    moving_pyramid : List[sitk.Image]
+        The moving image pyramid, each level must be on the same grid as the matching level of `fixed_pyramid`.
+
+    demons_type : str
+        The type of demons filter to use, a key of `DEMONS_FILTERS`.
+
+    demons_iterations : int
+        The number of demons iterations at each level.
+
+    demons_displacement_field_smooth_std : float
+        The standard deviation of the smoothing applied to the displacement field at each iteration.
+
+    demons_update_field_smooth_std : float
+        The standard deviation of the smoothing applied to the update field at each iteration.
+
+    initial_transform : Optional[sitk.Transform]
+        Transform to initialize the displacement field with. Default is `None`, for an identity initialization.
+
+    silent : bool
+        Set to `True` to suppress terminal output. Default is `True`.
+
+    Returns
+    -------
+    Tuple[sitk.Image, List[float]]
+        The displacement field, on the grid of the first fixed level, and the history of the demons metric.
+    """
+    from bonelab.util.demons_registration_util import DEMONS_FILTERS
+    from bonelab.util.registration_util import message_s
+    if len(fixed_pyramid) != len(moving_pyramid):
+        raise ValueError(
+            f"the fixed pyramid has {len(fixed_pyramid)} levels but the moving pyramid has {len(moving_pyramid)}"
+        )
+    demons_filter = DEMONS_FILTERS[demons_type]()
+    demons_filter.SetNumberOfIterations(demons_iterations)
+    demons_filter.SetSmoothDisplacementField(True)
+    demons_filter.SetStandardDeviations(demons_displacement_field_smooth_std)
+    demons_filter.SetSmoothUpdateField(True)
+    demons_filter.SetUpdateFieldStandardDeviations(demons_update_field_smooth_std)
+    metric_history = []
+    demons_filter.AddCommand(sitk.sitkIterationEvent, lambda: metric_history.append(demons_filter.GetMetric()))
+    coarsest = fixed_pyramid[-1]
+    if initial_transform is not None:
+        displacement_field = sitk.TransformToDisplacementField(
+            initial_transform, sitk.sitkVectorFloat64,
+            coarsest.GetSize(), coarsest.GetOrigin(), coarsest.GetSpacing(), coarsest.GetDirection()
+        )
+    else:
+        displacement_field = sitk.Image(coarsest.GetSize(), sitk.sitkVectorFloat64)
+        displacement_field.CopyInformation(coarsest)
+    for level in reversed(range(len(fixed_pyramid))):
+        message_s(f"Demons registration at level {level}", silent)
+        if level < len(fixed_pyramid) - 1:
+            displacement_field = sitk.Resample(displacement_field, fixed_pyramid[level])
+        displacement_field = demons_filter.Execute(fixed_pyramid[level], moving_pyramid[level], displacement_field)
+    return displacement_field, metric_history
+
+
+def multiscale_demons_with_fixed_pyramid(
+        fixed_pyramid: List[sitk.Image],
+        moving_image: sitk.Image,
+        demons_type: str,
+        demons_iterations: int,
+        demons_displacement_field_smooth_std: float,
+        demons_update_field_smooth_std: float,
+        initial_transform: Optional[sitk.Transform] = None,
+        multiscale_progression: Optional[List[Tuple[float, float]]] = None,
+        silent: bool = True
+) -> Tuple[sitk.Image, List[float]]:
+    """
+    Multiscale demons registration, the same as `multiscale_demons` except that the pyramid of the fixed image is
+    given instead of being rebuilt. When many images are registered to the same atlas the atlas pyramid can be built
+    once, with `build_pyramid` or `hrkGenerateAtlasPyramid`, and reused by every registration.
+
+    Parameters
+    ----------
+    fixed_pyramid : List[sitk.Image]
+        The fixed image pyramid, as returned by `build_pyramid` or `load_atlas_pyramid` for the same
+        `multiscale_progression`. The first level is the fixed image.
+
+    moving_image : sitk.Image
+        The moving image, on the same grid as the first level of the fixed pyramid.
+
+    demons_type : str
+        The type of demons filter to use, a key of `DEMONS_FILTERS`.
+
+    demons_iterations : int
+        The number of demons iterations at each level.
+
+    demons_displacement_field_smooth_std : float
+        The standard deviation of the smoothing applied to the displacement field at each iteration.
+
+    demons_update_field_smooth_std : float
+        The standard deviation of the smoothing applied to the update field at each iteration.
+
+    initial_transform : Optional[sitk.Transform]
+        Transform to initialize the displacement field with. Default is `None`, for an identity initialization.
+
+    multiscale_progression : Optional[List[Tuple[float, float]]]
+        The (shrink factor, smoothing sigma) pairs of the multiscale progression. Default is `None`.
+
+    silent : bool
+        Set to `True` to suppress terminal output. Default is `True`.
+
+    Returns
+    -------
+    Tuple[sitk.Image, List[float]]
+        The displacement field and the history of the demons metric.
+    """
+    from bonelab.util.demons_registration_util import smooth_and_resample
+    num_levels = len(multiscale_progression or []) + 1
+    if len(fixed_pyramid) != num_levels:
+        raise ValueError(
+            f"the fixed pyramid has {len(fixed_pyramid)} levels but the multiscale progression needs {num_levels}"
+        )
+    moving_pyramid = [moving_image] + [
+        smooth_and_resample(moving_image, shrink_factor, smoothing_sigma)
+        for shrink_factor, smoothing_sigma in reversed(multiscale_progression or [])
+    ]
+    return multiscale_demons_with_pyramids(
+        fixed_pyramid, moving_pyramid,
+        demons_type, demons_iterations,
+        demons_displacement_field_smooth_std, demons_update_field_smooth_std,
+        initial_transform, silent
+    )
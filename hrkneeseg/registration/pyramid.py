@@ -0,0 +1,188 @@
+from __future__ import annotations
+
+import os
+import yaml
+from typing import List, Optional, Tuple
+
+from hrkneeseg.registration.transform_cache import hash_file_contents
+from hrkneeseg.utils.lazy_import import lazy_import
+
+sitk = lazy_import("SimpleITK")
+
+PYRAMID_FORMAT_VERSION = 1
+
+
+def get_pyramid_manifest_filename(atlas_fn: str) -> str:
+    """
+    Get the filename of the pyramid manifest that goes with an atlas, e.g. `atlas_pyramid.yaml` next to `atlas.nii`.
+
+    Parameters
+    ----------
+    atlas_fn : str
+        The atlas filename.
+
+    Returns
+    -------
+    str
+    """
+    base = atlas_fn[:-len(".nii.gz")] if atlas_fn.lower().endswith(".nii.gz") else os.path.splitext(atlas_fn)[0]
+    return f"{base}_pyramid.yaml"
+
+
+def build_pyramid(
+        image: sitk.Image,
+        multiscale_progression: Optional[List[Tuple[float, float]]],
+        downsampling_shrink_factor: Optional[float] = None,
+        downsampling_smoothing_sigma: Optional[float] = None
+) -> List[sitk.Image]:
+    """
+    Build the multi-resolution pyramid of an image, in the same way as the fixed image pyramid is built inside of
+    `multiscale_demons`.
+
+    Parameters
+    ----------
+    image : sitk.Image
+        The image.
+
+    multiscale_progression : Optional[List[Tuple[float, float]]]
+        The (shrink factor, smoothing sigma) pairs of the multiscale progression, as from
+        `construct_multiscale_progression`. If `None`, the pyramid only has one level.
+
+    downsampling_shrink_factor : Optional[float]
+        Shrink factor to downsample the image by before building the pyramid. Default is `None`, for no downsampling.
+
+    downsampling_smoothing_sigma : Optional[float]
+        Smoothing sigma to use when downsampling the image before building the pyramid. Default is `None`.
+
+    Returns
+    -------
+    List[sitk.Image]
+        The pyramid levels, the first level is the (possibly downsampled) image at the finest resolution and the
+        following levels are in order of increasing shrink factor.
+    """
+    from bonelab.util.demons_registration_util import smooth_and_resample
+    if (downsampling_shrink_factor is not None) and (downsampling_smoothing_sigma is not None):
+        image = smooth_and_resample(image, downsampling_shrink_factor, downsampling_smoothing_sigma)
+    elif (downsampling_shrink_factor is not None) or (downsampling_smoothing_sigma is not None):
+        raise ValueError("must give both or neither of `downsampling_shrink_factor` and `downsampling_smoothing_sigma`")
+    levels = [image]
+    for shrink_factor, smoothing_sigma in reversed(multiscale_progression or []):
+        levels.append(smooth_and_resample(image, shrink_factor, smoothing_sigma))
+    return levels
+
+
+def write_atlas_pyramid(
+        atlas_fn: str,
+        multiscale_progression: Optional[List[Tuple[float, float]]],
+        downsampling_shrink_factor: Optional[float] = None,
+        downsampling_smoothing_sigma: Optional[float] = None,
+        manifest_fn: Optional[str] = None
+) -> str:
+    """
+    Build the pyramid of an atlas and write its levels and a YAML manifest describing them next to the atlas.
+
+    Parameters
+    ----------
+    atlas_fn : str
+        The atlas filename.
+
+    multiscale_progression : Optional[List[Tuple[float, float]]]
+        The (shrink factor, smoothing sigma) pairs of the multiscale progression.
+
+    downsampling_shrink_factor : Optional[float]
+        Shrink factor to downsample the atlas by before building the pyramid. Default is `None`.
+
+    downsampling_smoothing_sigma : Optional[float]
+        Smoothing sigma to use when downsampling the atlas before building the pyramid. Default is `None`.
+
+    manifest_fn : Optional[str]
+        The manifest filename, the level images are written next to it. If `None`, the default from
+        `get_pyramid_manifest_filename` is used.
+
+    Returns
+    -------
+    str
+        The manifest filename.
+    """
+    manifest_fn = get_pyramid_manifest_filename(atlas_fn) if manifest_fn is None else manifest_fn
+    levels = build_pyramid(
+        sitk.ReadImage(atlas_fn), multiscale_progression, downsampling_shrink_factor, downsampling_smoothing_sigma
+    )
+    base = os.path.splitext(manifest_fn)[0]
+    scales = [(None, None)] + [tuple(p) for p in reversed(multiscale_progression or [])]
+    manifest_levels = []
+    for i, (level, (shrink_factor, smoothing_sigma)) in enumerate(zip(levels, scales)):
+        level_fn = f"{base}_level{i}.nii"
+        sitk.WriteImage(level, level_fn)
+        manifest_levels.append({
+            "filename": os.path.basename(level_fn),
+            "shrink_factor": shrink_factor,
+            "smoothing_sigma": smoothing_sigma
+        })
+    with open(manifest_fn, "w") as f:
+        yaml.dump({
+            "version": PYRAMID_FORMAT_VERSION,
+            "atlas": os.path.abspath(atlas_fn),
+            "atlas_hash": hash_file_contents(atlas_fn),
+            "downsampling_shrink_factor": downsampling_shrink_factor,
+            "downsampling_smoothing_sigma": downsampling_smoothing_sigma,
+            "levels": manifest_levels
+        }, f)
+    return manifest_fn
+
+
+def load_atlas_pyramid(
+        manifest_fn: str,
+        multiscale_progression: Optional[List[Tuple[float, float]]],
+        downsampling_shrink_factor: Optional[float] = None,
+        downsampling_smoothing_sigma: Optional[float] = None,
+        atlas_fn: Optional[str] = None
+) -> List[sitk.Image]:
+    """
+    Load a stored atlas pyramid, checking that it was built with the given parameters.
+
+    Parameters
+    ----------
+    manifest_fn : str
+        The manifest filename.
+
+    multiscale_progression : Optional[List[Tuple[float, float]]]
+        The (shrink factor, smoothing sigma) pairs of the multiscale progression the pyramid is wanted for.
+
+    downsampling_shrink_factor : Optional[float]
+        The shrink factor the atlas should have been downsampled by before building the pyramid. Default is `None`.
+
+    downsampling_smoothing_sigma : Optional[float]
+        The smoothing sigma the atlas should have been downsampled with before building the pyramid. Default is `None`.
+
+    atlas_fn : Optional[str]
+        If given, also check that the pyramid was built from an atlas with the same contents as this one, so a stale
+        pyramid is never used after an atlas is regenerated. Default is `None`.
+
+    Returns
+    -------
+    List[sitk.Image]
+        The pyramid levels, in the same order as returned by `build_pyramid`.
+    """
+    with open(manifest_fn, "r") as f:
+        manifest = yaml.safe_load(f)
+    expected_scales = [[None, None]] + [list(p) for p in reversed(multiscale_progression or [])]
+    scales = [[level["shrink_factor"], level["smoothing_sigma"]] for level in manifest["levels"]]
+    if (
+            manifest["version"] != PYRAMID_FORMAT_VERSION
+            or scales != expected_scales
+            or manifest["downsampling_shrink_factor"] != downsampling_shrink_factor
+            or manifest["downsampling_smoothing_sigma"] != downsampling_smoothing_sigma
+    ):
+        raise ValueError(
+            f"the atlas pyramid in {manifest_fn} was not built with the requested downsampling and multiscale "
+            f"progression, regenerate it with `hrkGenerateAtlasPyramid`"
+        )
+    if (atlas_fn is not None) and (hash_file_contents(atlas_fn) != manifest["atlas_hash"]):
+        raise ValueError(
+            f"the atlas pyramid in {manifest_fn} was built from a different atlas than {atlas_fn}, regenerate it "
+            f"with `hrkGenerateAtlasPyramid`"
+        )
+    return [
+        sitk.ReadImage(os.path.join(os.path.dirname(manifest_fn), level["filename"])) for level in manifest["levels"]
+    ]
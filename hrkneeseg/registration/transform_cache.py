@@ -0,0 +1,396 @@
+from __future__ import annotations
+
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter, Namespace, REMAINDER
+import numpy as np
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import time
+import yaml
+from datetime import datetime
+from typing import List, Optional
+
+from hrkneeseg.utils.lazy_import import lazy_import
+
+sitk = lazy_import("SimpleITK")
+
+# bump this if the way keys are computed or entries are stored changes, so that old entries are never restored
+CACHE_FORMAT_VERSION = 1
+IMAGE_EXTENSIONS = (".nii", ".nii.gz", ".mha", ".mhd", ".nrrd")
+ENTRY_YAML = "entry.yaml"
+
+
+def hash_file_contents(fn: str) -> str:
+    """
+    Hash the contents of an input.
+
+    Images are hashed on their voxel data and geometry rather than the bytes of the file, so that the same image
+    written again (e.g. re-masked or re-compressed by a resubmitted job) gives the same hash. Any other file is hashed
+    on its bytes.
+
+    Parameters
+    ----------
+    fn : str
+        The filename of the input.
+
+    Returns
+    -------
+    str
+        The hex digest of the contents.
+    """
+    h = hashlib.sha256()
+    if fn.lower().endswith(IMAGE_EXTENSIONS):
+        image = sitk.ReadImage(fn)
+        h.update(json.dumps([
+            image.GetPixelIDTypeAsString(), image.GetSize(), image.GetOrigin(),
+            image.GetSpacing(), image.GetDirection()
+        ]).encode())
+        h.update(np.ascontiguousarray(sitk.GetArrayViewFromImage(image)).data)
+    else:
+        with open(fn, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+def normalize_command(command: List[str], inputs: List[str], outputs: List[str]) -> List[str]:
+    """
+    Replace the input and output filenames in a command with placeholders, so that the same registration of the same
+    data has the same key no matter where the files are.
+
+    Parameters
+    ----------
+    command : List[str]
+        The command, as a list of arguments.
+
+    inputs : List[str]
+        The input filenames.
+
+    outputs : List[str]
+        The output filenames.
+
+    Returns
+    -------
+    List[str]
+        The command with `{input_i}` and `{output_i}` in place of the filenames.
+    """
+    replacements = sorted(
+        [(fn, f"{{input_{i}}}") for i, fn in enumerate(inputs)]
+        + [(fn, f"{{output_{i}}}") for i, fn in enumerate(outputs)],
+        key=lambda r: len(r[0]), reverse=True
+    )
+    normalized = []
+    for arg in command:
+        for fn, placeholder in replacements:
+            arg = arg.replace(fn, placeholder)
+        normalized.append(arg)
+    return normalized
+
+
+def compute_cache_key(command: List[str], inputs: List[str], outputs: List[str]) -> str:
+    """
+    Compute the cache key for running a command on some inputs.
+
+    Parameters
+    ----------
+    command : List[str]
+        The command, as a list of arguments.
+
+    inputs : List[str]
+        The input filenames, the contents of these are part of the key.
+
+    outputs : List[str]
+        The output filenames, only the number of outputs and where they appear in the command are part of the key.
+
+    Returns
+    -------
+    str
+        The cache key.
+    """
+    return hashlib.sha256(json.dumps({
+        "version": CACHE_FORMAT_VERSION,
+        "command": normalize_command(command, inputs, outputs),
+        "inputs": [hash_file_contents(fn) for fn in inputs],
+        "num_outputs": len(outputs)
+    }).encode()).hexdigest()
+
+
+class TransformCache:
+    """
+    A content-addressed cache of registration outputs on disk.
+
+    Each entry is a directory named with its key that holds copies of the output files of one registration and an
+    `entry.yaml` with the normalized command, the size of the entry, and when it was created and last used. Entries are
+    written to a temporary directory and renamed into place, so concurrent jobs sharing a cache never see a partial
+    entry.
+
+    Parameters
+    ----------
+    cache_dir : str
+        The directory the cache is kept in, created if it does not exist.
+    """
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _entry_dir(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key)
+
+    def _read_entry(self, key: str) -> Optional[dict]:
+        try:
+            with open(os.path.join(self._entry_dir(key), ENTRY_YAML), "r") as f:
+                return yaml.safe_load(f)
+        except FileNotFoundError:
+            return None
+
+    def _write_entry(self, key: str, entry: dict, entry_dir: Optional[str] = None) -> None:
+        entry_dir = self._entry_dir(key) if entry_dir is None else entry_dir
+        with open(os.path.join(entry_dir, ENTRY_YAML), "w") as f:
+            yaml.dump(entry, f)
+
+    def restore(self, key: str, outputs: List[str]) -> bool:
+        """
+        Copy the outputs of a cached registration to where they are wanted, if there is an entry for the key.
+
+        Parameters
+        ----------
+        key : str
+            The cache key.
+
+        outputs : List[str]
+            Where to put the output files.
+
+        Returns
+        -------
+        bool
+            Whether there was an entry for the key.
+        """
+        entry = self._read_entry(key)
+        if entry is None or len(entry["outputs"]) != len(outputs):
+            return False
+        for cached_fn, output_fn in zip(entry["outputs"], outputs):
+            if os.path.dirname(output_fn):
+                os.makedirs(os.path.dirname(output_fn), exist_ok=True)
+            shutil.copyfile(os.path.join(self._entry_dir(key), cached_fn), output_fn)
+        entry["last_used"] = time.time()
+        self._write_entry(key, entry)
+        return True
+
+    def store(self, key: str, outputs: List[str], command: List[str]) -> None:
+        """
+        Store the outputs of a registration in the cache.
+
+        Parameters
+        ----------
+        key : str
+            The cache key.
+
+        outputs : List[str]
+            The output files to store.
+
+        command : List[str]
+            The normalized command, kept so entries can be identified when listing the cache.
+
+        Returns
+        -------
+        None
+        """
+        tmp_dir = os.path.join(self.cache_dir, f".tmp_{key}_{os.getpid()}")
+        os.makedirs(tmp_dir, exist_ok=True)
+        cached_fns = []
+        for i, output_fn in enumerate(outputs):
+            extension = ".nii.gz" if output_fn.lower().endswith(".nii.gz") else os.path.splitext(output_fn)[1]
+            cached_fns.append(f"output_{i}{extension}")
+            shutil.copyfile(output_fn, os.path.join(tmp_dir, cached_fns[-1]))
+        now = time.time()
+        self._write_entry(key, {
+            "outputs": cached_fns,
+            "command": command,
+            "size": sum(os.path.getsize(os.path.join(tmp_dir, fn)) for fn in cached_fns),
+            "created": now,
+            "last_used": now
+        }, tmp_dir)
+        try:
+            os.rename(tmp_dir, self._entry_dir(key))
+        except OSError:
+            # another job stored the same entry first
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def entries(self) -> List[dict]:
+        """
+        Get all of the entries in the cache.
+
+        Returns
+        -------
+        List[dict]
+            The metadata of each entry, with its key, sorted from least to most recently used.
+        """
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            if key.startswith("."):
+                continue
+            entry = self._read_entry(key)
+            if entry is not None:
+                entries.append({"key": key, **entry})
+        return sorted(entries, key=lambda e: e["last_used"])
+
+    def prune(self, max_size: Optional[int] = None, max_age: Optional[float] = None) -> List[str]:
+        """
+        Evict entries from the cache, first any that have not been used within `max_age` seconds and then the least
+        recently used entries until the cache is no larger than `max_size` bytes.
+
+        Parameters
+        ----------
+        max_size : Optional[int]
+            The maximum total size of the cache in bytes. If `None`, there is no size limit.
+
+        max_age : Optional[float]
+            The maximum time since an entry was last used, in seconds. If `None`, there is no age limit.
+
+        Returns
+        -------
+        List[str]
+            The keys of the evicted entries.
+        """
+        entries = self.entries()
+        evicted = []
+        if max_age is not None:
+            now = time.time()
+            evicted += [e["key"] for e in entries if now - e["last_used"] > max_age]
+        if max_size is not None:
+            kept = [e for e in entries if e["key"] not in evicted]
+            total_size = sum(e["size"] for e in kept)
+            for e in kept:
+                if total_size <= max_size:
+                    break
+                evicted.append(e["key"])
+                total_size -= e["size"]
+        for key in evicted:
+            shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+        return evicted
+
+
+def get_max_size(args: Namespace) -> Optional[int]:
+    return int(args.max_size_gb * 1024 ** 3) if args.max_size_gb is not None else None
+
+
+def get_max_age(args: Namespace) -> Optional[float]:
+    return args.max_age_days * 24 * 60 * 60 if args.max_age_days is not None else None
+
+
+def run_cached(args: Namespace) -> int:
+    from bonelab.util.registration_util import message_s
+    command = args.command[1:] if (args.command and args.command[0] == "--") else args.command
+    if len(command) == 0:
+        raise ValueError("no command given to run")
+    cache = TransformCache(args.cache_dir)
+    message_s("Computing cache key from the inputs and the command", args.silent)
+    key = compute_cache_key(command, args.inputs, args.outputs)
+    if cache.restore(key, args.outputs):
+        message_s(f"Cache hit ({key}), outputs restored without running the command", args.silent)
+        return 0
+    message_s(f"Cache miss ({key}), running: {' '.join(command)}", args.silent)
+    return_code = subprocess.run(command).returncode
+    if return_code != 0:
+        message_s(f"Command failed with return code {return_code}, nothing was cached", args.silent)
+        return return_code
+    missing = [fn for fn in args.outputs if not os.path.isfile(fn)]
+    if missing:
+        raise FileNotFoundError(f"the command did not create these outputs, nothing was cached: {missing}")
+    cache.store(key, args.outputs, normalize_command(command, args.inputs, args.outputs))
+    message_s(f"Stored outputs in the cache", args.silent)
+    if (args.max_size_gb is not None) or (args.max_age_days is not None):
+        evicted = cache.prune(get_max_size(args), get_max_age(args))
+        message_s(f"Evicted {len(evicted)} entries from the cache", args.silent)
+    return 0
+
+
+def list_cache(args: Namespace) -> int:
+    entries = TransformCache(args.cache_dir).entries()
+    for e in entries:
+        print(
+            f"{e['key'][:16]}  {e['size'] / 1024 ** 2:10.1f} MB  "
+            f"created {datetime.fromtimestamp(e['created']):%Y-%m-%d %H:%M}  "
+            f"last used {datetime.fromtimestamp(e['last_used']):%Y-%m-%d %H:%M}  "
+            f"{' '.join(e['command'])}"
+        )
+    print(f"{len(entries)} entries, {sum(e['size'] for e in entries) / 1024 ** 3:.2f} GB total")
+    return 0
+
+
+def prune_cache(args: Namespace) -> int:
+    from bonelab.util.registration_util import message_s
+    evicted = TransformCache(args.cache_dir).prune(get_max_size(args), get_max_age(args))
+    message_s(f"Evicted {len(evicted)} entries from the cache", args.silent)
+    return 0
+
+
+def add_eviction_arguments(parser: ArgumentParser) -> None:
+    parser.add_argument(
+        "--max-size-gb", "-msg", type=float, default=None, metavar="X",
+        help="evict the least recently used entries until the cache is no larger than this many GB"
+    )
+    parser.add_argument(
+        "--max-age-days", "-mad", type=float, default=None, metavar="X",
+        help="evict entries that have not been used in this many days"
+    )
+
+
+def create_parser() -> ArgumentParser:
+    parser = ArgumentParser(
+        description="Content-addressed cache of registration outputs. The key of an entry is a hash of the contents of "
+                    "the inputs of a registration and of the command with the input and output filenames left out, "
+                    "so a resubmitted job with unchanged inputs and parameters restores its outputs instead of "
+                    "optimizing again.",
+        formatter_class=ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        "--cache-dir", "-cd", type=str, required=True, metavar="DIR",
+        help="the directory the cache is kept in"
+    )
+    parser.add_argument(
+        "--silent", "-s", default=False, action="store_true",
+        help="enable this flag to suppress terminal output"
+    )
+    subparsers = parser.add_subparsers(dest="subcommand", required=True)
+    run_parser = subparsers.add_parser(
+        "run", formatter_class=ArgumentDefaultsHelpFormatter,
+        help="restore the outputs of a command from the cache, or run the command and cache its outputs"
+    )
+    run_parser.add_argument(
+        "--inputs", "-i", type=str, nargs="+", required=True, metavar="FN",
+        help="the input files of the command, whose contents are part of the key"
+    )
+    run_parser.add_argument(
+        "--outputs", "-o", type=str, nargs="+", required=True, metavar="FN",
+        help="the output files of the command, that are stored in and restored from the cache"
+    )
+    add_eviction_arguments(run_parser)
+    run_parser.add_argument(
+        "command", nargs=REMAINDER, metavar="COMMAND",
+        help="the registration command to run, after a `--`"
+    )
+    run_parser.set_defaults(func=run_cached)
+    list_parser = subparsers.add_parser("list", help="list the entries in the cache")
+    list_parser.set_defaults(func=list_cache)
+    prune_parser = subparsers.add_parser(
+        "prune", formatter_class=ArgumentDefaultsHelpFormatter, help="evict entries from the cache by size and age"
+    )
+    add_eviction_arguments(prune_parser)
+    prune_parser.set_defaults(func=prune_cache)
+    return parser
+
+
+def main() -> None:
+    args = create_parser().parse_args()
+    from bonelab.util.echo_arguments import echo_arguments
+    if not args.silent:
+        print(echo_arguments("Transform Cache", {k: v for k, v in vars(args).items() if k != "func"}))
+    raise SystemExit(args.func(args))
+
+
+if __name__ == "__main__":
+    main()
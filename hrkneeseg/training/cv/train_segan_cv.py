@@ -1,16 +1,11 @@
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter, Namespace
 import numpy as np
-import torch
-from torch.nn import L1Loss
-from torch.utils.data import DataLoader, ConcatDataset, Subset
-from pytorch_lightning import Trainer
-from pytorch_lightning.loggers import CSVLogger
-from pytorch_lightning.callbacks.early_stopping import EarlyStopping
-from blpytorchlightning.tasks.SeGANTask import SeGANTask
-from blpytorchlightning.dataset_components.datasets.PickledDataset import PickledDataset
-from blpytorchlightning.models.SeGAN import get_segmentor_and_discriminators
 from glob import glob
 from shutil import rmtree
+from hrkneeseg.datasets.volume_store import add_volume_sampling_arguments, get_volume_sampling
+from hrkneeseg.utils.lazy_import import lazy_import
+
+torch = lazy_import("torch")
 
 
 def create_parser() -> ArgumentParser:
@@ -99,10 +94,19 @@ def create_parser() -> ArgumentParser:
         help="if enabled, check for GPUs and use them"
     )
 
+    add_volume_sampling_arguments(parser)
     return parser
 
 
 def train_segan_cv(args):
+    from torch.nn import L1Loss
+    from torch.utils.data import DataLoader, ConcatDataset, Subset
+    from pytorch_lightning import Trainer
+    from pytorch_lightning.loggers import CSVLogger
+    from pytorch_lightning.callbacks.early_stopping import EarlyStopping
+    from blpytorchlightning.tasks.SeGANTask import SeGANTask
+    from blpytorchlightning.models.SeGAN import get_segmentor_and_discriminators
+    from hrkneeseg.datasets.sample_store_dataset import load_sample_dataset
     torch.set_float32_matmul_precision('medium')
     # check if we are using CUDA and set accelerator, devices, strategy
     if args.cuda:
@@ -122,7 +126,7 @@ def train_segan_cv(args):
     # create datasets
     datasets = []
     for data_dir in args.data_dirs:
-        datasets.append(PickledDataset(data_dir))
+        datasets.append(load_sample_dataset(data_dir, args.is_3d, volume_sampling=get_volume_sampling(args)))
     dataset = ConcatDataset(datasets)
 
     # create the fold index lists
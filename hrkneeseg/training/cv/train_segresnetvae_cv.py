@@ -1,16 +1,9 @@
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter, Namespace
 import numpy as np
-import torch
-from torch.nn import CrossEntropyLoss
-from torchmetrics import Dice
-from torch.utils.data import DataLoader, ConcatDataset, Subset
-from pytorch_lightning import Trainer
-from pytorch_lightning.loggers import CSVLogger
-from pytorch_lightning.callbacks.early_stopping import EarlyStopping
-from blpytorchlightning.tasks.SegResNetVAETask import SegResNetVAETask
-from blpytorchlightning.dataset_components.datasets.PickledDataset import PickledDataset
-from blpytorchlightning.loss_functions.DiceLoss import DiceLoss
-from monai.networks.nets.segresnet import SegResNetVAE
+from hrkneeseg.datasets.volume_store import add_volume_sampling_arguments, get_volume_sampling
+from hrkneeseg.utils.lazy_import import lazy_import
+
+torch = lazy_import("torch")
 
 
 def create_parser() -> ArgumentParser:
@@ -107,10 +100,20 @@ def create_parser() -> ArgumentParser:
         help="enable this flag to use Dice loss instead of Cross-Entropy"
     )
 
+    add_volume_sampling_arguments(parser)
     return parser
 
 
 def train_segresnetvae_cv(args):
+    from torch.nn import CrossEntropyLoss
+    from torch.utils.data import DataLoader, ConcatDataset, Subset
+    from pytorch_lightning import Trainer
+    from pytorch_lightning.loggers import CSVLogger
+    from pytorch_lightning.callbacks.early_stopping import EarlyStopping
+    from blpytorchlightning.tasks.SegResNetVAETask import SegResNetVAETask
+    from blpytorchlightning.loss_functions.DiceLoss import DiceLoss
+    from monai.networks.nets.segresnet import SegResNetVAE
+    from hrkneeseg.datasets.sample_store_dataset import load_sample_dataset
     torch.set_float32_matmul_precision('medium')
     # check if we are using CUDA and set accelerator, devices, strategy
     if args.cuda:
@@ -130,7 +133,7 @@ def train_segresnetvae_cv(args):
     # create datasets
     datasets = []
     for data_dir in args.data_dirs:
-        datasets.append(PickledDataset(data_dir))
+        datasets.append(load_sample_dataset(data_dir, args.is_3d, volume_sampling=get_volume_sampling(args)))
     dataset = ConcatDataset(datasets)
 
     # create the fold index lists
@@ -1,22 +1,12 @@
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter, Namespace
 import numpy as np
-import torch
-from torch.nn import CrossEntropyLoss
-from torch.utils.data import DataLoader, ConcatDataset, Subset
-from pytorch_lightning import Trainer
-from pytorch_lightning.tuner.tuning import Tuner
-from pytorch_lightning.loggers import CSVLogger, TensorBoardLogger
-from pytorch_lightning.callbacks.early_stopping import EarlyStopping
-from blpytorchlightning.tasks.SegmentationTask import SegmentationTask
-from blpytorchlightning.dataset_components.datasets.PickledDataset import PickledDataset
-from blpytorchlightning.dataset_components.transformers.TensorOneHotEncoder import TensorOneHotEncoder
-from blpytorchlightning.loss_functions.DiceLoss import DiceLoss
-from monai.networks.nets.unet import UNet
-from monai.networks.nets.attentionunet import AttentionUnet
-from monai.networks.nets.unetr import UNETR
-from monai.networks.nets.basic_unetplusplus import BasicUNetPlusPlus
 from glob import glob
 from shutil import rmtree
+from hrkneeseg.datasets.volume_store import add_volume_sampling_arguments, get_volume_sampling
+from hrkneeseg.models.registry import create_training_model, get_model_architecture
+from hrkneeseg.utils.lazy_import import lazy_import
+
+torch = lazy_import("torch")
 
 
 def create_parser() -> ArgumentParser:
@@ -125,6 +115,7 @@ def create_parser() -> ArgumentParser:
         help="enable this flag to use Dice loss instead of Cross-Entropy"
     )
 
+    add_volume_sampling_arguments(parser)
     return parser
 
 
@@ -139,6 +130,15 @@ def create_unetplusplus_loss_function(loss_function):
 
 
 def train_unet_cv(args: Namespace) -> None:
+    from torch.nn import CrossEntropyLoss
+    from torch.utils.data import DataLoader, ConcatDataset, Subset
+    from pytorch_lightning import Trainer
+    from pytorch_lightning.loggers import CSVLogger
+    from pytorch_lightning.callbacks.early_stopping import EarlyStopping
+    from blpytorchlightning.tasks.SegmentationTask import SegmentationTask
+    from blpytorchlightning.dataset_components.transformers.TensorOneHotEncoder import TensorOneHotEncoder
+    from blpytorchlightning.loss_functions.DiceLoss import DiceLoss
+    from hrkneeseg.datasets.sample_store_dataset import load_sample_dataset
     torch.set_float32_matmul_precision('medium')
     # check if we are using CUDA and set accelerator, devices, strategy
     if args.cuda:
@@ -159,7 +159,11 @@ def train_unet_cv(args: Namespace) -> None:
     transformer = TensorOneHotEncoder(num_classes=args.output_channels) if args.dice_loss else None
     datasets = []
     for data_dir in args.data_dirs:
-        datasets.append(PickledDataset(data_dir, transformer=transformer))
+        datasets.append(
+            load_sample_dataset(
+                data_dir, args.is_3d, transformer=transformer, volume_sampling=get_volume_sampling(args)
+            )
+        )
     dataset = ConcatDataset(datasets)
 
     # create the fold index lists
@@ -196,60 +200,11 @@ def train_unet_cv(args: Namespace) -> None:
         )
 
         # create the model
-        model_kwargs = {
-            "spatial_dims": 3 if args.is_3d else 2,
-            "in_channels": args.input_channels,
-            "out_channels": args.output_channels,
-        }
-        if args.dropout < 0 or args.dropout > 1:
-            raise ValueError("dropout must be between 0 and 1")
-        if args.model_architecture == "unet":
-            if len(args.model_channels) < 2:
-                raise ValueError("model channels must be sequence of integers of at least length 2")
-            model_kwargs["channels"] = args.model_channels
-            model_kwargs["strides"] = [1 for _ in range(len(args.model_channels) - 1)]
-            model_kwargs["dropout"] = args.dropout
-            model = UNet(**model_kwargs)
-        elif args.model_architecture == "attention-unet":
-            if len(args.model_channels) < 2:
-                raise ValueError("model channels must be sequence of integers of at least length 2")
-            model_kwargs["channels"] = args.model_channels
-            model_kwargs["strides"] = [1 for _ in range(len(args.model_channels) - 1)]
-            model_kwargs["dropout"] = args.dropout
-            model = AttentionUnet(**model_kwargs)
-        elif args.model_architecture == "unet-r":
-            if args.image_size is None:
-                raise ValueError("if model architecture set to `unet-r`, you must specify image size")
-            if args.is_3d and len(args.image_size) != 3:
-                raise ValueError("if 3D, image_size must be integer or length-3 sequence of integers")
-            if not args.is_3d and len(args.image_size) != 2:
-                raise ValueError("if not 3D, image_size must be integer or length-2 sequence of integers")
-            model_kwargs["img_size"] = args.image_size
-            model_kwargs["dropout_rate"] = args.dropout
-            model_kwargs["feature_size"] = args.unet_r_feature_size
-            model_kwargs["hidden_size"] = args.unet_r_hidden_size
-            model_kwargs["mlp_dim"] = args.unet_r_mlp_dim
-            model_kwargs["num_heads"] = args.unet_r_num_heads
-            model = UNETR(**model_kwargs)
-        elif args.model_architecture == "unet++":
-            if len(args.model_channels) != 6:
-                raise ValueError("if model architecture set to `unet++`, model channels must be length-6 sequence of "
-                                 "integers")
-            model_kwargs["features"] = args.model_channels
-            model_kwargs["dropout"] = args.dropout
-            model = BasicUNetPlusPlus(**model_kwargs)
-            if strategy == "ddp_find_unused_parameters_false":
-                strategy = "ddp"
-                print(f"using `unet++`, so changing strategy to {strategy}")
-        else:
-            raise ValueError(f"model architecture must be `unet`, `attention-unet`, `unet++`, or `unet-r`, "
-                             f"given {args.model_architecture}")
-
-        model.float()
+        model, strategy = create_training_model(args, strategy)
 
         # create loss function
         loss_function = DiceLoss() if args.dice_loss else CrossEntropyLoss()
-        if args.model_architecture == "unet++":
+        if get_model_architecture(args) == "unet++":
             loss_function = create_unetplusplus_loss_function(loss_function)
 
         # create the task
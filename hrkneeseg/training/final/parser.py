@@ -1,5 +1,7 @@
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter, Namespace
 
+from hrkneeseg.datasets.volume_store import add_volume_sampling_arguments
+
 
 def create_parser(model_type: str) -> ArgumentParser:
     parser = ArgumentParser(
@@ -61,4 +63,5 @@ def create_parser(model_type: str) -> ArgumentParser:
         help="filename to load hyperparameters from, within the reference version directory"
     )
 
+    add_volume_sampling_arguments(parser)
     return parser
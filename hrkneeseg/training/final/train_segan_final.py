@@ -1,20 +1,23 @@
 import numpy as np
 import os
-import torch
 import yaml
-from torch.nn import L1Loss
-from torch.utils.data import DataLoader, ConcatDataset, Subset
-from pytorch_lightning import Trainer
-from pytorch_lightning.loggers import CSVLogger
-from pytorch_lightning.callbacks.early_stopping import EarlyStopping
-from blpytorchlightning.tasks.SeGANTask import SeGANTask
-from blpytorchlightning.dataset_components.datasets.PickledDataset import PickledDataset
-from blpytorchlightning.models.SeGAN import get_segmentor_and_discriminators
+from hrkneeseg.datasets.volume_store import get_volume_sampling
 from hrkneeseg.training.final.parser import create_parser
+from hrkneeseg.utils.lazy_import import lazy_import
+
+torch = lazy_import("torch")
 
 
 def train_segan_final(args):
     # load the hyperparameters from file
+    from torch.nn import L1Loss
+    from torch.utils.data import DataLoader, ConcatDataset
+    from pytorch_lightning import Trainer
+    from pytorch_lightning.loggers import CSVLogger
+    from pytorch_lightning.callbacks.early_stopping import EarlyStopping
+    from blpytorchlightning.tasks.SeGANTask import SeGANTask
+    from blpytorchlightning.models.SeGAN import get_segmentor_and_discriminators
+    from hrkneeseg.datasets.sample_store_dataset import load_sample_dataset
     with open(os.path.join(args.log_dir, args.reference_label, args.reference_version, args.hparams_fn)) as f:
         hparams = yaml.safe_load(f)
 
@@ -36,7 +39,7 @@ def train_segan_final(args):
     # create datasets
     datasets = []
     for data_dir in args.data_dirs:
-        datasets.append(PickledDataset(data_dir))
+        datasets.append(load_sample_dataset(data_dir, hparams["is_3d"], volume_sampling=get_volume_sampling(args)))
     dataset = ConcatDataset(datasets)
 
     # dataloader standard kwargs
@@ -1,22 +1,23 @@
 import numpy as np
 import os
-import torch
 import yaml
-from torch.nn import CrossEntropyLoss
-from torchmetrics import Dice
-from torch.utils.data import DataLoader, ConcatDataset, Subset
-from pytorch_lightning import Trainer
-from pytorch_lightning.loggers import CSVLogger
-from pytorch_lightning.callbacks.early_stopping import EarlyStopping
-from blpytorchlightning.tasks.SegResNetVAETask import SegResNetVAETask
-from blpytorchlightning.dataset_components.datasets.PickledDataset import PickledDataset
-from blpytorchlightning.loss_functions.DiceLoss import DiceLoss
-from monai.networks.nets.segresnet import SegResNetVAE
+from hrkneeseg.datasets.volume_store import get_volume_sampling
 from hrkneeseg.training.final.parser import create_parser
+from hrkneeseg.utils.lazy_import import lazy_import
+
+torch = lazy_import("torch")
 
 
 def train_segresnetvae_cv(args):
     # load the hyperparameters from file
+    from torch.nn import CrossEntropyLoss
+    from torch.utils.data import DataLoader, ConcatDataset
+    from pytorch_lightning import Trainer
+    from pytorch_lightning.loggers import CSVLogger
+    from pytorch_lightning.callbacks.early_stopping import EarlyStopping
+    from blpytorchlightning.tasks.SegResNetVAETask import SegResNetVAETask
+    from monai.networks.nets.segresnet import SegResNetVAE
+    from hrkneeseg.datasets.sample_store_dataset import load_sample_dataset
     with open(os.path.join(args.log_dir, args.reference_label, args.reference_version, args.hparams_fn)) as f:
         hparams = yaml.safe_load(f)
 
@@ -38,7 +39,7 @@ def train_segresnetvae_cv(args):
     # create datasets
     datasets = []
     for data_dir in args.data_dirs:
-        datasets.append(PickledDataset(data_dir))
+        datasets.append(load_sample_dataset(data_dir, hparams["is_3d"], volume_sampling=get_volume_sampling(args)))
     dataset = ConcatDataset(datasets)
 
     # dataloader standard kwargs
@@ -1,27 +1,18 @@
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter, Namespace
 import numpy as np
 import os
-import torch
 import yaml
-from torch.nn import CrossEntropyLoss
-from torch.utils.data import DataLoader, ConcatDataset, Subset
-from pytorch_lightning import Trainer
-from pytorch_lightning.tuner.tuning import Tuner
-from pytorch_lightning.loggers import CSVLogger, TensorBoardLogger
-from pytorch_lightning.callbacks.early_stopping import EarlyStopping
-from blpytorchlightning.tasks.SegmentationTask import SegmentationTask
-from blpytorchlightning.dataset_components.datasets.PickledDataset import PickledDataset
-from blpytorchlightning.dataset_components.transformers.TensorOneHotEncoder import TensorOneHotEncoder
-from blpytorchlightning.loss_functions.DiceLoss import DiceLoss
-from monai.networks.nets.unet import UNet
-from monai.networks.nets.attentionunet import AttentionUnet
-from monai.networks.nets.unetr import UNETR
-from monai.networks.nets.basic_unetplusplus import BasicUNetPlusPlus
 from glob import glob
+from hrkneeseg.datasets.volume_store import get_volume_sampling
 from hrkneeseg.training.final.parser import create_parser
+from hrkneeseg.models.registry import create_training_model, get_model_architecture
+from hrkneeseg.utils.lazy_import import lazy_import
 
+torch = lazy_import("torch")
 
 # we need a factory function for creating a loss function that can be used for the unet++
+
+
 def create_unetplusplus_loss_function(loss_function):
     def unetplusplus_loss_function(y_hat_list, y):
         loss = 0
@@ -33,6 +24,13 @@ def create_unetplusplus_loss_function(loss_function):
 
 def train_unet_cv(args: Namespace) -> None:
     # load the hyperparameters from file
+    from torch.nn import CrossEntropyLoss
+    from torch.utils.data import DataLoader, ConcatDataset
+    from pytorch_lightning import Trainer
+    from pytorch_lightning.loggers import CSVLogger
+    from pytorch_lightning.callbacks.early_stopping import EarlyStopping
+    from blpytorchlightning.tasks.SegmentationTask import SegmentationTask
+    from hrkneeseg.datasets.sample_store_dataset import load_sample_dataset
     with open(os.path.join(args.log_dir, args.reference_label, args.reference_version, args.hparams_fn)) as f:
         hparams = yaml.safe_load(f)
 
@@ -54,7 +52,7 @@ def train_unet_cv(args: Namespace) -> None:
     # create datasets
     datasets = []
     for data_dir in args.data_dirs:
-        datasets.append(PickledDataset(data_dir))
+        datasets.append(load_sample_dataset(data_dir, hparams["is_3d"], volume_sampling=get_volume_sampling(args)))
     dataset = ConcatDataset(datasets)
 
     # dataloader standard kwargs
@@ -70,60 +68,11 @@ def train_unet_cv(args: Namespace) -> None:
     dataloader = DataLoader(dataset, **dataloader_kwargs)
 
     # create the model
-    model_kwargs = {
-        "spatial_dims": 3 if hparams["is_3d"] else 2,
-        "in_channels": hparams["input_channels"],
-        "out_channels": hparams["output_channels"],
-    }
-    if hparams["dropout"] < 0 or hparams["dropout"] > 1:
-        raise ValueError("dropout must be between 0 and 1")
-    if hparams.get("model_architecture") == "unet" or hparams.get("model_architecture") is None:
-        if len(hparams["model_channels"]) < 2:
-            raise ValueError("model channels must be sequence of integers of at least length 2")
-        model_kwargs["channels"] = hparams["model_channels"]
-        model_kwargs["strides"] = [1 for _ in range(len(hparams["model_channels"]) - 1)]
-        model_kwargs["dropout"] = hparams["dropout"]
-        model = UNet(**model_kwargs)
-    elif hparams.get("model_architecture") == "attention-unet":
-        if len(hparams["model_channels"]) < 2:
-            raise ValueError("model channels must be sequence of integers of at least length 2")
-        model_kwargs["channels"] = hparams["model_channels"]
-        model_kwargs["strides"] = [1 for _ in range(len(hparams["model_channels"]) - 1)]
-        model_kwargs["dropout"] = hparams["dropout"]
-        model = AttentionUnet(**model_kwargs)
-    elif hparams.get("model_architecture") == "unet-r":
-        if hparams["image_size"] is None:
-            raise ValueError("if model architecture set to `unet-r`, you must specify image size")
-        if hparams["is_3d"] and len(hparams["image_size"]) != 3:
-            raise ValueError("if 3D, image_size must be integer or length-3 sequence of integers")
-        if not hparams["is_3d"] and len(hparams["image_size"]) != 2:
-            raise ValueError("if not 3D, image_size must be integer or length-2 sequence of integers")
-        model_kwargs["img_size"] = hparams["image_size"]
-        model_kwargs["dropout_rate"] = hparams["dropout"]
-        model_kwargs["feature_size"] = hparams["unet_r_feature_size"]
-        model_kwargs["hidden_size"] = hparams["unet_r_hidden_size"]
-        model_kwargs["mlp_dim"] = hparams["unet_r_mlp_dim"]
-        model_kwargs["num_heads"] = hparams["unet_r_num_heads"]
-        model = UNETR(**model_kwargs)
-    elif hparams.get("model_architecture") == "unet++":
-        if len(hparams["model_channels"]) != 6:
-            raise ValueError("if model architecture set to `unet++`, model channels must be length-6 sequence of "
-                             "integers")
-        model_kwargs["features"] = hparams["model_channels"]
-        model_kwargs["dropout"] = hparams["dropout"]
-        model = BasicUNetPlusPlus(**model_kwargs)
-        if strategy == "ddp_find_unused_parameters_false":
-            strategy = "ddp"
-            print(f"using `unet++`, so changing strategy to {strategy}")
-    else:
-        raise ValueError(f"model architecture must be `unet`, `attention-unet`, `unet++`, or `unet-r`, "
-                         f"given {hparams['model_architecture']}")
-
-    model.float()
+    model, strategy = create_training_model(hparams, strategy)
 
     # create loss function
     loss_function = CrossEntropyLoss()
-    if hparams.get("model_architecture") == "unet++":
+    if get_model_architecture(hparams) == "unet++":
         loss_function = create_unetplusplus_loss_function(loss_function)
 
     # create the task
@@ -1,5 +1,7 @@
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter, Namespace
 
+from hrkneeseg.datasets.volume_store import add_volume_sampling_arguments
+
 
 def create_parser(model_type: str) -> ArgumentParser:
     parser = ArgumentParser(
@@ -65,4 +67,5 @@ def create_parser(model_type: str) -> ArgumentParser:
         help="if enabled, check for GPUs and use them"
     )
 
+    add_volume_sampling_arguments(parser)
     return parser
\ No newline at end of file
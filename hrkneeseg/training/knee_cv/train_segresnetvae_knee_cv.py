@@ -1,22 +1,23 @@
 import numpy as np
 import os
-import torch
 import yaml
-from torch.nn import CrossEntropyLoss
-from torchmetrics import Dice
-from torch.utils.data import DataLoader, ConcatDataset, Subset
-from pytorch_lightning import Trainer
-from pytorch_lightning.loggers import CSVLogger
-from pytorch_lightning.callbacks.early_stopping import EarlyStopping
-from blpytorchlightning.tasks.SegResNetVAETask import SegResNetVAETask
-from blpytorchlightning.dataset_components.datasets.PickledDataset import PickledDataset
-from blpytorchlightning.loss_functions.DiceLoss import DiceLoss
-from monai.networks.nets.segresnet import SegResNetVAE
 from glob import glob
+from hrkneeseg.datasets.volume_store import get_volume_sampling
 from hrkneeseg.training.knee_cv.parser import create_parser
+from hrkneeseg.utils.lazy_import import lazy_import
+
+torch = lazy_import("torch")
 
 
 def train_segresnetvae_cv(args):
+    from torch.nn import CrossEntropyLoss
+    from torch.utils.data import DataLoader, ConcatDataset, Subset
+    from pytorch_lightning import Trainer
+    from pytorch_lightning.loggers import CSVLogger
+    from pytorch_lightning.callbacks.early_stopping import EarlyStopping
+    from blpytorchlightning.tasks.SegResNetVAETask import SegResNetVAETask
+    from monai.networks.nets.segresnet import SegResNetVAE
+    from hrkneeseg.datasets.sample_store_dataset import load_sample_dataset
     torch.set_float32_matmul_precision('medium')
     # load the hyperparameters from file
     # with open(os.path.join(args.log_dir, args.reference_label, args.reference_version, "hparams.yaml")) as f:
@@ -42,7 +43,7 @@ def train_segresnetvae_cv(args):
     # create datasets
     datasets = []
     for data_dir in args.data_dirs:
-        datasets.append(PickledDataset(data_dir))
+        datasets.append(load_sample_dataset(data_dir, ref_hparams["is_3d"], volume_sampling=get_volume_sampling(args)))
     dataset = ConcatDataset(datasets)
 
     # create the fold index lists
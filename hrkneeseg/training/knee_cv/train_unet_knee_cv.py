@@ -1,27 +1,18 @@
 from argparse import Namespace
 import numpy as np
 import os
-import torch
 import yaml
-from torch.nn import CrossEntropyLoss
-from torch.utils.data import DataLoader, ConcatDataset, Subset
-from pytorch_lightning import Trainer
-from pytorch_lightning.tuner.tuning import Tuner
-from pytorch_lightning.loggers import CSVLogger, TensorBoardLogger
-from pytorch_lightning.callbacks.early_stopping import EarlyStopping
-from blpytorchlightning.tasks.SegmentationTask import SegmentationTask
-from blpytorchlightning.dataset_components.datasets.PickledDataset import PickledDataset
-from blpytorchlightning.dataset_components.transformers.TensorOneHotEncoder import TensorOneHotEncoder
-from blpytorchlightning.loss_functions.DiceLoss import DiceLoss
-from monai.networks.nets.unet import UNet
-from monai.networks.nets.attentionunet import AttentionUnet
-from monai.networks.nets.unetr import UNETR
-from monai.networks.nets.basic_unetplusplus import BasicUNetPlusPlus
 from glob import glob
+from hrkneeseg.datasets.volume_store import get_volume_sampling
 from hrkneeseg.training.knee_cv.parser import create_parser
+from hrkneeseg.models.registry import create_training_model, get_model_architecture
+from hrkneeseg.utils.lazy_import import lazy_import
 
+torch = lazy_import("torch")
 
 # we need a factory function for creating a loss function that can be used for the unet++
+
+
 def create_unetplusplus_loss_function(loss_function):
     def unetplusplus_loss_function(y_hat_list, y):
         loss = 0
@@ -32,6 +23,13 @@ def create_unetplusplus_loss_function(loss_function):
 
 
 def train_unet_cv(args: Namespace) -> None:
+    from torch.nn import CrossEntropyLoss
+    from torch.utils.data import DataLoader, ConcatDataset, Subset
+    from pytorch_lightning import Trainer
+    from pytorch_lightning.loggers import CSVLogger
+    from pytorch_lightning.callbacks.early_stopping import EarlyStopping
+    from blpytorchlightning.tasks.SegmentationTask import SegmentationTask
+    from hrkneeseg.datasets.sample_store_dataset import load_sample_dataset
     torch.set_float32_matmul_precision('medium')
     # load the hyperparameters from file
     # with open(os.path.join(args.log_dir, args.reference_label, args.reference_version, "hparams.yaml")) as f:
@@ -57,7 +55,7 @@ def train_unet_cv(args: Namespace) -> None:
     # create datasets
     datasets = []
     for data_dir in args.data_dirs:
-        datasets.append(PickledDataset(data_dir))
+        datasets.append(load_sample_dataset(data_dir, ref_hparams["is_3d"], volume_sampling=get_volume_sampling(args)))
     dataset = ConcatDataset(datasets)
 
     # create the fold index lists
@@ -93,60 +91,11 @@ def train_unet_cv(args: Namespace) -> None:
         )
 
         # create the model
-        model_kwargs = {
-            "spatial_dims": 3 if ref_hparams["is_3d"] else 2,
-            "in_channels": ref_hparams["input_channels"],
-            "out_channels": ref_hparams["output_channels"],
-        }
-        if ref_hparams["dropout"] < 0 or ref_hparams["dropout"] > 1:
-            raise ValueError("dropout must be between 0 and 1")
-        if ref_hparams.get("model_architecture") == "unet" or ref_hparams.get("model_architecture") is None:
-            if len(ref_hparams["model_channels"]) < 2:
-                raise ValueError("model channels must be sequence of integers of at least length 2")
-            model_kwargs["channels"] = ref_hparams["model_channels"]
-            model_kwargs["strides"] = [1 for _ in range(len(ref_hparams["model_channels"]) - 1)]
-            model_kwargs["dropout"] = ref_hparams["dropout"]
-            model = UNet(**model_kwargs)
-        elif ref_hparams.get("model_architecture") == "attention-unet":
-            if len(ref_hparams["model_channels"]) < 2:
-                raise ValueError("model channels must be sequence of integers of at least length 2")
-            model_kwargs["channels"] = ref_hparams["model_channels"]
-            model_kwargs["strides"] = [1 for _ in range(len(ref_hparams["model_channels"]) - 1)]
-            model_kwargs["dropout"] = ref_hparams["dropout"]
-            model = AttentionUnet(**model_kwargs)
-        elif ref_hparams.get("model_architecture") == "unet-r":
-            if ref_hparams["image_size"] is None:
-                raise ValueError("if model architecture set to `unet-r`, you must specify image size")
-            if ref_hparams["is_3d"] and len(ref_hparams["image_size"]) != 3:
-                raise ValueError("if 3D, image_size must be integer or length-3 sequence of integers")
-            if not ref_hparams["is_3d"] and len(ref_hparams["image_size"]) != 2:
-                raise ValueError("if not 3D, image_size must be integer or length-2 sequence of integers")
-            model_kwargs["img_size"] = ref_hparams["image_size"]
-            model_kwargs["dropout_rate"] = ref_hparams["dropout"]
-            model_kwargs["feature_size"] = ref_hparams["unet_r_feature_size"]
-            model_kwargs["hidden_size"] = ref_hparams["unet_r_hidden_size"]
-            model_kwargs["mlp_dim"] = ref_hparams["unet_r_mlp_dim"]
-            model_kwargs["num_heads"] = ref_hparams["unet_r_num_heads"]
-            model = UNETR(**model_kwargs)
-        elif ref_hparams.get("model_architecture") == "unet++":
-            if len(ref_hparams["model_channels"]) != 6:
-                raise ValueError("if model architecture set to `unet++`, model channels must be length-6 sequence of "
-                                 "integers")
-            model_kwargs["features"] = ref_hparams["model_channels"]
-            model_kwargs["dropout"] = ref_hparams["dropout"]
-            model = BasicUNetPlusPlus(**model_kwargs)
-            if strategy == "ddp_find_unused_parameters_false":
-                strategy = "ddp"
-                print(f"using `unet++`, so changing strategy to {strategy}")
-        else:
-            raise ValueError(f"model architecture must be `unet`, `attention-unet`, `unet++`, or `unet-r`, "
-                             f"given {ref_hparams['model_architecture']}")
-
-        model.float()
+        model, strategy = create_training_model(ref_hparams, strategy)
 
         # create loss function
         loss_function = CrossEntropyLoss()
-        if ref_hparams.get("model_architecture") == "unet++":
+        if get_model_architecture(ref_hparams) == "unet++":
             loss_function = create_unetplusplus_loss_function(loss_function)
 
         checkpoint_path = glob(
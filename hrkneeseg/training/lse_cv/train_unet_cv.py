@@ -13,15 +13,13 @@ from blpytorchlightning.loss_functions.CurvatureLoss import CurvatureLoss, Curva
 from blpytorchlightning.loss_functions.MagnitudeGradientSDTLoss import (
     MagnitudeGradientSDTLoss, MagnitudeGradientSDTLoss3D
 )
-from blpytorchlightning.dataset_components.datasets.PickledDataset import PickledDataset
 from blpytorchlightning.dataset_components.transformers.TensorOneHotEncoder import TensorOneHotEncoder
 from blpytorchlightning.loss_functions.DiceLoss import DiceLoss
-from monai.networks.nets.unet import UNet
-from monai.networks.nets.attentionunet import AttentionUnet
-from monai.networks.nets.unetr import UNETR
-from monai.networks.nets.basic_unetplusplus import BasicUNetPlusPlus
 from glob import glob
 from shutil import rmtree
+from hrkneeseg.datasets.sample_store_dataset import load_sample_dataset
+from hrkneeseg.datasets.volume_store import add_volume_sampling_arguments, get_volume_sampling
+from hrkneeseg.models.registry import create_training_model, get_model_architecture
 
 
 def create_parser() -> ArgumentParser:
@@ -150,6 +148,7 @@ def create_parser() -> ArgumentParser:
         help="enable this flag to use Dice loss instead of Cross-Entropy"
     )
 
+    add_volume_sampling_arguments(parser)
     return parser
 
 
@@ -178,62 +177,6 @@ def create_unetplusplus_embedding_conversion_function(convert_embeddings):
     return convert_embeddings_unetplusplus
 
 
-# model creation got a bit crazy, separate into function for readability
-def create_model(args: Namespace, strategy: str) -> torch.nn.Module():
-    model_kwargs = {
-        "spatial_dims": 3 if args.is_3d else 2,
-        "in_channels": args.input_channels,
-        "out_channels": args.output_channels,
-    }
-    if args.dropout < 0 or args.dropout > 1:
-        raise ValueError("dropout must be between 0 and 1")
-    if args.model_architecture == "unet":
-        if len(args.model_channels) < 2:
-            raise ValueError("model channels must be sequence of integers of at least length 2")
-        model_kwargs["channels"] = args.model_channels
-        model_kwargs["strides"] = [1 for _ in range(len(args.model_channels) - 1)]
-        model_kwargs["dropout"] = args.dropout
-        model = UNet(**model_kwargs)
-    elif args.model_architecture == "attention-unet":
-        if len(args.model_channels) < 2:
-            raise ValueError("model channels must be sequence of integers of at least length 2")
-        model_kwargs["channels"] = args.model_channels
-        model_kwargs["strides"] = [1 for _ in range(len(args.model_channels) - 1)]
-        model_kwargs["dropout"] = args.dropout
-        model = AttentionUnet(**model_kwargs)
-    elif args.model_architecture == "unet-r":
-        if args.image_size is None:
-            raise ValueError("if model architecture set to `unet-r`, you must specify image size")
-        if args.is_3d and len(args.image_size) != 3:
-            raise ValueError("if 3D, image_size must be integer or length-3 sequence of integers")
-        if not args.is_3d and len(args.image_size) != 2:
-            raise ValueError("if not 3D, image_size must be integer or length-2 sequence of integers")
-        model_kwargs["img_size"] = args.image_size
-        model_kwargs["dropout_rate"] = args.dropout
-        model_kwargs["feature_size"] = args.unet_r_feature_size
-        model_kwargs["hidden_size"] = args.unet_r_hidden_size
-        model_kwargs["mlp_dim"] = args.unet_r_mlp_dim
-        model_kwargs["num_heads"] = args.unet_r_num_heads
-        model = UNETR(**model_kwargs)
-    elif args.model_architecture == "unet++":
-        if len(args.model_channels) != 6:
-            raise ValueError("if model architecture set to `unet++`, model channels must be length-6 sequence of "
-                             "integers")
-        model_kwargs["features"] = args.model_channels
-        model_kwargs["dropout"] = args.dropout
-        model = BasicUNetPlusPlus(**model_kwargs)
-        if strategy == "ddp_find_unused_parameters_false":
-            strategy = "ddp"
-            print(f"using `unet++`, so changing strategy to {strategy}")
-    else:
-        raise ValueError(f"model architecture must be `unet`, `attention-unet`, `unet++`, or `unet-r`, "
-                         f"given {args.model_architecture}")
-
-    model.float()
-
-    return model, strategy
-
-
 def train_unet_cv(args: Namespace) -> None:
 
     # check if we are using CUDA and set accelerator, devices, strategy
@@ -255,7 +198,11 @@ def train_unet_cv(args: Namespace) -> None:
     transformer = TensorOneHotEncoder(num_classes=args.output_channels) if args.dice_loss else None
     datasets = []
     for data_dir in args.data_dirs:
-        datasets.append(PickledDataset(data_dir, transformer=transformer))
+        datasets.append(
+            load_sample_dataset(
+                data_dir, args.is_3d, transformer=transformer, volume_sampling=get_volume_sampling(args)
+            )
+        )
     dataset = ConcatDataset(datasets)
 
     # create the fold index lists
@@ -292,7 +239,7 @@ def train_unet_cv(args: Namespace) -> None:
         )
 
         # create the model
-        model, strategy = create_model(args, strategy)
+        model, strategy = create_training_model(args, strategy)
 
         # create loss functions and embedding conversion functions
         classification_loss_function = DiceLoss() if args.dice_loss else CrossEntropyLoss()
@@ -311,7 +258,7 @@ def train_unet_cv(args: Namespace) -> None:
 
         # if we are doing a UNet++, then the output will be a list of outputs, so we need to redefine all functions
         # that we will be using that take the model output as input
-        if args.model_architecture == "unet++":
+        if get_model_architecture(args) == "unet++":
             classification_loss_function = create_unetplusplus_loss_function(classification_loss_function)
             curvature_loss_function = create_unetplusplus_loss_function(curvature_loss_function, classification=False)
             mag_grad_loss_function = create_unetplusplus_loss_function(mag_grad_loss_function, classification=False)
@@ -0,0 +1,172 @@
+from __future__ import annotations
+
+from argparse import ArgumentParser, Namespace
+import os
+import yaml
+from typing import Dict, Iterable, List, Optional
+
+from hrkneeseg.registration.transform_cache import hash_file_contents
+
+# bump this if what goes into a fingerprint changes, so that outputs recorded in the old format are recomputed
+FINGERPRINT_FORMAT_VERSION = 1
+FINGERPRINT_SUFFIX = ".fingerprint.yaml"
+# arguments of every tool that do not change its outputs
+IGNORED_ARGUMENTS = ("overwrite", "silent", "skip_if_unchanged")
+
+
+def get_fingerprint_filename(output_fn: str) -> str:
+    return f"{output_fn}{FINGERPRINT_SUFFIX}"
+
+
+def get_file_stat(fn: str) -> Dict[str, int]:
+    stat = os.stat(fn)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def get_input_record(fn: str, previous: Optional[Dict] = None) -> Dict:
+    """
+    Get the size, modification time and content hash of an input file. The hash of the previous record is reused if
+    the size and modification time have not changed, so an unchanged input is not read again.
+
+    Parameters
+    ----------
+    fn : str
+        The input file.
+
+    previous : Optional[Dict]
+        The previous record of the file, if any. Default is `None`.
+
+    Returns
+    -------
+    Dict
+    """
+    record = get_file_stat(fn)
+    if isinstance(previous, dict) and "hash" in previous and all(previous.get(k) == v for k, v in record.items()):
+        record["hash"] = previous["hash"]
+    else:
+        record["hash"] = hash_file_contents(fn)
+    return record
+
+
+class StepFingerprint:
+    """
+    The fingerprint of a run of a command line tool: the content hashes of its input files and the arguments it was
+    run with, recorded after the run in a sidecar of its first output, `{output}.fingerprint.yaml`, with the sizes
+    and modification times of its outputs. A later run with the same fingerprint can be skipped.
+
+    Images are hashed on their voxel data and geometry, see `hash_file_contents`, so an input that is written again
+    with the same contents by a rerun of an earlier step does not make the step run again.
+
+    Parameters
+    ----------
+    tool : str
+        The name of the tool.
+
+    args : Namespace
+        The arguments of the tool. The arguments in `IGNORED_ARGUMENTS` and `ignore` are not part of the fingerprint.
+
+    inputs : List[str]
+        The input files.
+
+    outputs : List[str]
+        The output files. The sidecar is kept next to the first one.
+
+    ignore : Iterable[str]
+        More arguments that do not change the outputs, e.g. the device or the number of threads. Default is `()`.
+    """
+
+    def __init__(self, tool: str, args: Namespace, inputs: List[str], outputs: List[str], ignore: Iterable[str] = ()):
+        self.tool = tool
+        ignored = set(IGNORED_ARGUMENTS) | set(ignore)
+        # round trip through yaml so the arguments compare equal to the recorded ones, e.g. tuples become lists
+        self.arguments = yaml.safe_load(yaml.safe_dump(
+            {k: v for k, v in sorted(vars(args).items()) if k not in ignored}
+        ))
+        self.inputs = list(dict.fromkeys(inputs))
+        self.outputs = list(dict.fromkeys(outputs))
+        self.filename = get_fingerprint_filename(outputs[0])
+        self._input_records: Dict[str, Dict] = {}
+
+    def read(self) -> Optional[Dict]:
+        try:
+            with open(self.filename, "r") as f:
+                recorded = yaml.safe_load(f)
+        except (OSError, yaml.YAMLError):
+            return None
+        if not isinstance(recorded, dict) or recorded.get("version") != FINGERPRINT_FORMAT_VERSION:
+            return None
+        return recorded
+
+    def is_unchanged(self) -> bool:
+        """
+        Check whether the outputs were made by the tool from the same input contents and arguments. Inputs whose size
+        or modification time changed are hashed, and if their contents turn out to be the same, the sidecar is
+        updated so they are not hashed again.
+
+        Returns
+        -------
+        bool
+        """
+        recorded = self.read()
+        if recorded is None or recorded.get("tool") != self.tool or recorded.get("arguments") != self.arguments:
+            return False
+        recorded_inputs = recorded.get("inputs") or {}
+        recorded_outputs = recorded.get("outputs") or {}
+        if list(recorded_inputs) != self.inputs or list(recorded_outputs) != self.outputs:
+            return False
+        for fn in self.outputs:
+            if not os.path.isfile(fn) or get_file_stat(fn) != recorded_outputs[fn]:
+                return False
+        for fn in self.inputs:
+            if not os.path.isfile(fn):
+                return False
+            self._input_records[fn] = get_input_record(fn, recorded_inputs[fn])
+            if self._input_records[fn]["hash"] != recorded_inputs[fn].get("hash"):
+                return False
+        if self._input_records != recorded_inputs:
+            self.write()
+        return True
+
+    def invalidate(self) -> None:
+        """ Remove the sidecar before the outputs are written, so that a run that fails part of the way is redone. """
+        if os.path.isfile(self.filename):
+            os.remove(self.filename)
+
+    def write(self) -> None:
+        """ Record the fingerprint, once the outputs are written. """
+        recorded = self.read() or {}
+        previous_inputs = recorded.get("inputs") or {}
+        inputs = {
+            fn: self._input_records.get(fn) or get_input_record(fn, previous_inputs.get(fn)) for fn in self.inputs
+        }
+        with open(self.filename, "w") as f:
+            yaml.safe_dump({
+                "version": FINGERPRINT_FORMAT_VERSION,
+                "tool": self.tool,
+                "arguments": self.arguments,
+                "inputs": inputs,
+                "outputs": {fn: get_file_stat(fn) for fn in self.outputs},
+            }, f, sort_keys=False)
+
+
+def add_skip_if_unchanged_argument(parser: ArgumentParser) -> ArgumentParser:
+    """
+    Add the `--skip-if-unchanged` option of `StepFingerprint` to the parser of a tool.
+
+    Parameters
+    ----------
+    parser : ArgumentParser
+        The parser.
+
+    Returns
+    -------
+    ArgumentParser
+        The parser.
+    """
+    parser.add_argument(
+        "--skip-if-unchanged", "-siu", action="store_true",
+        help=f"skip the run if the outputs were made from input files with the same contents and the same arguments, "
+             f"as recorded in the `{FINGERPRINT_SUFFIX}` sidecar of the first output, otherwise run and overwrite the "
+             f"outputs"
+    )
+    return parser
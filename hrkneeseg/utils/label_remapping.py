@@ -0,0 +1,108 @@
+from __future__ import annotations
+
+import numpy as np
+from typing import Dict, Iterable
+
+from hrkneeseg.utils.lazy_import import lazy_import
+
+sitk = lazy_import("SimpleITK")
+
+
+def create_lookup_table(mapping: Dict[int, int], offset: int, size: int, default: int = 0) -> np.ndarray:
+    """
+    Create a uint8 lookup table for relabelling, where `lookup_table[code - offset]` is the output for `code`.
+
+    Parameters
+    ----------
+    mapping : Dict[int, int]
+        Mapping from input codes to output codes, output codes must be in [0, 255].
+
+    offset : int
+        The input code that the first entry of the table is for.
+
+    size : int
+        The number of entries in the table.
+
+    default : int
+        The output code for any input code that is not in `mapping`. Default is 0.
+
+    Returns
+    -------
+    np.ndarray
+    """
+    for output in list(mapping.values()) + [default]:
+        if not (0 <= output <= np.iinfo(np.uint8).max):
+            raise ValueError(f"output codes must be in [0, 255], got {output}")
+    lookup_table = np.full(size, default, dtype=np.uint8)
+    for code, output in mapping.items():
+        if 0 <= code - offset < size:
+            lookup_table[code - offset] = output
+    return lookup_table
+
+
+def remap_labels_array(labels: np.ndarray, mapping: Dict[int, int], default: int = 0) -> np.ndarray:
+    """
+    Relabel an integer label array in a single pass with a uint8 lookup table.
+
+    Parameters
+    ----------
+    labels : np.ndarray
+        The label array, can be a read-only view (e.g. from `sitk.GetArrayViewFromImage`). Float labels, e.g. from a
+        resampled mask, are truncated to integers.
+
+    mapping : Dict[int, int]
+        Mapping from input codes to output codes, output codes must be in [0, 255].
+
+    default : int
+        The output code for any input code that is not in `mapping`. Default is 0.
+
+    Returns
+    -------
+    np.ndarray
+        The relabelled uint8 array, with the same shape as `labels`.
+    """
+    if labels.dtype == bool:
+        labels = labels.view(np.uint8)
+    if labels.dtype.kind == "f":
+        # the lookup table needs integer labels
+        labels = labels.astype(np.int64)
+    if labels.dtype.kind not in "ui":
+        raise TypeError(f"labels must have an integer dtype, got {labels.dtype}")
+    if labels.dtype.kind == "u" and labels.dtype.itemsize <= 2:
+        # the table can cover every possible value, so there is no need to look at the data first
+        return create_lookup_table(mapping, 0, np.iinfo(labels.dtype).max + 1, default)[labels]
+    if labels.size == 0:
+        return np.zeros(labels.shape, dtype=np.uint8)
+    lo, hi = int(labels.min()), int(labels.max())
+    if lo >= 0:
+        return create_lookup_table(mapping, 0, hi + 1, default)[labels]
+    return create_lookup_table(mapping, lo, hi - lo + 1, default)[np.subtract(labels, lo, dtype=np.int64)]
+
+
+def remap_labels_image(image: sitk.Image, mapping: Dict[int, int], default: int = 0) -> sitk.Image:
+    """
+    Relabel an integer label image in a single pass with a uint8 lookup table.
+
+    Parameters
+    ----------
+    image : sitk.Image
+        The label image.
+
+    mapping : Dict[int, int]
+        Mapping from input codes to output codes, output codes must be in [0, 255].
+
+    default : int
+        The output code for any input code that is not in `mapping`. Default is 0.
+
+    Returns
+    -------
+    sitk.Image
+        The relabelled uint8 image, with the same geometry as `image`.
+    """
+    remapped = sitk.GetImageFromArray(remap_labels_array(sitk.GetArrayViewFromImage(image), mapping, default))
+    remapped.CopyInformation(image)
+    return remapped
+
+
+def codes_to_mapping(codes: Iterable[int], output: int) -> Dict[int, int]:
+    return {code: output for code in codes}
@@ -0,0 +1,57 @@
+from __future__ import annotations
+
+from importlib import import_module
+import sys
+from types import ModuleType
+from typing import List
+
+# the dependencies that take most of the start-up time of the command line tools, and that must not be imported before
+# the arguments of a tool are parsed, so that `-h` and argument errors are fast
+HEAVY_MODULES = [
+    "bonelab", "blpytorchlightning", "matplotlib", "monai", "pandas", "pytorch_lightning", "scipy", "SimpleITK",
+    "skimage", "torch", "torchmetrics", "vtk", "vtkbone",
+]
+
+
+class LazyModule(ModuleType):
+    """
+    A stand-in for a module that imports the module the first time one of its attributes is used, and from then on
+    holds the attributes of the module, so later uses cost no more than using the module itself.
+
+    Only attribute access imports the module, so a lazily imported module can be used freely in function bodies, but
+    using it in a default argument, or in an annotation of a file without `from __future__ import annotations`,
+    imports it when the function is defined.
+
+    Parameters
+    ----------
+    name : str
+        The name of the module.
+    """
+
+    def __getattr__(self, attr: str):
+        module = import_module(self.__name__)
+        self.__dict__.update(module.__dict__)
+        return getattr(module, attr)
+
+    def __dir__(self) -> List[str]:
+        return dir(import_module(self.__name__))
+
+
+def lazy_import(name: str) -> ModuleType:
+    """
+    Import a module the first time one of its attributes is used, e.g. `sitk = lazy_import("SimpleITK")` in place of
+    `import SimpleITK as sitk`, so that a command line tool can parse its arguments without importing it.
+
+    Parameters
+    ----------
+    name : str
+        The name of the module.
+
+    Returns
+    -------
+    ModuleType
+        The module if it is already imported, otherwise a `LazyModule`.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    return LazyModule(name)
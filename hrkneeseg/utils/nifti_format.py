@@ -0,0 +1,50 @@
+from __future__ import annotations
+
+import os
+
+# the environment variable that sets the format of intermediate NIfTI images for the whole package
+INTERMEDIATE_FORMAT_ENV_VAR = "HRKNEESEG_INTERMEDIATE_FORMAT"
+# `nii.gz` is compressed with single-threaded gzip on write, `nii` is written and read without compression
+NIFTI_FORMATS = ["nii.gz", "nii"]
+# deliverables, and intermediates when no format is set, are always compressed
+DELIVERABLE_FORMAT = "nii.gz"
+
+
+def get_intermediate_format() -> str:
+    """
+    Get the format to write intermediate NIfTI images in, from the `HRKNEESEG_INTERMEDIATE_FORMAT` environment
+    variable. Intermediates are images that are only read by later steps of the pipeline and then deleted, so they do
+    not need to be compressed.
+
+    Returns
+    -------
+    str
+        `nii.gz` or `nii`. `nii.gz` if the environment variable is not set.
+    """
+    intermediate_format = os.environ.get(INTERMEDIATE_FORMAT_ENV_VAR, DELIVERABLE_FORMAT).strip().lstrip(".").lower()
+    if intermediate_format not in NIFTI_FORMATS:
+        raise ValueError(
+            f"`{INTERMEDIATE_FORMAT_ENV_VAR}` must be one of {NIFTI_FORMATS}, got {os.environ[INTERMEDIATE_FORMAT_ENV_VAR]}"
+        )
+    return intermediate_format
+
+
+def nifti_filename(base: str, nifti_format: str) -> str:
+    """
+    Add the extension of a NIfTI format to a filename.
+
+    Parameters
+    ----------
+    base : str
+        The filename without an extension.
+
+    nifti_format : str
+        `nii.gz` or `nii`.
+
+    Returns
+    -------
+    str
+    """
+    if nifti_format not in NIFTI_FORMATS:
+        raise ValueError(f"`nifti_format` must be one of {NIFTI_FORMATS}, got {nifti_format}")
+    return f"{base}.{nifti_format}"
@@ -1,11 +1,9 @@
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
-from bonelab.io.vtk_helpers import get_vtk_reader
-from bonelab.util.aim_calibration_header import get_aim_density_equation
-from bonelab.util.vtk_util import vtkImageData_to_numpy
 from pathlib import Path
+from typing import Tuple
 import numpy as np
-from matplotlib import pyplot as plt
-from matplotlib.animation import FuncAnimation, FFMpegWriter
+
+from hrkneeseg.aim_nifti.aim_io import AIM_BACKENDS, is_aim_filename, read_aim
 
 
 def create_parser() -> ArgumentParser:
@@ -29,6 +27,11 @@ def create_parser() -> ArgumentParser:
         "--scanco-aim", "-aim", action="store_true", default=False,
         help="Set this flag if your image is a Scanco AIM and you want the intensities converted to densities."
     )
+    parser.add_argument(
+        "--aim-backend", "-ab", default="vtk", choices=AIM_BACKENDS,
+        help="How to read AIM files. `numpy` reads uncompressed AIMs directly without vtk/vtkbone, other file types "
+             "are always read with vtk."
+    )
     parser.add_argument(
         "--intensity-bounds", "-ib", nargs=2, type=int, default=None, metavar="N",
         help="Lower and upper limit of intensities to display. If `None`, use maximum range."
@@ -77,25 +80,50 @@ def create_parser() -> ArgumentParser:
     return parser
 
 
+def read_image(fn: str, aim_backend: str) -> Tuple[np.ndarray, Tuple[float, float, float], str]:
+    """
+    Read an image as an (x, y, z) array.
+
+    Parameters
+    ----------
+    fn : str
+        The image filename.
+
+    aim_backend : str
+        The backend to read AIM files with.
+
+    Returns
+    -------
+    Tuple[np.ndarray, Tuple[float, float, float], str]
+        The array, the spacing, and the processing log (empty if the image is not an AIM).
+    """
+    if aim_backend == "numpy" and is_aim_filename(fn):
+        array, header = read_aim(fn)
+        return array.transpose(), header.spacing, header.processing_log
+    from bonelab.io.vtk_helpers import get_vtk_reader
+    from bonelab.util.vtk_util import vtkImageData_to_numpy
+    reader = get_vtk_reader(fn)
+    reader.SetFileName(fn)
+    reader.Update()
+    processing_log = reader.GetProcessingLog() if hasattr(reader, "GetProcessingLog") else ""
+    return vtkImageData_to_numpy(reader.GetOutput()), reader.GetOutput().GetSpacing(), processing_log
+
+
 def main() -> None:
     args = create_parser().parse_args()
+    from bonelab.util.aim_calibration_header import get_aim_density_equation
+    from matplotlib import pyplot as plt
+    from matplotlib.animation import FuncAnimation, FFMpegWriter
     if args.panning_dimension not in [0, 1, 2]:
         args.panning_dimension = 2
     # read image
-    reader = get_vtk_reader(args.image)
-    reader.SetFileName(args.image)
-    reader.Update()
-    image = vtkImageData_to_numpy(reader.GetOutput())
-    # this will be used in the future to set figure sizing so there's the correct aspect ratio
-    image_spacing = reader.GetOutput().GetSpacing()
+    # this spacing will be used in the future to set figure sizing so there's the correct aspect ratio
+    image, image_spacing, processing_log = read_image(args.image, args.aim_backend)
     if args.scanco_aim:
-        calib_m, calib_b = get_aim_density_equation(reader.GetProcessingLog())
+        calib_m, calib_b = get_aim_density_equation(processing_log)
         image = calib_m * image + calib_b
     # read mask
-    reader = get_vtk_reader(args.mask)
-    reader.SetFileName(args.mask)
-    reader.Update()
-    mask = vtkImageData_to_numpy(reader.GetOutput())
+    mask, _, _ = read_image(args.mask, args.aim_backend)
     num_labels = np.max(mask)
     if args.intensity_bounds is None:
         args.intensity_bounds = [image.min(), image.max()]
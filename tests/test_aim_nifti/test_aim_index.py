@@ -0,0 +1,110 @@
+'''Test the cached AIM header index'''
+
+import os
+import tempfile
+import time
+import unittest
+
+import numpy as np
+
+from hrkneeseg.aim_nifti.aim_index import AIM_INDEX_FILENAME, AIMIndex, get_aim_header
+from hrkneeseg.aim_nifti.aim_io import AIM_STRUCT_TYPE_OFFSET, read_aim_header, write_aim
+
+
+class TestAIMIndex(unittest.TestCase):
+    '''Test reading AIM headers through the index'''
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        rng = np.random.default_rng(12345)
+        self.image = rng.integers(-2000, 8000, size=(5, 7, 9), dtype=np.int16)
+        self.element_size = (0.0607, 0.0607, 0.0607)
+        self.position = (12, -3, 40)
+        self.processing_log = "Density: slope                1.6399e+00\nDensity: intercept           -3.9190e+02"
+        self.fn = os.path.join(self.test_dir, "image.AIM")
+        write_aim(self.fn, self.image, self.element_size, self.position, self.processing_log)
+
+    def tearDown(self):
+        for fn in os.listdir(self.test_dir):
+            os.remove(os.path.join(self.test_dir, fn))
+        os.rmdir(self.test_dir)
+
+    def _assert_same_header(self, header, expected):
+        self.assertEqual(tuple(header.dimensions), tuple(expected.dimensions))
+        self.assertEqual(tuple(header.position), tuple(expected.position))
+        np.testing.assert_allclose(header.element_size, expected.element_size)
+        self.assertEqual(header.processing_log, expected.processing_log)
+        self.assertEqual(header.dtype, expected.dtype)
+        self.assertEqual(header.data_offset, expected.data_offset)
+
+    def test_header_matches(self):
+        '''The indexed header is the header of the AIM'''
+        self._assert_same_header(AIMIndex(self.test_dir).get(self.fn), read_aim_header(self.fn))
+
+    def test_reuse(self):
+        '''A saved index is used without reading the AIM again'''
+        index = AIMIndex(self.test_dir)
+        index.get(self.fn)
+        index.get(self.fn)
+        self.assertEqual(index.num_read, 1)
+        self.assertTrue(index.save())
+        self.assertTrue(os.path.isfile(os.path.join(self.test_dir, AIM_INDEX_FILENAME)))
+        index = AIMIndex(self.test_dir)
+        self._assert_same_header(index.get(self.fn), read_aim_header(self.fn))
+        self.assertEqual(index.num_read, 0)
+
+    def test_invalidated_by_rewrite(self):
+        '''An entry is read again when its AIM is rewritten'''
+        get_aim_header(self.fn)
+        # make sure the modification time changes even on coarse filesystems
+        time.sleep(0.01)
+        write_aim(self.fn, self.image[:3], self.element_size, (0, 0, 0), self.processing_log)
+        os.utime(self.fn, ns=(time.time_ns(), time.time_ns() + 10 ** 9))
+        index = AIMIndex(self.test_dir)
+        header = index.get(self.fn)
+        self.assertEqual(index.num_read, 1)
+        self.assertEqual(tuple(header.dimensions), (9, 7, 3))
+        self.assertEqual(tuple(header.position), (0, 0, 0))
+
+    def test_not_an_aim(self):
+        '''Files that are not AIMs raise a ValueError and are remembered'''
+        fn = os.path.join(self.test_dir, "broken.AIM")
+        with open(fn, "wb") as f:
+            f.write(b"not an AIM")
+        index = AIMIndex(self.test_dir)
+        for _ in range(2):
+            with self.assertRaises(ValueError):
+                index.get(fn)
+        self.assertEqual(index.num_read, 1)
+        self.assertEqual(index.update(), sorted([fn, self.fn]))
+
+    def test_update_forgets_deleted(self):
+        '''Updating drops the entries of AIMs that were deleted'''
+        other_fn = os.path.join(self.test_dir, "other.AIM")
+        write_aim(other_fn, self.image, self.element_size, self.position, self.processing_log)
+        index = AIMIndex(self.test_dir)
+        self.assertEqual(index.update(), sorted([other_fn, self.fn]))
+        index.save()
+        os.remove(other_fn)
+        index = AIMIndex(self.test_dir)
+        self.assertEqual(index.update(), [self.fn])
+        self.assertEqual(index.num_read, 0)
+        index.save()
+        self.assertEqual(index.update(), [self.fn])
+
+    def test_compressed(self):
+        '''The header of a compressed AIM is indexed with no data type'''
+        with open(self.fn, "r+b") as f:
+            pre_header_size = int(np.frombuffer(f.read(4), dtype="<i4")[0])
+            f.seek(pre_header_size + AIM_STRUCT_TYPE_OFFSET)
+            # the bit-compressed char type of segmented AIMs
+            f.write(np.array([0x00150001], dtype="<i4").tobytes())
+        header = AIMIndex(self.test_dir).get(self.fn)
+        self.assertTrue(header.compressed)
+        self.assertIsNone(header.dtype)
+        self.assertEqual(tuple(header.dimensions), (9, 7, 5))
+        self.assertEqual(tuple(header.position), self.position)
+
+
+if __name__ == '__main__':
+    unittest.main()
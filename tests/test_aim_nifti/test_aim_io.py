@@ -0,0 +1,107 @@
+'''Test the numpy AIM reader and writer'''
+
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from hrkneeseg.aim_nifti.aim_io import (
+    AIM_V020, AIM_V030, decode_vax_float, encode_vax_float, read_aim, read_aim_header, write_aim
+)
+
+try:
+    import vtkbone
+    from bonelab.util.vtk_util import vtkImageData_to_numpy, numpy_to_vtkImageData
+    from bonelab.io.vtk_helpers import handle_filetype_writing_special_cases
+    HAS_VTKBONE = True
+except ImportError:
+    HAS_VTKBONE = False
+
+
+class TestAIMIO(unittest.TestCase):
+    '''Test round trips through the numpy AIM reader and writer'''
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        rng = np.random.default_rng(12345)
+        self.image = rng.integers(-2000, 8000, size=(5, 7, 9), dtype=np.int16)
+        self.mask = (self.image > 3000) * np.int8(127)
+        self.element_size = (0.0607, 0.0607, 0.0607)
+        self.position = (12, -3, 40)
+        self.processing_log = "Density: slope                1.6399e+00\nDensity: intercept           -3.9190e+02"
+
+    def tearDown(self):
+        for fn in os.listdir(self.test_dir):
+            os.remove(os.path.join(self.test_dir, fn))
+        os.rmdir(self.test_dir)
+
+    def test_vax_float(self):
+        '''VAX float encoding round trips'''
+        values = np.array([0.0607, 1.0, 82.0], dtype=np.float32)
+        np.testing.assert_array_equal(decode_vax_float(encode_vax_float(values)), values)
+
+    def _round_trip(self, array, version, mmap):
+        fn = os.path.join(self.test_dir, f"test_{version}.AIM")
+        write_aim(fn, array, self.element_size, self.position, self.processing_log, version)
+        read_array, header = read_aim(fn, mmap=mmap)
+        np.testing.assert_array_equal(read_array, array)
+        self.assertEqual(read_array.dtype, array.dtype)
+        self.assertEqual(header.version, version)
+        self.assertEqual(header.dimensions, array.shape[::-1])
+        self.assertEqual(header.position, self.position)
+        np.testing.assert_allclose(header.element_size, self.element_size, rtol=1e-6)
+        self.assertEqual(header.processing_log, self.processing_log)
+
+    def test_round_trip_v020(self):
+        '''Images and masks round trip through v020 AIMs'''
+        self._round_trip(self.image, AIM_V020, True)
+        self._round_trip(self.mask, AIM_V020, False)
+
+    def test_round_trip_v030(self):
+        '''Images and masks round trip through v030 AIMs'''
+        self._round_trip(self.image, AIM_V030, True)
+        self._round_trip(self.mask, AIM_V030, False)
+
+    def test_header_only(self):
+        '''The header can be read without the voxel data'''
+        fn = os.path.join(self.test_dir, "test.AIM")
+        write_aim(fn, self.image, self.element_size, self.position, self.processing_log)
+        header = read_aim_header(fn)
+        self.assertEqual(header.data_offset, os.path.getsize(fn) - self.image.nbytes)
+
+    def test_unsupported_dtype(self):
+        '''Arrays with dtypes that AIMs cannot hold are rejected'''
+        with self.assertRaises(ValueError):
+            write_aim(os.path.join(self.test_dir, "test.AIM"), self.image.astype(np.float64), self.element_size)
+
+    @unittest.skipUnless(HAS_VTKBONE, "vtkbone is not installed")
+    def test_vtkbone_round_trip(self):
+        '''AIMs round trip between the numpy and vtkbone readers and writers'''
+        numpy_fn = os.path.join(self.test_dir, "numpy.AIM")
+        vtk_fn = os.path.join(self.test_dir, "vtk.AIM")
+        write_aim(numpy_fn, self.image, self.element_size, self.position, self.processing_log)
+        reader = vtkbone.vtkboneAIMReader()
+        reader.DataOnCellsOff()
+        reader.SetFileName(numpy_fn)
+        reader.Update()
+        np.testing.assert_array_equal(vtkImageData_to_numpy(reader.GetOutput()).transpose(), self.image)
+        self.assertEqual(tuple(reader.GetPosition()), self.position)
+        np.testing.assert_allclose(reader.GetOutput().GetSpacing(), self.element_size, rtol=1e-6)
+        writer = vtkbone.vtkboneAIMWriter()
+        writer.SetInputData(numpy_to_vtkImageData(
+            self.image.transpose(),
+            spacing=reader.GetOutput().GetSpacing(),
+            origin=reader.GetOutput().GetOrigin()
+        ))
+        handle_filetype_writing_special_cases(writer, processing_log=self.processing_log)
+        writer.SetFileName(vtk_fn)
+        writer.Update()
+        array, header = read_aim(vtk_fn)
+        np.testing.assert_array_equal(array, self.image)
+        self.assertEqual(header.position, self.position)
+        np.testing.assert_allclose(header.origin, reader.GetOutput().GetOrigin(), rtol=1e-6)
+
+
+if __name__ == '__main__':
+    unittest.main()
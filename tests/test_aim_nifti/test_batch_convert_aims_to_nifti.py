@@ -0,0 +1,58 @@
+'''Test grouping and skipping in the batch AIM to NIfTI conversion'''
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import numpy as np
+
+from hrkneeseg.aim_nifti.aim_io import write_aim
+from hrkneeseg.aim_nifti.batch_convert_aims_to_nifti import find_aim_tasks, is_up_to_date, get_source_record
+
+
+class TestBatchConvertAIMsToNIfTI(unittest.TestCase):
+    '''Test how AIMs are grouped into tasks and when tasks are skipped'''
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.output_dir = os.path.join(self.test_dir, "niftis")
+        os.mkdir(self.output_dir)
+        array = np.zeros((2, 3, 4), dtype=np.int16)
+        for fn in ["A.AIM", "A_CORT_MASK.AIM", "A_ROI10_MASK.AIM", "AB.AIM", "AB_TRAB_MASK.AIM"]:
+            write_aim(os.path.join(self.test_dir, fn), array, (0.0607, 0.0607, 0.0607))
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def test_find_aim_tasks(self):
+        '''Masks are grouped with the image whose name they extend'''
+        tasks = {
+            os.path.basename(image): sorted(map(os.path.basename, masks))
+            for image, masks in find_aim_tasks(self.test_dir)
+        }
+        self.assertEqual(tasks, {
+            "A.AIM": ["A_CORT_MASK.AIM", "A_ROI10_MASK.AIM"],
+            "AB.AIM": ["AB_TRAB_MASK.AIM"],
+        })
+
+    def test_is_up_to_date(self):
+        '''Tasks are up to date only if every output exists and is newer than, or was recorded from, its AIM'''
+        image = os.path.join(self.test_dir, "AB.AIM")
+        masks = [os.path.join(self.test_dir, "AB_TRAB_MASK.AIM")]
+        self.assertFalse(is_up_to_date(image, masks, self.output_dir, "mtime", {}))
+        time.sleep(0.01)
+        for fn in ["ab.nii.gz", "ab_trab_mask.nii.gz"]:
+            with open(os.path.join(self.output_dir, fn), "w") as f:
+                f.write("converted")
+        self.assertTrue(is_up_to_date(image, masks, self.output_dir, "mtime", {}))
+        self.assertFalse(is_up_to_date(image, masks, self.output_dir, "none", {}))
+        state = {"ab.nii.gz": get_source_record(image), "ab_trab_mask.nii.gz": get_source_record(masks[0])}
+        self.assertTrue(is_up_to_date(image, masks, self.output_dir, "hash", state))
+        write_aim(masks[0], np.ones((2, 3, 4), dtype=np.int16), (0.0607, 0.0607, 0.0607))
+        self.assertFalse(is_up_to_date(image, masks, self.output_dir, "hash", state))
+
+
+if __name__ == '__main__':
+    unittest.main()
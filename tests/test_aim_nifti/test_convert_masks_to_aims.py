@@ -0,0 +1,39 @@
+'''Test the argument checks of the conversion of a multiclass mask to AIMs'''
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from hrkneeseg.aim_nifti.convert_masks_to_aims import convert_masks_to_aims, create_parser
+from hrkneeseg.utils.fingerprint import get_fingerprint_filename
+
+
+class TestConvertMasksToAIMs(unittest.TestCase):
+    '''Test that invalid arguments are rejected before any outputs are touched'''
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.output_base = os.path.join(self.test_dir, "mask")
+        self.inputs = [os.path.join(self.test_dir, fn) for fn in ["mask.nii.gz", "reference.AIM"]]
+        for fn in self.inputs:
+            open(fn, "w").close()
+        self.sidecar = get_fingerprint_filename(f"{self.output_base}_cort.AIM")
+        with open(self.sidecar, "w") as f:
+            f.write("version: 1\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def test_mismatched_classes(self):
+        '''A mismatched number of class values and labels leaves the fingerprint of the last run in place'''
+        args = create_parser().parse_args([
+            *self.inputs, self.output_base, "-cv", "1", "2", "-cl", "cort", "-siu"
+        ])
+        with self.assertRaises(ValueError):
+            convert_masks_to_aims(args)
+        self.assertTrue(os.path.isfile(self.sidecar))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+'''Test aligning mask AIMs to the grid of their image'''
+
+import itertools
+import unittest
+
+import numpy as np
+
+from hrkneeseg.aim_nifti.mask_alignment import align_mask_to_image, get_overlap_slices
+
+
+def align_mask_voxelwise(mask, mask_position, image_position, image_shape):
+    '''Place each mask voxel in the image grid one at a time, as a reference'''
+    aligned = np.zeros(tuple(image_shape)[::-1], dtype=mask.dtype)
+    offset = np.asarray(mask_position) - np.asarray(image_position)
+    for z, y, x in itertools.product(*map(range, mask.shape)):
+        i, j, k = np.array([x, y, z]) + offset
+        if 0 <= i < image_shape[0] and 0 <= j < image_shape[1] and 0 <= k < image_shape[2]:
+            aligned[k, j, i] = mask[z, y, x]
+    return aligned
+
+
+class TestMaskAlignment(unittest.TestCase):
+    '''Test cropping and padding masks to the image grid'''
+
+    def setUp(self):
+        self.image_position = (10, 20, 30)
+        self.image_shape = (6, 5, 4)
+        rng = np.random.default_rng(12345)
+        self.mask = (rng.random((3, 4, 5)) > 0.5) * np.int8(127)
+
+    def _check(self, mask_position):
+        aligned = align_mask_to_image(self.mask, mask_position, self.image_position, self.image_shape)
+        self.assertEqual(aligned.dtype, self.mask.dtype)
+        self.assertEqual(aligned.shape, self.image_shape[::-1])
+        np.testing.assert_array_equal(
+            aligned, align_mask_voxelwise(self.mask, mask_position, self.image_position, self.image_shape)
+        )
+
+    def test_same_position(self):
+        '''A mask at the image position is padded at the upper side'''
+        self._check(self.image_position)
+
+    def test_offset_on_each_side(self):
+        '''Masks offset below and above the image on each axis are cropped and padded'''
+        for axis in range(3):
+            for shift in [-4, -2, 1, 3]:
+                with self.subTest(axis=axis, shift=shift):
+                    mask_position = list(self.image_position)
+                    mask_position[axis] += shift
+                    self._check(mask_position)
+
+    def test_offset_on_all_axes(self):
+        '''Masks offset on all axes at once are aligned'''
+        for shifts in itertools.product([-2, 0, 2], repeat=3):
+            with self.subTest(shifts=shifts):
+                self._check([p + s for p, s in zip(self.image_position, shifts)])
+
+    def test_larger_than_image(self):
+        '''A mask that covers the whole image is cropped on both sides'''
+        mask = np.ones((8, 9, 10), dtype=np.uint8)
+        aligned = align_mask_to_image(mask, (8, 18, 28), self.image_position, self.image_shape)
+        np.testing.assert_array_equal(aligned, np.ones(self.image_shape[::-1], dtype=np.uint8))
+
+    def test_no_overlap(self):
+        '''A mask that does not overlap the image is aligned to an empty mask'''
+        for mask_position in [(0, 20, 30), (10, 40, 30), (10, 20, 34)]:
+            with self.subTest(mask_position=mask_position):
+                image_slices, mask_slices = get_overlap_slices(
+                    mask_position, self.mask.shape[::-1], self.image_position, self.image_shape
+                )
+                self.assertEqual(self.mask[mask_slices].size, 0)
+                self._check(mask_position)
+
+
+if __name__ == '__main__':
+    unittest.main()
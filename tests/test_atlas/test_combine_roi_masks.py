@@ -0,0 +1,48 @@
+'''Test combining the peri-articular ROIs into medial and lateral masks'''
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import SimpleITK as sitk
+
+from hrkneeseg.atlas.combine_roi_masks import combine_roi_masks, create_parser
+
+
+class TestCombineROIMasks(unittest.TestCase):
+    '''Test the output codes of the combined mask'''
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.input_fn = os.path.join(self.test_dir, "rois.nii")
+        self.output_fn = os.path.join(self.test_dir, "combined.nii")
+        sitk.WriteImage(sitk.GetImageFromArray(np.array([[[0, 10, 13, 16], [17, 20, 30, 33]]], dtype=np.float32)),
+                        self.input_fn)
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def combine(self, *argv):
+        combine_roi_masks(create_parser().parse_args([self.input_fn, self.output_fn, "--silent", *argv]))
+        return sitk.GetArrayFromImage(sitk.ReadImage(self.output_fn))
+
+    def test_default_codes(self):
+        '''Medial ROIs get the medial output code and lateral ROIs the lateral one, other voxels are 0'''
+        np.testing.assert_array_equal(self.combine(), [[[0, 1, 2, 1], [2, 0, 1, 2]]])
+
+    def test_output_codes(self):
+        np.testing.assert_array_equal(
+            self.combine("-msc", "10", "-lsc", "13", "-moc", "5", "-loc", "7"), [[[0, 5, 7, 0], [0, 0, 0, 0]]]
+        )
+
+    def test_overlapping_codes(self):
+        '''A site code cannot be both medial and lateral'''
+        with self.assertRaises(ValueError):
+            self.combine("-msc", "10", "13", "-lsc", "13")
+        self.assertFalse(os.path.exists(self.output_fn))
+
+
+if __name__ == '__main__':
+    unittest.main()
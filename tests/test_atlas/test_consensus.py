@@ -0,0 +1,72 @@
+'''Test the streaming atlas mask consensus methods'''
+
+import unittest
+
+import numpy as np
+import SimpleITK as sitk
+
+from hrkneeseg.atlas.consensus import VoteAccumulator
+
+
+class TestVoteAccumulator(unittest.TestCase):
+    '''Test the vote accumulator against `sitk.STAPLE` on small inputs'''
+
+    def setUp(self):
+        rng = np.random.default_rng(12345)
+        truth = np.zeros((16, 24, 24), dtype=np.uint8)
+        truth[4:12, 6:18, 8:20] = 1
+        self.masks = []
+        for _ in range(7):
+            mask = truth.copy()
+            flip = rng.random(truth.shape) < 0.05
+            mask[flip] = 1 - mask[flip]
+            image = sitk.GetImageFromArray(mask)
+            image.SetSpacing((0.5, 0.5, 0.5))
+            image.SetOrigin((1.0, 2.0, 3.0))
+            self.masks.append(image)
+        self.accumulator = VoteAccumulator()
+        for mask in self.masks:
+            self.accumulator.add(mask)
+
+    def test_votes(self):
+        '''The vote volume counts the foreground masks at each voxel'''
+        expected = sum(sitk.GetArrayFromImage(mask).astype(np.uint16) for mask in self.masks)
+        self.assertEqual(self.accumulator.votes.dtype, np.uint16)
+        np.testing.assert_array_equal(self.accumulator.votes, expected)
+
+    def test_vote_em_matches_staple(self):
+        '''Vote-EM gives the same binarized consensus as STAPLE and close probabilities'''
+        staple = sitk.STAPLE(self.masks)
+        vote_em = self.accumulator.vote_em()
+        self.assertEqual(vote_em.GetSpacing(), staple.GetSpacing())
+        self.assertEqual(vote_em.GetOrigin(), staple.GetOrigin())
+        staple = sitk.GetArrayFromImage(staple)
+        vote_em = sitk.GetArrayFromImage(vote_em)
+        np.testing.assert_array_equal(vote_em >= 0.5, staple >= 0.5)
+        # STAPLE estimates a sensitivity and specificity per mask, vote-EM shares one pair, so only close
+        np.testing.assert_allclose(vote_em, staple, atol=0.1)
+
+    def test_majority_vote_matches_staple(self):
+        '''Majority voting gives the same binarized consensus as STAPLE'''
+        np.testing.assert_array_equal(
+            sitk.GetArrayFromImage(self.accumulator.majority_vote()),
+            sitk.GetArrayFromImage(sitk.STAPLE(self.masks)) >= 0.5
+        )
+
+    def test_identical_masks(self):
+        '''If all masks agree, the consensus is the mask'''
+        accumulator = VoteAccumulator()
+        for _ in range(3):
+            accumulator.add(self.masks[0])
+        expected = sitk.GetArrayFromImage(self.masks[0])
+        np.testing.assert_array_equal(sitk.GetArrayFromImage(accumulator.vote_em()) >= 0.5, expected)
+        np.testing.assert_array_equal(sitk.GetArrayFromImage(accumulator.majority_vote()), expected)
+
+    def test_shape_mismatch(self):
+        '''Masks on a different grid are rejected'''
+        with self.assertRaises(ValueError):
+            self.accumulator.add(sitk.Image(4, 4, 4, sitk.sitkUInt8))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+'''Test resuming an affine atlas build from its checkpoints'''
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+import SimpleITK as sitk
+
+from hrkneeseg.atlas import generate_affine_atlas as gaa
+
+
+def create_image(array):
+    image = sitk.GetImageFromArray(array)
+    image.SetSpacing((0.5, 0.5, 0.5))
+    return image
+
+
+def write_partially(image, fn):
+    '''Write the start of an image and stop, as a job killed part of the way through writing it would'''
+    with open(fn, "wb") as f:
+        f.write(b"\0" * 16)
+    raise RuntimeError("killed while writing")
+
+
+class TestGenerateAffineAtlas(unittest.TestCase):
+    '''Test that finished checkpoints are reused and partially written ones are not'''
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.checkpoint_dir = os.path.join(self.test_dir, "checkpoints")
+        os.mkdir(self.checkpoint_dir)
+        zz, yy, xx = np.mgrid[:12, :12, :12]
+        self.images, self.masks = [], []
+        for i, shift in enumerate([0, 1]):
+            ball = (zz - 6) ** 2 + (yy - 6 - shift) ** 2 + (xx - 6) ** 2 < 16
+            self.images.append(os.path.join(self.test_dir, f"image_{i}.nii"))
+            self.masks.append(os.path.join(self.test_dir, f"mask_{i}.nii"))
+            sitk.WriteImage(create_image(np.where(ball, 1000, 0).astype(np.float32)), self.images[-1])
+            sitk.WriteImage(create_image(np.where(ball, np.where(xx < 6, 13, 10), 0).astype(np.uint8)), self.masks[-1])
+        self.atlas = os.path.join(self.test_dir, "atlas.nii")
+        self.atlas_mask = os.path.join(self.test_dir, "atlas_mask.nii")
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def parse_args(self, *argv):
+        return gaa.create_parser().parse_args([
+            self.atlas, self.atlas_mask, "-img", *self.images, "-msk", *self.masks, "-cd", self.checkpoint_dir,
+            "-pa", "2", "-bv", "0", "-sf", "2", "-ss", "1", "-mai", "5", "-mdi", "5", "-cm", "majority-vote",
+            "--silent", *argv
+        ])
+
+    def test_write_checkpoint(self):
+        '''A checkpoint is only in place once it is completely written'''
+        fn = gaa.get_checkpoint_filenames(self.checkpoint_dir, 0)["image"]
+        with mock.patch.object(gaa.sitk, "WriteImage", side_effect=write_partially):
+            with self.assertRaises(RuntimeError):
+                gaa.write_checkpoint(create_image(np.zeros((4, 4, 4), dtype=np.float32)), fn)
+        self.assertEqual(os.listdir(self.checkpoint_dir), [])
+        gaa.write_checkpoint(sitk.Euler3DTransform(), gaa.get_checkpoint_filenames(self.checkpoint_dir, 0)["affine"])
+        self.assertEqual(os.listdir(self.checkpoint_dir), ["image_0_affine.tfm"])
+
+    def test_finished_checkpoint_is_skipped(self):
+        '''The downsampled image and affine transform of an image are read from finished checkpoints'''
+        args = self.parse_args()
+        checkpoint_fns = gaa.get_checkpoint_filenames(self.checkpoint_dir, 1)
+        cached = create_image(np.full((4, 4, 4), 7, dtype=np.float32))
+        gaa.write_checkpoint(cached, checkpoint_fns["image"])
+        image = gaa.get_downsampled_image(os.path.join(self.test_dir, "missing.nii"), 1, self.checkpoint_dir, args)
+        np.testing.assert_array_equal(sitk.GetArrayFromImage(image), sitk.GetArrayFromImage(cached))
+        gaa.write_checkpoint(sitk.AffineTransform(3), checkpoint_fns["affine"])
+        with mock.patch.object(gaa, "affine_registration") as affine_registration:
+            self.assertEqual(
+                gaa.affinely_register_image(1, self.images[1], "missing.nii", self.checkpoint_dir, 0, args), (1, None)
+            )
+        affine_registration.assert_not_called()
+
+    def test_partial_checkpoint_is_not_used(self):
+        '''A downsampled image that was not completely written is computed again from the image'''
+        args = self.parse_args()
+        with mock.patch.object(gaa.sitk, "WriteImage", side_effect=write_partially):
+            with self.assertRaises(RuntimeError):
+                gaa.get_downsampled_image(self.images[0], 0, self.checkpoint_dir, args)
+        image = gaa.get_downsampled_image(self.images[0], 0, self.checkpoint_dir, args)
+        self.assertEqual(image.GetSize(), (16, 16, 16))
+        self.assertEqual(os.listdir(self.checkpoint_dir), ["image_0_downsampled.nii"])
+
+    def test_resume(self):
+        '''A build stopped part of the way resumes without `--overwrite` and reuses the finished checkpoints'''
+        deformable_registration = gaa.deformable_registration
+        calls = []
+
+        def stop_on_second_image(atlas, image, label, *args, **kwargs):
+            calls.append(label)
+            if len(calls) == 2:
+                raise RuntimeError("killed")
+            return deformable_registration(atlas, image, label, *args, **kwargs)
+
+        with mock.patch.object(gaa, "deformable_registration", side_effect=stop_on_second_image):
+            with self.assertRaises(RuntimeError):
+                gaa.generate_affine_atlas(self.parse_args())
+        self.assertFalse(os.path.exists(self.atlas))
+        self.assertFalse(os.path.exists(os.path.join(self.test_dir, "atlas.yaml")))
+        finished = gaa.get_checkpoint_filenames(self.checkpoint_dir, 0)["medial_mask"]
+        mtime = os.stat(finished).st_mtime_ns
+        calls.clear()
+        with mock.patch.object(gaa, "deformable_registration", side_effect=stop_on_second_image):
+            gaa.generate_affine_atlas(self.parse_args())
+        self.assertEqual(calls, ["image 1"])
+        self.assertEqual(os.stat(finished).st_mtime_ns, mtime)
+        for fn in [self.atlas, self.atlas_mask, os.path.join(self.test_dir, "atlas.yaml")]:
+            self.assertTrue(os.path.isfile(fn))
+        self.assertEqual(set(np.unique(sitk.GetArrayFromImage(sitk.ReadImage(self.atlas_mask)))), {0, 1, 2})
+        with self.assertRaises(FileExistsError):
+            gaa.generate_affine_atlas(self.parse_args())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+'''Test the job arrays that submit each step of the workflow for all of the images at once'''
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from hrkneeseg.automation.crosssectional import create_slurm_files
+from hrkneeseg.automation.job_arrays import create_job_array_files
+from hrkneeseg.automation.job_graph import JobGraph, read_submit_script
+from hrkneeseg.automation.run_jobs import DONE, LocalExecutor
+from hrkneeseg.automation.write_slurm_script import write_slurm_script
+
+
+class TestJobArrays(unittest.TestCase):
+    '''Test that the job arrays keep the dependencies of the jobs of each image'''
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.test_dir = tempfile.mkdtemp()
+        os.chdir(self.test_dir)
+        os.mkdir("automation")
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.test_dir)
+
+    def write_unit(self, unit, steps):
+        '''Write the scripts of the steps of a unit, given as the step names and the steps they depend on'''
+        os.makedirs(os.path.join("automation", unit, "slurm"))
+        lines = ["#!/bin/bash"]
+        for step, dependencies in steps:
+            script = os.path.join("automation", unit, "slurm", f"{step}.slurm")
+            write_slurm_script(script, [f"echo {unit} {step} >> log.txt"], step, "1:00:00", "1G", 1, "conda", "env")
+            dependency_option = (
+                f"--dependency=afterok:{':'.join(f'${{JID_{d}}}' for d in dependencies)} " if dependencies else ""
+            )
+            lines.append(f"JID_{step}=$(sbatch {dependency_option}{script} | tr -dc \"0-9\")")
+        with open(os.path.join("automation", unit, "submit_all.sh"), "w") as f:
+            f.write("\n".join(lines))
+        return f"./{os.path.join('automation', unit, 'submit_all.sh')}"
+
+    def write_arrays(self, submit_script_lines):
+        lines = create_job_array_files("automation", submit_script_lines)
+        with open(os.path.join("automation", "submit_all.sh"), "w") as f:
+            f.write("\n".join(lines))
+        return lines
+
+    def assert_dependencies_kept(self, submit_script_lines):
+        '''Every task waits for the tasks that run the scripts its script depends on'''
+        graph = JobGraph.from_submit_script(os.path.join("automation", "submit_all.sh"))
+        scripts = {}
+        for name, job in graph.jobs.items():
+            with open(job.script.replace(".slurm", ".manifest"), "r") as f:
+                scripts[f.read().split("\n")[job.array_index]] = name
+        for line in submit_script_lines:
+            for job in read_submit_script(line[2:]):
+                for dependency in job.dependencies:
+                    self.assertIn(scripts[dependency], graph.jobs[scripts[job.script]].dependencies)
+
+    def test_crosssectional(self):
+        '''The steps of the images are submitted as arrays that wait for the corresponding tasks'''
+        models = [{"hyperparameters": "model.yaml", "checkpoint": "model.ckpt", "type": "unet"}]
+        submit_script_lines = []
+        for image in ["SCAN001", "SCAN002", "SCAN003"]:
+            os.mkdir(os.path.join("automation", image))
+            submit_script_lines.append(create_slurm_files(
+                "automation", "femur", "left", False, image, "study", "atlas", "conda", "env", models
+            ))
+        lines = self.write_arrays(submit_script_lines)
+        self.assertEqual(len(lines) - 1, len(read_submit_script(submit_script_lines[0][2:])))
+        self.assertTrue(all("afterok" not in line for line in lines))
+        with open(os.path.join("automation", "arrays", "1_inference.slurm"), "r") as f:
+            script = f.read()
+        self.assertIn("#SBATCH --array=0-2\n", script)
+        self.assertIn("#SBATCH --gres=gpu:1\n", script)
+        graph = JobGraph.from_submit_script(os.path.join("automation", "submit_all.sh"))
+        self.assertEqual(len(graph), 3 * len(lines[1:]))
+        self.assert_dependencies_kept(submit_script_lines)
+
+    def test_uneven_units(self):
+        '''A step waits for all of the tasks of a step that only some of its tasks depend on'''
+        submit_script_lines = [
+            self.write_unit("U0", [("a", []), ("b", ["a"]), ("c", ["a", "b"])]),
+            self.write_unit("U1", [("a", []), ("c", ["a"])]),
+        ]
+        lines = self.write_arrays(submit_script_lines)
+        self.assertIn("--dependency=aftercorr:${JID_ARRAY_0},afterok:${JID_ARRAY_1} ", lines[3])
+        with open(os.path.join("automation", "arrays", "b.manifest"), "r") as f:
+            self.assertEqual(f.read().split("\n")[0], os.path.join("automation", "U0", "slurm", "b.slurm"))
+        self.assert_dependencies_kept(submit_script_lines)
+
+    def test_missing_corresponding_task(self):
+        '''`aftercorr` on an array without the task with the same index is an error'''
+        self.write_arrays([self.write_unit("U0", [("a", [])]), self.write_unit("U1", [("a", []), ("b", ["a"])])])
+        with open(os.path.join("automation", "submit_all.sh"), "w") as f:
+            f.write("\n".join([
+                "#!/bin/bash",
+                f"JID_B=$(sbatch {os.path.join('automation', 'arrays', 'b.slurm')} | tr -dc \"0-9\")",
+                f"sbatch --dependency=aftercorr:${{JID_B}} {os.path.join('automation', 'arrays', 'a.slurm')}",
+            ]))
+        with self.assertRaises(ValueError):
+            read_submit_script(os.path.join("automation", "submit_all.sh"))
+
+    def test_run_locally(self):
+        '''The tasks of the arrays run the scripts of the units'''
+        self.write_arrays([
+            self.write_unit("U0", [("a", []), ("b", ["a"])]), self.write_unit("U1", [("a", []), ("b", ["a"])])
+        ])
+        graph = JobGraph.from_submit_script(os.path.join("automation", "submit_all.sh"))
+        states = LocalExecutor(graph, 2, 4, poll_interval=0.01, silent=True).run()
+        self.assertEqual(set(states.values()), {DONE})
+        with open("log.txt", "r") as f:
+            log = [line.strip() for line in f]
+        self.assertEqual(sorted(log), ["U0 a", "U0 b", "U1 a", "U1 b"])
+        for unit in ["U0", "U1"]:
+            self.assertLess(log.index(f"{unit} a"), log.index(f"{unit} b"))
+
+
+if __name__ == '__main__':
+    unittest.main()
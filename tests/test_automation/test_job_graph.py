@@ -0,0 +1,172 @@
+'''Test reading the job graph of the submit scripts and running it on the local machine'''
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from hrkneeseg.automation.crosssectional import create_slurm_files
+from hrkneeseg.automation.job_graph import (
+    Job, JobGraph, format_array_indices, format_time, parse_array_indices, parse_memory, parse_time, read_submit_script
+)
+from hrkneeseg.automation.run_jobs import DONE, FAILED, SKIPPED, LocalExecutor
+from hrkneeseg.automation.write_slurm_script import write_slurm_script
+
+
+class TestJobGraph(unittest.TestCase):
+    '''Test reading the jobs and dependencies of the submit scripts'''
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.test_dir = tempfile.mkdtemp()
+        os.chdir(self.test_dir)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.test_dir)
+
+    def test_parse_memory(self):
+        self.assertEqual(parse_memory("150G"), 150)
+        self.assertEqual(parse_memory("24GB"), 24)
+        self.assertEqual(parse_memory("2048M"), 2)
+        self.assertEqual(parse_memory("1024"), 1)
+        with self.assertRaises(ValueError):
+            parse_memory("lots")
+
+    def test_parse_time(self):
+        self.assertEqual(parse_time("30"), 30 * 60)
+        self.assertEqual(parse_time("30:15"), 30 * 60 + 15)
+        self.assertEqual(parse_time("4:00:00"), 4 * 3600)
+        self.assertEqual(parse_time("1-12"), 36 * 3600)
+        self.assertEqual(format_time(parse_time("1-12:30:05")), "1-12:30:05")
+        with self.assertRaises(ValueError):
+            parse_time("soon")
+
+    def test_array_indices(self):
+        self.assertEqual(parse_array_indices("0-3,7%2"), [0, 1, 2, 3, 7])
+        self.assertEqual(format_array_indices([7, 0, 1, 2, 3, 9]), "0-3,7,9")
+
+    def test_crosssectional_scripts(self):
+        '''The jobs of the generated scripts have the dependencies and resources given to slurm'''
+        os.mkdir("automation")
+        os.mkdir(os.path.join("automation", "SCAN001"))
+        models = [{"hyperparameters": "model.yaml", "checkpoint": "model.ckpt", "type": "unet"}]
+        line = create_slurm_files(
+            "automation", "femur", "left", False, "SCAN001", "study", "atlas", "conda", "env", models
+        )
+        with open("submit_all.sh", "w") as f:
+            f.write("\n".join(["#!/bin/bash", line]))
+        graph = JobGraph.from_submit_script("submit_all.sh")
+        self.assertEqual(len(graph), len(read_submit_script(line[2:])))
+        slurm_dir = os.path.join("automation", "SCAN001", "slurm")
+        self.assertEqual(set(os.path.dirname(name) for name in graph.jobs), {slurm_dir})
+        inference = graph.jobs[os.path.join(slurm_dir, "1_inference.slurm")]
+        self.assertEqual(inference.dependencies, [os.path.join(slurm_dir, "0_convert_to_nifti.slurm")])
+        self.assertEqual(inference.num_gpus, 1)
+        for name in graph.jobs:
+            for dependency in graph.jobs[name].dependencies:
+                self.assertLess(graph.order.index(dependency), graph.order.index(name))
+
+    def test_unknown_dependency(self):
+        write_slurm_script("a.slurm", ["true"], "a", "1:00:00", "1G", 1, "conda", "env")
+        with open("submit.sh", "w") as f:
+            f.write("\n".join(["#!/bin/bash", "sbatch --dependency=afterok:${JID_X} a.slurm"]))
+        with self.assertRaises(ValueError):
+            read_submit_script("submit.sh")
+
+    def test_unreadable_line(self):
+        with open("submit.sh", "w") as f:
+            f.write("\n".join(["#!/bin/bash", "echo hello"]))
+        with self.assertRaises(ValueError):
+            read_submit_script("submit.sh")
+
+    def test_cycle(self):
+        with self.assertRaises(ValueError):
+            JobGraph([Job("a", ["b"]), Job("b", ["a"])])
+        with self.assertRaises(ValueError):
+            JobGraph([Job("a", []), Job("a", [])])
+
+
+class TestLocalExecutor(unittest.TestCase):
+    '''Test running the jobs with the resources of the machine'''
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.log = os.path.join(self.test_dir, "log.txt")
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def create_job(self, name, dependencies=(), command=None, num_cpus=1):
+        script = os.path.join(self.test_dir, f"{name}.sh")
+        with open(script, "w") as f:
+            f.write("\n".join([
+                "#!/bin/bash",
+                f"echo start {name} >> {self.log}",
+                command or "sleep 0.1",
+                f"echo end {name} >> {self.log}",
+            ]))
+        return Job(script, [os.path.join(self.test_dir, f"{d}.sh") for d in dependencies], num_cpus, 1)
+
+    def read_log(self):
+        with open(self.log, "r") as f:
+            return [line.split() for line in f]
+
+    def run_jobs(self, jobs, num_cpus=4, **kwargs):
+        states = LocalExecutor(JobGraph(jobs), num_cpus, 8, poll_interval=0.01, silent=True, **kwargs).run()
+        return {os.path.basename(name)[:-3]: state for name, state in states.items()}
+
+    def test_dependencies(self):
+        '''A job starts after its dependencies end'''
+        states = self.run_jobs([self.create_job("a"), self.create_job("b", ["a"]), self.create_job("c", ["a", "b"])])
+        self.assertEqual(states, {"a": DONE, "b": DONE, "c": DONE})
+        log = self.read_log()
+        for job, dependency in [("b", "a"), ("c", "b")]:
+            self.assertLess(log.index(["end", dependency]), log.index(["start", job]))
+
+    def test_resources(self):
+        '''Jobs run at the same time only if their CPUs fit, and a job larger than the machine runs alone'''
+        self.run_jobs([self.create_job(name, num_cpus=2) for name in "abc"] + [self.create_job("d", num_cpus=8)])
+        running, most_running = 0, 0
+        for event, name in self.read_log():
+            running += 1 if event == "start" else -1
+            most_running = max(most_running, running)
+            if name == "d" and event == "start":
+                self.assertEqual(running, 1)
+        self.assertEqual(most_running, 2)
+
+    def test_failure(self):
+        '''The jobs that depend on a failed job are skipped and the others run'''
+        states = self.run_jobs([
+            self.create_job("a", command="exit 1"), self.create_job("b", ["a"]), self.create_job("c", ["b"]),
+            self.create_job("d")
+        ])
+        self.assertEqual(states, {"a": FAILED, "b": SKIPPED, "c": SKIPPED, "d": DONE})
+
+    def test_simulate(self):
+        '''A simulated run takes the time limits of the jobs, with the jobs that fit running at the same time'''
+        jobs = [self.create_job(name, deps, num_cpus=2) for name, deps in [("a", []), ("b", []), ("c", ["a"])]]
+        for job, time_limit in zip(jobs, ["1:00:00", "3:00:00", "30"]):
+            job.time = time_limit
+        schedule = LocalExecutor(JobGraph(jobs), 4, 8).simulate()
+        self.assertEqual({os.path.basename(name)[:-3]: (start, end) for name, start, end in schedule}, {
+            "a": (0, 3600), "b": (0, 3 * 3600), "c": (3600, 3600 + 30 * 60)
+        })
+        self.assertFalse(os.path.exists(self.log))
+        schedule = LocalExecutor(JobGraph(jobs), 2, 8).simulate()
+        self.assertEqual(max(end for _, _, end in schedule), 3600 + 3 * 3600 + 30 * 60)
+
+    def test_resume(self):
+        '''With `resume`, jobs that succeeded are not run again unless their script changed'''
+        self.assertEqual(self.run_jobs([self.create_job("a"), self.create_job("b", ["a"], command="exit 1")]),
+                         {"a": DONE, "b": FAILED})
+        os.remove(self.log)
+        self.run_jobs([self.create_job("a", command="true"), self.create_job("b", ["a"])], resume=True)
+        self.assertEqual([name for event, name in self.read_log() if event == "start"], ["a", "b"])
+        os.remove(self.log)
+        self.run_jobs([self.create_job("a", command="true"), self.create_job("b", ["a"])], resume=True)
+        self.assertFalse(os.path.exists(self.log))
+
+
+if __name__ == '__main__':
+    unittest.main()
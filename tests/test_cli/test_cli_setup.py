@@ -146,6 +146,38 @@ class TestCommandLineInterfeceSetup(unittest.TestCase):
         '''Can run `hrkLongitudinal`'''
         self.runner('hrkLongitudinal')
 
+    def test_hrkTransformCache(self):
+        '''Can run `hrkTransformCache`'''
+        self.runner('hrkTransformCache')
+
+    def test_hrkGenerateAtlasPyramid(self):
+        '''Can run `hrkGenerateAtlasPyramid`'''
+        self.runner('hrkGenerateAtlasPyramid')
+
+    def test_hrkAtlasRegistration(self):
+        '''Can run `hrkAtlasRegistration`'''
+        self.runner('hrkAtlasRegistration')
+
+    def test_hrkBatchAIMs2NIIs(self):
+        '''Can run `hrkBatchAIMs2NIIs`'''
+        self.runner('hrkBatchAIMs2NIIs')
+
+    def test_hrkIndexAIMs(self):
+        '''Can run `hrkIndexAIMs`'''
+        self.runner('hrkIndexAIMs')
+
+    def test_hrkPreProcessVolumes(self):
+        '''Can run `hrkPreProcessVolumes`'''
+        self.runner('hrkPreProcessVolumes')
+
+    def test_hrkPipeline(self):
+        '''Can run `hrkPipeline`'''
+        self.runner('hrkPipeline')
+
+    def test_hrkRunJobs(self):
+        '''Can run `hrkRunJobs`'''
+        self.runner('hrkRunJobs')
+
 
 
 if __name__ == '__main__':
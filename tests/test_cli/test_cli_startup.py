@@ -0,0 +1,56 @@
+'''Test that the command line tools parse their arguments before importing their heavy dependencies'''
+
+import configparser
+import os
+import subprocess
+import sys
+import unittest
+
+from hrkneeseg.utils.lazy_import import HEAVY_MODULES
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# runs a console script with any of the heavy modules failing to import, as if they were not installed
+RUN_BLOCKED = '''
+import sys
+heavy = set(sys.argv.pop(1).split(","))
+class Blocker:
+    def find_spec(self, name, path=None, target=None):
+        if name.split(".")[0] in heavy:
+            raise ImportError(f"{name} was imported before the arguments were parsed")
+sys.meta_path.insert(0, Blocker())
+module, function = sys.argv.pop(1).split(":")
+getattr(__import__(module, fromlist=[function]), function)()
+'''
+
+# these tools build their parsers from the argument checkers and constants of bonelab, so `-h` imports it
+PARSER_IMPORTS_HEAVY = {"hrkAtlasRegistration", "hrkGenerateAffineAtlas", "hrkGenerateAtlasPyramid"}
+
+
+def get_console_scripts():
+    config = configparser.ConfigParser()
+    config.read(os.path.join(ROOT, "setup.cfg"))
+    lines = config["entry_points"]["console_scripts"].strip().splitlines()
+    return dict(tuple(part.strip() for part in line.split("=")) for line in lines)
+
+
+class TestCommandLineInterfaceStartup(unittest.TestCase):
+    '''Run `-h` of every console script without its heavy dependencies'''
+
+    def test_help_without_heavy_imports(self):
+        for name, entry_point in get_console_scripts().items():
+            if name in PARSER_IMPORTS_HEAVY:
+                continue
+            with self.subTest(name=name):
+                result = subprocess.run(
+                    [sys.executable, "-c", RUN_BLOCKED, ",".join(HEAVY_MODULES), entry_point, "-h"],
+                    capture_output=True, text=True, cwd=ROOT
+                )
+                if "ModuleNotFoundError" in result.stderr:
+                    self.skipTest(f"a light dependency of {name} is not installed")
+                self.assertEqual(result.returncode, 0, result.stderr)
+                self.assertIn("usage:", result.stdout)
+
+
+if __name__ == '__main__':
+    unittest.main()
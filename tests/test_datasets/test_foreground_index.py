@@ -0,0 +1,119 @@
+'''Test the foreground index and the patch sampler that uses it'''
+
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from hrkneeseg.datasets.foreground_index import ForegroundIndex
+from hrkneeseg.datasets.patch_sampling import IndexedForegroundPatchSampler
+
+
+class TestForegroundIndex(unittest.TestCase):
+    '''Test building, saving, and drawing from foreground indices'''
+
+    def setUp(self):
+        rng = np.random.default_rng(12345)
+        self.foreground = rng.random((10, 12, 14)) > 0.9
+
+    def test_draw(self):
+        '''Draws are foreground voxels, and every foreground voxel can be drawn'''
+        index = ForegroundIndex.from_foreground(self.foreground)
+        self.assertEqual(len(index), self.foreground.sum())
+        self.assertEqual(index.indices.dtype, np.uint32)
+        rng = np.random.default_rng(0)
+        drawn = np.zeros_like(self.foreground)
+        for _ in range(5000):
+            drawn[index.draw(rng)] = True
+        np.testing.assert_array_equal(drawn, self.foreground)
+
+    def test_draw_many(self):
+        '''Batches of draws are foreground voxels'''
+        index = ForegroundIndex.from_foreground(self.foreground)
+        positions = index.draw_many(np.random.default_rng(0), 1000)
+        self.assertEqual(positions.shape, (1000, 3))
+        self.assertTrue(self.foreground[tuple(positions.T)].all())
+
+    def test_draw_in_slabs(self):
+        '''Draws in slabs are foreground voxels of those slabs, slabs without foreground are masked'''
+        self.foreground[3] = False
+        index = ForegroundIndex.from_foreground(self.foreground)
+        np.testing.assert_array_equal(np.diff(index.get_slab_offsets()), self.foreground.sum(axis=(1, 2)))
+        slabs = np.random.default_rng(1).integers(0, 10, size=500)
+        positions, has_foreground = index.draw_in_slabs(np.random.default_rng(0), slabs)
+        np.testing.assert_array_equal(has_foreground, slabs != 3)
+        np.testing.assert_array_equal(positions[has_foreground, 0], slabs[has_foreground])
+        self.assertTrue(self.foreground[tuple(positions[has_foreground].T)].all())
+
+    def test_from_labels(self):
+        '''The foreground of channelled labels is the foreground channel'''
+        labels = np.stack([~self.foreground, self.foreground]).astype(np.uint8)
+        np.testing.assert_array_equal(
+            ForegroundIndex.from_labels(labels, 3, foreground_channel=1).indices, np.flatnonzero(self.foreground)
+        )
+        np.testing.assert_array_equal(
+            ForegroundIndex.from_labels(labels[1] * 3, 3).indices, np.flatnonzero(self.foreground)
+        )
+        with self.assertRaises(ValueError):
+            ForegroundIndex.from_labels(labels[1, 0], 3)
+
+    def test_save_load(self):
+        '''Saved indices are memory-mapped back'''
+        test_dir = tempfile.mkdtemp()
+        try:
+            fn = os.path.join(test_dir, "foreground.npy")
+            ForegroundIndex.from_foreground(self.foreground).save(fn)
+            index = ForegroundIndex.load(fn, self.foreground.shape)
+            self.assertIsInstance(index.indices, np.memmap)
+            self.assertTrue(self.foreground[index.draw(np.random.default_rng(0))])
+        finally:
+            shutil.rmtree(test_dir)
+
+    def test_empty(self):
+        with self.assertRaises(ValueError):
+            ForegroundIndex.from_foreground(np.zeros((4, 4), dtype=bool)).draw(np.random.default_rng(0))
+
+
+class TestIndexedForegroundPatchSampler(unittest.TestCase):
+    '''Test the foreground patch sampler that indexes each image once'''
+
+    def setUp(self):
+        rng = np.random.default_rng(12345)
+        self.image = rng.random((1, 20, 20, 20), dtype=np.float32)
+        self.labels = np.zeros((2, 20, 20, 20), dtype=np.int64)
+        self.labels[1, 2:4, 15:17, 8:10] = 1
+        self.labels[0] = 1 - self.labels[1]
+
+    def test_foreground_patches(self):
+        '''With probability 1, every patch contains the foreground channel'''
+        sampler = IndexedForegroundPatchSampler(patch_width=6, foreground_channel=1, prob=1.0, seed=0)
+        for _ in range(20):
+            image_patch, labels_patch = sampler((self.image, self.labels))
+            self.assertEqual(image_patch.shape, (1, 6, 6, 6))
+            self.assertEqual(labels_patch.shape, (2, 6, 6, 6))
+            self.assertTrue(labels_patch[1].any())
+
+    def test_index_reused(self):
+        '''The index is built once per image'''
+        sampler = IndexedForegroundPatchSampler(patch_width=6, seed=0)
+        sampler((self.image, self.labels))
+        index = sampler._index
+        sampler((self.image, self.labels))
+        self.assertIs(sampler._index, index)
+        sampler((self.image, self.labels.copy()))
+        self.assertIsNot(sampler._index, index)
+
+    def test_pickle(self):
+        '''A pickled sampler drops its cached image'''
+        sampler = IndexedForegroundPatchSampler(patch_width=6, seed=0)
+        sampler((self.image, self.labels))
+        unpickled = pickle.loads(pickle.dumps(sampler))
+        self.assertIsNone(unpickled._index)
+        self.assertEqual(unpickled((self.image, self.labels))[0].shape, (1, 6, 6, 6))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,158 @@
+'''Test the sharded sample store'''
+
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from hrkneeseg.datasets.sample_store import (
+    SampleStore, SampleStoreWriter, get_manifest_filename, is_sample_store, merge_parts, write_samples
+)
+
+
+class RandomPatchDataset:
+    '''A stand-in for `ComposedDataset` that returns a new random patch each time it is indexed'''
+
+    def __init__(self, num_images, seed=12345):
+        self.num_images = num_images
+        self.rng = np.random.default_rng(seed)
+        self.samples = []
+
+    def __len__(self):
+        return self.num_images
+
+    def __getitem__(self, idx):
+        image = self.rng.random((1, 8, 8, 8), dtype=np.float32) + idx
+        masks = (self.rng.random((3, 8, 8, 8)) > 0.5).astype(np.int64)
+        self.samples.append((image, masks))
+        return image, masks
+
+
+class TestSampleStore(unittest.TestCase):
+    '''Test writing and reading sample stores'''
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def _assert_samples_equal(self, store, samples):
+        self.assertEqual(len(store), len(samples))
+        for i, expected in enumerate(samples):
+            sample = store[i]
+            self.assertEqual(len(sample), len(expected))
+            for field, expected_field in zip(sample, expected):
+                self.assertEqual(field.dtype, expected_field.dtype)
+                np.testing.assert_array_equal(field, expected_field)
+
+    def test_round_trip(self):
+        '''Samples are read back in order, across full and partial shards'''
+        dataset = RandomPatchDataset(5)
+        self.assertEqual(write_samples(dataset, self.test_dir, np.arange(5), 3, shard_size=4), 15)
+        self.assertTrue(is_sample_store(self.test_dir))
+        store = SampleStore(self.test_dir)
+        self._assert_samples_equal(store, dataset.samples)
+        # the last shard holds the remaining 3 samples
+        self.assertEqual(store[-1][0].base.shape[0], 3)
+
+    def test_views(self):
+        '''Samples are views of the memory-mapped shards'''
+        write_samples(RandomPatchDataset(2), self.test_dir, np.arange(2), 1)
+        store = SampleStore(self.test_dir)
+        image, masks = store[1]
+        self.assertIsInstance(image.base, np.memmap)
+        self.assertFalse(image.flags.writeable)
+        image_cow, _ = SampleStore(self.test_dir, mmap_mode="c")[1]
+        image_cow[...] = 0
+        np.testing.assert_array_equal(SampleStore(self.test_dir)[1][0], image)
+
+    def test_parts(self):
+        '''Parts written by separate jobs are read as one store, and unfinished parts are ignored'''
+        dataset = RandomPatchDataset(6)
+        write_samples(dataset, self.test_dir, np.arange(0, 3), 2, shard_size=4)
+        write_samples(dataset, self.test_dir, np.arange(3, 6), 2, shard_size=4)
+        with self.assertRaises(RuntimeError):
+            with SampleStoreWriter(self.test_dir, part="unfinished") as writer:
+                writer.add(dataset[0])
+                raise RuntimeError("job killed")
+        self.assertFalse(os.path.isfile(get_manifest_filename(self.test_dir, "unfinished")))
+        self._assert_samples_equal(SampleStore(self.test_dir), dataset.samples[:12])
+
+    def test_merge_parts(self):
+        '''Merged parts are read in the order they were merged, and an interrupted merge does not repeat samples'''
+        dataset = RandomPatchDataset(3)
+        for idx in [2, 0, 1]:
+            with SampleStoreWriter(self.test_dir, part=f"image-{idx}", shard_size=2) as writer:
+                for _ in range(3):
+                    writer.add(dataset[idx])
+        self.assertEqual(merge_parts(self.test_dir, ["image-2", "image-0", "image-1"], "merged"), 9)
+        self.assertEqual(os.listdir(self.test_dir).count("part-merged.json"), 1)
+        self.assertFalse(os.path.isfile(get_manifest_filename(self.test_dir, "image-0")))
+        self._assert_samples_equal(SampleStore(self.test_dir), dataset.samples)
+        with SampleStoreWriter(self.test_dir, part="image-0", shard_size=2) as writer:
+            for sample in dataset.samples[3:6]:
+                writer.add(sample)
+        self.assertEqual(len(SampleStore(self.test_dir)), 9)
+
+    def test_replace_part(self):
+        '''Writing a part again replaces it'''
+        write_samples(RandomPatchDataset(4, seed=1), self.test_dir, np.arange(4), 2, shard_size=3)
+        dataset = RandomPatchDataset(4, seed=2)
+        write_samples(dataset, self.test_dir, np.arange(4), 1, shard_size=3)
+        self._assert_samples_equal(SampleStore(self.test_dir), dataset.samples)
+
+    def test_mismatched_samples(self):
+        '''Samples with different shapes cannot be stored together'''
+        with SampleStoreWriter(self.test_dir) as writer:
+            writer.add((np.zeros((2, 2)), np.zeros(3)))
+            with self.assertRaises(ValueError):
+                writer.add((np.zeros((2, 3)), np.zeros(3)))
+            with self.assertRaises(ValueError):
+                writer.add(np.zeros((2, 2)))
+
+    def test_add_batch(self):
+        '''Batches are split across shards and read back like samples added one at a time'''
+        rng = np.random.default_rng(0)
+        images = rng.random((7, 1, 4, 4), dtype=np.float32)
+        masks = (images > 0.5).astype(np.int64)
+        with SampleStoreWriter(self.test_dir, shard_size=3) as writer:
+            writer.add((images[0], masks[0]))
+            writer.add_batch((images[1:], masks[1:]))
+            with self.assertRaises(ValueError):
+                writer.add_batch((images[:2], masks[:1]))
+            with self.assertRaises(ValueError):
+                writer.add_batch((images[:2, 0], masks[:2]))
+        self.assertEqual(writer.shard_counts, [3, 3, 1])
+        self._assert_samples_equal(SampleStore(self.test_dir), list(zip(images, masks)))
+
+    def test_single_array_samples(self):
+        '''Samples that are single arrays are read back as arrays'''
+        samples = [np.full((4,), i, dtype=np.int16) for i in range(5)]
+        with SampleStoreWriter(self.test_dir, shard_size=2) as writer:
+            for sample in samples:
+                writer.add(sample)
+        store = SampleStore(self.test_dir)
+        for i, sample in enumerate(samples):
+            np.testing.assert_array_equal(store[i], sample)
+
+    def test_pickle(self):
+        '''A store can be pickled, e.g. to DataLoader workers, without its memory maps'''
+        dataset = RandomPatchDataset(3)
+        write_samples(dataset, self.test_dir, np.arange(3), 1)
+        store = SampleStore(self.test_dir)
+        store[0]
+        self._assert_samples_equal(pickle.loads(pickle.dumps(store)), dataset.samples)
+
+    def test_empty_directory(self):
+        '''A directory with no store cannot be read as one'''
+        self.assertFalse(is_sample_store(self.test_dir))
+        with self.assertRaises(FileNotFoundError):
+            SampleStore(self.test_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
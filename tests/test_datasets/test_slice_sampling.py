@@ -0,0 +1,83 @@
+'''Test drawing batches of slice stacks from volumes'''
+
+import unittest
+
+import numpy as np
+
+from hrkneeseg.datasets.foreground_index import ForegroundIndex
+from hrkneeseg.datasets.slice_sampling import draw_slice_stacks, gather_slice_stacks
+
+
+class TestSliceSampling(unittest.TestCase):
+    '''Test gathering and drawing slice stacks'''
+
+    def setUp(self):
+        rng = np.random.default_rng(12345)
+        self.image = rng.random((2, 10, 12, 14), dtype=np.float32)
+        self.labels = np.zeros((3, 10, 12, 14), dtype=np.int64)
+        self.labels[1, :, 2:4, 3:5] = 1
+        self.labels[1, 6] = 0
+        self.labels[0] = 1 - self.labels[1]
+
+    def test_gather(self):
+        '''Gathered stacks match slicing each stack on its own, with the ends repeated'''
+        slices = np.array([0, 4, 9])
+        starts = np.array([[0, 0], [3, 5], [4, 6]])
+        image_stacks, labels_stacks = gather_slice_stacks(self.image, self.labels, slices, starts, 8, 1)
+        self.assertEqual(image_stacks.shape, (3, 6, 8, 8))
+        self.assertTrue(image_stacks.flags.c_contiguous)
+        self.assertEqual(labels_stacks.shape, (3, 3, 8, 8))
+        for i, (z, (y, x)) in enumerate(zip(slices, starts)):
+            zs = np.clip([z - 1, z, z + 1], 0, 9)
+            expected = self.image[:, zs, y:y + 8, x:x + 8].reshape(6, 8, 8)
+            np.testing.assert_array_equal(image_stacks[i], expected)
+            np.testing.assert_array_equal(labels_stacks[i], self.labels[:, z, y:y + 8, x:x + 8])
+        _, labels_stacks = gather_slice_stacks(self.image, self.labels[1], slices, starts, 8)
+        np.testing.assert_array_equal(labels_stacks[1], self.labels[1, 4, 3:11, 5:13])
+
+    def test_foreground_stacks(self):
+        '''With probability 1, stacks on slices with foreground contain foreground'''
+        foreground = ForegroundIndex.from_labels(self.labels, 3, foreground_channel=1)
+        image_stacks, labels_stacks = draw_slice_stacks(
+            self.image, self.labels, foreground, 200, 6, num_adjacent_slices=2, probability=1.0,
+            rng=np.random.default_rng(0)
+        )
+        self.assertEqual(image_stacks.shape, (200, 10, 6, 6))
+        self.assertEqual(labels_stacks.shape, (200, 3, 6, 6))
+        has_foreground = labels_stacks[:, 1].any(axis=(1, 2))
+        # slice 6 has no foreground, only its stacks can miss it
+        missed = image_stacks[~has_foreground][:, 2]
+        for stack in missed:
+            self.assertTrue(any(np.array_equal(stack, self.image[0, 6, y:y + 6, x:x + 6])
+                                for y in range(7) for x in range(9)))
+        self.assertGreater(has_foreground.mean(), 0.75)
+
+    def test_slice_range(self):
+        '''Central slices leave room for the adjacent slices'''
+        foreground = ForegroundIndex.from_labels(self.labels, 3, foreground_channel=1)
+        image_stacks, _ = draw_slice_stacks(
+            self.image[:, :, :6, :6], self.labels[:, :, :6, :6], foreground, 100, 6, num_adjacent_slices=4,
+            probability=0.0, rng=np.random.default_rng(0)
+        )
+        centers = [int(np.flatnonzero((self.image[0, :, :6, :6] == stack[4]).all(axis=(1, 2)))[0])
+                   for stack in image_stacks]
+        self.assertEqual(set(centers), {4, 5})
+
+    def test_padding(self):
+        '''Slices narrower than the patch are padded with zeros'''
+        foreground = ForegroundIndex.from_labels(self.labels, 3, foreground_channel=1)
+        image_stacks, labels_stacks = draw_slice_stacks(
+            self.image, self.labels, foreground, 5, 16, rng=np.random.default_rng(0)
+        )
+        self.assertEqual(image_stacks.shape, (5, 2, 16, 16))
+        self.assertEqual(labels_stacks.shape, (5, 3, 16, 16))
+        self.assertTrue((image_stacks[:, :, 12:] == 0).all())
+        self.assertTrue((image_stacks[:, :, :, 14:] == 0).all())
+
+    def test_invalid_image(self):
+        with self.assertRaises(ValueError):
+            draw_slice_stacks(self.image[0], self.labels, None, 1, 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
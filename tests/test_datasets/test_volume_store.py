@@ -0,0 +1,125 @@
+'''Test drawing patches on the fly from a volume store'''
+
+import importlib.util
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from hrkneeseg.datasets.patch_sampling import sample_patch
+from hrkneeseg.datasets.volume_store import (
+    VolumeStore, is_volume_store, read_sampling, write_sampling, write_volume
+)
+
+HAS_TORCH = importlib.util.find_spec("torch") is not None
+
+
+class TestVolumeStore(unittest.TestCase):
+    '''Test writing volumes and sampling patches from them'''
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        rng = np.random.default_rng(12345)
+        self.image = rng.random((1, 20, 24, 28), dtype=np.float32)
+        self.labels = np.zeros((20, 24, 28), dtype=np.int64)
+        self.labels[5:8, 10:12, 20:23] = 1
+        self.labels[6, 11, 21] = 2
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def test_round_trip(self):
+        '''Volumes are read back as memory-maps with their foreground index'''
+        self.assertEqual(write_volume(self.test_dir, "0", self.image, self.labels), 18)
+        write_sampling(self.test_dir, 8, 0.5, 10)
+        self.assertTrue(is_volume_store(self.test_dir))
+        store = VolumeStore(self.test_dir)
+        self.assertEqual(len(store), 1)
+        image, labels, foreground = store[0]
+        self.assertIsInstance(image, np.memmap)
+        np.testing.assert_array_equal(image, self.image)
+        np.testing.assert_array_equal(labels, self.labels)
+        self.assertEqual(labels.dtype, np.uint8)
+        np.testing.assert_array_equal(foreground.indices, np.flatnonzero(self.labels))
+        self.assertIsInstance(foreground.indices, np.memmap)
+        store = pickle.loads(pickle.dumps(store))
+        np.testing.assert_array_equal(store[0][0], self.image)
+
+    def test_foreground_channel(self):
+        '''The foreground of channelled labels is the foreground channel'''
+        labels = np.stack([self.labels == 0, self.labels > 0]).astype(np.int64)
+        self.assertEqual(write_volume(self.test_dir, "0", self.image, labels, foreground_channel=1), 18)
+        self.assertEqual(write_volume(self.test_dir, "1", self.image, labels, foreground_channel=0), 20 * 24 * 28 - 18)
+
+    def test_foreground_patches(self):
+        '''Patches drawn with probability 1 contain foreground, and match the volume at their position'''
+        write_volume(self.test_dir, "0", self.image, self.labels)
+        image, labels, foreground = VolumeStore(self.test_dir)[0]
+        rng = np.random.default_rng(0)
+        for _ in range(50):
+            image_patch, labels_patch = sample_patch(image, labels, foreground, 6, 1.0, rng)
+            self.assertEqual(image_patch.shape, (1, 6, 6, 6))
+            self.assertEqual(labels_patch.shape, (6, 6, 6))
+            self.assertTrue((labels_patch > 0).any())
+            self.assertTrue(image_patch.flags.c_contiguous)
+            # find the patch in the image from its values
+            position = np.argwhere(self.image[0] == image_patch[0, 0, 0, 0])[0]
+            slices = tuple(slice(p, p + 6) for p in position)
+            np.testing.assert_array_equal(image_patch[0], self.image[0][slices])
+            np.testing.assert_array_equal(labels_patch, self.labels[slices])
+
+    def test_random_patches(self):
+        '''Patches drawn with probability 0 cover the whole volume'''
+        write_volume(self.test_dir, "0", self.image, self.labels)
+        image, labels, foreground = VolumeStore(self.test_dir)[0]
+        rng = np.random.default_rng(0)
+        covered = np.zeros(self.image.shape[1:], dtype=bool)
+        for _ in range(500):
+            image_patch, _ = sample_patch(image, labels, foreground, 8, 0.0, rng)
+            position = np.argwhere(self.image[0] == image_patch[0, 0, 0, 0])[0]
+            covered[tuple(slice(p, p + 8) for p in position)] = True
+        self.assertTrue(covered.all())
+
+    def test_small_volume(self):
+        '''Volumes narrower than the patch are padded'''
+        write_volume(self.test_dir, "0", self.image[:, :4], self.labels[:4])
+        image, labels, foreground = VolumeStore(self.test_dir)[0]
+        image_patch, labels_patch = sample_patch(image, labels, foreground, 6, 0.5, np.random.default_rng(0))
+        self.assertEqual(image_patch.shape, (1, 6, 6, 6))
+        self.assertEqual(labels_patch.shape, (6, 6, 6))
+        np.testing.assert_array_equal(image_patch[:, 4:], 0)
+
+    def test_sampling(self):
+        '''The sampling of a store can be overridden, and is checked'''
+        write_sampling(self.test_dir, 128, 0.5, 200)
+        self.assertEqual(
+            read_sampling(self.test_dir, {"patch_width": 64, "probability": None}),
+            {"patch_width": 64, "probability": 0.5, "samples_per_volume": 200}
+        )
+        with self.assertRaises(ValueError):
+            read_sampling(self.test_dir, {"probability": 2})
+        with self.assertRaises(ValueError):
+            write_sampling(self.test_dir, 0, 0.5, 200)
+
+    def test_mismatched_labels(self):
+        with self.assertRaises(ValueError):
+            write_volume(self.test_dir, "0", self.image, self.labels[:, :5])
+        self.assertFalse(os.listdir(self.test_dir))
+
+    @unittest.skipUnless(HAS_TORCH, "torch is not installed")
+    def test_load_for_2d_model(self):
+        '''A volume store gives 3D patches, so it is not loaded for a 2D or 2.5D model'''
+        from hrkneeseg.datasets.sample_store_dataset import load_sample_dataset
+        from hrkneeseg.datasets.volume_patch_dataset import VolumePatchDataset
+        write_volume(self.test_dir, "0", self.image, self.labels)
+        write_sampling(self.test_dir, 8, 0.5, 10)
+        self.assertIsInstance(load_sample_dataset(self.test_dir, True), VolumePatchDataset)
+        with self.assertRaises(ValueError):
+            load_sample_dataset(self.test_dir, False)
+
+
+if __name__ == '__main__':
+    unittest.main()
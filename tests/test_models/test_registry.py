@@ -0,0 +1,136 @@
+'''Test the model registry'''
+
+from argparse import Namespace
+import importlib.util
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+from hrkneeseg.models.registry import (
+    MODEL_ARCHITECTURES, create_training_model, get_model_architecture, get_model_cache_filename, get_model_hash,
+    get_model_kwargs
+)
+
+HAS_MONAI = importlib.util.find_spec("monai") is not None
+
+
+def get_hparams(**kwargs):
+    hparams = {
+        "is_3d": True,
+        "input_channels": 1,
+        "output_channels": 3,
+        "dropout": 0.1,
+        "model_channels": [8, 16],
+        "image_size": [32, 32, 32],
+        "unet_r_feature_size": 16,
+        "unet_r_hidden_size": 96,
+        "unet_r_mlp_dim": 192,
+        "unet_r_num_heads": 4,
+        "learning_rate": 0.001,
+    }
+    hparams.update(kwargs)
+    return hparams
+
+
+class TestModelRegistry(unittest.TestCase):
+    '''Test validating hyperparameters and hashing model graphs'''
+
+    def test_default_architecture(self):
+        '''Hparams saved before the architecture was an option are UNets'''
+        self.assertEqual(get_model_architecture(get_hparams()), "unet")
+        self.assertEqual(get_model_architecture(get_hparams(model_architecture=None)), "unet")
+        self.assertEqual(get_model_architecture(Namespace(**get_hparams(model_architecture="unet-r"))), "unet-r")
+
+    def test_model_kwargs(self):
+        self.assertEqual(
+            get_model_kwargs(get_hparams()),
+            {
+                "spatial_dims": 3, "in_channels": 1, "out_channels": 3,
+                "channels": [8, 16], "strides": [1], "dropout": 0.1
+            }
+        )
+        self.assertEqual(
+            get_model_kwargs(
+                Namespace(**get_hparams(model_architecture="unet++", model_channels=[8] * 6, is_3d=False))
+            ),
+            {"spatial_dims": 2, "in_channels": 1, "out_channels": 3, "features": [8] * 6, "dropout": 0.1}
+        )
+        self.assertEqual(get_model_kwargs(get_hparams(model_architecture="unet-r"))["num_heads"], 4)
+
+    def test_invalid_hparams(self):
+        for hparams in [
+            get_hparams(dropout=1.5),
+            get_hparams(model_channels=[8]),
+            get_hparams(model_architecture="unet++"),
+            get_hparams(model_architecture="unet-r", image_size=None),
+            get_hparams(model_architecture="unet-r", is_3d=False),
+            get_hparams(model_architecture="vnet"),
+        ]:
+            with self.subTest(hparams=hparams):
+                with self.assertRaises(ValueError):
+                    get_model_kwargs(hparams)
+
+    def test_model_hash(self):
+        '''Only the hyperparameters of the network change the hash'''
+        self.assertEqual(get_model_hash(get_hparams()), get_model_hash(get_hparams(learning_rate=0.1)))
+        self.assertEqual(get_model_hash(get_hparams()), get_model_hash(Namespace(**get_hparams())))
+        self.assertNotEqual(get_model_hash(get_hparams()), get_model_hash(get_hparams(model_channels=[8, 32])))
+        self.assertNotEqual(
+            get_model_hash(get_hparams()), get_model_hash(get_hparams(model_architecture="attention-unet"))
+        )
+        self.assertTrue(get_model_cache_filename("cache", get_hparams()).startswith("cache"))
+
+    def test_lazy_imports(self):
+        '''Importing the registry imports neither torch nor any network'''
+        code = (
+            "import sys; import hrkneeseg.models.registry; "
+            "print(any(m.split('.')[0] in ['torch', 'monai'] for m in sys.modules))"
+        )
+        output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True).stdout
+        self.assertEqual(output.strip(), "False")
+
+    @unittest.skipUnless(HAS_MONAI, "monai is not installed")
+    def test_create_model(self):
+        '''Networks of each architecture are created, and cached graphs are reused'''
+        for architecture in MODEL_ARCHITECTURES:
+            hparams = get_hparams(
+                model_architecture=architecture, model_channels=[4] * 6 if architecture == "unet++" else [4, 8]
+            )
+            with self.subTest(architecture=architecture):
+                model, strategy = create_training_model(hparams, "ddp_find_unused_parameters_false")
+                self.assertEqual(strategy, "ddp" if architecture == "unet++" else "ddp_find_unused_parameters_false")
+                self.assertEqual(type(model).__name__, MODEL_ARCHITECTURES[architecture][1])
+        cache_dir = tempfile.mkdtemp()
+        try:
+            from hrkneeseg.models.registry import create_model
+            compiled = create_model(get_hparams(), cache_dir)
+            cached = create_model(get_hparams(learning_rate=0.1), cache_dir)
+            self.assertEqual(
+                {k: v.shape for k, v in compiled.state_dict().items()},
+                {k: v.shape for k, v in cached.state_dict().items()}
+            )
+        finally:
+            shutil.rmtree(cache_dir)
+
+    @unittest.skipUnless(HAS_MONAI, "monai is not installed")
+    def test_create_model_uncompiled(self):
+        '''A network that TorchScript cannot compile is returned uncompiled with a warning, and is not cached'''
+        import torch
+        from hrkneeseg.models.registry import create_model
+        cache_dir = tempfile.mkdtemp()
+        try:
+            with mock.patch.object(torch.jit, "script", side_effect=RuntimeError("not scriptable")):
+                with self.assertWarnsRegex(UserWarning, "not scriptable"):
+                    model = create_model(get_hparams(), cache_dir)
+            self.assertEqual(type(model).__name__, MODEL_ARCHITECTURES["unet"][1])
+            self.assertFalse(os.listdir(cache_dir))
+        finally:
+            shutil.rmtree(cache_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
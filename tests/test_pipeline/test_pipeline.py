@@ -0,0 +1,155 @@
+'''Test the stage planning and the passing of outputs between stages in the single-process pipeline'''
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import SimpleITK as sitk
+
+from hrkneeseg.pipeline.pipeline import SEGMENTATION_STAGES, STAGES, ScanPipeline, create_parser, get_stages
+
+
+class CountingPipeline(ScanPipeline):
+    '''A pipeline with cheap image stages, which records the stages that ran'''
+
+    def __init__(self, args):
+        super().__init__(args)
+        self.ran = []
+
+    def run_convert(self):
+        self.ran.append("convert")
+        return sitk.GetImageFromArray(np.arange(24, dtype=np.int32).reshape(2, 3, 4))
+
+    def run_infer(self):
+        self.ran.append("infer")
+        return self.get_output("convert") + 1
+
+    def run_postprocess(self):
+        self.ran.append("postprocess")
+        return self.get_output("infer") * 2
+
+
+class TestGetStages(unittest.TestCase):
+    '''Test the selection of the stages to run'''
+
+    def test_defaults(self):
+        self.assertEqual(get_stages(None, None), SEGMENTATION_STAGES)
+        self.assertEqual(get_stages(None, "femur"), STAGES)
+
+    def test_order(self):
+        self.assertEqual(get_stages(["postprocess", "convert"], None), ["convert", "postprocess"])
+
+    def test_rois_need_bone(self):
+        with self.assertRaises(ValueError):
+            get_stages(["rois"], None)
+
+
+class TestScanPipeline(unittest.TestCase):
+    '''Test running the stages in one process'''
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.aim = os.path.join(self.test_dir, "SCAN001.AIM")
+        self.model_fns = [os.path.join(self.test_dir, fn) for fn in ["model.yaml", "model.ckpt"]]
+        for fn in [self.aim] + self.model_fns:
+            open(fn, "w").close()
+        self.expected = (np.arange(24, dtype=np.int32).reshape(2, 3, 4) + 1) * 2
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def create_pipeline(self, *argv):
+        args = create_parser().parse_args([
+            self.aim, self.test_dir, "-hf", self.model_fns[0], "-cf", self.model_fns[1], "-mt", "unet",
+            "-if", "nii", "--silent", *argv
+        ])
+        return CountingPipeline(args)
+
+    def read_postprocessed_mask(self, pipeline):
+        return sitk.GetArrayFromImage(sitk.ReadImage(pipeline.get_output_filenames("postprocess")[0]))
+
+    def test_in_memory(self):
+        '''Intermediates are passed in memory and not written, the post-processed mask is written'''
+        pipeline = self.create_pipeline("--stages", "convert", "infer", "postprocess")
+        pipeline.run()
+        self.assertEqual(pipeline.ran, ["convert", "infer", "postprocess"])
+        self.assertEqual(
+            pipeline.get_output_filenames("convert"), [os.path.join(self.test_dir, "niftis", "scan001.nii")]
+        )
+        self.assertFalse(os.path.exists(pipeline.get_output_filenames("convert")[0]))
+        self.assertFalse(os.path.exists(pipeline.get_output_filenames("infer")[0]))
+        np.testing.assert_array_equal(self.read_postprocessed_mask(pipeline), self.expected)
+        self.assertEqual(pipeline._outputs, {})
+
+    def test_restart_from_disk(self):
+        '''A stage reads its input from disk when the producing stage is not run'''
+        with self.assertRaises(FileNotFoundError):
+            self.create_pipeline("--stages", "postprocess").run()
+        self.create_pipeline("--stages", "convert", "infer", "-wi", "infer").run()
+        pipeline = self.create_pipeline("--stages", "postprocess")
+        pipeline.run()
+        self.assertEqual(pipeline.ran, ["postprocess"])
+        np.testing.assert_array_equal(self.read_postprocessed_mask(pipeline), self.expected)
+
+    def test_resume(self):
+        '''Stages with outputs on disk are skipped with `--resume`, and their outputs are read if needed'''
+        self.create_pipeline("--stages", "convert", "infer", "-wi", "convert").run()
+        pipeline = self.create_pipeline("--stages", "convert", "infer", "postprocess", "--resume")
+        pipeline.run()
+        self.assertEqual(pipeline.ran, ["infer", "postprocess"])
+        np.testing.assert_array_equal(self.read_postprocessed_mask(pipeline), self.expected)
+        pipeline = self.create_pipeline("--stages", "convert", "infer", "postprocess", "--resume")
+        pipeline.run()
+        self.assertEqual(pipeline.ran, [])
+
+    def test_resume_without_intermediates(self):
+        '''Intermediate stages whose outputs are not written are skipped when the stages that read them are done'''
+        self.create_pipeline("--stages", "convert", "infer", "postprocess").run()
+        pipeline = self.create_pipeline("--stages", "convert", "infer", "postprocess", "--resume")
+        self.assertEqual(pipeline.get_stages_to_run(), [])
+        pipeline.run()
+        self.assertEqual(pipeline.ran, [])
+        os.remove(pipeline.get_output_filenames("postprocess")[0])
+        pipeline = self.create_pipeline("--stages", "convert", "infer", "postprocess", "--resume")
+        pipeline.run()
+        self.assertEqual(pipeline.ran, ["convert", "infer", "postprocess"])
+        np.testing.assert_array_equal(self.read_postprocessed_mask(pipeline), self.expected)
+
+    def test_skip_if_unchanged(self):
+        '''With `-siu`, only the stages whose fingerprints changed run, and the stages that read their outputs'''
+        stages = ["--stages", "convert", "infer", "postprocess", "-wi", "convert", "infer", "-siu"]
+        self.create_pipeline(*stages).run()
+        pipeline = self.create_pipeline(*stages)
+        pipeline.run()
+        self.assertEqual(pipeline.ran, [])
+        pipeline = self.create_pipeline(*stages, "-po=-bfgr 3")
+        pipeline.run()
+        self.assertEqual(pipeline.ran, ["postprocess"])
+        with open(self.aim, "w") as f:
+            f.write("a new scan")
+        pipeline = self.create_pipeline(*stages, "-po=-bfgr 3")
+        pipeline.run()
+        self.assertEqual(pipeline.ran, ["convert", "infer", "postprocess"])
+        np.testing.assert_array_equal(self.read_postprocessed_mask(pipeline), self.expected)
+
+    def test_skip_if_unchanged_without_intermediates(self):
+        '''The fingerprint of a stage covers the stages whose outputs it is passed in memory'''
+        self.create_pipeline("--stages", "convert", "infer", "postprocess", "-siu").run()
+        pipeline = self.create_pipeline("--stages", "convert", "infer", "postprocess", "-siu")
+        pipeline.run()
+        self.assertEqual(pipeline.ran, [])
+        pipeline = self.create_pipeline("--stages", "convert", "infer", "postprocess", "-siu", "-io=-pw 128")
+        pipeline.run()
+        self.assertEqual(pipeline.ran, ["convert", "infer", "postprocess"])
+
+    def test_infer_needs_models(self):
+        args = create_parser().parse_args([self.aim, self.test_dir])
+        with self.assertRaises(ValueError):
+            ScanPipeline(args)
+        ScanPipeline(create_parser().parse_args([self.aim, self.test_dir, "--stages", "postprocess"]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+'''Test sampling each image once per worker into a sample store'''
+
+from glob import glob
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from hrkneeseg.datasets.sample_store import SampleStore, get_manifest_filename
+from hrkneeseg.preprocessing.parallel_sampling import write_samples_by_image, write_slice_samples_by_image
+
+
+class CountingLoader:
+    '''A stand-in for `AIMLoader` that returns images filled with their index and counts the loads'''
+
+    def __init__(self, num_images):
+        self.num_images = num_images
+        self.loads = 0
+
+    def __len__(self):
+        return self.num_images
+
+    def __getitem__(self, idx):
+        self.loads += 1
+        image = np.full((1, 12, 12), idx, dtype=np.float32)
+        return image, (image > 0).astype(np.int64)
+
+
+class VolumeLoader(CountingLoader):
+    '''A stand-in for `AIMLoader` that returns volumes with a foreground block and one-hot labels'''
+
+    def __getitem__(self, idx):
+        self.loads += 1
+        image = np.zeros((1, 6, 10, 10), dtype=np.float32)
+        image[:, :, 2:5, 2:5] = idx + 1
+        foreground = (image[0] > 0).astype(np.int64)
+        return image, np.stack([1 - foreground, foreground])
+
+
+def sample_patch(data):
+    '''Take a random 4x4 patch, like `ForegroundPatchSampler`'''
+    image, mask = data
+    i, j = np.random.randint(0, 8, size=2)
+    return image[:, i:i + 4, j:j + 4], mask[:, i:i + 4, j:j + 4]
+
+
+def rescale(sample):
+    image, mask = sample
+    return image / 10, mask
+
+
+class TestParallelSampling(unittest.TestCase):
+    '''Test writing the samples of each image from one load'''
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def _check_store(self, idxs, epochs):
+        store = SampleStore(self.test_dir)
+        self.assertEqual(len(store), len(idxs) * epochs)
+        values = [float(store[i][0][0, 0, 0]) for i in range(len(store))]
+        for idx in idxs:
+            self.assertEqual(values.count(np.float32(idx / 10)), epochs)
+        for i in range(len(store)):
+            image, mask = store[i]
+            self.assertEqual(image.shape, (1, 4, 4))
+            np.testing.assert_array_equal(mask, (image > 0).astype(np.int64))
+        # only the merged part is left
+        self.assertEqual(
+            glob(get_manifest_filename(self.test_dir, "*")),
+            [get_manifest_filename(self.test_dir, f"{idxs[0]:06d}-{idxs[-1]:06d}")]
+        )
+
+    def test_one_load_per_image(self):
+        '''Each image is loaded once, however many epochs are sampled'''
+        loader = CountingLoader(4)
+        self.assertEqual(
+            write_samples_by_image(loader, sample_patch, rescale, self.test_dir, np.arange(1, 4), 5, shard_size=3),
+            15
+        )
+        self.assertEqual(loader.loads, 3)
+        self._check_store([1, 2, 3], 5)
+
+    def test_workers(self):
+        '''Workers write the same samples as one process'''
+        write_samples_by_image(
+            CountingLoader(6), sample_patch, rescale, self.test_dir, np.arange(6), 4, num_workers=3, shard_size=3
+        )
+        self._check_store(list(range(6)), 4)
+
+    def test_rerun(self):
+        '''Running again replaces the merged part instead of adding to it'''
+        for _ in range(2):
+            write_samples_by_image(CountingLoader(3), sample_patch, None, self.test_dir, np.arange(3), 2)
+        self.assertEqual(len(SampleStore(self.test_dir)), 6)
+
+    def test_slice_samples(self):
+        '''Slice stacks of each image are drawn in batches from one load'''
+        loader = VolumeLoader(3)
+        self.assertEqual(
+            write_slice_samples_by_image(
+                loader, rescale, self.test_dir, np.arange(3), 300, 4, num_adjacent_slices=1, probability=1.0,
+                foreground_channel=1, shard_size=64, num_workers=2
+            ),
+            900
+        )
+        store = SampleStore(self.test_dir)
+        self.assertEqual(len(store), 900)
+        image, mask = store[0]
+        self.assertEqual((image.shape, image.dtype), ((3, 4, 4), np.float32))
+        self.assertEqual((mask.shape, mask.dtype), ((2, 4, 4), np.int64))
+        self.assertTrue(all(f["tensor"] for f in store.fields))
+        values = sorted({float(store[i][0].max()) for i in range(len(store))})
+        self.assertEqual(values, [float(np.float32(v / 10)) for v in (1, 2, 3)])
+
+    def test_invalid_workers(self):
+        with self.assertRaises(ValueError):
+            write_samples_by_image(CountingLoader(1), sample_patch, None, self.test_dir, [0], 1, num_workers=0)
+        self.assertFalse(os.listdir(self.test_dir))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+'''Test the cropping, mirroring and slab-wise resampling of the downsampled-domain atlas registration'''
+
+import unittest
+
+import numpy as np
+import SimpleITK as sitk
+
+from hrkneeseg.registration.atlas_registration import (
+    create_parser, crop_and_mask_image, get_bounding_box, register_to_atlas, resample_in_slabs, uncrop_array
+)
+from hrkneeseg.registration.pyramid import build_pyramid
+
+
+def create_image(array):
+    image = sitk.GetImageFromArray(array)
+    image.SetSpacing((0.5, 0.6, 0.7))
+    image.SetOrigin((-3.0, 2.0, 5.0))
+    return image
+
+
+class TestAtlasRegistration(unittest.TestCase):
+    '''Test that the crop and the slabs put every label back on the voxels it came from'''
+
+    def setUp(self):
+        # a bone off the centre of the image, with labels that differ along every axis so any flip or shift shows
+        zz, yy, xx = np.mgrid[:20, :18, :22]
+        self.bone = (zz >= 5) & (zz < 14) & (yy >= 3) & (yy < 10) & (xx >= 12) & (xx < 19)
+        self.labels = np.where(self.bone, 1 + (zz >= 9) + 2 * (yy >= 6) + 4 * (xx >= 15), 0).astype(np.uint8)
+        self.image = create_image((100 * zz + 10 * yy + xx).astype(np.int16))
+        self.mask = create_image(self.bone.astype(np.uint8))
+
+    def parse_args(self, *argv):
+        return create_parser().parse_args([
+            "image.nii", "mask.nii", "atlas.nii", "atlas_mask.nii", "output.nii", "-da", "1", "-cp", "2",
+            "-bv", "-1", "--silent", *argv
+        ])
+
+    def round_trip(self, args, slab_thickness):
+        '''Transform the labels with the identity to the cropped grid and put them back into the full grid'''
+        cropped_image, crop = crop_and_mask_image(self.image, self.mask, args)
+        # on the grid of the image, the mirrored crop is in the place of the crop
+        atlas_labels = self.labels.copy()
+        if args.mirror:
+            atlas_labels[crop] = self.labels[crop][:, :, ::-1]
+        atlas_mask = create_image(atlas_labels)
+        identity = sitk.Transform(3, sitk.sitkIdentity)
+        cropped_output = resample_in_slabs(atlas_mask, cropped_image, identity, slab_thickness)
+        return sitk.GetArrayFromImage(uncrop_array(cropped_output, self.image, crop, args.mirror))
+
+    def test_get_bounding_box(self):
+        self.assertEqual(get_bounding_box(self.bone, 0), (slice(5, 14), slice(3, 10), slice(12, 19)))
+        self.assertEqual(get_bounding_box(self.bone, 4), (slice(1, 18), slice(0, 14), slice(8, 22)))
+        with self.assertRaises(ValueError):
+            get_bounding_box(np.zeros((3, 3, 3), dtype=bool), 1)
+
+    def test_crop(self):
+        '''The cropped image has the voxels of the crop and the physical position of the crop in the image'''
+        cropped_image, crop = crop_and_mask_image(self.image, self.mask, self.parse_args("-da", "0"))
+        self.assertEqual(crop, (slice(3, 16), slice(1, 12), slice(10, 21)))
+        start = (crop[2].start, crop[1].start, crop[0].start)
+        self.assertEqual(cropped_image.GetOrigin(), self.image.TransformIndexToPhysicalPoint(start))
+        self.assertEqual(cropped_image.GetSpacing(), self.image.GetSpacing())
+        expected = np.where(self.bone, sitk.GetArrayFromImage(self.image), -1)[crop]
+        np.testing.assert_array_equal(sitk.GetArrayFromImage(cropped_image), expected)
+        resampled = sitk.Resample(self.image, cropped_image, sitk.Transform(), sitk.sitkNearestNeighbor)
+        np.testing.assert_array_equal(
+            sitk.GetArrayFromImage(resampled)[self.bone[crop]], sitk.GetArrayFromImage(cropped_image)[self.bone[crop]]
+        )
+
+    def test_mirror(self):
+        '''The mirrored crop is the crop of the image mirrored along the x axis as a whole, as `blImageMirror` does'''
+        args = self.parse_args("--mirror")
+        cropped_image, crop = crop_and_mask_image(self.image, self.mask, args)
+        unmirrored, _ = crop_and_mask_image(self.image, self.mask, self.parse_args())
+        width = self.image.GetSize()[0]
+        full_mirror = sitk.GetArrayFromImage(unmirrored)
+        full_mirror = np.pad(full_mirror, [(s.start, n - s.stop) for s, n in zip(crop, self.labels.shape)],
+                             constant_values=-1)[:, :, ::-1]
+        mirrored_crop = (crop[0], crop[1], slice(width - crop[2].stop, width - crop[2].start))
+        np.testing.assert_array_equal(sitk.GetArrayFromImage(cropped_image), full_mirror[mirrored_crop])
+
+    def test_identity_round_trip(self):
+        '''With the identity transform, the mask comes back on the voxels it came from'''
+        for mirror in [[], ["--mirror"]]:
+            for slab_thickness in [1, 4, 5, 100]:
+                with self.subTest(mirror=mirror, slab_thickness=slab_thickness):
+                    output = self.round_trip(self.parse_args(*mirror), slab_thickness)
+                    np.testing.assert_array_equal(output, self.labels)
+
+    def test_slab_boundaries(self):
+        '''A label straddling the boundary between slabs is resampled the same as in one pass over the whole grid'''
+        reference = create_image(np.zeros((12, 10, 9), dtype=np.float32))
+        label = np.zeros((12, 10, 9), dtype=np.uint8)
+        label[2:9, 3:7, 2:6] = 3
+        atlas_mask = create_image(label)
+        transform = sitk.Euler3DTransform((0.0, 0.0, 0.0), 0.05, -0.1, 0.2, (0.2, -0.3, 0.9))
+        whole = sitk.GetArrayFromImage(sitk.Resample(atlas_mask, reference, transform, sitk.sitkNearestNeighbor))
+        self.assertTrue(whole[3].any() and whole[4].any())
+        for slab_thickness in [1, 2, 4, 5]:
+            with self.subTest(slab_thickness=slab_thickness):
+                output = resample_in_slabs(atlas_mask, reference, transform, slab_thickness)
+                np.testing.assert_array_equal(output, whole)
+
+    def test_register_to_itself(self):
+        '''Registering an image to itself moves the mask by less than a voxel'''
+        args = self.parse_args("-mi", "20")
+        image = sitk.Cast(sitk.SmoothingRecursiveGaussian(sitk.Cast(self.mask, sitk.sitkFloat32) * 1000, 1.0),
+                          sitk.sitkFloat32)
+        pyramid = build_pyramid(image, [(2, 1.0)])
+        transform = register_to_atlas(pyramid, pyramid, args)
+        for point in [(1.0, 4.0, 8.0), (3.0, 5.0, 10.0)]:
+            np.testing.assert_allclose(transform.TransformPoint(point), point, atol=0.5)
+        output = resample_in_slabs(self.mask, image, transform, 4)
+        np.testing.assert_array_equal(output[self.bone], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+'''Test the multiscale demons registrations on precomputed pyramids'''
+
+import unittest
+
+import numpy as np
+import SimpleITK as sitk
+
+from hrkneeseg.registration.demons import multiscale_demons_with_fixed_pyramid, multiscale_demons_with_pyramids
+from hrkneeseg.registration.pyramid import build_pyramid
+
+PROGRESSION = [(4, 2.0), (2, 1.0)]
+
+
+def create_ball(shift):
+    zz, yy, xx = np.mgrid[:24, :24, :24]
+    array = np.where((zz - 12) ** 2 + (yy - 12) ** 2 + (xx - 12 - shift) ** 2 < 36, 1000, 0).astype(np.float32)
+    return sitk.SmoothingRecursiveGaussian(sitk.GetImageFromArray(array), 1.0)
+
+
+class TestMultiscaleDemons(unittest.TestCase):
+    '''Test that the demons registrations take the pyramids as they are built by `build_pyramid`'''
+
+    def setUp(self):
+        self.fixed, self.moving = create_ball(0), create_ball(2)
+        self.fixed_pyramid = build_pyramid(self.fixed, PROGRESSION)
+
+    def register(self, **kwargs):
+        return multiscale_demons_with_fixed_pyramid(
+            self.fixed_pyramid, self.moving, "demons", 50, 1.0, 1.0, multiscale_progression=PROGRESSION, **kwargs
+        )
+
+    def test_recovers_shift(self):
+        '''The displacement field at the centre of the ball moves it to the shifted ball'''
+        displacement, metric_history = self.register()
+        self.assertEqual(displacement.GetSize(), self.fixed.GetSize())
+        self.assertGreater(metric_history[0], metric_history[-1])
+        x, _, _ = displacement[12, 12, 12]
+        self.assertAlmostEqual(x, 2, delta=0.5)
+
+    def test_same_as_both_pyramids(self):
+        '''Giving only the fixed pyramid is the same as giving both pyramids built in the same way'''
+        displacement, _ = self.register()
+        expected, _ = multiscale_demons_with_pyramids(
+            self.fixed_pyramid, build_pyramid(self.moving, PROGRESSION), "demons", 50, 1.0, 1.0
+        )
+        np.testing.assert_allclose(sitk.GetArrayFromImage(displacement), sitk.GetArrayFromImage(expected))
+
+    def test_mismatched_levels(self):
+        with self.assertRaises(ValueError):
+            multiscale_demons_with_fixed_pyramid(
+                self.fixed_pyramid[:2], self.moving, "demons", 5, 1.0, 1.0, multiscale_progression=PROGRESSION
+            )
+        with self.assertRaises(ValueError):
+            multiscale_demons_with_pyramids(self.fixed_pyramid, self.fixed_pyramid[:2], "demons", 5, 1.0, 1.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
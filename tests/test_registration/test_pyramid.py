@@ -0,0 +1,111 @@
+'''Test building, storing and loading the precomputed atlas pyramids'''
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import SimpleITK as sitk
+
+from hrkneeseg.registration.pyramid import (
+    build_pyramid, get_pyramid_manifest_filename, load_atlas_pyramid, write_atlas_pyramid
+)
+
+# coarse to fine, as from `construct_multiscale_progression`
+PROGRESSION = [(4, 2.0), (2, 1.0)]
+
+
+def create_atlas(fn=None, value=1.0):
+    zz, yy, xx = np.mgrid[:17, :21, :25]
+    array = np.where((zz - 8) ** 2 + (yy - 10) ** 2 + (xx - 12) ** 2 < 36, value, 0).astype(np.float32)
+    atlas = sitk.GetImageFromArray(array)
+    atlas.SetSpacing((0.5, 0.6, 0.7))
+    atlas.SetOrigin((1.0, -2.0, 3.0))
+    if fn is not None:
+        sitk.WriteImage(atlas, fn)
+    return atlas
+
+
+class TestBuildPyramid(unittest.TestCase):
+    '''Test the sizes and spacings of the pyramid levels'''
+
+    def assert_level(self, level, image, shrink_factor):
+        size = [int(s / shrink_factor + 0.5) for s in image.GetSize()]
+        self.assertEqual(list(level.GetSize()), size)
+        # the level covers the same physical extent as the image
+        np.testing.assert_allclose(
+            [(n - 1) * sp for n, sp in zip(level.GetSize(), level.GetSpacing())],
+            [(n - 1) * sp for n, sp in zip(image.GetSize(), image.GetSpacing())]
+        )
+        self.assertEqual(level.GetOrigin(), image.GetOrigin())
+
+    def test_levels(self):
+        '''The first level is the image and the others are shrunk by the factors, from finest to coarsest'''
+        atlas = create_atlas()
+        levels = build_pyramid(atlas, PROGRESSION)
+        self.assertEqual(len(levels), 3)
+        self.assertIs(levels[0], atlas)
+        self.assert_level(levels[1], atlas, 2)
+        self.assert_level(levels[2], atlas, 4)
+
+    def test_downsampling(self):
+        '''The image is downsampled before the levels are built from it'''
+        atlas = create_atlas()
+        levels = build_pyramid(atlas, PROGRESSION, 2, 0.5)
+        self.assert_level(levels[0], atlas, 2)
+        self.assert_level(levels[1], levels[0], 2)
+        self.assert_level(levels[2], levels[0], 4)
+        self.assertEqual(len(build_pyramid(atlas, None)), 1)
+        with self.assertRaises(ValueError):
+            build_pyramid(atlas, PROGRESSION, 2)
+
+
+class TestAtlasPyramid(unittest.TestCase):
+    '''Test that a stored pyramid is only loaded for the parameters and atlas it was built from'''
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.atlas_fn = os.path.join(self.test_dir, "atlas.nii")
+        create_atlas(self.atlas_fn)
+        self.manifest_fn = write_atlas_pyramid(self.atlas_fn, PROGRESSION, 2, 0.5)
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def test_round_trip(self):
+        self.assertEqual(self.manifest_fn, get_pyramid_manifest_filename(self.atlas_fn))
+        self.assertEqual(self.manifest_fn, os.path.join(self.test_dir, "atlas_pyramid.yaml"))
+        levels = load_atlas_pyramid(self.manifest_fn, PROGRESSION, 2, 0.5, self.atlas_fn)
+        expected = build_pyramid(sitk.ReadImage(self.atlas_fn), PROGRESSION, 2, 0.5)
+        self.assertEqual(len(levels), len(expected))
+        for level, expected_level in zip(levels, expected):
+            self.assertEqual(level.GetSize(), expected_level.GetSize())
+            np.testing.assert_allclose(level.GetSpacing(), expected_level.GetSpacing())
+            np.testing.assert_allclose(sitk.GetArrayFromImage(level), sitk.GetArrayFromImage(expected_level))
+
+    def test_mismatched_scales(self):
+        '''A pyramid built with other shrink factors, smoothing sigmas or downsampling is not loaded'''
+        for progression, shrink_factor, smoothing_sigma in [
+            ([(8, 4.0), (4, 2.0)], 2, 0.5),
+            ([(4, 2.0), (2, 0.5)], 2, 0.5),
+            ([(2, 1.0)], 2, 0.5),
+            ([(2, 1.0), (4, 2.0)], 2, 0.5),
+            (PROGRESSION, 4, 0.5),
+            (PROGRESSION, None, None),
+        ]:
+            with self.subTest(progression=progression, shrink_factor=shrink_factor, smoothing_sigma=smoothing_sigma):
+                with self.assertRaises(ValueError):
+                    load_atlas_pyramid(self.manifest_fn, progression, shrink_factor, smoothing_sigma, self.atlas_fn)
+
+    def test_stale_atlas(self):
+        '''A pyramid built from an atlas that has since been regenerated is not loaded'''
+        create_atlas(self.atlas_fn, value=2.0)
+        with self.assertRaises(ValueError):
+            load_atlas_pyramid(self.manifest_fn, PROGRESSION, 2, 0.5, self.atlas_fn)
+        # the atlas is only checked if it is given
+        self.assertEqual(len(load_atlas_pyramid(self.manifest_fn, PROGRESSION, 2, 0.5)), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
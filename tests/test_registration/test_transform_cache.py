@@ -0,0 +1,155 @@
+'''Test the content-addressed cache of registration outputs'''
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import numpy as np
+import SimpleITK as sitk
+
+from hrkneeseg.registration.transform_cache import (
+    TransformCache, compute_cache_key, create_parser, hash_file_contents, normalize_command, run_cached
+)
+
+
+class TestCacheKey(unittest.TestCase):
+    '''Test that the key depends on the input contents and the command, not on where the files are'''
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.image = sitk.GetImageFromArray(np.arange(60, dtype=np.int16).reshape(3, 4, 5))
+        self.image.SetSpacing((0.5, 0.5, 0.5))
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def write_image(self, name, image=None):
+        fn = os.path.join(self.test_dir, name)
+        os.makedirs(os.path.dirname(fn), exist_ok=True)
+        sitk.WriteImage(self.image if image is None else image, fn)
+        return fn
+
+    def get_key(self, fixed, moving, output, iterations="100"):
+        command = ["blRegistration", fixed, moving, output, "-mi", iterations]
+        return compute_cache_key(command, [fixed, moving], [output])
+
+    def test_normalize_command(self):
+        self.assertEqual(
+            normalize_command(["reg", "a/fixed.nii", "--out=b/t.txt", "-n", "3"], ["a/fixed.nii"], ["b/t.txt"]),
+            ["reg", "{input_0}", "--out={output_0}", "-n", "3"]
+        )
+        # longer filenames are replaced first, so a filename that contains another is not split
+        self.assertEqual(
+            normalize_command(["reg", "a/fixed.nii", "a/fixed.nii.gz"], ["a/fixed.nii", "a/fixed.nii.gz"], []),
+            ["reg", "{input_0}", "{input_1}"]
+        )
+
+    def test_same_data_at_different_paths(self):
+        '''The same images at other paths, with other outputs, give the same key'''
+        key = self.get_key(self.write_image("a/fixed.nii"), self.write_image("a/moving.nii"), "a/transform.txt")
+        self.assertEqual(
+            key, self.get_key(self.write_image("b/f.nii.gz"), self.write_image("b/m.nii.gz"), "b/t.txt")
+        )
+
+    def test_changed_parameter(self):
+        fixed, moving = self.write_image("fixed.nii"), self.write_image("moving.nii")
+        self.assertNotEqual(
+            self.get_key(fixed, moving, "transform.txt"), self.get_key(fixed, moving, "transform.txt", "200")
+        )
+
+    def test_changed_voxel_data(self):
+        fixed, moving = self.write_image("fixed.nii"), self.write_image("moving.nii")
+        key = self.get_key(fixed, moving, "transform.txt")
+        hash_before = hash_file_contents(moving)
+        self.write_image("moving.nii", self.image + 1)
+        self.assertNotEqual(hash_file_contents(moving), hash_before)
+        self.assertNotEqual(self.get_key(fixed, moving, "transform.txt"), key)
+
+    def test_changed_geometry(self):
+        fixed, moving = self.write_image("fixed.nii"), self.write_image("moving.nii")
+        key = self.get_key(fixed, moving, "transform.txt")
+        image = sitk.Image(self.image)
+        image.SetSpacing((0.6, 0.5, 0.5))
+        self.write_image("moving.nii", image)
+        self.assertNotEqual(self.get_key(fixed, moving, "transform.txt"), key)
+
+
+class TestTransformCache(unittest.TestCase):
+    '''Test storing, restoring and evicting entries'''
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.cache = TransformCache(os.path.join(self.test_dir, "cache"))
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def write_file(self, name, size):
+        fn = os.path.join(self.test_dir, name)
+        with open(fn, "wb") as f:
+            f.write(bytes(range(256)) * (size // 256))
+        return fn
+
+    def store(self, key, size):
+        self.cache.store(key, [self.write_file(f"{key}.nii.gz", size)], ["reg", "{input_0}", "{output_0}"])
+
+    def set_last_used(self, key, last_used):
+        entry = self.cache._read_entry(key)
+        entry["last_used"] = last_used
+        self.cache._write_entry(key, entry)
+
+    def test_round_trip(self):
+        '''Restored outputs are copies of the stored outputs'''
+        outputs = [self.write_file("transform.txt", 512), self.write_file("mask.nii.gz", 1024)]
+        self.cache.store("key", outputs, ["reg"])
+        restored = [os.path.join(self.test_dir, "restored", fn) for fn in ["t.txt", "m.nii.gz"]]
+        self.assertTrue(self.cache.restore("key", restored))
+        for output, restored_fn in zip(outputs, restored):
+            with open(output, "rb") as f, open(restored_fn, "rb") as g:
+                self.assertEqual(f.read(), g.read())
+        self.assertEqual([e["size"] for e in self.cache.entries()], [512 + 1024])
+
+    def test_miss(self):
+        self.assertFalse(self.cache.restore("key", [os.path.join(self.test_dir, "out.txt")]))
+        self.store("key", 256)
+        self.assertFalse(self.cache.restore("key", ["a.txt", "b.txt"]))
+
+    def test_prune_by_size(self):
+        '''The least recently used entries are evicted first'''
+        for i, key in enumerate(["a", "b", "c"]):
+            self.store(key, 1024)
+            self.set_last_used(key, 1000 + i)
+        self.set_last_used("a", 2000)
+        self.assertEqual(self.cache.prune(max_size=2048), ["b"])
+        self.assertEqual(sorted(e["key"] for e in self.cache.entries()), ["a", "c"])
+        self.assertEqual(self.cache.prune(max_size=0), ["c", "a"])
+
+    def test_prune_by_age(self):
+        self.store("old", 256)
+        self.store("new", 256)
+        self.set_last_used("old", time.time() - 10 * 24 * 60 * 60)
+        self.assertEqual(self.cache.prune(max_age=24 * 60 * 60), ["old"])
+        self.assertEqual([e["key"] for e in self.cache.entries()], ["new"])
+
+    def test_run_cached(self):
+        '''A second run with the same inputs restores the outputs without running the command'''
+        input_fn = self.write_file("input.txt", 256)
+        output_fn = os.path.join(self.test_dir, "output.txt")
+        counter_fn = os.path.join(self.test_dir, "counter.txt")
+        argv = [
+            "--cache-dir", self.cache.cache_dir, "--silent", "run", "-i", input_fn, "-o", output_fn,
+            "--", "bash", "-c", f"echo run >> {counter_fn} && cp {input_fn} {output_fn}"
+        ]
+        for _ in range(2):
+            self.assertEqual(run_cached(create_parser().parse_args(argv)), 0)
+            os.remove(output_fn)
+        self.assertEqual(run_cached(create_parser().parse_args(argv)), 0)
+        self.assertTrue(os.path.isfile(output_fn))
+        with open(counter_fn, "r") as f:
+            self.assertEqual(f.read().split(), ["run"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+'''Test the fingerprints that let the command line tools skip unchanged runs'''
+
+import os
+import shutil
+import tempfile
+import unittest
+from argparse import Namespace
+
+import numpy as np
+import SimpleITK as sitk
+
+from hrkneeseg.utils.fingerprint import StepFingerprint, get_fingerprint_filename
+
+
+class TestStepFingerprint(unittest.TestCase):
+    '''Test recording and checking the fingerprint of a run'''
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.input_fn = os.path.join(self.test_dir, "input.nii")
+        self.output_fn = os.path.join(self.test_dir, "output.nii")
+        self.image = sitk.GetImageFromArray(np.arange(60, dtype=np.int16).reshape(3, 4, 5))
+        sitk.WriteImage(self.image, self.input_fn)
+        sitk.WriteImage(self.image, self.output_fn)
+        self.args = Namespace(radius=3, classes=[1, 2], overwrite=True, silent=False, skip_if_unchanged=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def create_fingerprint(self, args=None):
+        return StepFingerprint("tool", args or self.args, [self.input_fn], [self.output_fn])
+
+    def test_unchanged(self):
+        '''A run with the same inputs and arguments is unchanged once recorded'''
+        self.assertFalse(self.create_fingerprint().is_unchanged())
+        self.create_fingerprint().write()
+        self.assertTrue(os.path.isfile(get_fingerprint_filename(self.output_fn)))
+        self.assertTrue(self.create_fingerprint().is_unchanged())
+        self.assertTrue(self.create_fingerprint(Namespace(**{**vars(self.args), "silent": True})).is_unchanged())
+
+    def test_changed_arguments(self):
+        self.create_fingerprint().write()
+        self.assertFalse(self.create_fingerprint(Namespace(**{**vars(self.args), "radius": 4})).is_unchanged())
+
+    def test_rewritten_input(self):
+        '''An input written again with the same voxels is unchanged, one with other voxels is changed'''
+        self.create_fingerprint().write()
+        sitk.WriteImage(self.image, self.input_fn)
+        os.utime(self.input_fn, ns=(0, 0))
+        self.assertTrue(self.create_fingerprint().is_unchanged())
+        sitk.WriteImage(self.image + 1, self.input_fn)
+        self.assertFalse(self.create_fingerprint().is_unchanged())
+
+    def test_changed_output(self):
+        '''Outputs that were modified or removed after the run are changed'''
+        self.create_fingerprint().write()
+        os.utime(self.output_fn, ns=(0, 0))
+        self.assertFalse(self.create_fingerprint().is_unchanged())
+        os.remove(self.output_fn)
+        self.assertFalse(self.create_fingerprint().is_unchanged())
+
+    def test_invalidate(self):
+        fingerprint = self.create_fingerprint()
+        fingerprint.write()
+        fingerprint.invalidate()
+        self.assertFalse(os.path.isfile(get_fingerprint_filename(self.output_fn)))
+        self.assertFalse(self.create_fingerprint().is_unchanged())
+
+
+if __name__ == '__main__':
+    unittest.main()
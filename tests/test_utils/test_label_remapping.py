@@ -0,0 +1,81 @@
+'''Test relabelling label arrays and images with a lookup table'''
+
+import unittest
+
+import numpy as np
+import SimpleITK as sitk
+
+from hrkneeseg.utils.label_remapping import codes_to_mapping, remap_labels_array, remap_labels_image
+
+
+def remap_reference(labels, mapping, default=0):
+    '''Relabel one voxel at a time'''
+    return np.vectorize(lambda code: mapping.get(int(code), default), otypes=[np.uint8])(labels)
+
+
+class TestRemapLabelsArray(unittest.TestCase):
+    '''Test each way the lookup table is built for the dtype of the labels'''
+
+    def setUp(self):
+        self.mapping = {1: 10, 3: 30, 7: 70}
+
+    def assert_remapped(self, labels, mapping=None, default=0):
+        mapping = self.mapping if mapping is None else mapping
+        remapped = remap_labels_array(labels, mapping, default)
+        self.assertEqual(remapped.dtype, np.uint8)
+        self.assertEqual(remapped.shape, labels.shape)
+        np.testing.assert_array_equal(remapped, remap_reference(labels, mapping, default))
+
+    def test_bool(self):
+        '''Boolean labels are viewed as 0 and 1'''
+        self.assert_remapped(np.array([[True, False], [False, True]]), {1: 5})
+
+    def test_small_unsigned(self):
+        '''Unsigned labels of up to 16 bits use a table that covers every value'''
+        self.assert_remapped(np.array([0, 1, 2, 3, 7, 255], dtype=np.uint8))
+        self.assert_remapped(np.array([0, 1, 3, 7, 1000, 65535], dtype=np.uint16))
+
+    def test_non_negative(self):
+        '''Wider non-negative labels use a table up to the largest label'''
+        self.assert_remapped(np.array([0, 1, 3, 7, 100000], dtype=np.int64))
+        self.assert_remapped(np.array([[1, 3], [7, 2]], dtype=np.uint32))
+
+    def test_negative(self):
+        '''Negative labels use a table that starts at the smallest label'''
+        self.assert_remapped(np.array([-5, -1, 0, 1, 3, 7], dtype=np.int16), {-5: 50, 3: 30})
+
+    def test_float(self):
+        '''Float labels, e.g. from a resampled mask, are relabelled as integers'''
+        self.assert_remapped(np.array([0.0, 1.0, 3.0, 7.0, 2.0], dtype=np.float32))
+
+    def test_empty(self):
+        self.assert_remapped(np.zeros((0, 3), dtype=np.int32))
+
+    def test_default(self):
+        '''Codes that are not in the mapping get the default'''
+        self.assert_remapped(np.array([0, 1, 2, 3], dtype=np.uint8), default=9)
+        self.assert_remapped(np.array([-2, 1, 2, 100000], dtype=np.int64), default=9)
+
+    def test_invalid_output(self):
+        with self.assertRaises(ValueError):
+            remap_labels_array(np.array([1], dtype=np.uint8), {1: 256})
+        with self.assertRaises(TypeError):
+            remap_labels_array(np.array(["a"]), {1: 1})
+
+
+class TestRemapLabelsImage(unittest.TestCase):
+    '''Test relabelling an image'''
+
+    def test_geometry(self):
+        image = sitk.GetImageFromArray(np.array([[[10, 11], [13, 0]]], dtype=np.float32))
+        image.SetSpacing((0.5, 0.5, 2.0))
+        image.SetOrigin((1.0, 2.0, 3.0))
+        remapped = remap_labels_image(image, codes_to_mapping([10, 11], 1))
+        self.assertEqual(remapped.GetPixelID(), sitk.sitkUInt8)
+        self.assertEqual(remapped.GetSpacing(), image.GetSpacing())
+        self.assertEqual(remapped.GetOrigin(), image.GetOrigin())
+        np.testing.assert_array_equal(sitk.GetArrayFromImage(remapped), [[[1, 1], [0, 0]]])
+
+
+if __name__ == '__main__':
+    unittest.main()
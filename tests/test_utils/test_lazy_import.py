@@ -0,0 +1,33 @@
+'''Test importing modules on first use'''
+
+import sys
+import unittest
+
+from hrkneeseg.utils.lazy_import import LazyModule, lazy_import
+
+
+class TestLazyImport(unittest.TestCase):
+    '''Test lazily imported modules'''
+
+    def test_imported_on_first_use(self):
+        sys.modules.pop("colorsys", None)
+        colorsys = lazy_import("colorsys")
+        self.assertIsInstance(colorsys, LazyModule)
+        self.assertNotIn("colorsys", sys.modules)
+        self.assertEqual(colorsys.rgb_to_hsv(1.0, 0.0, 0.0), (0.0, 1.0, 1.0))
+        self.assertIn("colorsys", sys.modules)
+        # the attributes are held by the stand-in after the first use
+        self.assertIs(colorsys.__dict__["rgb_to_hsv"], sys.modules["colorsys"].rgb_to_hsv)
+
+    def test_already_imported(self):
+        self.assertIs(lazy_import("json"), __import__("json"))
+
+    def test_missing_module(self):
+        '''A missing module is only reported when it is used'''
+        missing = lazy_import("hrkneeseg_missing_module")
+        with self.assertRaises(ModuleNotFoundError):
+            missing.anything
+
+
+if __name__ == '__main__':
+    unittest.main()
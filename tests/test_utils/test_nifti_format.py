@@ -0,0 +1,40 @@
+'''Test the intermediate NIfTI format setting'''
+
+import os
+import unittest
+from unittest import mock
+
+from hrkneeseg.utils.nifti_format import (
+    DELIVERABLE_FORMAT, INTERMEDIATE_FORMAT_ENV_VAR, get_intermediate_format, nifti_filename
+)
+
+
+class TestNIfTIFormat(unittest.TestCase):
+    '''Test reading the intermediate format from the environment'''
+
+    def test_default(self):
+        '''Intermediates are compressed when the environment variable is not set'''
+        with mock.patch.dict(os.environ, clear=True):
+            self.assertEqual(get_intermediate_format(), DELIVERABLE_FORMAT)
+
+    def test_environment_variable(self):
+        '''The environment variable sets the format, with or without a leading dot'''
+        for value in ["nii", ".nii", "NII"]:
+            with mock.patch.dict(os.environ, {INTERMEDIATE_FORMAT_ENV_VAR: value}):
+                self.assertEqual(get_intermediate_format(), "nii")
+
+    def test_invalid_format(self):
+        '''Unknown formats are rejected'''
+        with mock.patch.dict(os.environ, {INTERMEDIATE_FORMAT_ENV_VAR: "mha"}):
+            with self.assertRaises(ValueError):
+                get_intermediate_format()
+        with self.assertRaises(ValueError):
+            nifti_filename("mask", "mha")
+
+    def test_nifti_filename(self):
+        '''The extension is added to the filename'''
+        self.assertEqual(nifti_filename(os.path.join("out", "mask"), "nii"), os.path.join("out", "mask.nii"))
+
+
+if __name__ == '__main__':
+    unittest.main()